@@ -32,7 +32,11 @@ class MobilityModel:
         self.load_models()
 
     def load_models(self):
-        if not os.path.exists(self.transport_network_path):
+        # a snapshot directory next to the pickled network is preferred, see save_transport_network_snapshot()
+        transport_network_snapshot_dir = self.get_transport_network_snapshot_dir()
+        if os.path.exists(os.path.join(transport_network_snapshot_dir, 'meta.json')):
+            self.tn = Transport_Network.load_snapshot(transport_network_snapshot_dir)
+        elif not os.path.exists(self.transport_network_path):
             self.tn = Transport_Network(table=self.table)
         else:
             self.tn = pickle.load(open(self.transport_network_path, 'rb'))
@@ -51,6 +55,15 @@ class MobilityModel:
             self.home_workplace_assigner = pickle.load(open(self.home_workplace_assigner_path, 'rb'))
         self.mocho_model = MochoModelRF(table=self.table)
 
+    def get_transport_network_snapshot_dir(self):
+        return os.path.splitext(self.transport_network_path)[0] + '_snapshot'
+
+    def save_transport_network_snapshot(self):
+        """
+        Save the transport network to the snapshot directory next to its pickle, which load_models() prefers
+        """
+        self.tn.save_snapshot(self.get_transport_network_snapshot_dir())
+
     def init_simulation(self):
         base_sim_pop = self.H3.Pop.base_sim_pop[:20]
         self.H3.Pop.impact = base_sim_pop
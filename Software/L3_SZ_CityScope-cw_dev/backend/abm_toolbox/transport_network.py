@@ -12,6 +12,8 @@ try:
     from abm_toolbox.abm_utils import dict_to_gzip, gzip_to_dict
 except:
     from abm_utils import dict_to_gzip, gzip_to_dict
+from utils import (write_snapshot, read_snapshot, select_arrays, prefix_arrays, json_to_array, array_to_json,
+                   dataframe_to_arrays, arrays_to_dataframe)
 
 class Mode:
     def __init__(self, mode_spec, mode_id):
@@ -38,7 +40,55 @@ class Route():
         self.external_distance = external_distance
 
 
+class FloydPredecessors:
+    """
+    Read-only lookup of Floyd-Warshall predecessors with the same interface as the nested dict
+    {from_node: {to_node: predecessor}}, backed by a matrix of node positions (-1: no path) which could be
+    memory-mapped from a snapshot instead of being built as nested dicts
+    """
+    def __init__(self, node_ids, pred_matrix):
+        self.node_ids = node_ids
+        self.node_pos = {node: pos for pos, node in enumerate(node_ids)}
+        self.pred_matrix = pred_matrix
+
+    @classmethod
+    def from_dict(cls, fw_result):
+        node_ids = list(dict.fromkeys(
+            [str(node) for node in fw_result] +
+            [str(node) for preds in fw_result.values() for item in preds.items() for node in item]
+        ))
+        node_pos = {node: pos for pos, node in enumerate(node_ids)}
+        pred_matrix = np.full((len(node_ids), len(node_ids)), -1, dtype=np.int32)
+        for from_node, preds in fw_result.items():
+            pred_matrix[node_pos[str(from_node)], [node_pos[str(node)] for node in preds.keys()]] = \
+                [node_pos[str(node)] for node in preds.values()]
+        return cls(node_ids, pred_matrix)
+
+    def __getitem__(self, from_node):
+        return FloydPredecessorsRow(self, self.node_pos[str(from_node)])
+
+    def __contains__(self, from_node):
+        return str(from_node) in self.node_pos
+
+
+class FloydPredecessorsRow:
+    def __init__(self, lookup, row):
+        self.lookup = lookup
+        self.row = row
+
+    def __getitem__(self, to_node):
+        pred_pos = int(self.lookup.pred_matrix[self.row, self.lookup.node_pos[str(to_node)]])
+        if pred_pos < 0:
+            raise KeyError(to_node)
+        return self.lookup.node_ids[pred_pos]
+
+
 class Transport_Network:
+    # attributes saved as they are in meta.json of snapshots, see save_snapshot()
+    _snapshot_meta_attrs = ['table', 'external_routes_db_name', 'external_route_costs_path', 'external_h3_resolution',
+                            'mode_spec_path', 'sim_net_floyd_result_paths', 'sim_net_floyd_df_paths',
+                            'portal_path', 'save_path']
+
     def __init__(self, table='shenzhen', external_routes_db_name='external_routes', external_h3_resolution=None):
         self.table = table
         self.root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -415,6 +465,93 @@ class Transport_Network:
     def save(self):
         pickle.dump(self, open(self.save_path, 'wb'))
 
+    def save_snapshot(self, snapshot_dir):
+        """
+        Save this network to a snapshot directory, see utils.write_snapshot() for the format.
+        Floyd-Warshall predecessors are saved as matrices and reopened lazily by load_snapshot() with mmap, link and
+        node lookups are saved as columns instead of being rebuilt from the network tables row by row.
+        """
+        arrays = {}
+        meta = {attr: getattr(self, attr) for attr in self._snapshot_meta_attrs}
+        meta.update({'base_modes': [vars(mode) for mode in self.base_modes],
+                     'portals': list(self.portals.items()), 'modes': list(self.sim_net_floyd_results.keys()),
+                     'link_weight_columns': {}, 'sim_net_floyd_df_columns': {}})
+        costs = [(mode, h3_cell, pid, cost) for mode, mode_costs in self.external_costs.items()
+                 for h3_cell, cell_costs in mode_costs.items() for pid, cost in cell_costs.items()]
+        for i, col in enumerate(['mode', 'h3_cell', 'portal']):
+            arrays[f'external_costs:{col}'] = np.array([str(item[i]) for item in costs])
+        for col in ['distance', 'duration', 'price']:
+            arrays[f'external_costs:{col}'] = np.array([item[3][col] for item in costs], dtype=np.float64)
+        for mode in meta['modes']:
+            fw_result = self.sim_net_floyd_results[mode]
+            if not isinstance(fw_result, FloydPredecessors):
+                fw_result = FloydPredecessors.from_dict(fw_result)
+            arrays[f'fw:{mode}:node_ids'] = np.array(fw_result.node_ids, dtype=str)
+            arrays[f'fw:{mode}:pred_matrix'] = fw_result.pred_matrix
+            df_arrays, meta['sim_net_floyd_df_columns'][mode] = dataframe_to_arrays(self.sim_net_floyd_df[mode])
+            arrays.update(prefix_arrays(df_arrays, f'df:{mode}:'))
+            links = self.nodes_to_link_attributes[mode]
+            link_attrs = list(links.values())
+            weight_columns = [col for col in self.sim_net_floyd_df[mode] if 'minutes' in col]
+            meta['link_weight_columns'][mode] = weight_columns
+            arrays[f'links:{mode}:keys'] = np.array(list(links.keys()), dtype=str)
+            arrays[f'links:{mode}:distance'] = np.array([link['distance'] for link in link_attrs], dtype=np.float64)
+            arrays[f'links:{mode}:from_coord'] = np.array([link['from_coord'] for link in link_attrs], dtype=np.float64)
+            arrays[f'links:{mode}:to_coord'] = np.array([link['to_coord'] for link in link_attrs], dtype=np.float64)
+            for j, col in enumerate(weight_columns):
+                arrays[f'links:{mode}:weight:{j}'] = np.array([link[col] for link in link_attrs], dtype=np.float64)
+            arrays[f'links:{mode}:activity'] = json_to_array([link['activity'] for link in link_attrs])
+            arrays[f'nodes:{mode}:ids'] = np.array(self.sim_node_ids[mode], dtype=str)
+            arrays[f'nodes:{mode}:lon_lat'] = np.array([self.node_to_lon_lat[mode][node]
+                                                        for node in self.sim_node_ids[mode]], dtype=np.float64)
+        write_snapshot(snapshot_dir, arrays, meta, kind=type(self).__name__)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir, mmap=True):
+        arrays, meta = read_snapshot(snapshot_dir, kind=cls.__name__, mmap=mmap)
+        self = cls.__new__(cls)
+        for attr in cls._snapshot_meta_attrs:
+            setattr(self, attr, meta[attr])
+        self.root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.base_modes = []
+        for mode_attrs in meta['base_modes']:
+            mode = Mode.__new__(Mode)
+            mode.__dict__.update(mode_attrs)
+            self.base_modes.append(mode)
+        self.portals = dict(meta['portals'])
+        self.pids = list(self.portals.keys())
+        self.external_costs = {}
+        for mode, h3_cell, pid, distance, duration, price in zip(
+                *[arrays[f'external_costs:{col}'].tolist()
+                  for col in ['mode', 'h3_cell', 'portal', 'distance', 'duration', 'price']]):
+            self.external_costs.setdefault(mode, {}).setdefault(h3_cell, {})[pid] = {
+                'distance': distance, 'duration': duration, 'price': price}
+        self.sim_net_floyd_results, self.sim_net_floyd_df = {}, {}
+        self.nodes_to_link_attributes, self.node_to_lon_lat, self.sim_node_ids = {}, {}, {}
+        self.internal_nodes_kdtree, self.link_collection = {}, {}
+        for mode in meta['modes']:
+            self.sim_net_floyd_results[mode] = FloydPredecessors(arrays[f'fw:{mode}:node_ids'].tolist(),
+                                                                 arrays[f'fw:{mode}:pred_matrix'])
+            self.sim_net_floyd_df[mode] = arrays_to_dataframe(select_arrays(arrays, f'df:{mode}:'),
+                                                              meta['sim_net_floyd_df_columns'][mode])
+            weight_columns = meta['link_weight_columns'][mode]
+            columns = [arrays[f'links:{mode}:keys'].tolist(), arrays[f'links:{mode}:distance'].tolist(),
+                       arrays[f'links:{mode}:from_coord'].tolist(), arrays[f'links:{mode}:to_coord'].tolist(),
+                       array_to_json(arrays[f'links:{mode}:activity'])]
+            weights = [arrays[f'links:{mode}:weight:{j}'].tolist() for j in range(len(weight_columns))]
+            weight_rows = zip(*weights) if weights else [()] * len(columns[0])
+            links = {}
+            for key, distance, from_coord, to_coord, activity, link_weights in zip(*columns, weight_rows):
+                links[key] = {'distance': distance, 'from_coord': from_coord, 'to_coord': to_coord}
+                links[key].update(zip(weight_columns, link_weights))
+                links[key]['activity'] = activity
+            self.nodes_to_link_attributes[mode] = links
+            self.sim_node_ids[mode] = arrays[f'nodes:{mode}:ids'].tolist()
+            node_lls = np.asarray(arrays[f'nodes:{mode}:lon_lat'])
+            self.node_to_lon_lat[mode] = dict(zip(self.sim_node_ids[mode], node_lls.tolist()))
+            self.internal_nodes_kdtree[mode] = spatial.KDTree(node_lls)
+        return self
+
 
 
 def test():
@@ -0,0 +1,1045 @@
+import os, sys, time, copy, json, random, tempfile, shutil, pickle, threading, tracemalloc
+import h3.api.numpy_int as h3
+import numpy as np
+from types import SimpleNamespace
+from functools import partial
+from scipy import stats
+from pyproj import Transformer
+from geodata_toolbox import GeoData, PolygonGeoData, MIN_POLYGONS_PER_WORKER
+from grids_toolbox import TableGrids, H3Grids, H3DistLookup, H3KDTree, H3KRingKernel
+from indicator_toolbox import Indicator, IndicatorPool, AsyncHandler
+from proximity_indicator import IncrementalProximity, ProximityIndicator
+from density_indicator import DensityIndicator
+from diversity_indicator import DiversityIndicator
+from loopback import LoopbackBroker, LoopbackNetwork, load_replay, replay
+from population_toolbox import HousingUnits, Population, Person
+from utils import crs_lookup_code_to_name, binned_kde, H3BoundaryCache, export_h3_features, read_snapshot, \
+    LocationSetter, load_geojsons, resolve_n_workers
+from payload_codec import get_codec, decode_payload
+from heatmap_delta import HeatmapFrame, HeatmapDeltaEncoder, HeatmapDeltaDecoder
+from numpyencoder import NumpyEncoder
+
+
+def make_synthetic_links(num_features, resolution=11, center=(22.54, 114.05), span_deg=0.1,
+                         max_cells_per_feature=4, seed=0):
+    """
+    Make synthetic features and their mapping-to-h3-cells information, roughly like a building layer
+    :param num_features: number of features
+    :param resolution: h3 resolution
+    :param center: (lat, lon) of the center of synthetic data
+    :param span_deg: features are uniformly located within center +/- span_deg/2
+    :param max_cells_per_feature: each feature is linked to 1 ~ max_cells_per_feature neighbouring cells
+    :param seed: random seed
+    :return: features (list of geojson features without geometry), cells_to_map (list of dict)
+    """
+    rng = np.random.default_rng(seed)
+    lats = center[0] + (rng.random(num_features) - 0.5) * span_deg
+    lons = center[1] + (rng.random(num_features) - 0.5) * span_deg
+    features, cells_to_map = [], []
+    for idx, (lat, lon) in enumerate(zip(lats, lons)):
+        home_cell = h3.geo_to_h3(lat, lon, resolution)
+        num_cells = int(rng.integers(1, max_cells_per_feature + 1))
+        cells = [home_cell] + [c for c in h3.k_ring(home_cell, 1) if c != home_cell][:num_cells-1]
+        weights = rng.random(len(cells))
+        weights = weights / weights.sum()
+        cells_to_map.append({
+            cell: {'intersection_area': w, 'weight_in_raw_data': w, 'weight_in_new_data': w}
+            for cell, w in zip(cells, weights.tolist())
+        })
+        area = float(rng.random() * 1000)
+        features.append({'properties': {
+            'area': area,
+            'height': int(rng.integers(1, 30)),
+            'usage': {
+                'area': area,
+                'sqm_pperson': 40.0,
+                'LBCS': {'1100': 0.6, str(2000 + 100 * (idx % 5)): 0.4},
+                'NAICS': {'44': 0.5, str(50 + idx % 9): 0.5}
+            }
+        }})
+    return features, cells_to_map
+
+
+def benchmark_aggregate_attrs_to_cells(num_features=100000, resolution=11, repeat=3):
+    """
+    Compare the "columnar" engine of GeoData.aggregate_attrs_to_cells() against the original "python" engine
+    """
+    features, cells_to_map = make_synthetic_links(num_features, resolution)
+    num_links = sum(len(x) for x in cells_to_map)
+    print(f'\naggregate_attrs_to_cells: {num_features} features, {num_links} feature-cell links')
+    G = GeoData(name='bench')
+    agg_attrs = {'area': 'sum', 'height': 'max', 'usage': 'decompose'}
+    for this_agg_attrs in [{'area': 'sum'}, {'area': 'mean', 'height': 'max'}, {'area': 'count'}, agg_attrs]:
+        rsts, elapsed = {}, {}
+        for engine in ['python', 'columnar']:
+            t0 = time.time()
+            for _ in range(repeat):
+                rsts[engine] = G.aggregate_attrs_to_cells(cells_to_map, features, this_agg_attrs, engine=engine)
+            elapsed[engine] = (time.time() - t0) / repeat
+        consistent = _h3_stats_close(rsts['python'], rsts['columnar'])
+        print('{:48s} python {:8.4f}s | columnar {:8.4f}s | speedup {:6.1f}x | consistent: {}'.format(
+            str(this_agg_attrs), elapsed['python'], elapsed['columnar'],
+            elapsed['python'] / max(elapsed['columnar'], 1e-9), consistent))
+
+
+def make_synthetic_polygons(num_features, num_vertices=12, center=(22.54, 114.05), span_deg=0.1,
+                            radius_deg=0.0003, seed=0):
+    """
+    Make synthetic polygon features in EPSG:4326, roughly like a building layer
+    :param num_features: number of features
+    :param num_vertices: number of vertices of the exterior ring of each polygon (the closing vertex excluded)
+    :param center: (lat, lon) of the center of synthetic data
+    :param span_deg: features are uniformly located within center +/- span_deg/2
+    :param radius_deg: radius of each polygon in degree
+    :param seed: random seed
+    :return: list of geojson features
+    """
+    rng = np.random.default_rng(seed)
+    lats = center[0] + (rng.random(num_features) - 0.5) * span_deg
+    lons = center[1] + (rng.random(num_features) - 0.5) * span_deg
+    angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    features = []
+    for idx, (lat, lon) in enumerate(zip(lats, lons)):
+        ring = np.column_stack([lon + radius_deg * np.cos(angles), lat + radius_deg * np.sin(angles)]).tolist()
+        ring.append(list(ring[0]))
+        features.append({'type': 'Feature',
+                         'properties': {'idx': idx, 'area': float(rng.random() * 1000)},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return features
+
+
+def _convert_crs_per_vertex(G, features, to_crs, from_crs):
+    # the original implementation: deepcopy all features and call pyproj once per vertex
+    transformer = G._get_transformer(to_crs, from_crs)
+    features = copy.deepcopy(features)
+    for fea in features:
+        for line in fea['geometry']['coordinates']:
+            for coord in line:
+                new_coord = transformer.transform(coord[1], coord[0])
+                coord[0], coord[1] = new_coord[1], new_coord[0]
+    return features
+
+
+def benchmark_convert_crs(num_features=50000, num_vertices=12, repeat=3):
+    """
+    Compare the bulk CRS conversion of GeoData.convert_crs_for_features() against per-vertex conversion
+    """
+    features = make_synthetic_polygons(num_features, num_vertices)
+    num_total_vertices = sum(len(ring) for fea in features for ring in fea['geometry']['coordinates'])
+    print(f'\nconvert_crs_for_features: {num_features} polygons, {num_total_vertices} vertices')
+    G = GeoData(name='bench')
+    G.crs['src'] = 4326
+    G.features[4326] = features
+    for to_crs in [4547, 3857]:
+        G._get_transformer(to_crs, 4326)   # exclude the construction of Transformer from timing
+        t0 = time.time()
+        for _ in range(repeat):
+            rst_per_vertex = _convert_crs_per_vertex(G, features, to_crs, 4326)
+        elapsed_per_vertex = (time.time() - t0) / repeat
+        t0 = time.time()
+        for _ in range(repeat):
+            rst_bulk = G.convert_crs_for_features(to_crs)
+        elapsed_bulk = (time.time() - t0) / repeat
+        consistent = all(
+            np.allclose(a['geometry']['coordinates'][0], b['geometry']['coordinates'][0], rtol=0, atol=1e-6)
+            for a, b in zip(rst_per_vertex, rst_bulk)
+        )
+        print('EPSG:4326 -> EPSG:{:<6d} per-vertex {:12,.0f} vertices/s | bulk {:12,.0f} vertices/s | '
+              'speedup {:6.1f}x | consistent: {}'.format(
+            to_crs, num_total_vertices / elapsed_per_vertex, num_total_vertices / elapsed_bulk,
+            elapsed_per_vertex / max(elapsed_bulk, 1e-9), consistent))
+
+
+def benchmark_link_polygons_to_h3(resolution=11, repeat=1):
+    """
+    Compare the "strtree" engine of PolygonGeoData.link_to_h3_using_polygon_intersection() against the original
+    "python" engine, measured on make_h3_stats() of building-like and land-use-like layers
+    """
+    layers = {
+        'buildings': make_synthetic_polygons(20000, num_vertices=8, radius_deg=0.00015),
+        'land_use': make_synthetic_polygons(2000, num_vertices=24, radius_deg=0.002, seed=1)
+    }
+    for layer_name, features in layers.items():
+        print(f'\nmake_h3_stats of {layer_name}: {len(features)} polygons, resolution {resolution}')
+        rsts, elapsed = {}, {}
+        for engine in ['python', 'strtree']:
+            G = PolygonGeoData(name=layer_name, proj_crs=4547)
+            G.crs['src'] = 4326
+            G.features[4326] = features
+            G.convert_to_shapely(4326, self_update=True)
+            G.convert_to_shapely(4547, self_update=True)   # used by buffers of the "python" engine
+            t0 = time.time()
+            for _ in range(repeat):
+                G.link_to_h3(resolution, engine=engine)
+                G.make_h3_stats(resolution, {'area': 'sum'})
+            elapsed[engine] = (time.time() - t0) / repeat
+            rsts[engine] = G.map_to_h3_cells[resolution]
+        # the "python" engine may miss cells barely touched by a polygon, as the buffer is polyfilled by cell centers
+        num_links = {engine: sum(len(x) for x in rst) for engine, rst in rsts.items()}
+        reproduced = all(_nested_close(a, {cell: b[cell] for cell in a if cell in b})
+                         for a, b in zip(rsts['python'], rsts['strtree']))
+        extra_weight = sum(info['weight_in_raw_data'] for a, b in zip(rsts['python'], rsts['strtree'])
+                           for cell, info in b.items() if cell not in a)
+        print('python {:8.4f}s ({} links) | strtree {:8.4f}s ({} links) | speedup {:6.1f}x | '
+              'python links reproduced: {} | weight of extra links per polygon: {:.2e}'.format(
+            elapsed['python'], num_links['python'], elapsed['strtree'], num_links['strtree'],
+            elapsed['python'] / max(elapsed['strtree'], 1e-9), reproduced, extra_weight / len(features)))
+
+
+def benchmark_link_to_h3_in_process_pool(resolution=11, n_workers_list=(1, 2, 4, None)):
+    """
+    Compare PolygonGeoData.link_to_h3() with different number of worker processes, 1 is the default and None means
+    as many workers as os.cpu_count() and the layer size allow. Requested numbers are capped by os.cpu_count(), so on a
+    single-core machine all of them run serially.
+    """
+    features = make_synthetic_polygons(50000, num_vertices=8, radius_deg=0.00015)
+    print(f'\nlink_to_h3 in process pool: {len(features)} polygons, resolution {resolution}, {os.cpu_count()} CPUs')
+    G = PolygonGeoData(name='bench', proj_crs=4547)
+    G.crs['src'] = 4326
+    G.features[4326] = features
+    G.convert_to_shapely(4326, self_update=True)
+    rsts = {}
+    for n_workers in n_workers_list:
+        t0 = time.time()
+        rsts[n_workers] = G.link_to_h3(resolution, self_update=False, n_workers=n_workers)
+        elapsed = time.time() - t0
+        consistent = all(_nested_close(a, b) for a, b in zip(rsts[n_workers_list[0]], rsts[n_workers]))
+        used_workers = resolve_n_workers(n_workers, len(features), MIN_POLYGONS_PER_WORKER)
+        print('n_workers={:<5s} used {:<3d} {:8.4f}s | consistent: {}'.format(
+            str(n_workers), used_workers, elapsed, consistent))
+
+
+def benchmark_h3_stats_cache(resolution=11):
+    """
+    Compare PolygonGeoData.make_h3_stats() with a cold cache (link, aggregate and save) against a warm cache (load)
+    """
+    features = make_synthetic_polygons(20000, num_vertices=8, radius_deg=0.00015)
+    for fea in features:
+        fea['properties']['usage'] = {'area': fea['properties']['area'], 'sqm_pperson': 40.0,
+                                      'LBCS': {'1100': 0.6, '2100': 0.4}, 'NAICS': {'44': 1.0}}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_geojson_path = os.path.join(tmp_dir, 'buildings.geojson')
+        json.dump({'type': 'FeatureCollection', 'crs': {'type': 'name', 'properties': {'name': crs_lookup_code_to_name[4326]}},
+                   'features': features}, open(src_geojson_path, 'w'))
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        print(f'\nmake_h3_stats with cache: {len(features)} polygons, resolution {resolution}')
+        rsts, elapsed = {}, {}
+        for run in ['cold', 'warm']:
+            G = PolygonGeoData(name='buildings', src_geojson_path=src_geojson_path, proj_crs=4547)
+            t0 = time.time()
+            G.make_h3_stats(resolution, {'area': 'sum', 'usage': 'decompose'}, cache_dir=cache_dir)
+            elapsed[run] = time.time() - t0
+            rsts[run] = G
+        consistent = rsts['cold'].map_to_h3_cells[resolution] == rsts['warm'].map_to_h3_cells[resolution] \
+                     and _h3_stats_close(rsts['cold'].h3_stats[resolution], rsts['warm'].h3_stats[resolution])
+        print('cold {:8.4f}s | warm {:8.4f}s | speedup {:6.1f}x | consistent: {}'.format(
+            elapsed['cold'], elapsed['warm'], elapsed['cold'] / max(elapsed['warm'], 1e-9), consistent))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_snapshot(resolution=11):
+    """
+    Compare GeoData.save_snapshot() / load_snapshot() against pickling the whole instance. Snapshots are loaded
+    lazily, so the time until features, links and h3 stats are all materialized is also reported.
+    """
+    features = make_synthetic_polygons(20000, num_vertices=8, radius_deg=0.00015)
+    for fea in features:
+        fea['properties']['usage'] = {'area': fea['properties']['area'], 'sqm_pperson': 40.0,
+                                      'LBCS': {'1100': 0.6, '2100': 0.4}, 'NAICS': {'44': 1.0}}
+    G = PolygonGeoData(name='buildings', proj_crs=4547)
+    G.crs['src'] = 4326
+    G.features[4326] = features
+    G.convert_to_shapely(4326, self_update=True)
+    G.make_h3_stats(resolution, {'area': 'sum', 'usage': 'decompose'})
+    print(f'\nsnapshot of PolygonGeoData: {len(features)} polygons with links and h3 stats at resolution {resolution}')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pickle_path, snapshot_dir = os.path.join(tmp_dir, 'buildings.p'), os.path.join(tmp_dir, 'buildings')
+        t0 = time.time()
+        pickle.dump(G, open(pickle_path, 'wb'))
+        t1 = time.time()
+        rst_pickle = pickle.load(open(pickle_path, 'rb'))
+        t2 = time.time()
+        G.save_snapshot(snapshot_dir)
+        t3 = time.time()
+        rst_snapshot = PolygonGeoData.load_snapshot(snapshot_dir)
+        t4 = time.time()
+        for attr in ['features', 'shapely_objects', 'map_to_h3_cells', 'h3_stats']:
+            list(getattr(rst_snapshot, attr).values())
+        t5 = time.time()
+        consistent = rst_snapshot.features == rst_pickle.features and \
+                     rst_snapshot.map_to_h3_cells == rst_pickle.map_to_h3_cells and \
+                     _h3_stats_close(rst_snapshot.h3_stats[resolution], rst_pickle.h3_stats[resolution])
+        print('pickle save {:8.4f}s load {:8.4f}s | snapshot save {:8.4f}s load {:8.4f}s materialized {:8.4f}s | '
+              'load speedup {:6.1f}x (materialized {:4.1f}x) | consistent: {}'.format(
+                  t1-t0, t2-t1, t3-t2, t4-t3, t5-t3, (t2-t1) / max(t4-t3, 1e-9), (t2-t1) / max(t5-t3, 1e-9),
+                  consistent))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _export_h3_features_former(h3_stats, save_to):
+    h3_features = []
+    for h3_cell, properties in h3_stats.items():
+        h3_boundary = [list(coord) for coord in h3.h3_to_geo_boundary(h3_cell, geo_json=True)]
+        properties['h3_id'] = h3_cell
+        h3_features.append({'type': 'Feature', 'properties': properties,
+                            'geometry': {'type': 'Polygon', 'coordinates': [h3_boundary]}})
+    h3_geojson_content = {'type': 'FeatureCollection', 'name': os.path.basename(save_to).split('.')[0],
+                          'crs': {'type': 'name', 'properties': {'name': 'urn:ogc:def:crs:OGC:1.3:CRS84'}},
+                          'features': h3_features}
+    json.dump(h3_geojson_content, open(save_to, 'w', encoding='utf-8'), indent=4, ensure_ascii=False,
+              cls=NumpyEncoder)
+    return h3_features
+
+
+def benchmark_h3_export(num_cells=50000, num_exports=3, resolution=11, seed=0):
+    """
+    Compare exporting a heatmap of h3 cells to geojson on each update, computing boundaries and dumping with
+    indent as before, against the H3BoundaryCache and write_h3_geojson(); and the cache in H3Grids snapshots
+    """
+    rng = np.random.default_rng(seed)
+    cells = h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 150)[:num_cells].tolist()
+    boundary_cache = H3BoundaryCache()
+    tmp_dir = tempfile.mkdtemp()
+    print(f'\nh3 export: heatmaps of {len(cells)} h3 cells, {num_exports} exports')
+    try:
+        former_path, cached_path = os.path.join(tmp_dir, 'former.geojson'), os.path.join(tmp_dir, 'cached.geojson')
+        for i in range(num_exports):
+            h3_stats = {h3_cell: {'heatmap_park_proximity': round(value, 3)}
+                        for h3_cell, value in zip(cells, rng.random(len(cells)).tolist())}
+            t0 = time.time()
+            _export_h3_features_former(copy.deepcopy(h3_stats), former_path)
+            t1 = time.time()
+            export_h3_features(h3_stats, cached_path, boundary_cache)
+            t2 = time.time()
+            consistent = json.load(open(former_path))['features'] == json.load(open(cached_path))['features']
+            print('export {} | former {:8.4f}s {:6.1f}MB | cached {:8.4f}s {:6.1f}MB | speedup {:6.1f}x | '
+                  'consistent: {}'.format(i, t1-t0, os.path.getsize(former_path) / 1e6, t2-t1,
+                                          os.path.getsize(cached_path) / 1e6, (t1-t0) / max(t2-t1, 1e-9),
+                                          consistent))
+        H3 = _make_h3_grids(resolution, h3_stats, required_cells=[], results={}, precooked_rsts={},
+                            h3_stats_base={}, h3_stats_interactive={}, usage_base={}, usage_interactive={},
+                            boundary_cache=boundary_cache)
+        snapshot_dir = os.path.join(tmp_dir, 'h3_grids')
+        H3.save_snapshot(snapshot_dir, with_population=False, with_housing=False)
+        t0 = time.time()
+        loaded_cache = H3BoundaryCache.from_arrays(read_snapshot(snapshot_dir)[0], prefix='boundaries:')
+        t1 = time.time()
+        consistent = all(np.array_equal(loaded_cache.boundaries[h3_cell], boundary_cache.boundaries[h3_cell])
+                         for h3_cell in cells)
+        print('boundary cache from snapshot {:8.4f}s | consistent: {}'.format(t1 - t0, consistent))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _dist_lookup_dict(from_h3_cells, to_h3_cells, resolution):
+    # the former H3Grids._get_h3_dist_lookup(), one h3.point_dist() per pair
+    inner_dist = h3.edge_length(resolution) / 2
+    return {from_h3_cell: {to_h3_cell: h3.point_dist(h3.h3_to_geo(from_h3_cell), h3.h3_to_geo(to_h3_cell))
+                           if to_h3_cell != from_h3_cell else inner_dist
+                           for to_h3_cell in to_h3_cells}
+            for from_h3_cell in from_h3_cells}
+
+
+def benchmark_dist_lookup(num_from_cells=1000, num_to_cells=4000, resolution=11, seed=0):
+    """
+    Compare the dict-of-dicts distance lookup against H3DistLookup (dense float32 matrix, vectorized haversine)
+    """
+    rng = np.random.default_rng(seed)
+    center_cell = h3.geo_to_h3(22.54, 114.05, resolution)
+    all_cells = np.asarray(h3.k_ring(center_cell, 60))
+    from_cells = rng.choice(all_cells, num_from_cells, replace=False).tolist()
+    to_cells = rng.choice(all_cells, num_to_cells, replace=False).tolist()
+    print(f'\ndistance lookup: {num_from_cells} x {num_to_cells} h3 cells at resolution {resolution}')
+    t0 = time.time()
+    dist_dict = _dist_lookup_dict(from_cells, to_cells, resolution)
+    t1 = time.time()
+    dist_lookup = H3DistLookup(resolution, from_cells, to_cells)
+    t2 = time.time()
+    dist_matrix = dist_lookup.get_dist_matrix(from_cells, to_cells)
+    t3 = time.time()
+    expected = np.array([list(dist_dict[from_cell].values()) for from_cell in from_cells])
+    max_error_m = np.abs(dist_matrix - expected).max() * 1000
+    print('dict build {:8.4f}s | matrix build {:8.4f}s query {:8.4f}s | build speedup {:6.1f}x | '
+          'max error {:.3f}m'.format(t1-t0, t2-t1, t3-t2, (t1-t0) / max(t2-t1, 1e-9), max_error_m))
+
+
+def benchmark_nearest_targets(num_required_cells=5000, num_target_cells=20000, kth=3, resolution=11, seed=0):
+    """
+    Compare the kth nearest target distance from dense distance rows (H3DistLookup + np.partition) against one
+    batched H3KDTree query
+    """
+    rng = np.random.default_rng(seed)
+    all_cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 100))
+    required_cells = rng.choice(all_cells, num_required_cells, replace=False).tolist()
+    target_cells = rng.choice(all_cells, num_target_cells, replace=False).tolist()
+    print(f'\nkth={kth} nearest of {num_target_cells} targets for {num_required_cells} h3 cells at resolution {resolution}')
+    t0 = time.time()
+    dist_lookup = H3DistLookup(resolution, [], target_cells)
+    dense_rst = np.concatenate([np.partition(dists, kth-1, axis=1)[:, kth-1]
+                                for _, dists in dist_lookup.iter_dist_blocks(required_cells, target_cells)])
+    t1 = time.time()
+    tree_rst = H3KDTree(resolution, target_cells).query_knn(required_cells, kth)[0][:, kth-1]
+    t2 = time.time()
+    print('dense rows {:8.4f}s | kd-tree {:8.4f}s | speedup {:6.1f}x | max error {:.3f}m'.format(
+        t1-t0, t2-t1, (t1-t0) / max(t2-t1, 1e-9), np.abs(dense_rst - tree_rst).max() * 1000))
+
+
+def benchmark_incremental_proximity(num_required_cells=20000, num_target_cells=2000, num_updates=20,
+                                    max_changed_targets=4, nearest_k=3, resolution=11, seed=0):
+    """
+    Compare recomputing proximity after every small change of target cells against IncrementalProximity.update()
+    """
+    rng = np.random.default_rng(seed)
+    all_cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 100))
+    required_cells = rng.choice(all_cells, num_required_cells, replace=False)
+    # IncrementalProximity only needs resolution and dist_lookup of H3Grids
+    H3 = SimpleNamespace(resolution=resolution, dist_lookup=H3DistLookup(resolution, [], []))
+    targets = set(rng.choice(all_cells, num_target_cells, replace=False).tolist())
+    target_sets = []
+    for _ in range(num_updates):
+        targets = set(targets)
+        for cell in rng.choice(all_cells, int(rng.integers(1, max_changed_targets + 1))).tolist():
+            targets.symmetric_difference_update([cell])
+        target_sets.append(targets)
+    print(f'\nincremental proximity: {num_required_cells} cells, {num_target_cells} targets, '
+          f'{num_updates} updates of 1~{max_changed_targets} targets')
+    for mode, k in [(f'nearest_k={nearest_k}', nearest_k), ('all targets', None)]:
+        full, incremental = IncrementalProximity(H3, required_cells, k), IncrementalProximity(H3, required_cells, k)
+        incremental.reset(target_sets[0])
+        t_full = t_incremental = 0
+        num_changed, max_error = 0, 0
+        for targets in target_sets[1:]:
+            t0 = time.time()
+            full.reset(targets)
+            expected = full.closeness()
+            t1 = time.time()
+            num_changed += incremental.update(targets).sum()
+            rst = incremental.closeness()
+            t2 = time.time()
+            t_full, t_incremental = t_full + t1 - t0, t_incremental + t2 - t1
+            max_error = max(max_error, np.abs(rst - expected).max() / np.abs(expected).max())
+        print('{:<16} recompute {:8.4f}s/update | incremental {:8.4f}s/update | speedup {:6.1f}x | '
+              'changed cells {:8.1f}/update | max relative error {:.1e}'.format(
+              mode, t_full / (num_updates - 1), t_incremental / (num_updates - 1), t_full / max(t_incremental, 1e-9),
+              num_changed / (num_updates - 1), max_error))
+
+
+def benchmark_kde(num_targets=3000, num_cells=20000, bandwidth_multiplier=0.3, seed=0):
+    """
+    Compare evaluating a gaussian_kde cell by cell, in one batched call, and binned by FFT (utils.binned_kde)
+    """
+    rng = np.random.default_rng(seed)
+    targets = np.vstack([114.05 + rng.normal(0, 0.01, num_targets) + rng.choice([0, 0.03], num_targets),
+                         22.54 + rng.normal(0, 0.006, num_targets)])
+    cells = np.vstack([114.0 + rng.random(num_cells) * 0.12, 22.5 + rng.random(num_cells) * 0.1])
+    kernel = stats.gaussian_kde(targets, 'scott')
+    kernel.set_bandwidth(bw_method=kernel.factor * bandwidth_multiplier)
+    print(f'\nkde of {num_targets} targets at {num_cells} cells, bandwidth multiplier {bandwidth_multiplier}')
+    t0 = time.time()
+    per_cell_rst = np.array([kernel(cells[:, i])[0] for i in range(num_cells)])
+    t1 = time.time()
+    batched_rst = kernel(cells)
+    t2 = time.time()
+    binned_rst = binned_kde(kernel, cells)
+    t3 = time.time()
+    print('per cell {:8.4f}s | batched {:8.4f}s | binned {:8.4f}s | speedup {:6.1f}x / {:6.1f}x | '
+          'batched consistent: {} | max error of binned {:.2%} of max density'.format(
+          t1-t0, t2-t1, t3-t2, (t1-t0) / max(t2-t1, 1e-9), (t1-t0) / max(t3-t2, 1e-9),
+          np.allclose(batched_rst, per_cell_rst), np.abs(binned_rst - per_cell_rst).max() / per_cell_rst.max()))
+
+
+def benchmark_kring_kernel(num_required_cells=10000, num_target_cells=2000, k=10, power=0.75, resolution=11,
+                           seed=0):
+    """
+    Compare closeness over all targets (dense distance rows) against a precomputed H3KRingKernel mat-vec, which
+    only counts targets within k rings
+    """
+    rng = np.random.default_rng(seed)
+    all_cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 100))
+    required_cells = rng.choice(all_cells, num_required_cells, replace=False)
+    target_cells = rng.choice(all_cells, num_target_cells, replace=False)
+    print(f'\nk-ring kernel: {num_required_cells} cells, {num_target_cells} targets, k={k} at resolution {resolution}')
+    t0 = time.time()
+    dist_lookup = H3DistLookup(resolution, [], [])
+    dense_rst = np.concatenate([(1 / dists.astype(np.float64) ** power).mean(axis=1)
+                                for _, dists in dist_lookup.iter_dist_blocks(required_cells, target_cells)])
+    t1 = time.time()
+    kring_kernel = H3KRingKernel(resolution, required_cells, k, kernel='power', power=power)
+    t2 = time.time()
+    kring_rst = kring_kernel.apply(target_cells) / num_target_cells
+    t3 = time.time()
+    print('dense closeness {:8.4f}s | kernel build {:8.4f}s ({} nonzeros) apply {:8.4f}s | speedup per update {:6.0f}x'
+          ' | correlation with dense {:.4f}'.format(t1-t0, t2-t1, kring_kernel.matrix.nnz, t3-t2,
+                                                     (t1-t0) / max(t3-t2, 1e-9), np.corrcoef(dense_rst, kring_rst)[0, 1]))
+
+
+def _make_h3_grids(resolution, h3_stats, **attrs):
+    """
+    H3Grids with given h3_stats, without reading bounds or population data
+    """
+    H3 = H3Grids.__new__(H3Grids)
+    H3.resolution, H3.h3_cell_area, H3.h3_stats = resolution, h3.hex_area(resolution, 'm^2'), h3_stats
+    H3.values, H3.usage, H3.class_indexes, H3.kring_kernels, H3.dist_lookup = {}, {}, {}, {}, None
+    H3.versions, H3.memo, H3.changed_cells = {}, {}, None
+    H3.boundary_cache = H3BoundaryCache()
+    H3.__dict__.update(attrs)
+    return H3
+
+
+def _target_h3_cells_by_loop(h3_stats, h3_cell_area, target_classes, minimum_ratio_th=0):
+    # Indicator.get_target_h3_cells() before the class index
+    target_h3_cells = []
+    for class_name in target_classes:
+        target_h3_cells += [h3_cell for h3_cell, h3_attrs in h3_stats.items()
+                            if h3_attrs['usage']['LBCS']['area'].get(str(class_name), -1)
+                            > minimum_ratio_th * h3_cell_area]
+    return list(set(target_h3_cells))
+
+
+def benchmark_target_cells(num_cells=50000, num_queries=20, resolution=11, seed=0):
+    """
+    Compare selecting target cells by iterating h3_stats against the H3ClassIndex of H3Grids
+    """
+    rng = np.random.default_rng(seed)
+    all_cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 130))[:num_cells].tolist()
+    class_names = ['1100', '1200', '2100', '2200', '2300', '2400', '5500', '7240', '4100', '6100']
+    h3_stats = {}
+    for h3_cell in all_cells:
+        area = {class_name: float(rng.random() * 2000) for class_name in class_names if rng.random() < 0.1}
+        h3_stats[h3_cell] = {'usage': {'LBCS': {'area': area}}}
+    H3 = _make_h3_grids(resolution, h3_stats)
+    indicator = Indicator.__new__(Indicator)
+    indicator.H3 = H3
+    queries = [([5500], 0.25), ([2100, 2200, 2300, 7240], 0.25), (['1100'], 0)] * (num_queries // 3 + 1)
+    queries = queries[:num_queries]
+    print(f'\ntarget cells: {len(all_cells)} cells, {num_queries} queries')
+    t0 = time.time()
+    loop_rst = [_target_h3_cells_by_loop(h3_stats, H3.h3_cell_area, *query) for query in queries]
+    t1 = time.time()
+    H3.get_class_index()
+    t2 = time.time()
+    index_rst = [indicator.get_target_h3_cells(target_classes, minimum_ratio_th=th) for target_classes, th in queries]
+    t3 = time.time()
+    consistent = all(set(a) == set(b) for a, b in zip(loop_rst, index_rst))
+    print('loop {:8.4f}s/query | index build {:8.4f}s, {:8.5f}s/query | speedup {:6.1f}x | consistent: {}'.format(
+        (t1-t0) / num_queries, t2-t1, (t3-t2) / num_queries, (t1-t0) / max(t3-t2, 1e-9), consistent))
+
+
+def _make_table_grids(num_base_features, num_grids, resolution=11, seed=0):
+    """
+    TableGrids of num_grids interactive grids in one zone "1" over a synthetic base layer, without reading files
+    :return: TableGrids, with its H3Grids as Table.H3
+    """
+    features, cells_to_map = make_synthetic_links(num_base_features, resolution)
+    G = GeoData(name='base')
+    h3_stats_columnar = G.aggregate_attrs_to_cells(cells_to_map, features, {'usage': 'decompose'},
+                                                   agg_attr_names=['usage'], as_dict=False)
+    h3_stats_base = G._set_h3_stats(resolution, h3_stats_columnar)
+    H3 = _make_h3_grids(resolution, h3_stats_base, h3_stats_base=h3_stats_base, usage_base=G.h3_usage[resolution],
+                        Housing=HousingUnits(housing_type_def={}, resolution=resolution))
+    # TableGrids only reads these attributes besides those of GeoData
+    T = TableGrids.__new__(TableGrids)
+    GeoData.__init__(T, name='table')
+    T.H3, T.density_spec, T.interactive_usage, T.grid_housing, T.grid_housing_states = H3, {}, {}, {}, {}
+    T.grid_housing_changes = None
+    T.version = 0
+    T.map_to_h3_cells = {resolution: make_synthetic_links(num_grids, resolution, span_deg=0.02, seed=seed+1)[1]}
+    T.spec = {'parcel_area': 3600, 'housing_type_def': {'residential_medium': {'area': 90}}}
+    T.land_type_def = {
+        '1': {'function': 'residential_medium', 'sqm_pperson': 40, 'default_height': 10,
+              'density_scale_factor': {'lower': 0.5, 'upper': 2},
+              'LBCS': [{'p': 1, 'use': {'1100': 1.0}}], 'NAICS': [{'p': 1, 'use': {'53': 1.0}}]},
+        '2': {'function': 'office_small', 'sqm_pperson': 5, 'default_height': 6,
+              'density_scale_factor': {'lower': 0.5, 'upper': 2},
+              'LBCS': [{'p': 1, 'use': {'2400': 1.0}}],
+              'NAICS': [{'p': 0.5, 'use': {'52': 0.5, '54': 0.5}}, {'p': 0.5, 'use': {'44': 1.0}}]},
+        '3': {'function': 'park', 'sqm_pperson': 1000, 'default_height': 1,
+              'density_scale_factor': {'lower': 1, 'upper': 1},
+              'LBCS': [{'p': 1, 'use': {'5500': 1.0}}], 'NAICS': [{'p': 1, 'use': {'71': 1.0}}]}
+    }
+    T.interactive_grid_layout = {'1': {idx: {'code': -1, 'height': None} for idx in range(num_grids)}}
+    return T
+
+
+def benchmark_table_update(num_base_features=50000, num_grids=2000, num_updates=10, max_changed_grids=3,
+                           resolution=11, seed=0):
+    """
+    Compare TableGrids.update() from scratch against the diff-based one, when a few interactive grids change
+    """
+    rng = random.Random(seed)
+    T = _make_table_grids(num_base_features, num_grids, resolution, seed)
+    H3, h3_stats_base = T.H3, T.H3.h3_stats_base
+    codes = [-1, 1, 2, 3]
+    layout = [rng.choice(codes) for _ in range(num_grids)]
+    layout_strs = []
+    for _ in range(num_updates):
+        for _ in range(rng.randint(1, max_changed_grids)):
+            layout[rng.randrange(num_grids)] = rng.choice(codes)
+        layout_strs.append('i1 ' + ' '.join(str(code) for code in layout))
+    print(f'\ntable update: {len(h3_stats_base)} base cells, {num_grids} interactive grids, '
+          f'{num_updates} updates of 1~{max_changed_grids} grids')
+    T.update(layout_strs[0], incremental=False)
+    elapsed, num_cells = {}, {}
+    for incremental in [False, True]:
+        t0 = time.time()
+        for layout_str in layout_strs:
+            T.update(layout_str, incremental=incremental)
+        elapsed[incremental] = (time.time() - t0) / num_updates
+        num_cells[incremental] = (len(H3.h3_stats), sum(len(h['usage']['LBCS']['area']) for h in
+                                                         H3.h3_stats.values() if type(h['usage']) == dict))
+        T.update(layout_strs[0], incremental=False)
+    print('from scratch {:8.4f}s/update | diff-based {:8.4f}s/update | speedup {:6.1f}x | consistent: {}'.format(
+        elapsed[False], elapsed[True], elapsed[False] / max(elapsed[True], 1e-9), num_cells[False] == num_cells[True]))
+
+
+def _make_proximity_h3_grids(num_cells, num_required_cells, resolution=11, seed=0):
+    """
+    H3Grids of random LBCS areas and population on num_cells cells, for proximity indicators
+    """
+    rng = np.random.default_rng(seed)
+    all_cells = rng.choice(np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 100)), num_cells,
+                           replace=False).tolist()
+    class_names = ['5500', '2100', '2200', '2300', '7240', '1100']
+    h3_stats = {}
+    for h3_cell in all_cells:
+        area = {class_name: float(rng.random() * 2000) for class_name in class_names if rng.random() < 0.05}
+        h3_stats[h3_cell] = {'usage': {'LBCS': {'area': area}}, 'tt_pop': int(rng.integers(0, 20))}
+    # the lookup is precomputed as in Indicator.__init__
+    return _make_h3_grids(resolution, h3_stats, required_cells=all_cells[:num_required_cells],
+                          dist_lookup=H3DistLookup(resolution, all_cells[:num_required_cells], all_cells))
+
+
+def _make_proximity_indicator(H3, name='proximity'):
+    # H3 comes with a prebuilt dist_lookup, so the constructor does not read the bounds of a table
+    return ProximityIndicator(H3, name=name)
+
+
+def benchmark_indicator_pool(num_base_features=20000, num_grids=2000, num_required_cells=2000, num_indicators=4,
+                             num_updates=5, max_changed_grids=3, n_workers_list=(1, 2, 4), resolution=11, seed=0):
+    """
+    Compare cycles of TableGrids.update() and proximity heatmap tasks run one indicator after another in the main
+    process, against an IndicatorPool which updates Table once and sends the diff to its workers. Tasks only run in
+    parallel with more than one CPU, otherwise the pool adds the cost of pickling diffs and results.
+    """
+    rng = random.Random(seed)
+    T = _make_table_grids(num_base_features, num_grids, resolution, seed)
+    H3 = T.H3
+    all_cells = list(H3.h3_stats_base.keys())
+    H3.required_cells = rng.sample(all_cells, num_required_cells)
+    H3.dist_lookup = H3DistLookup(resolution, H3.required_cells, all_cells)
+    class_names = [5500, [2100, 2200], 2400, 1100]
+    indicators = []
+    for i in range(num_indicators):
+        P = _make_proximity_indicator(H3, name=f'proximity_{i}')
+        P.set_scheduled_tasks(('screen_all', 'r {}', partial(P.closeness, name=f'heatmap_{i}',
+                                                              target_classes=class_names[i % len(class_names)],
+                                                              power=0.5 + 0.25 * i, round_digits=6)))
+        indicators.append(P)
+    codes = [-1, 1, 2, 3]
+    layout = [rng.choice(codes) for _ in range(num_grids)]
+    layout_strs = []
+    for _ in range(num_updates):
+        for _ in range(rng.randint(1, max_changed_grids)):
+            layout[rng.randrange(num_grids)] = rng.choice(codes)
+        layout_strs.append('i1 ' + ' '.join(str(code) for code in layout))
+    print(f'\nindicator pool: {num_updates} updates of {num_grids} interactive grids, {num_indicators} closeness '
+          f'heatmaps, {num_required_cells} required cells, {os.cpu_count()} cpus')
+
+    def run_cycles(update, process_tasks):
+        elapsed_update = elapsed_tasks = 0
+        rsts = []
+        for i, layout_str in enumerate(layout_strs):
+            random.seed(seed + i)   # floors and housing units are drawn at random
+            t0 = time.time()
+            update(layout_str)
+            t1 = time.time()
+            rsts.append(process_tasks())
+            t2 = time.time()
+            # the first cycle builds the initial interactive usage and learns the cost of tasks
+            if i > 0:
+                elapsed_update, elapsed_tasks = elapsed_update + t1 - t0, elapsed_tasks + t2 - t1
+        return elapsed_update / (num_updates - 1), elapsed_tasks / (num_updates - 1), rsts
+
+    # copies share the read-only distance lookup
+    shared = {id(H3.dist_lookup): H3.dist_lookup}
+    T_serial, indicators_serial = copy.deepcopy((T, indicators), dict(shared))
+    update_serial, tasks_serial, expected = run_cycles(
+        T_serial.update, lambda: [rst for P in indicators_serial for rst in P.process_tasks(['screen_all'])])
+    print('one by one   update {:8.4f}s | tasks {:8.4f}s'.format(update_serial, tasks_serial))
+    for n_workers in n_workers_list:
+        T_pool, indicators_pool = copy.deepcopy((T, indicators), dict(shared))
+        pool = IndicatorPool(indicators_pool, T_pool, n_workers=n_workers)
+        try:
+            update_pool, tasks_pool, rsts = run_cycles(
+                pool.update, lambda: [(task_name, formatted_rst)
+                                      for _, task_name, formatted_rst in pool.process_tasks(['screen_all'])])
+        finally:
+            pool.close()
+        # heatmaps saved to H3.values in workers are applied to the main process
+        consistent = rsts == expected and T_pool.H3.values == T_serial.H3.values and \
+                     T_pool.H3.h3_stats == T_serial.H3.h3_stats
+        print('{} workers    update {:8.4f}s | tasks {:8.4f}s | cycle speedup {:6.1f}x | consistent: {}'.format(
+            n_workers, update_pool, tasks_pool, (update_serial + tasks_serial) / max(update_pool + tasks_pool, 1e-9),
+            consistent))
+
+
+def benchmark_batch_proximity(num_cells=20000, num_required_cells=5000, resolution=11, seed=0):
+    """
+    Compare the proximity tasks of example.py (2 closeness heatmaps, 2 accessibility scores) run one by one against
+    one ProximityIndicator.batch_proximity() call
+    """
+    H3 = _make_proximity_h3_grids(num_cells, num_required_cells, resolution, seed)
+    P = _make_proximity_indicator(H3)
+    groups = [
+        {'kind': 'closeness', 'name': 'heatmap_park_proximity', 'target_classes': 5500, 'minimum_ratio_th': 0.25,
+         'power': 0.75},
+        {'kind': 'closeness', 'name': 'heatmap_third_place_proximity', 'target_classes': [2100, 2200, 2300, 7240],
+         'minimum_ratio_th': 0.25, 'power': 0.75},
+        {'kind': 'accessibility', 'name': 'park_proximity', 'target_classes': 5500, 'dist_threshold': 500/1.5},
+        {'kind': 'accessibility', 'name': 'third_place_proximity', 'target_classes': [2100, 2200, 2300, 7240],
+         'dist_threshold': 500/1.5}
+    ]
+    print(f'\nbatched proximity: {len(groups)} groups, {num_required_cells} required cells, {num_cells} h3 cells')
+    t0 = time.time()
+    separate_rst = []
+    for group in groups:
+        kwargs = {key: value for key, value in group.items() if key != 'kind'}
+        if group['kind'] == 'closeness':
+            separate_rst.append(P.closeness(**kwargs))
+        else:
+            separate_rst.append(P.return_accessibility_within_dist(population_attr='tt_pop', **kwargs))
+    t1 = time.time()
+    batch_rst = P.batch_proximity(groups)
+    t2 = time.time()
+    consistent = all(a['to_frontend'] == b['to_frontend'] for a, b in zip(separate_rst, batch_rst))
+    print('one by one {:8.4f}s | batched {:8.4f}s | speedup {:6.1f}x | consistent: {}'.format(
+        t1-t0, t2-t1, (t1-t0) / max(t2-t1, 1e-9), consistent))
+
+
+def _time_per_call(func, repeat):
+    t0 = time.time()
+    for _ in range(repeat):
+        rst = func()
+    return (time.time() - t0) / repeat, rst
+
+
+def benchmark_payload_codec(num_cells=20000, repeat=20, resolution=11, seed=0):
+    """
+    Compare mqtt payloads of the former format (json.dumps, then eval on receipt) against the json and msgpack
+    codecs, for an update message, a screen result and heatmap results in several shapes
+    """
+    rng = np.random.default_rng(seed)
+    cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 90)[:num_cells], dtype=np.uint64)
+    values = rng.random(len(cells))
+    messages = {
+        'update': {'task_tokens': ['screen_all', 'heatmaps_all'], 'msg': 'table updated', 'version': 12,
+                   'epoch': 1.7e9, 'time': '2024-01-01 00:00:00'},
+        'screen result': 'r deres 0.04938888888888889',
+        'heatmap text': 'ap: ' + ' '.join(str(round(v, 3)) for v in values.tolist()),
+        'heatmap dict': dict(zip(cells.tolist(), values.tolist())),
+        'heatmap arrays': {'name': 'heatmap', 'cells': cells, 'values': values.astype(np.float32)}
+    }
+    formats = {
+        'former': (lambda msg_data: json.dumps(msg_data, cls=NumpyEncoder).encode(),
+                   lambda payload: eval(payload.decode())),
+        'json': (get_codec('json').encode, decode_payload),
+        'msgpack': (get_codec('msgpack').encode, decode_payload)
+    }
+    print(f'\npayload codec: heatmaps of {len(cells)} cells, mean of {repeat} runs')
+    for msg_name, msg_data in messages.items():
+        for format_name, (encode, decode) in formats.items():
+            encode_time, payload = _time_per_call(lambda: encode(msg_data), repeat)
+            decode_time, decoded = _time_per_call(lambda: decode(payload), repeat)
+            if msg_name == 'heatmap arrays' and format_name == 'msgpack':
+                consistent = all(np.array_equal(decoded[key], msg_data[key]) for key in ['cells', 'values'])
+            elif msg_name == 'heatmap arrays':
+                consistent = np.allclose(decoded['values'], msg_data['values'])
+            elif msg_name == 'heatmap dict' and format_name != 'msgpack':
+                # json turns integer keys into strings
+                consistent = {int(k): v for k, v in decoded.items()} == msg_data
+            else:
+                consistent = decoded == msg_data
+            print('{:15s} {:8s} {:10d} bytes | encode {:9.4f}ms | decode {:9.4f}ms | '
+                  'decode {:8.1f}MB/s | consistent: {}'.format(
+                msg_name, format_name, len(payload), encode_time * 1000, decode_time * 1000,
+                len(payload) / max(decode_time, 1e-9) / 1e6, consistent))
+
+
+def benchmark_heatmap_delta(num_cells=20000, num_updates=20, changed_ratio=0.01, round_digits=3, resolution=11,
+                            seed=0):
+    """
+    Compare publishing an h3 heatmap as full text on each update against the delta mode (a full message once, then
+    the changed values only), in payload bytes and time from the result to the text at the receiver
+    """
+    rng = np.random.default_rng(seed)
+    cells = np.asarray(h3.k_ring(h3.geo_to_h3(22.54, 114.05, resolution), 90)[:num_cells], dtype=np.uint64)
+    values = rng.random(len(cells))
+    codec = get_codec('msgpack')
+    encoder, decoder = HeatmapDeltaEncoder('proximity', 'heatmap'), HeatmapDeltaDecoder()
+    full_bytes, delta_bytes, full_time, delta_time, consistent = [], [], 0, 0, True
+    for i in range(num_updates):
+        values = values.copy()
+        changed = rng.choice(len(cells), max(1, int(len(cells) * changed_ratio)), replace=False)
+        values[changed] = rng.random(len(changed))
+        rst = dict(zip(cells.tolist(), values.tolist()))
+
+        t0 = time.time()
+        text = 'ap: {}'.format(' '.join(str(round(d, round_digits)) for d in rst.values()))
+        full_payload = codec.encode(text)
+        received_text = decode_payload(full_payload)
+        full_time += time.time() - t0
+        full_bytes.append(len(full_payload))
+
+        t0 = time.time()
+        keys = np.fromiter(rst.keys(), dtype=np.uint64, count=len(rst))
+        frame = HeatmapFrame(None, keys, list(rst.values()), 'ap: {}', round_digits)
+        delta_payload = codec.encode(encoder.encode(frame))
+        decoder.apply(decode_payload(delta_payload))
+        delta_text = decoder.to_text()
+        delta_time += time.time() - t0
+        delta_bytes.append(len(delta_payload))
+        consistent = consistent and delta_text == received_text
+    print(f'\nheatmap delta: {len(cells)} cells, {num_updates} updates changing {changed_ratio:.1%} of cells each')
+    print('full text  | first {:9d} bytes | later mean {:9.0f} bytes | mean {:8.2f}ms per update'.format(
+        full_bytes[0], np.mean(full_bytes[1:]), full_time / num_updates * 1000))
+    print('delta mode | first {:9d} bytes | later mean {:9.0f} bytes | mean {:8.2f}ms per update | '
+          'consistent: {}'.format(delta_bytes[0], np.mean(delta_bytes[1:]), delta_time / num_updates * 1000,
+                                  consistent))
+
+
+def make_synthetic_replay(num_grids, num_events=40, interval=0.2, max_changed_grids=3, slider_every=5, seed=0):
+    """
+    Events of a table session in the format of loopback.load_replay(): layouts of zone "1" changing 1 ~
+    max_changed_grids grids each, and a density slider moved every slider_every events
+    """
+    rng = random.Random(seed)
+    codes = [-1, 1, 2, 3]
+    layout = [rng.choice(codes) for _ in range(num_grids)]
+    events = []
+    for idx in range(num_events):
+        if slider_every and idx % slider_every == slider_every - 1:
+            events.append({'t': idx * interval, 'channel': 'tablet', 'data': f'/slider 1 {rng.randint(0, 100)}'})
+            continue
+        for _ in range(rng.randint(1, max_changed_grids)):
+            layout[rng.randrange(num_grids)] = rng.choice(codes)
+        events.append({'t': idx * interval, 'channel': 'table', 'data': 'i1 ' + ' '.join(str(c) for c in layout)})
+    return events
+
+
+def benchmark_loopback_replay(replay_path=None, num_base_features=20000, num_grids=400, num_required_cells=2000,
+                              coalesce_window=0.02, speed=1.0, resolution=11, seed=0):
+    """
+    Replay table and tablet events into an AsyncHandler over the in-process mqtt broker and udp network, and report
+    the latency from each event to each indicator result, in closed pace and at the recorded pace
+    :param replay_path: events recorded by udp_mqtt_utils/udp_recorder.py, synthetic ones if not given
+    """
+    T = _make_table_grids(num_base_features, num_grids, resolution, seed)
+    H3 = T.H3
+    T.update('i1 ' + ' '.join(['-1'] * num_grids))
+    all_cells = list(H3.h3_stats.keys())
+    required_cells = all_cells[:num_required_cells]
+    H3.dist_lookup = H3DistLookup(resolution, required_cells, all_cells)
+    Density = DensityIndicator(H3, base_area=T.spec['parcel_area'] * num_grids)
+    Density.set_scheduled_tasks(('screen_all', 'r deem {}', partial(Density.return_job_density), ['h3_stats']))
+    Diversity = DiversityIndicator(H3)
+    Diversity.set_scheduled_tasks(('screen_all', 'r dilu {}',
+                                   partial(Diversity.return_usage_diversity, name='land_use_diversity',
+                                           target_classes=['1100', '2000', '2400', '5500']), ['h3_stats']))
+    Prox = ProximityIndicator(H3, name='proximity')
+    Prox.set_scheduled_tasks(('heatmaps_all', 'ap: {}',
+                              partial(Prox.closeness, name='heatmap_park_proximity', target_classes=5500,
+                                      required_cells=required_cells, power=0.75), ['h3_stats']))
+    events = load_replay(replay_path) if replay_path else make_synthetic_replay(num_grids, seed=seed)
+    broker, network = LoopbackBroker(), LoopbackNetwork()
+    handler = AsyncHandler(mqtt_broker=broker, udp_network=network, coalesce_window=coalesce_window)
+    handler.tablet_spec = {'sliders': {'1': {'function': 'change density', 'land_type_code': 1}}, 'buttons': {}}
+    handler.add_table(T)
+    handler.add_indicators(Density, Diversity, Prox)
+    thread = threading.Thread(target=handler.run, name='loopback_handler')
+    thread.start()
+    while handler.sender is None:
+        time.sleep(0.01)
+    table_addr = ('127.0.0.1', handler.udp_receiver['table']['port'])
+    tablet_addr = ('127.0.0.1', handler.udp_receiver['tablet']['port'])
+    print(f'\nloopback replay: {len(events)} events, {num_grids} interactive grids, {len(all_cells)} h3 cells, '
+          f'{num_required_cells} heatmap cells')
+    try:
+        for pace in ['closed', 'recorded']:
+            latency, num_events_without_results = replay(events, network, broker, table_addr, tablet_addr,
+                                                         handler.mqtt.topics['results'], pace=pace, speed=speed)
+            print(f'{pace} pace: {num_events_without_results} events without results, '
+                  f'{handler.num_superseded} flushes superseded so far')
+            for name, histogram in sorted(latency.items()):
+                summary = histogram.summary()
+                print('  {:45s} n={:4d} | p50 {:8.4f}s | p95 {:8.4f}s | p99 {:8.4f}s | max {:8.4f}s'.format(
+                    name, summary['count'], summary['p50'], summary['p95'], summary['p99'], summary['max']))
+    finally:
+        handler.stop()
+        thread.join()
+
+
+def make_synthetic_population_geojson(save_to, num_persons, crs=4547, center=(22.54, 114.05), span_deg=0.1, seed=0):
+    """
+    Persons of the base simulation population (see Population.set_base_sim_population) as points in crs with
+    individual label data
+    """
+    rng = np.random.default_rng(seed)
+    lat = center[0] + (rng.random(num_persons) - 0.5) * span_deg
+    lon = center[1] + (rng.random(num_persons) - 0.5) * span_deg
+    y, x = Transformer.from_crs(4326, crs).transform(lat, lon)
+    sex, trade, edu = rng.integers(1, 3, num_persons), rng.integers(1, 10, num_persons), rng.integers(0, 10, num_persons)
+    birth_year = rng.integers(1940, 2020, num_persons)
+    features = [
+        {'type': 'Feature',
+         'properties': {'SEX': int(sex[i]), 'TRADEID': int(trade[i]), 'EDULEVELID': int(edu[i]),
+                        'BIRTHDAY': f'{birth_year[i]}/01/01'},
+         'geometry': {'type': 'MultiPoint', 'coordinates': [[float(x[i]), float(y[i])]]}}
+        for i in range(num_persons)
+    ]
+    json.dump({'type': 'FeatureCollection', 'crs': {'type': 'name', 'properties': {'name': crs_lookup_code_to_name[crs]}},
+               'features': features}, open(save_to, 'w', encoding='utf-8'))
+
+
+def _make_population(base_sim_pop_geojson_path, resolution, center=(22.54, 114.05), sim_area_k=60):
+    """
+    Population without reading person_attr_spec, bounds or the home workplace assigner from the city folder
+    """
+    Pop = Population.__new__(Population)
+    Pop.table, Pop.work_dir, Pop.resolution = 'shenzhen', './cities/shenzhen', resolution
+    Pop.person_attr_spec = {
+        'income': [{'value': 'low', 'p': 0.3}, {'value': 'medium', 'p': 0.5}, {'value': 'high', 'p': 0.2}],
+        'hh_size': [{'value': 1, 'p': 0.3}, {'value': 3, 'p': 0.7}],
+        'num_all_vehicles': [{'value': 0, 'p': 0.6}, {'value': 1, 'p': 0.4}],
+        'register_in_sz': True
+    }
+    Pop.base_sim_pop_geojson_path, Pop.base_floating_pop_json_path = base_sim_pop_geojson_path, None
+    Pop.base_sim_pop, Pop.base_floating_pop, Pop.sim_pop, Pop.person_store = [], [], [], None
+    Pop.h3_count_base_sim_pop, Pop.h3_count_sim_pop = {}, {}
+    Pop.home_workplace_assigner = None
+    location_setter = LocationSetter.__new__(LocationSetter)
+    location_setter.h3_cells_in = {resolution: h3.k_ring(h3.geo_to_h3(*center, resolution), sim_area_k).tolist(),
+                                   resolution - 3: []}
+    location_setter.resolution_in, location_setter.resolution_out = resolution, resolution - 3
+    location_setter.set_tn(None, 5)
+    Pop.location_setter = location_setter
+    return Pop
+
+
+def _set_base_sim_population_by_object(Pop):
+    # the former set_base_sim_population(): one Person with dicts of attributes and locations per feature
+    features, src_crs = load_geojsons(Pop.base_sim_pop_geojson_path)
+    transformer = Transformer.from_crs(src_crs, 4326) if src_crs != 4326 else None
+    random_persons_pool = Pop.generate_random_persons_pool(len(features))
+    for idx, fea in enumerate(features):
+        person_attrs = random_persons_pool[idx]
+        person_attrs.update(Pop.parse_person_attrs_from_individual_label_data(fea['properties']))
+        person = Person(f'b{idx}')
+        person.set_person_attrs(person_attrs)
+        coord = fea['geometry']['coordinates'][0]
+        if transformer:
+            new_coord = transformer.transform(coord[1], coord[0])
+            coord[0], coord[1] = new_coord[1], new_coord[0]
+        person.set_location(Pop.location_setter, coord=coord, resolution=Pop.resolution, location_type='home')
+        Pop.base_sim_pop.append(person)
+        Pop.sim_pop.append(person)
+    Pop.h3_count_base_sim_pop['home'] = {
+        Pop.resolution: Pop.count_population_on_h3(Pop.base_sim_pop, Pop.resolution, 'home')
+    }
+
+
+def benchmark_population_store(num_persons=50000, resolution=11, seed=0):
+    """
+    Compare setting the base simulation population as one Person object per person against the PersonStore
+    with Person views, in time, memory per person and counting persons on h3 cells
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        geojson_path = os.path.join(tmp_dir, 'base_pop.geojson')
+        make_synthetic_population_geojson(geojson_path, num_persons, seed=seed)
+        print(f'\npopulation store: {num_persons} persons in epsg 4547, located at resolution {resolution}')
+        counts = {}
+        for name, set_population in [('objects', _set_base_sim_population_by_object),
+                                     ('store', Population.set_base_sim_population)]:
+            Pop = _make_population(geojson_path, resolution)
+            np.random.seed(seed)
+            t0 = time.time()
+            set_population(Pop)
+            t1 = time.time()
+            counts[name] = Pop.count_population_on_h3(Pop.base_sim_pop, resolution, self_update=False)
+            t2 = time.time()
+            del Pop
+            Pop = _make_population(geojson_path, resolution)
+            tracemalloc.start()
+            set_population(Pop)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            line = '{:8s} set {:8.3f}s | count on h3 {:8.4f}s | {:6.0f} bytes per person, peak {:6.0f}'.format(
+                name, t1 - t0, t2 - t1, current / num_persons, peak / num_persons)
+            if Pop.person_store is not None:
+                store_bytes = sum(column['values'].nbytes for column in Pop.person_store.attr_columns.values()) + \
+                              Pop.person_store.idx.nbytes + \
+                              sum(locations[key].nbytes + sum(cells.nbytes for cells in locations['h3'].values())
+                                  for locations in Pop.person_store.locations.values()
+                                  for key in ['lon', 'lat', 'in_sim_area'])
+                line += ' | columns {:4.0f} bytes per person'.format(store_bytes / num_persons)
+            print(line)
+            del Pop
+        print('consistent:', counts['objects'] == counts['store'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _h3_stats_close(h3_stats_a, h3_stats_b, rtol=1e-6):
+    if set(h3_stats_a.keys()) != set(h3_stats_b.keys()):
+        return False
+    for cell, attrs in h3_stats_a.items():
+        for attr, value in attrs.items():
+            other = h3_stats_b[cell][attr]
+            if isinstance(value, dict):
+                if not _nested_close(value, other, rtol):
+                    return False
+            elif not np.isclose(value, other, rtol=rtol, equal_nan=True):
+                return False
+    return True
+
+
+def _nested_close(a, b, rtol=1e-6):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and set(a.keys()) == set(b.keys()) \
+               and all(_nested_close(a[k], b[k], rtol) for k in a)
+    return bool(np.isclose(a, b, rtol=rtol, equal_nan=True))
+
+
+benchmarks = {
+    'aggregate': benchmark_aggregate_attrs_to_cells,
+    'convert_crs': benchmark_convert_crs,
+    'link_polygons': benchmark_link_polygons_to_h3,
+    'link_parallel': benchmark_link_to_h3_in_process_pool,
+    'h3_cache': benchmark_h3_stats_cache,
+    'snapshot': benchmark_snapshot,
+    'h3_export': benchmark_h3_export,
+    'dist_lookup': benchmark_dist_lookup,
+    'nearest_targets': benchmark_nearest_targets,
+    'incremental_proximity': benchmark_incremental_proximity,
+    'kde': benchmark_kde,
+    'kring_kernel': benchmark_kring_kernel,
+    'batch_proximity': benchmark_batch_proximity,
+    'target_cells': benchmark_target_cells,
+    'table_update': benchmark_table_update,
+    'indicator_pool': benchmark_indicator_pool,
+    'payload_codec': benchmark_payload_codec,
+    'heatmap_delta': benchmark_heatmap_delta,
+    'loopback_replay': benchmark_loopback_replay,
+    'population_store': benchmark_population_store,
+}
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
@@ -4,7 +4,7 @@ import numpy as np
 from grids_toolbox import H3Grids
 from indicator_toolbox import Indicator
 from itertools import product
-from utils import num_neighbours_in_digraph, get_first_n_digits
+from utils import num_neighbours_in_digraph
 
 class DensityIndicator(Indicator):
     def __init__(self, H3, name='density', Table=None, base_area=None):
@@ -31,8 +31,7 @@ class DensityIndicator(Indicator):
 
 
     def return_resident_density(self, name='resident_density'):
-        Pop, Housing = self.H3.Pop, self.H3.Housing
-        num_residents = len(Pop.base_sim_pop) + Housing.get_tt_capacity('new')
+        num_residents = self.get_num_residents()
         density_raw = num_residents / self.base_area
         density_norm = density_raw
         return {
@@ -44,9 +43,7 @@ class DensityIndicator(Indicator):
 
 
     def return_job_density(self, name='job_density', usage_name='usage'):
-        num_jobs = 0
-        for h3_cell, h3_attrs in self.H3.h3_stats.items():
-            num_jobs += sum(h3_attrs[usage_name].get('NAICS', {}).get('pop', {}).values())
+        num_jobs = self.get_num_jobs(usage_name)
         density_raw = num_jobs / self.base_area
         density_norm = density_raw
         return {
@@ -62,14 +59,10 @@ class DensityIndicator(Indicator):
                              usage_name='usage', first_n_digits=None):
         if item_name == 'count':
             assert unit_area > 0
-        target_classes = [str(code) for code in target_classes]
-        tt_area, tt_pop = 0, 0
-        for h3_cell, h3_attrs in self.H3.h3_stats.items():
-            decomposition = h3_attrs.get(usage_name, {}).get(attr_name, {})
-            tt_area += sum([area for code, area in decomposition.get('area', {}).items()
-                            if get_first_n_digits(code, first_n_digits) in target_classes])
-            tt_pop += sum([area for code, area in decomposition.get('pop', {}).items()
-                           if get_first_n_digits(code, first_n_digits) in target_classes])
+        target_classes = list(set([str(code) for code in target_classes]))
+        usage = self.H3.get_usage(usage_name)
+        tt_area = sum(usage.class_totals(attr_name, 'area', target_classes, first_n_digits).values())
+        tt_pop = sum(usage.class_totals(attr_name, 'pop', target_classes, first_n_digits).values())
         if item_name == 'area':
             tt = tt_area
         elif item_name == 'count':
@@ -4,7 +4,6 @@ import numpy as np
 from collections import Counter
 from grids_toolbox import H3Grids
 from indicator_toolbox import Indicator
-from itertools import product
 
 
 class DiversityIndicator(Indicator):
@@ -118,11 +117,8 @@ class DiversityIndicator(Indicator):
 
 
     def return_residential_job_ratio(self, name='residential_job_ratio', usage_name='usage'):
-        Pop, Housing = self.H3.Pop, self.H3.Housing
-        num_residents = len(Pop.base_sim_pop) + Housing.get_tt_capacity('new')
-        num_jobs = 0
-        for h3_cell, h3_attrs in self.H3.h3_stats.items():
-            num_jobs += sum(h3_attrs[usage_name].get('NAICS', {}).get('pop', {}).values())
+        num_residents = self.get_num_residents()
+        num_jobs = self.get_num_jobs(usage_name)
         ratio_raw = num_residents / num_jobs
         ratio_norm = 2 * min(num_residents, num_jobs) / (num_residents + num_jobs)
         return {
@@ -137,14 +133,7 @@ class DiversityIndicator(Indicator):
         if type(target_classes) != list:
             raise TypeError(f'target_classes must be a list: {target_classes}')
         target_classes = [str(class_name) for class_name in target_classes]
-        class_stats = {class_name: 0 for class_name in target_classes}
-        for h3_cell, class_name in product(self.H3.h3_stats, target_classes):
-            decomposition = self.H3.h3_stats[h3_cell].get(usage_name, {}).get(attr_name, {}).get(item_name, {})
-            if not first_n_digits:
-                class_stats[class_name] += decomposition.get(str(class_name), 0)
-            else:
-                class_stats[class_name] += sum([value for code, value in decomposition.items()
-                                                if str(code)[:first_n_digits] in target_classes])
+        class_stats = self.H3.get_usage(usage_name).class_totals(attr_name, item_name, target_classes, first_n_digits)
         rst = self._calc_diversity(list(class_stats.values()), 'e')
         return {'name': name,
                 'composition': class_stats,
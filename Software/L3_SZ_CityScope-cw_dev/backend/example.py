@@ -15,11 +15,24 @@ table = 'shenzhen'
 
 
 precooked_fpath = f'cities/{table}/clean/precooked_data.p'
+snapshot_dir = f'cities/{table}/clean/snapshot'
+save_snapshots = False   # set to True to write precooked data (built or loaded from pickle) to snapshot_dir
+h3_cache_dir = f'cities/{table}/cache'
 precooked_existence = False
-if os.path.exists(precooked_fpath):
+snapshot_existence = os.path.exists(os.path.join(snapshot_dir, 'H3', 'meta.json'))
+if snapshot_existence:
+    precooked_existence = True
+    Buildings = PolygonGeoData.load_snapshot(os.path.join(snapshot_dir, 'buildings'))
+    H3 = H3Grids.load_snapshot(os.path.join(snapshot_dir, 'H3'))   # with population and housing units
+    T = TableGrids.load_snapshot(os.path.join(snapshot_dir, 'table'), H3=H3)
+    network = pickle.load(open('cities/shenzhen/clean/sim_network.p', 'rb'))
+    print(f"\nPrecooked snapshots loaded from {snapshot_dir}\n")
+elif os.path.exists(precooked_fpath):
     precooked_data = pickle.load(open(precooked_fpath, 'rb'))
     precooked_existence = True
+    POIs = precooked_data['POIs']
     Buildings = precooked_data['Buildings']
+    LU = precooked_data['LU']
     T = precooked_data['Table']
     H3 = precooked_data['H3']
     network = precooked_data['network']
@@ -30,19 +43,19 @@ else:
                         src_geojson_path='0323/poi_outside_final.geojson')
     POIs.make_h3_stats(resolution=resolution, agg_attrs={
         'usage': 'decompose'
-    })
+    }, cache_dir=h3_cache_dir)
 
     Buildings = PolygonGeoData(name='buildings',
                                src_geojson_path='0323/building_final.geojson')
     Buildings.make_h3_stats(resolution, agg_attrs={
         'usage': 'decompose'
-    })
+    }, cache_dir=h3_cache_dir)
 
     LU = PolygonGeoData(name='landuse',
                         src_geojson_path='0323/land_final.geojson')
     LU.make_h3_stats(resolution, agg_attrs={
         'usage': 'decompose'
-    })
+    }, cache_dir=h3_cache_dir)
     print('Data loaded\n')
 
     # load population
@@ -63,7 +76,10 @@ else:
     h3_stats = H3.combine_h3_stats([Buildings.h3_stats[resolution],
                                     POIs.h3_stats[resolution],
                                     LU.h3_stats[resolution],
-                                    pop_stats])
+                                    pop_stats],
+                                   h3_usage_list=[Buildings.h3_usage[resolution],
+                                                  POIs.h3_usage[resolution],
+                                                  LU.h3_usage[resolution]])
     H3.set_current_h3_stats_as_base()
     H3.Housing.set_housing_type_def('housing_type_def.json')
     H3.Housing.set_base_housing_units_from_buildings(Buildings)
@@ -128,6 +144,11 @@ if not precooked_existence:
     }
     pickle.dump(precooked_data, open(precooked_fpath, 'wb'))
 
+if save_snapshots and not snapshot_existence:
+    # H3 is saved last as its existence marks complete snapshots
+    for name, obj in [('pois', POIs), ('buildings', Buildings), ('landuse', LU), ('table', T), ('H3', H3)]:
+        obj.save_snapshot(os.path.join(snapshot_dir, name))
+
 
 ProxHeatmap.set_scheduled_tasks(
     (
@@ -138,7 +159,9 @@ ProxHeatmap.set_scheduled_tasks(
                 target_classes=5500,
                 minimum_ratio_th=0.25,
                 Table_to_map=T,
-                power=0.75)
+                power=0.75,
+                incremental=True),
+        ['h3_stats']
     ),
     (
         [['heatmap_third_place_proximity'], ['heatmaps_all']],
@@ -148,30 +171,32 @@ ProxHeatmap.set_scheduled_tasks(
                 target_classes=[2100, 2200, 2300, 7240],
                 minimum_ratio_th=0.25,
                 Table_to_map=T,
-                power=0.75)
+                power=0.75,
+                incremental=True),
+        ['h3_stats']
     )
 )
 
 Prox.set_scheduled_tasks(
     (
         'screen_all',
-        'r pap {}',
-        partial(Prox.return_accessibility_within_dist,
-                name='park_proximity',
-                population_attr='tt_pop',
-                target_classes=5500,
-                kth=1,
-                dist_threshold=500/1.5)
-    ),
-    (
-        'screen_all',
-        'r pa3p {}',
-        partial(Prox.return_accessibility_within_dist,
-                name='third_place_proximity',
-                population_attr='tt_pop',
-                target_classes=[2100, 2200, 2300, 7240],
-                kth=1,
-                dist_threshold=500/1.5)
+        {'park_proximity': 'r pap {}', 'third_place_proximity': 'r pa3p {}'},
+        partial(Prox.batch_proximity,
+                groups=[
+                    {'kind': 'accessibility',
+                     'name': 'park_proximity',
+                     'population_attr': 'tt_pop',
+                     'target_classes': 5500,
+                     'kth': 1,
+                     'dist_threshold': 500/1.5},
+                    {'kind': 'accessibility',
+                     'name': 'third_place_proximity',
+                     'population_attr': 'tt_pop',
+                     'target_classes': [2100, 2200, 2300, 7240],
+                     'kth': 1,
+                     'dist_threshold': 500/1.5}
+                ]),
+        ['h3_stats']
     )
 )
 
@@ -181,22 +206,26 @@ Diversity.set_scheduled_tasks(
         'r di3p {}',
         partial(Diversity.return_lbcs_area_diversity,
                 name='third_place_diversity',
-                target_lbcs_codes='third_places')
+                target_lbcs_codes='third_places'),
+        ['h3_stats']
     ),
     (
         'screen_all',
         'r dir {}',
-        partial(Diversity.return_residential_diversity)
+        partial(Diversity.return_residential_diversity),
+        ['h3_stats']
     ),
     (
         'screen_all',
         'r dij {}',
-        partial(Diversity.return_job_diversity)
+        partial(Diversity.return_job_diversity),
+        ['h3_stats']
     ),
     (
         'screen_all',
         'r dirjr {}',
-        partial(Diversity.return_residential_job_ratio)
+        partial(Diversity.return_residential_job_ratio),
+        ['h3_stats', 'housing']
     )
 )
 
@@ -204,25 +233,29 @@ Density.set_scheduled_tasks(
     (
         'screen_all',
         'r deres {}',
-        partial(Density.return_resident_density)
+        partial(Density.return_resident_density),
+        ['housing']
     ),
     (
         'screen_all',
         'r deem {}',
-        partial(Density.return_job_density)
+        partial(Density.return_job_density),
+        ['h3_stats']
     ),
     (
         'screen_all',
         'r de3pd {}',
         partial(Density.return_lbcs_density,
                 name='third_place_density',
-                target_lbcs_codes='third_places')
+                target_lbcs_codes='third_places'),
+        ['h3_stats']
     ),
     (
         'screen_all',
         'r pid {}',
         partial(Density.return_intersection_density,
-                road_network=network)
+                road_network=network),
+        []   # the road network does not change
     )
 )
 
@@ -231,7 +264,8 @@ BE.set_scheduled_tasks(
         'screen_all',
         'r ipbe {}',
         partial(BE.return_energy_pperson,
-                name='building_energy')
+                name='building_energy'),
+        ['h3_stats', 'housing']
     )
 )
 
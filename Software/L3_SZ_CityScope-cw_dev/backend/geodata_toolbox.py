@@ -2,14 +2,24 @@ import h3.api.numpy_int as h3
 import os, json, copy, re, random
 import matplotlib.pyplot as plt
 from pyproj import Transformer, CRS
-from shapely.geometry import Point, LineString, MultiLineString, shape
+import shapely
+from shapely.geometry import Point, LineString, MultiLineString, shape, mapping
 from shapely.geometry.polygon import Polygon
 import numpy as np
+from scipy import sparse
 from collections import Counter
-from functools import reduce
+from functools import reduce, partial
 from numpyencoder import NumpyEncoder
 from utils import *
 from typing import Union, Optional, Dict, List
+# bump it when linking or aggregation changes so that results cached by older code are not reused
+H3_CACHE_VERSION = 1
+# below these numbers of features per worker, starting processes and pickling results costs more than linking itself
+MIN_POLYGONS_PER_WORKER = 10000
+MIN_POINTS_PER_WORKER = 500000
+# upper bound of the length of 1 degree of latitude (111.7km at the poles), 1 degree of longitude is shorter
+MAX_METERS_PER_DEGREE = 111700
+
 try:
     import geopandas as gpd
     import h3pandas
@@ -44,6 +54,11 @@ class GeoData:
                 keys are h3 cell index
                 values are aggregating results on corresponding h3 cell.
                 see help on return of aggregate_attrs_to_cells() method for more information on how these results are organized
+        h3_usage: Dict[int, Dict[str, UsageDecomposition]]: sparse form of decomposed attributes in h3_stats,
+            keys are h3 resolutions, keys of inner dict are aggregated attribute names (e.g. "[buildings]_usage_(decompose)")
+        h3_boundaries: H3BoundaryCache: boundaries of h3 cells exported by export_h3_features(), of any resolution
+        src_fingerprint: str: sha1 of the bytes of source geojson file, identifies cached h3 results of this GeoData,
+            see make_h3_stats()
         transformer: Dict[int, Dict[int, 'Transformer_object']]: lookup for Transformer objects to convert CRS,
             keys of outer dict are epsg codes of from_CRS, and keys of inner dict are epsg codes of to_CRS.
             Note that the inclusion of Transformer objects will make the whole instance unpicklable. To pickle the
@@ -72,6 +87,9 @@ class GeoData:
         self.shapely_objects = {}
         self.map_to_h3_cells = {}
         self.h3_stats = {}
+        self.h3_usage = {}
+        self.h3_boundaries = H3BoundaryCache()
+        self.src_fingerprint = None
         if src_geojson_path:
             self.load_data(to_4326=True, to_shapely=True)
         self.set_default_decompose_spec()
@@ -85,6 +103,8 @@ class GeoData:
         """
         geojson_path = self.src_geojson_path
         features, src_crs = load_geojsons(geojson_path)
+        if os.path.exists(geojson_path):
+            self.src_fingerprint = fingerprint_file(geojson_path)
         self.crs['src'] = src_crs
         self.features[self.crs['src']] = features
         if CRS(self.crs['src']).is_projected and self.crs['projected'] is None:
@@ -140,6 +160,43 @@ class GeoData:
             self.shapely_objects[crs] = shapely_objects
         return shapely_objects
 
+    def _get_transformer(self, to_crs: int, from_crs: int) -> 'Transformer_object':
+        """
+        Get the cached Transformer object to convert from "from_crs" to "to_crs"
+        """
+        if not from_crs in self.transformer or to_crs not in self.transformer[from_crs]:
+            transformer = Transformer.from_crs(from_crs, to_crs)
+            self.transformer.setdefault(from_crs, {})[to_crs] = transformer
+        else:
+            transformer = self.transformer[from_crs][to_crs]
+        return transformer
+
+    def _convert_crs_bulk(self, features: List[dict], to_crs: int, from_crs: int) -> List[dict]:
+        """
+        Convert the CRS of many features with a single vectorized pyproj call over all their vertices
+        :param features: raw features from the features of geojson file, they are not modified
+        :param to_crs: epsg code of the new CRS to which the raw features will be converted
+        :param from_crs: epsg code of current CRS of raw features
+        :return: new features with geometry converted to "to_crs" from "from_crs". Other members of each feature
+            (eg, "properties") are shallow copies, i.e., nested values are shared with the raw features.
+        """
+        transformer = self._get_transformer(to_crs, from_crs)
+
+        def transform_func(xs, ys):
+            # keep the same axis order as Transformer.from_crs(from_crs, to_crs).transform(coord[1], coord[0])
+            new_ys, new_xs = transformer.transform(ys, xs)
+            return new_xs, new_ys
+
+        new_geometries = transform_geojson_geometries([fea.get('geometry', None) for fea in features],
+                                                      transform_func)
+        new_features = []
+        with gc_paused():
+            for fea, new_geometry in zip(features, new_geometries):
+                new_fea = {k: (dict(v) if isinstance(v, dict) else v) for k, v in fea.items() if k != 'geometry'}
+                new_fea['geometry'] = new_geometry
+                new_features.append(new_fea)
+        return new_features
+
     def _convert_crs(self, feature: dict, to_crs: int, from_crs: int, in_place: bool=True) -> dict:
         """
         Convert the CRS of a feature
@@ -150,41 +207,10 @@ class GeoData:
             happen on its copy.
         :return: the same feature with geometry converted to "to_crs" from "from_crs"
         """
-        if not from_crs in self.transformer or to_crs not in self.transformer[from_crs]:
-            transformer = Transformer.from_crs(from_crs, to_crs)
-            self.transformer.setdefault(from_crs, {})[to_crs] = transformer
-        else:
-            transformer = self.transformer[from_crs][to_crs]
+        new_feature = self._convert_crs_bulk([feature], to_crs, from_crs)[0]
         if not in_place:
-            feature = copy.deepcopy(feature)
-        if feature['geometry']['type'] == 'MultiPolygon':
-            for polygon in feature['geometry']['coordinates']:
-                for line in polygon:
-                    for coord in line:
-                        new_coord = transformer.transform(coord[1], coord[0])
-                        coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif feature['geometry']['type'] == 'Polygon':
-            for line in feature['geometry']['coordinates']:
-                for coord in line:
-                    new_coord = transformer.transform(coord[1], coord[0])
-                    coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif feature['geometry']['type'] == 'Point':
-            coord = feature['geometry']['coordinates']
-            new_coord = transformer.transform(coord[1], coord[0])
-            coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif feature['geometry']['type'] == 'MultiPoint':
-            for coord in feature['geometry']['coordinates']:
-                new_coord = transformer.transform(coord[1], coord[0])
-                coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif feature['geometry']['type'] == 'MultiLineString':
-            for line in feature['geometry']['coordinates']:
-                for coord in line:
-                    new_coord = transformer.transform(coord[1], coord[0])
-                    coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif feature['geometry']['type'] == 'LineString':
-            for coord in feature['geometry']['coordinates']:
-                new_coord = transformer.transform(coord[1], coord[0])
-                coord[0], coord[1] = new_coord[1], new_coord[0]
+            return new_feature
+        feature['geometry'] = new_feature['geometry']
         return feature
 
     def convert_crs_for_features(self, to_crs: int, from_crs: Optional[int]=None,
@@ -198,9 +224,7 @@ class GeoData:
         """
         if not from_crs:
             from_crs = self.crs['src']
-        features = copy.deepcopy(self.features[from_crs])
-        for fea in features:
-            self._convert_crs(fea, to_crs, from_crs)
+        features = self._convert_crs_bulk(self.features[from_crs], to_crs, from_crs)
         if save_to:
             name = os.path.basename(save_to).split('.')[0]
             geojson_content_to_save = {
@@ -305,9 +329,10 @@ class GeoData:
             else:
                 self.decompose_spec_default.update(decompose_spec_default)
 
-    def aggregate_attrs_to_cells(self, cells_to_map: List[dict], features: List[dict],
+    def aggregate_attrs_to_cells(self, cells_to_map: List[Union[int, dict]], features: List[dict],
                                  agg_attrs: Dict[str, str]={}, agg_attr_names: Optional[List[str]]=None,
-                                 use_weight: bool=True, decompose_spec_update: Optional[dict]=None) -> Dict[int, dict]:
+                                 use_weight: bool=True, decompose_spec_update: Optional[dict]=None,
+                                 engine: str='columnar', as_dict: bool=True) -> Union[Dict[int, dict], dict]:
         """
         Aggregate attributes of this GeoData to cells-system, generally to H3 cells
         :param cells_to_map: it defines which cells should a feature be mapped to using a dict. The keys of the dict
@@ -316,7 +341,8 @@ class GeoData:
             "weight_in_raw_data" shows the ratio of intersection part to raw geometry;
             the key of "weight_in_new_data" shows the ratio of intersection part to cell.
             For PointGeoData, "weight_in_raw_data" is always 1 as to the cell which contains the point.
-            These mapping-dict are kept in a list with the same order as param features
+            These mapping-dict are kept in a list with the same order as param features.
+            A single cell idx instead of dict is also accepted (e.g. linking by centroid), its weight is 1.
         :param features: list of features get from geojson file, it has the same order with params cells_to_map
         :param agg_attrs: defines which attributes of features should be aggregated to cells using what methods. Keys
             are attribute names, and values are corresponding aggregation methods. Following methods are supported:
@@ -336,6 +362,16 @@ class GeoData:
         :param decompose_spec_update: if aggregation method is "decompose" for some attribute, the code requires some
             decompose specifications. There is already a set of predefined specifications, and user could update
             them through this dict. For more information regarding decompose specifications, see set_default_decompose_spec
+        :param engine: "columnar" (default) flattens the feature-cell links into numpy arrays and aggregates them
+            with vectorized group-by operations; "python" is the original implementation based on per-cell lists,
+            kept for reference and benchmarking.
+        :param as_dict: if set to True, return the dict view described below; if set to False, return the columnar
+            results of the "columnar" engine: a dict with key "cells" (uint64 array of cell index in the order of
+            first appearance) and key "attrs" (dict of aggregated attribute name -> values with the same order as
+            "cells", numpy arrays for count, sum, min, max, mean, lists for list, and UsageDecomposition for
+            decompose). Cells without any valid value get NaN for min, max and mean.
+            Note that when floors are assigned in decomposition, the "columnar" engine samples floor assignments
+            once for each feature, while the "python" engine samples them for each feature-cell link.
         :return: a dict storing aggregated values for each cell. Keys are cell index, and values are inner dict with
             keys being aggregated attribute name and values being aggregated attribute value.
             For instance, for methods other than "decompose", the returned dict might look like:
@@ -379,9 +415,56 @@ class GeoData:
         if agg_attr_names is None:
             agg_attr_names = [f'[{self.name}]_{attr}_({agg_method})' for attr, agg_method in agg_attrs.items()]
         assert len(agg_attr_names) == len(agg_attrs)
+        if engine == 'python':
+            return self._aggregate_attrs_to_cells_python(cells_to_map, features, agg_attrs, agg_attr_names,
+                                                         use_weight, decompose_spec)
+        elif engine != 'columnar':
+            raise ValueError(f'Unrecognised engine "{engine}"')
+
+        feature_idx, link_cells, link_weights = flatten_cells_to_map(cells_to_map)
+        cells, link_cell_pos = unique_in_order(link_cells)
+        num_cells = len(cells)
+        h3_stats_columnar = {'cells': cells, 'attrs': {}}
+        for attr, agg_save_name in zip(agg_attrs, agg_attr_names):
+            agg_method = agg_attrs[attr]
+            raw_values = [fea['properties'].get(attr, None) for fea in features]
+            if agg_method == 'list':
+                rst = [[] for _ in range(num_cells)]
+                for fea_idx, cell_pos in zip(feature_idx.tolist(), link_cell_pos.tolist()):
+                    rst[cell_pos].append(raw_values[fea_idx])
+            elif agg_method == 'count':
+                if not use_weight:
+                    rst = np.bincount(link_cell_pos, minlength=num_cells).astype(np.float64)
+                else:
+                    rst = np.bincount(link_cell_pos, weights=link_weights, minlength=num_cells)
+            elif agg_method in ['sum', 'mean', 'min', 'max']:
+                # invalid values are NaN and ignored by group_reduce
+                values = np.array([parse_num(v) for v in raw_values], dtype=np.float64)
+                link_values = values[feature_idx]
+                if use_weight:
+                    link_values = link_values * link_weights
+                rst = group_reduce(link_cell_pos, link_values, num_cells, agg_method)
+            elif agg_method == 'decompose':
+                rst = UsageDecomposition.from_features(cells, link_cell_pos, feature_idx, link_weights,
+                                                       raw_values, decompose_spec)
+            else:
+                raise ValueError(f'Unrecognised agg_method "{agg_method}" for {attr}')
+            h3_stats_columnar['attrs'][agg_save_name] = rst
+        if as_dict:
+            return columnar_h3_stats_to_dict(h3_stats_columnar)
+        return h3_stats_columnar
+
+    def _aggregate_attrs_to_cells_python(self, cells_to_map: List[Union[int, dict]], features: List[dict],
+                                         agg_attrs: Dict[str, str], agg_attr_names: List[str],
+                                         use_weight: bool, decompose_spec: dict) -> Dict[int, dict]:
+        """
+        The original per-cell implementation of aggregate_attrs_to_cells(), see it for params and return
+        """
         h3_stats = {}
         weights = {}
         for cells_info, fea in zip(cells_to_map, features):
+            if not isinstance(cells_info, dict):
+                cells_info = {cells_info: {'weight_in_raw_data': 1}}
             for cell, info in cells_info.items():
                 if cell not in h3_stats:
                     h3_stats[cell] = {agg_save_name:[] for agg_save_name in agg_attr_names}
@@ -397,7 +480,7 @@ class GeoData:
             elif agg_method == 'count':
                 for cell in h3_stats.keys():
                     if not use_weight:
-                        h3_stats[cell][agg_save_name] = len(h3_info[cell][agg_save_name])
+                        h3_stats[cell][agg_save_name] = len(h3_stats[cell][agg_save_name])
                     else:
                         h3_stats[cell][agg_save_name] = sum(weights[cell])
             elif agg_method in ['sum', 'mean', 'min', 'max']:
@@ -414,73 +497,333 @@ class GeoData:
                         h3_stats[cell][agg_save_name] = sum(data_to_agg)
                     elif agg_method == 'mean':
                         h3_stats[cell][agg_save_name] = sum(data_to_agg) / len(data_to_agg)
-                    elif agg_mthod == 'min':
-                        h3_stats[cell][agg_save_name] = mean(data_to_agg)
+                    elif agg_method == 'min':
+                        h3_stats[cell][agg_save_name] = min(data_to_agg)
                     elif agg_method == 'max':
                         h3_stats[cell][agg_save_name] = max(data_to_agg)
             elif agg_method == 'decompose':
                 for cell in h3_stats.keys():
-                    data_to_agg = h3_stats[cell][agg_save_name]
-                    weight_to_agg = weights[cell]
-                    cell_agg_rst = {}
-                    for composition_attr, composition_item_list in decompose_spec['composition'].items():
-                        for composition_item in composition_item_list:
-                            # e.g. composition_attr=LBCS, composition_item=area
-                            cell_agg_rst.setdefault(composition_attr, {})[composition_item] = {}
-                    for d, wei in zip(data_to_agg, weight_to_agg):
-                        area_pperson = d.get(decompose_spec['area_per_person_attr_name'], -1)
-                        data_composition = {}   # create a new name to replace d[composition_attr] to avoid error from re-modifying raw data
-                        floor_group_tts = {}
-                        if not decompose_spec['assign_floors']:
-                            tt_area = d.get(decompose_spec['total_area_attr_name'], -1)
-                            tt_pop = tt_area / area_pperson if area_pperson > 0 else -1
-                            tt = {'area': tt_area*wei, 'pop': tt_pop*wei}
-                            for composition_attr in decompose_spec['composition']:
-                                floor_group_tts[composition_attr] = [tt]
-                                data_composition[composition_attr] = [{
-                                    decompose_spec['floor_proportion_attr_name']: 1,
-                                    decompose_spec['floor_usage_attr_name']: d[composition_attr]
-                                }]
-                        else:
-                            for composition_attr in decompose_spec['composition']:
-                                floor_group_tts[composition_attr] = []
-                                try:
-                                    assert composition_attr in d and type(d[composition_attr])==list
-                                except:
-                                    raise TypeError(f'Composition attribute {composition_attr} not found or not list when assigning floors')
-                                try:
-                                    height = d[decompose_spec['num_floors_attr_name']]
-                                    assert height >= 1 and type(height) == int
-                                except:
-                                    raise ValueError(f'Invalid height ({height}) when assigning floors')
-                                floor_assignments = random.choices(range(len(d[composition_attr])),
-                                                                   weights = [group[decompose_spec['floor_proportion_attr_name']]
-                                                                              for group in d[composition_attr]],
-                                                                   k = height)
-                                for i_g, group in enumerate(d[composition_attr]):
-                                    num_floors = floor_assignments.count(i_g)
-                                    tt_area = d.get(decompose_spec['area_per_floor_attr_name'], -1) * num_floors
-                                    tt_pop = tt_area / area_pperson if area_pperson > 0 else -1
-                                    tt = {'area': tt_area * wei, 'pop': tt_pop * wei}
-                                    floor_group_tts[composition_attr].append(tt)
-                                data_composition[composition_attr] = d[composition_attr]
-                        for composition_attr, composition_item_list in decompose_spec['composition'].items():
-                            for composition_item in composition_item_list:
-                                for tt, floor_group in zip(floor_group_tts[composition_attr], data_composition[composition_attr]):
-                                    if tt[composition_item] > 0 :
-                                        floor_group_usage = floor_group[decompose_spec['floor_usage_attr_name']]
-                                        for class_name, ratio in floor_group_usage.items():
-                                            # e.g. composition_attr=LBCS, composition_item=area, class_name=2100, ratio=0.5
-                                            # => we are processing area of LBCS-2100, and we know the ratio of LBCS-2100 is 0.5
-                                            if class_name not in cell_agg_rst[composition_attr][composition_item]:
-                                                cell_agg_rst[composition_attr][composition_item][class_name] = tt[composition_item] * ratio
-                                            else:
-                                                cell_agg_rst[composition_attr][composition_item][class_name] += tt[composition_item] * ratio
-                    h3_stats[cell][agg_save_name] = cell_agg_rst
+                    h3_stats[cell][agg_save_name] = self._decompose_usage(h3_stats[cell][agg_save_name],
+                                                                          weights[cell],
+                                                                          decompose_spec)
             else:
                 raise ValueError(f'Unrecognised agg_method "{agg_method}" for {attr}')
         return h3_stats
 
+    def _decompose_usage(self, data_to_agg: List[dict], weight_to_agg: List[float], decompose_spec: dict) -> dict:
+        """
+        Decompose the usage of features linked to one cell, see set_default_decompose_spec() for how it works
+        :param data_to_agg: list of usage attribute of features linked to this cell
+        :param weight_to_agg: list of weights with the same order as data_to_agg
+        :param decompose_spec: decompose specifications
+        :return: decomposed results of this cell, e.g. {'LBCS': {'area': {'2100': 100}, 'pop': {'2100': 2}}, ...}
+        """
+        cell_agg_rst = {}
+        for composition_attr, composition_item_list in decompose_spec['composition'].items():
+            for composition_item in composition_item_list:
+                # e.g. composition_attr=LBCS, composition_item=area
+                cell_agg_rst.setdefault(composition_attr, {})[composition_item] = {}
+        for d, wei in zip(data_to_agg, weight_to_agg):
+            for composition_attr, composition_item_list in decompose_spec['composition'].items():
+                floor_groups = UsageDecomposition._get_floor_group_totals(d, composition_attr, decompose_spec)
+                for composition_item in composition_item_list:
+                    for tt, floor_group_usage in floor_groups:
+                        if tt[composition_item] * wei > 0:
+                            for class_name, ratio in floor_group_usage.items():
+                                # e.g. composition_attr=LBCS, composition_item=area, class_name=2100, ratio=0.5
+                                # => we are processing area of LBCS-2100, and we know the ratio of LBCS-2100 is 0.5
+                                this_rst = cell_agg_rst[composition_attr][composition_item]
+                                this_rst[class_name] = this_rst.get(class_name, 0) + tt[composition_item] * wei * ratio
+        return cell_agg_rst
+
+    def _set_h3_stats(self, resolution: int, h3_stats_columnar: dict) -> Dict[int, dict]:
+        """
+        Update self.h3_stats and self.h3_usage with columnar aggregation results
+        :param resolution: h3 resolution
+        :param h3_stats_columnar: columnar results of aggregate_attrs_to_cells() with as_dict=False
+        :return: the dict view of h3 stats, which is also saved to self.h3_stats[resolution]
+        """
+        self.h3_usage[resolution] = {
+            attr: values for attr, values in h3_stats_columnar['attrs'].items()
+            if isinstance(values, UsageDecomposition)
+        }
+        h3_stats = columnar_h3_stats_to_dict(h3_stats_columnar)
+        self.h3_stats[resolution] = h3_stats
+        return h3_stats
+
+    @staticmethod
+    def h3_stats_columnar_to_arrays(h3_stats_columnar: dict) -> tuple:
+        """
+        Flatten columnar h3 stats (see aggregate_attrs_to_cells() with as_dict=False) to plain numpy arrays
+        :return: dict of array name -> array, and meta dict describing the kind of each attribute
+        """
+        arrays, attr_kinds = {'cells': h3_stats_columnar['cells']}, {}
+        for i, (attr, values) in enumerate(h3_stats_columnar['attrs'].items()):
+            if isinstance(values, UsageDecomposition):
+                attr_kinds[attr] = 'usage'
+                arrays.update(values.to_arrays(prefix=f'attr{i}:'))
+            elif isinstance(values, np.ndarray):
+                attr_kinds[attr] = 'array'
+                arrays[f'attr{i}:values'] = values
+            else:
+                # lists of raw values
+                attr_kinds[attr] = 'json'
+                arrays[f'attr{i}:values'] = np.array(json.dumps(values, ensure_ascii=False, cls=NumpyEncoder))
+        return arrays, {'attrs': list(attr_kinds.items())}
+
+    @staticmethod
+    def arrays_to_h3_stats_columnar(arrays: Dict[str, np.ndarray], meta: dict) -> dict:
+        """
+        Inverse of h3_stats_columnar_to_arrays()
+        """
+        h3_stats_columnar = {'cells': arrays['cells'], 'attrs': {}}
+        for i, (attr, kind) in enumerate(meta['attrs']):
+            if kind == 'usage':
+                values = UsageDecomposition.from_arrays(arrays, prefix=f'attr{i}:')
+            elif kind == 'array':
+                values = arrays[f'attr{i}:values']
+            else:
+                values = json.loads(str(arrays[f'attr{i}:values']))
+            h3_stats_columnar['attrs'][attr] = values
+        return h3_stats_columnar
+
+    def _get_h3_cache_path(self, cache_dir: str, resolution: int, agg_spec: Optional[dict]=None,
+                           engine: Optional[str]=None) -> Optional[str]:
+        """
+        Get the content-addressed cache path of h3 linking results (agg_spec is None) or h3 stats.
+        The key covers the source data fingerprint, resolution, linking method and engine and aggregation spec,
+            so that a cached file is never reused after any of them changes.
+        :param engine: engine of linking polygons (see PolygonGeoData.link_to_h3()), None for points
+        :return: path of the .npz file, or None if this GeoData is not loaded from a geojson file
+        """
+        if not getattr(self, 'src_fingerprint', None):
+            return None
+        key_parts = {
+            'version': H3_CACHE_VERSION,
+            'class': type(self).__name__,
+            'src': self.src_fingerprint,
+            'resolution': resolution,
+            'link_to_h3_method': getattr(self, 'link_to_h3_method', 'point'),
+            'engine': engine
+        }
+        kind = 'link'
+        if agg_spec is not None:
+            kind = 'stats'
+            key_parts.update({'name': self.name, 'agg_spec': agg_spec, 'decompose_spec': self.decompose_spec_default})
+        key = make_cache_key(**key_parts)
+        return os.path.join(cache_dir, f'{self.name}_{kind}_r{resolution}_{key[:16]}.npz')
+
+    def _link_to_h3_with_cache(self, resolution: int, cache_dir: Optional[str]=None,
+                               engine: Optional[str]=None) -> None:
+        """
+        Make sure self.map_to_h3_cells[resolution] exists: reuse it, or load it from cache, or link and save it to cache
+        :param engine: engine of linking polygons (see PolygonGeoData.link_to_h3()), None for points
+        """
+        if resolution in self.map_to_h3_cells:
+            return
+        cache_path = self._get_h3_cache_path(cache_dir, resolution, engine=engine) if cache_dir else None
+        if cache_path and os.path.exists(cache_path):
+            arrays, _ = load_arrays(cache_path)
+            self.map_to_h3_cells[resolution] = arrays_to_cells_to_map(arrays)
+            return
+        if engine is None:
+            self.link_to_h3(resolution)
+        else:
+            self.link_to_h3(resolution, engine=engine)
+        if cache_path:
+            save_arrays(cache_path, cells_to_map_to_arrays(self.map_to_h3_cells[resolution]))
+
+    def _load_h3_stats_cache(self, resolution: int, agg_spec: dict, cache_dir: Optional[str]=None,
+                             engine: Optional[str]=None) -> bool:
+        """
+        Load h3 stats (and h3 linking results) from cache
+        :return: whether h3 stats are found in cache
+        """
+        cache_path = self._get_h3_cache_path(cache_dir, resolution, agg_spec, engine) if cache_dir else None
+        if not cache_path or not os.path.exists(cache_path):
+            return False
+        arrays, meta = load_arrays(cache_path)
+        self._set_h3_stats(resolution, self.arrays_to_h3_stats_columnar(arrays, meta))
+        # linking results are also used elsewhere, e.g. HousingUnits.set_base_housing_units_from_buildings()
+        self._link_to_h3_with_cache(resolution, cache_dir, engine)
+        return True
+
+    def _save_h3_stats_cache(self, resolution: int, agg_spec: dict, h3_stats_columnar: dict,
+                             cache_dir: Optional[str]=None, engine: Optional[str]=None) -> None:
+        cache_path = self._get_h3_cache_path(cache_dir, resolution, agg_spec, engine) if cache_dir else None
+        if cache_path:
+            arrays, meta = self.h3_stats_columnar_to_arrays(h3_stats_columnar)
+            save_arrays(cache_path, arrays, meta)
+
+    @staticmethod
+    def h3_stats_to_arrays(h3_stats: Dict[int, dict], h3_usage: Optional[Dict[str, 'UsageDecomposition']]=None) -> tuple:
+        """
+        Flatten the dict view of h3 stats to plain numpy arrays, e.g. for snapshots
+        :param h3_stats: dict of cell index -> dict of attribute name -> value
+        :param h3_usage: sparse decomposed attributes of these h3 stats (e.g. self.h3_usage[resolution]), which are
+            saved as sparse matrices instead of nested dicts. They may cover only a part of cells, the value of other
+            cells (e.g. missing_value of H3Grids.combine_h3_stats()) is kept in meta.
+        :return: dict of array name -> array, and meta dict describing each attribute
+        """
+        h3_usage = h3_usage or {}
+        cells = np.fromiter(h3_stats.keys(), dtype=np.uint64, count=len(h3_stats))
+        attr_names = list(dict.fromkeys(attr for attrs in h3_stats.values() for attr in attrs))
+        arrays, attr_kinds = {'cells': cells}, []
+        for i, attr in enumerate(attr_names):
+            if attr in h3_usage:
+                usage = h3_usage[attr]
+                covered = set(usage.cells.tolist())
+                fill = next((attrs.get(attr) for cell, attrs in h3_stats.items() if cell not in covered), None)
+                arrays.update(usage.to_arrays(prefix=f'attr{i}:'))
+                attr_kinds.append([attr, 'usage', fill])
+                continue
+            values = [attrs.get(attr) for attrs in h3_stats.values()]
+            if all(isinstance(v, (int, float, np.number)) for v in values):
+                arrays[f'attr{i}:values'] = np.asarray(values)
+                attr_kinds.append([attr, 'array', None])
+            else:
+                arrays[f'attr{i}:values'] = json_to_array(values)
+                attr_kinds.append([attr, 'json', None])
+        return arrays, {'attrs': attr_kinds}
+
+    @staticmethod
+    def arrays_to_h3_usage(arrays: Dict[str, np.ndarray], meta: dict) -> Dict[str, 'UsageDecomposition']:
+        """
+        Sparse decomposed attributes saved by h3_stats_to_arrays(), without building the dict view of h3 stats
+        """
+        return {attr: UsageDecomposition.from_arrays(arrays, prefix=f'attr{i}:')
+                for i, (attr, kind, fill) in enumerate(meta['attrs']) if kind == 'usage'}
+
+    @staticmethod
+    def arrays_to_h3_stats(arrays: Dict[str, np.ndarray], meta: dict,
+                           h3_usage: Optional[Dict[str, 'UsageDecomposition']]=None) -> tuple:
+        """
+        Inverse of h3_stats_to_arrays()
+        :param h3_usage: sparse decomposed attributes already loaded by arrays_to_h3_usage(), if None, they are loaded
+        :return: h3_stats in dict view, and dict of sparse decomposed attributes
+        """
+        h3_stats = {cell: {} for cell in arrays['cells'].tolist()}
+        if h3_usage is None:
+            h3_usage = GeoData.arrays_to_h3_usage(arrays, meta)
+        with gc_paused():
+            for i, (attr, kind, fill) in enumerate(meta['attrs']):
+                if kind == 'usage':
+                    usage = h3_usage[attr]
+                    decompositions = dict(zip(usage.cells.tolist(), usage.to_dict_list()))
+                    for cell, attrs in h3_stats.items():
+                        attrs[attr] = decompositions.get(cell, fill)
+                    continue
+                if kind == 'array':
+                    values = arrays[f'attr{i}:values'].tolist()
+                else:
+                    values = array_to_json(arrays[f'attr{i}:values'])
+                for attrs, value in zip(h3_stats.values(), values):
+                    attrs[attr] = value
+        return h3_stats, h3_usage
+
+    # attributes saved as they are in meta.json of snapshots, see save_snapshot()
+    _snapshot_meta_attrs = ['name', 'table', 'work_dir', 'src_geojson_path', 'src_fingerprint', 'crs',
+                            'decompose_spec_default']
+
+    def _to_snapshot(self) -> tuple:
+        """
+        Flatten this GeoData to arrays and json-serializable meta, subclasses extend it with their own attributes
+        :return: dict of array name -> array, and meta dict
+        """
+        meta = {attr: getattr(self, attr, None) for attr in self._snapshot_meta_attrs}
+        arrays = {}
+        # properties are shared by features of all CRS, so they are only saved once
+        feature_crs = [crs for crs, features in self.features.items() if features is not None]
+        meta['feature_crs'] = feature_crs
+        if feature_crs:
+            properties_crs = self.crs['src'] if self.crs['src'] in feature_crs else feature_crs[0]
+            arrays['properties'] = json_to_array([fea.get('properties', {}) for fea in self.features[properties_crs]])
+        for i, crs in enumerate(feature_crs):
+            arrays[f'features:{i}'] = json_to_array([{key: value for key, value in fea.items() if key != 'properties'}
+                                                     for fea in self.features[crs]])
+        meta['shapely_crs'] = [crs for crs, objs in self.shapely_objects.items() if objs is not None]
+        for i, crs in enumerate(meta['shapely_crs']):
+            arrays.update(prefix_arrays(_geometries_to_wkb_arrays(self.shapely_objects[crs]), f'shapely:{i}:'))
+        meta['link_resolutions'] = list(self.map_to_h3_cells.keys())
+        for resolution, cells_to_map in self.map_to_h3_cells.items():
+            arrays.update(prefix_arrays(cells_to_map_to_arrays(cells_to_map), f'link:{resolution}:'))
+        meta['h3_stats'] = []
+        for resolution, h3_stats in self.h3_stats.items():
+            stats_arrays, stats_meta = self.h3_stats_to_arrays(h3_stats, self.h3_usage.get(resolution))
+            arrays.update(prefix_arrays(stats_arrays, f'stats:{resolution}:'))
+            meta['h3_stats'].append([resolution, stats_meta])
+        arrays.update(self.h3_boundaries.to_arrays(prefix='boundaries:'))
+        return arrays, meta
+
+    def _from_snapshot(self, arrays: Dict[str, np.ndarray], meta: dict) -> None:
+        """
+        Inverse of _to_snapshot(), sets attributes of an instance created without __init__().
+        Features, shapely objects, links and h3 stats are LazyDict: the arrays stay memory-mapped, and the per-feature
+        and per-cell dicts of a CRS or resolution are only built when it is first accessed.
+        """
+        for attr in self._snapshot_meta_attrs:
+            setattr(self, attr, meta.get(attr))
+        self.transformer = {}
+        feature_crs, stats_metas = meta['feature_crs'], dict(meta['h3_stats'])
+        properties = []   # decoded once and shared by features of all CRS
+
+        def load_features(i, crs):
+            properties_crs = self.crs['src'] if self.crs['src'] in feature_crs else feature_crs[0]
+            with gc_paused():
+                if not properties:
+                    properties.append(array_to_json(arrays['properties']))
+                features = array_to_json(arrays[f'features:{i}'])
+                for fea, fea_properties in zip(features, properties[0]):
+                    fea['properties'] = fea_properties if crs == properties_crs else dict(fea_properties)
+            return features
+
+        def load_shapely_objects(i):
+            return _wkb_arrays_to_geometries(select_arrays(arrays, f'shapely:{i}:'))
+
+        def load_links(resolution):
+            return arrays_to_cells_to_map(select_arrays(arrays, f'link:{resolution}:'))
+
+        def load_h3_usage(resolution):
+            return self.arrays_to_h3_usage(select_arrays(arrays, f'stats:{resolution}:'), stats_metas[resolution])
+
+        def load_h3_stats(resolution):
+            return self.arrays_to_h3_stats(select_arrays(arrays, f'stats:{resolution}:'), stats_metas[resolution],
+                                           self.h3_usage[resolution])[0]
+
+        self.features = LazyDict({crs: partial(load_features, i, crs) for i, crs in enumerate(feature_crs)})
+        self.shapely_objects = LazyDict({crs: partial(load_shapely_objects, i)
+                                         for i, crs in enumerate(meta['shapely_crs'])})
+        self.map_to_h3_cells = LazyDict({resolution: partial(load_links, resolution)
+                                         for resolution in meta['link_resolutions']})
+        self.h3_usage = LazyDict({resolution: partial(load_h3_usage, resolution) for resolution in stats_metas})
+        self.h3_stats = LazyDict({resolution: partial(load_h3_stats, resolution) for resolution in stats_metas})
+        self.h3_boundaries = H3BoundaryCache.from_arrays(arrays, prefix='boundaries:')
+
+    def save_snapshot(self, snapshot_dir: str) -> None:
+        """
+        Save this GeoData to a snapshot directory, see utils.write_snapshot() for the format. Loading a snapshot with
+            load_snapshot() skips reading geojson files, CRS conversion, linking to h3 and aggregation, and does
+            not depend on pickling the whole instance.
+        :param snapshot_dir: path of the snapshot directory, replaced if it exists
+        :return: None
+        """
+        arrays, meta = self._to_snapshot()
+        write_snapshot(snapshot_dir, arrays, meta, kind=type(self).__name__)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir: str, mmap: bool=True, **kwargs) -> 'GeoData':
+        """
+        Load an instance from a snapshot directory saved by save_snapshot() of the same class
+        :param snapshot_dir: path of the snapshot directory
+        :param mmap: whether to open arrays as memory maps, so that they are only read from disk when used
+        :param kwargs: passed to _from_snapshot() of subclasses, e.g. H3 of TableGrids
+        :return: the loaded instance
+        """
+        arrays, meta = read_snapshot(snapshot_dir, kind=cls.__name__, mmap=mmap)
+        obj = cls.__new__(cls)
+        obj._from_snapshot(arrays, meta, **kwargs)
+        return obj
+
     def export_h3_features(self, resolution: int, save_to: Optional[str]=None) -> List[dict]:
         """
         Export h3 cells on which attributes of this GeoData are aggregated to geojson features,
@@ -493,7 +836,7 @@ class GeoData:
             print('Error: must have h3_info first')
             return
         h3_stats = self.h3_stats[resolution]
-        h3_features = export_h3_features(h3_stats, save_to)
+        h3_features = export_h3_features(h3_stats, save_to, self.h3_boundaries)
         return h3_features
 
     def export_geojson(self, crs: Optional[int]=None, save_to: Optional[str]=None) -> None:
@@ -565,6 +908,309 @@ class GeoData:
         return ax
 
 
+class UsageDecomposition:
+    """
+    UsageDecomposition is the sparse representation of decomposed usage (see GeoData.set_default_decompose_spec)
+    aggregated on cells. Each (composition attribute, composition item) pair, e.g. ("LBCS", "area"), is stored as
+    a cells x classes sparse matrix, so that layers could be merged by sparse addition and indicators could read
+    column slices instead of iterating nested dicts of every cell.
+    It has following attributes:
+        cells: np.ndarray: uint64 array of cell index, the row order of all matrices
+        classes: Dict[str, np.ndarray]: class names (str) of each composition attribute, e.g. classes['LBCS'] is the
+            column order of matrices of LBCS
+        matrices: Dict[str, Dict[str, 'csr_matrix']]: cells x classes matrices, keys of outer dict are composition
+            attributes (e.g. "LBCS"), keys of inner dict are composition items (e.g. "area")
+    """
+    def __init__(self, cells: np.ndarray, classes: Dict[str, np.ndarray],
+                 matrices: Dict[str, Dict[str, 'csr_matrix']]) -> None:
+        self.cells = np.asarray(cells, dtype=np.uint64)
+        self.classes = {attr: np.asarray(class_names, dtype=str) for attr, class_names in classes.items()}
+        self.matrices = matrices
+
+    @classmethod
+    def from_features(cls, cells: np.ndarray, link_cell_pos: np.ndarray, feature_idx: np.ndarray,
+                      link_weights: np.ndarray, usages: List[Optional[dict]],
+                      decompose_spec: dict) -> 'UsageDecomposition':
+        """
+        Build the decomposition in one pass from features: the usage of each feature is decomposed to a
+        features x classes matrix, and then distributed to cells by the sparse cells x features link matrix.
+        :param cells: uint64 array of cell index, the row order of the decomposition
+        :param link_cell_pos: for each feature-cell link, the position of its cell in param cells
+        :param feature_idx: for each feature-cell link, the index of its feature in param usages
+        :param link_weights: for each feature-cell link, the weight of this link
+        :param usages: list of usage attribute of features, see GeoData.set_default_decompose_spec for its format
+        :param decompose_spec: decompose specifications
+        :return: UsageDecomposition
+        """
+        feature_matrices, class_lookup = cls.decompose_features(usages, decompose_spec)
+        link_matrix = sparse.csr_matrix((link_weights, (link_cell_pos, feature_idx)),
+                                        shape=(len(cells), len(usages)))
+        matrices = {attr: {item: (link_matrix @ feature_matrix).tocsr() for item, feature_matrix in items.items()}
+                    for attr, items in feature_matrices.items()}
+        classes = {attr: list(class_lookup[attr].keys()) for attr in class_lookup}
+        return cls(cells, classes, matrices)
+
+    @classmethod
+    def decompose_features(cls, usages: List[Optional[dict]], decompose_spec: dict,
+                           class_lookup: Optional[Dict[str, Dict[str, int]]]=None) -> tuple:
+        """
+        Decompose the usage of each feature to a features x classes matrix
+        :param usages: list of usage attribute of features, None for features without usage
+        :param decompose_spec: decompose specifications
+        :param class_lookup: dict of composition attribute -> dict of class name -> column, new classes are appended
+            to it in place, so that features decomposed in several calls share columns
+        :return: dict of composition attribute -> dict of composition item -> csr_matrix, and class_lookup
+        """
+        composition = decompose_spec['composition']
+        if class_lookup is None:
+            class_lookup = {}
+        for attr in composition:
+            class_lookup.setdefault(attr, {})
+        entries = {attr: {item: ([], [], []) for item in items} for attr, items in composition.items()}
+        for fea_idx, d in enumerate(usages):
+            if not d:
+                continue
+            for attr, items in composition.items():
+                for tt, floor_usage in cls._get_floor_group_totals(d, attr, decompose_spec):
+                    for item in items:
+                        if not tt[item] > 0:
+                            continue
+                        rows, cols, values = entries[attr][item]
+                        for class_name, ratio in floor_usage.items():
+                            class_name = str(class_name)
+                            rows.append(fea_idx)
+                            cols.append(class_lookup[attr].setdefault(class_name, len(class_lookup[attr])))
+                            values.append(tt[item] * ratio)
+        feature_matrices = {}
+        for attr, items in composition.items():
+            for item in items:
+                rows, cols, values = entries[attr][item]
+                feature_matrices.setdefault(attr, {})[item] = sparse.csr_matrix(
+                    (values, (rows, cols)), shape=(len(usages), len(class_lookup[attr])))
+        return feature_matrices, class_lookup
+
+    @staticmethod
+    def _get_floor_group_totals(d: dict, composition_attr: str, decompose_spec: dict) -> List[tuple]:
+        """
+        Get the total amount (area, pop) and usage ratio of each floor group of a feature
+        :param d: usage attribute of this feature
+        :param composition_attr: composition attribute, e.g. "LBCS"
+        :param decompose_spec: decompose specifications
+        :return: list of (dict of total amount of each composition item, dict of class name -> ratio)
+        """
+        area_pperson = d.get(decompose_spec['area_per_person_attr_name'], -1)
+        if not decompose_spec['assign_floors']:
+            tt_area = d.get(decompose_spec['total_area_attr_name'], -1)
+            tt_pop = tt_area / area_pperson if area_pperson > 0 else -1
+            return [({'area': tt_area, 'pop': tt_pop}, d[composition_attr])]
+        try:
+            assert composition_attr in d and type(d[composition_attr]) == list
+        except:
+            raise TypeError(f'Composition attribute {composition_attr} not found or not list when assigning floors')
+        try:
+            height = d[decompose_spec['num_floors_attr_name']]
+            assert height >= 1 and type(height) == int
+        except:
+            raise ValueError(f'Invalid height ({height}) when assigning floors')
+        groups = d[composition_attr]
+        floor_assignments = random.choices(range(len(groups)),
+                                           weights=[group[decompose_spec['floor_proportion_attr_name']]
+                                                    for group in groups],
+                                           k=height)
+        rst = []
+        for i_g, group in enumerate(groups):
+            num_floors = floor_assignments.count(i_g)
+            tt_area = d.get(decompose_spec['area_per_floor_attr_name'], -1) * num_floors
+            tt_pop = tt_area / area_pperson if area_pperson > 0 else -1
+            rst.append(({'area': tt_area, 'pop': tt_pop}, group[decompose_spec['floor_usage_attr_name']]))
+        return rst
+
+    @classmethod
+    def from_h3_stats(cls, h3_stats: Dict[int, dict], usage_name: str='usage') -> 'UsageDecomposition':
+        """
+        Build the decomposition from the dict view of h3_stats, e.g. for h3_stats made by older versions
+        :param h3_stats: dict of cell index -> dict of attributes, see GeoData.aggregate_attrs_to_cells
+        :param usage_name: the name of decomposed usage attribute
+        :return: UsageDecomposition, cells without this attribute are ignored
+        """
+        cells, class_lookup, entries = [], {}, {}
+        for h3_cell, h3_attrs in h3_stats.items():
+            decomposition = h3_attrs.get(usage_name, None)
+            if type(decomposition) != dict:
+                continue
+            row = len(cells)
+            cells.append(h3_cell)
+            for attr, attr_rst in decomposition.items():
+                this_class_lookup = class_lookup.setdefault(attr, {})
+                for item, item_rst in attr_rst.items():
+                    rows, cols, values = entries.setdefault(attr, {}).setdefault(item, ([], [], []))
+                    for class_name, value in item_rst.items():
+                        rows.append(row)
+                        cols.append(this_class_lookup.setdefault(str(class_name), len(this_class_lookup)))
+                        values.append(value)
+        matrices = {
+            attr: {
+                item: sparse.csr_matrix((values, (rows, cols)), shape=(len(cells), len(class_lookup[attr])))
+                for item, (rows, cols, values) in attr_entries.items()
+            }
+            for attr, attr_entries in entries.items()
+        }
+        classes = {attr: list(this_class_lookup.keys()) for attr, this_class_lookup in class_lookup.items()}
+        return cls(np.asarray(cells, dtype=np.uint64), classes, matrices)
+
+    @classmethod
+    def combine(cls, decompositions: List['UsageDecomposition']) -> 'UsageDecomposition':
+        """
+        Merge decompositions of different layers by sparse addition
+        :param decompositions: list of UsageDecomposition
+        :return: UsageDecomposition whose cells and classes are the union of all inputs
+        """
+        decompositions = [x for x in decompositions if x is not None]
+        if len(decompositions) == 1:
+            return decompositions[0]
+        cells, cell_pos = unique_in_order(np.concatenate([x.cells for x in decompositions]
+                                                         + [np.array([], dtype=np.uint64)]))
+        cell_offsets = np.cumsum([0] + [len(x.cells) for x in decompositions])
+        attrs = list(dict.fromkeys(attr for x in decompositions for attr in x.matrices))
+        classes, matrices = {}, {}
+        for attr in attrs:
+            has_attr = [x for x in decompositions if attr in x.classes]
+            attr_classes, _ = unique_in_order(np.concatenate([x.classes[attr] for x in has_attr]))
+            classes[attr] = attr_classes
+            class_index = {class_name: col for col, class_name in enumerate(attr_classes.tolist())}
+            class_cols = [np.array([class_index[class_name] for class_name in x.classes[attr].tolist()], dtype=np.int64)
+                          if attr in x.classes else None for x in decompositions]
+            items = list(dict.fromkeys(item for x in has_attr for item in x.matrices[attr]))
+            for item in items:
+                rows, cols, values = [], [], []
+                for x, cell_offset, x_cols in zip(decompositions, cell_offsets, class_cols):
+                    if attr not in x.matrices or item not in x.matrices[attr]:
+                        continue
+                    coo = x.matrices[attr][item].tocoo()
+                    rows.append(cell_pos[cell_offset + coo.row])
+                    cols.append(x_cols[coo.col])
+                    values.append(coo.data)
+                matrices.setdefault(attr, {})[item] = sparse.csr_matrix(
+                    (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                    shape=(len(cells), len(attr_classes))
+                )
+        return cls(cells, classes, matrices)
+
+    def _match_classes(self, attr: str, target_classes: Optional[List[str]]=None,
+                       first_n_digits: Optional[int]=None) -> Dict[str, np.ndarray]:
+        """
+        Find columns of target classes
+        :param attr: composition attribute, e.g. "LBCS"
+        :param target_classes: list of target class names, if None, all classes are targets
+        :param first_n_digits: if not None, a class matches a target class if its first n digits equal the target
+        :return: dict of target class name -> array of column index
+        """
+        class_names = self.classes.get(attr, np.array([], dtype=str))
+        if target_classes is None:
+            return {class_name: np.array([col]) for col, class_name in enumerate(class_names.tolist())}
+        if first_n_digits:
+            class_names = np.array([get_first_n_digits(class_name, first_n_digits) for class_name in class_names],
+                                   dtype=str)
+        return {str(target): np.flatnonzero(class_names == str(target)) for target in target_classes}
+
+    def class_totals(self, attr: str, item: str, target_classes: Optional[List[str]]=None,
+                     first_n_digits: Optional[int]=None) -> Dict[str, float]:
+        """
+        Get the total amount of classes over all cells
+        :param attr: composition attribute, e.g. "LBCS"
+        :param item: composition item, e.g. "area"
+        :param target_classes: list of target class names, if None, return all classes
+        :param first_n_digits: if not None, sum all classes whose first n digits equal the target class
+        :return: dict of class name -> total amount
+        """
+        matched = self._match_classes(attr, target_classes, first_n_digits)
+        if attr not in self.matrices or item not in self.matrices[attr]:
+            return {class_name: 0 for class_name in matched}
+        column_sums = np.asarray(self.matrices[attr][item].sum(axis=0)).ravel()
+        return {class_name: float(column_sums[cols].sum()) for class_name, cols in matched.items()}
+
+    def class_values(self, attr: str, item: str, target_classes: Optional[List[str]]=None,
+                     first_n_digits: Optional[int]=None) -> np.ndarray:
+        """
+        Get the amount of target classes on each cell
+        :param attr: composition attribute, e.g. "LBCS"
+        :param item: composition item, e.g. "area"
+        :param target_classes: list of target class names, if None, all classes are targets
+        :param first_n_digits: if not None, sum all classes whose first n digits equal the target class
+        :return: cells x target classes dense array with the same order as self.cells and target_classes
+        """
+        matched = self._match_classes(attr, target_classes, first_n_digits)
+        rst = np.zeros((len(self.cells), len(matched)))
+        if attr not in self.matrices or item not in self.matrices[attr]:
+            return rst
+        matrix = self.matrices[attr][item].tocsc()
+        for i, cols in enumerate(matched.values()):
+            if len(cols) > 0:
+                rst[:, i] = np.asarray(matrix[:, cols].sum(axis=1)).ravel()
+        return rst
+
+    def to_arrays(self, prefix: str='') -> Dict[str, np.ndarray]:
+        """
+        Flatten this decomposition to a dict of plain numpy arrays, e.g. to be saved with utils.save_arrays()
+        :param prefix: prefix of array names, to save several decompositions together
+        :return: dict of array name -> array
+        """
+        arrays = {f'{prefix}cells': self.cells}
+        for attr, attr_matrices in self.matrices.items():
+            arrays[f'{prefix}classes:{attr}'] = self.classes[attr]
+            for item, matrix in attr_matrices.items():
+                for part in ['data', 'indices', 'indptr']:
+                    arrays[f'{prefix}matrix:{attr}:{item}:{part}'] = getattr(matrix, part)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], prefix: str='') -> 'UsageDecomposition':
+        """
+        Inverse of to_arrays()
+        """
+        cells = arrays[f'{prefix}cells']
+        classes, matrices = {}, {}
+        for name in arrays:
+            if not name.startswith(f'{prefix}matrix:') or not name.endswith(':data'):
+                continue
+            attr, item = name[len(f'{prefix}matrix:'): -len(':data')].split(':')
+            classes[attr] = arrays[f'{prefix}classes:{attr}']
+            matrices.setdefault(attr, {})[item] = sparse.csr_matrix(
+                (arrays[name], arrays[f'{prefix}matrix:{attr}:{item}:indices'],
+                 arrays[f'{prefix}matrix:{attr}:{item}:indptr']),
+                shape=(len(cells), len(classes[attr]))
+            )
+        return cls(cells, classes, matrices)
+
+    def take(self, positions: np.ndarray) -> 'UsageDecomposition':
+        """
+        Get the decomposition of some cells, e.g. to make the dict view of a few changed cells
+        :param positions: positions of these cells in self.cells
+        :return: UsageDecomposition with the same classes
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        matrices = {attr: {item: matrix[positions] for item, matrix in attr_matrices.items()}
+                    for attr, attr_matrices in self.matrices.items()}
+        return UsageDecomposition(self.cells[positions], self.classes, matrices)
+
+    def to_dict_list(self) -> List[dict]:
+        """
+        Make the dict view of this decomposition
+        :return: list of decomposed results with the same order as self.cells, e.g.
+            [{'LBCS': {'area': {'2100': 100}, 'pop': {'2100': 2}}, 'NAICS': {...}}, ...]
+        """
+        rst = [{} for _ in range(len(self.cells))]
+        for attr, attr_matrices in self.matrices.items():
+            class_names = self.classes[attr]
+            for item, matrix in attr_matrices.items():
+                # slicing python lists is much faster than slicing numpy arrays row by row
+                indptr, data = matrix.indptr.tolist(), matrix.data.tolist()
+                names = np.asarray(class_names)[matrix.indices].tolist()
+                for cell_rst, start, end in zip(rst, indptr[:-1], indptr[1:]):
+                    cell_rst.setdefault(attr, {})[item] = dict(zip(names[start:end], data[start:end]))
+        return rst
+
+
 class PointGeoData(GeoData):
     def __init__(self, name: str, src_geojson_path: Optional[str] = None,
                  table: str = 'shenzhen', proj_crs: Optional[int] = None) -> None:
@@ -581,22 +1227,33 @@ class PointGeoData(GeoData):
         """
         super().__init__(name, src_geojson_path, table, proj_crs)
 
-    def link_to_h3(self, resolution: int=12) -> None:
+    def link_to_h3(self, resolution: int=12, n_workers: Optional[int]=1, chunk_size: Optional[int]=None) -> None:
         """
         Link this PointgonGeoData to h3 cells, a point will be linked to the h3 cell which contains this point
         :param resolution: resolution of h3 cells to be linked with
+        :param n_workers: maximum number of worker processes, 1 (default) to link serially, None for as many as
+            os.cpu_count(). Coordinates of points are sent to the workers in chunks, each worker gets at least
+            MIN_POINTS_PER_WORKER points, and small layers are linked serially. See map_chunks_in_process_pool() for
+            the entry point guard worker processes need.
+        :param chunk_size: number of points in a chunk, if None, each worker gets about 4 chunks
         :return: None, updates self.map_to_h3_cells[resolution] in place
         """
-        features_to_h3_cells = []
+        coords = []
         for fea in self.features[self.crs['geographic']]:
             coord = fea['geometry']['coordinates']
             if fea['geometry']['type'] == 'MultiPoint':
                 coord = coord[0]
-            h3_cell = h3.geo_to_h3(coord[1], coord[0], resolution)
-            features_to_h3_cells.append(h3_cell)
+            coords.append((coord[0], coord[1]))
+        n_workers = resolve_n_workers(n_workers, len(coords), MIN_POINTS_PER_WORKER)
+        if n_workers > 1:
+            features_to_h3_cells = map_chunks_in_process_pool(_link_points_to_h3_worker, coords, n_workers,
+                                                              chunk_size, resolution)
+        else:
+            features_to_h3_cells = _link_points_to_h3_worker(coords, resolution)
         self.map_to_h3_cells[resolution] = features_to_h3_cells
 
-    def make_h3_stats(self, resolution: int, agg_attrs: Dict[str, str]={}, count: bool=True) -> None:
+    def make_h3_stats(self, resolution: int, agg_attrs: Dict[str, str]={}, count: bool=True,
+                      cache_dir: Optional[str]=None) -> None:
         """
         Link this PointGeoData to h3 cells, then aggregate its attributes on h3 cells and make statistics
             for each h3 cell being linked with one or more points
@@ -604,22 +1261,31 @@ class PointGeoData(GeoData):
         :param agg_attrs: defines which attributes of features should be aggregated to cells using what methods.
             See params agg_attrs of aggregate_attrs_to_cells() method for more information of available aggregation methods
         :param count: whether to include the count of points in h3 cells as an attribute of h3 cells
-        :return: None, updates self.h3_stats[resolution] in place, see return of aggregate_attrs_to_cells() method
-            for how h3_stats as the results are formatted.
+        :param cache_dir: if not None, linking results and h3 stats are loaded from / saved to .npz files in this
+            directory, keyed by the fingerprint of source geojson file, resolution, linking method and aggregation spec.
+            Note that a cached decomposition with floor assignments keeps its random draw.
+        :return: None, updates self.h3_stats[resolution] and self.h3_usage[resolution] in place, see return of
+            aggregate_attrs_to_cells() method for how h3_stats as the results are formatted.
         """
-        if resolution not in self.map_to_h3_cells:
-            self.link_to_h3(resolution)
+        agg_spec = {'agg_attrs': agg_attrs, 'count': count}
+        if self._load_h3_stats_cache(resolution, agg_spec, cache_dir):
+            return
+        self._link_to_h3_with_cache(resolution, cache_dir)
         features_to_h3_cells = self.map_to_h3_cells[resolution]
-        h3_cells_to_map = [{h3_cell: {'weight_in_raw_data': 1}} for h3_cell in features_to_h3_cells]
-        h3_stats = self.aggregate_attrs_to_cells(h3_cells_to_map, self.features[self.crs['src']], agg_attrs)
+        h3_stats_columnar = self.aggregate_attrs_to_cells(features_to_h3_cells, self.features[self.crs['src']],
+                                                          agg_attrs, as_dict=False)
         if count:
-            counter = Counter(features_to_h3_cells)
-            for cell, num in counter.items():
-                h3_stats[cell][f'{self.name}_count'] = num
-        self.h3_stats[resolution] = h3_stats
+            h3_stats_columnar['attrs'][f'{self.name}_count'] = np.bincount(
+                unique_in_order(np.asarray(features_to_h3_cells, dtype=np.uint64))[1],
+                minlength=len(h3_stats_columnar['cells'])
+            )
+        self._set_h3_stats(resolution, h3_stats_columnar)
+        self._save_h3_stats_cache(resolution, agg_spec, h3_stats_columnar, cache_dir)
 
 
 class PolygonGeoData(GeoData):
+    _snapshot_meta_attrs = GeoData._snapshot_meta_attrs + ['link_to_h3_method']
+
     def __init__(self, name: str, src_geojson_path: Optional[str]=None,
                  table: str='shenzhen', proj_crs: Optional[int]=None,
                  link_to_h3_method: str='polygon_intersection') -> None:
@@ -680,11 +1346,16 @@ class PolygonGeoData(GeoData):
             buffered_feature = buffered_feature_projected
         return buffered_feature
 
-    def link_to_h3(self, resolution: int=11, self_update: bool=True) -> List[Union[int, Dict[int, dict]]]:
+    def link_to_h3(self, resolution: int=11, self_update: bool=True, engine: str='strtree',
+                   n_workers: Optional[int]=1, chunk_size: Optional[int]=None) -> List[Union[int, Dict[int, dict]]]:
         """
         Link this PolygonGeoData to h3 cells
         :param resolution: resolution of h3 cells to be linked with
         :param self_update: whether to update self.map_to_h3_cells attribute
+        :param engine: engine of linking based on polygon intersections, see link_to_h3_using_polygon_intersection()
+        :param n_workers: number of worker processes of linking based on polygon intersections, see
+            link_to_h3_using_polygon_intersection()
+        :param chunk_size: number of polygons sent to a worker process at a time
         :return: list of mapping-to-h3-cells info with the same order as self.features.
                  If linking method is "polygon_intersection", then list element is dict:
                      keys are index of h3 cells with which the polygon should be linked
@@ -695,16 +1366,32 @@ class PolygonGeoData(GeoData):
                  If linking method is "centroid", then list element is int index of h3 cell with which the polygon should be linked.
         """
         if self.link_to_h3_method == 'polygon_intersection':
-            features_to_h3_cells = self.link_to_h3_using_polygon_intersection(resolution, self_update)
+            features_to_h3_cells = self.link_to_h3_using_polygon_intersection(resolution, self_update, engine,
+                                                                              n_workers, chunk_size)
         elif self.link_to_h3_method == 'centroid':
             features_to_h3_cells = self.link_to_h3_using_centroid(resolution, self_update)
         return features_to_h3_cells
 
-    def link_to_h3_using_polygon_intersection(self, resolution: int=11, self_update: bool=True) -> List[Dict[int, dict]]:
+    def link_to_h3_using_polygon_intersection(self, resolution: int=11, self_update: bool=True,
+                                              engine: str='strtree', n_workers: Optional[int]=1,
+                                              chunk_size: Optional[int]=None) -> List[Dict[int, dict]]:
         """
         Link this PolygonGeoData to h3 cells based on polygon intersections
         :param resolution: resolution of h3 cells to be linked with
         :param self_update: whether to update self.map_to_h3_cells attribute
+        :param engine: "strtree" or "python".
+            If set to "strtree", candidate cells of all polygons are collected at once, each hexagon is built only once
+            into a shapely STRtree, and all polygon-hexagon pairs are intersected in bulk with shapely vectorized functions.
+            If set to "python", each polygon is buffered and polyfilled, then intersected with its candidate hexagons
+            one by one (the original implementation).
+        :param n_workers: maximum number of worker processes of the "strtree" engine, 1 (default) to link serially,
+            None for as many as os.cpu_count(). Polygons are grouped spatially, sent to the workers in chunks as WKB,
+            and linked with the "strtree" engine in each process. Each worker gets at least MIN_POLYGONS_PER_WORKER
+            polygons, and small layers are linked serially. See map_chunks_in_process_pool() for the entry point
+            guard worker processes need.
+            The "python" engine always runs serially, a ValueError is raised if it is combined with n_workers other
+            than 1.
+        :param chunk_size: number of polygons in a chunk, if None, each worker gets about 4 chunks
         :return: list of mapping-to-h3-cells info with the same order as self.features, elements are dict:
                  keys are index of h3 cells with which the polygon should be linked
                  values are weights information given in a dict when linking this polygon with the h3 cell, including:
@@ -712,6 +1399,138 @@ class PolygonGeoData(GeoData):
                      key="weight_in_raw_data": the ratio of intersection_area to the area of polygon
                      key="weight_in_new_data": the ratio of intersection_area to the area of h3 cell
         """
+        if engine not in ['strtree', 'python']:
+            raise ValueError(f'Invalid engine: {engine}')
+        if engine == 'python':
+            if n_workers != 1:
+                raise ValueError('The "python" engine runs serially, use the "strtree" engine to link in parallel')
+            n_workers = 1
+        else:
+            n_workers = resolve_n_workers(n_workers, len(self.shapely_objects[4326]), MIN_POLYGONS_PER_WORKER)
+        if n_workers > 1:
+            features_to_h3_cells = self._link_to_h3_in_process_pool(resolution, n_workers, chunk_size)
+        elif engine == 'strtree':
+            features_to_h3_cells = self._link_polygons_to_h3_using_strtree(self.shapely_objects[4326], resolution)
+        elif engine == 'python':
+            features_to_h3_cells = self._link_to_h3_using_polygon_intersection_python(resolution)
+        else:
+            raise ValueError(f'Invalid engine: {engine}')
+        if self_update:
+            self.map_to_h3_cells[resolution] = features_to_h3_cells
+        return features_to_h3_cells
+
+    @staticmethod
+    def _get_candidate_h3_cells(polygons: np.ndarray, resolution: int) -> np.ndarray:
+        """
+        Get a superset of the h3 cells intersecting with any of the polygons: cells containing the densified boundary
+            vertices plus their direct neighbours, and cells whose centers are within the polygons
+        :param polygons: array of shapely Polygon / MultiPolygon in epsg 4326
+        :param resolution: resolution of h3 cells
+        :return: sorted unique array of cell index
+        """
+        # a boundary crossing a cell is within half of the spacing of densified vertices from a vertex, which is no more
+        # than half of the edge length, so that the cell is a direct neighbour of the cell containing that vertex
+        # (1 degree of lat is at most MAX_METERS_PER_DEGREE, 1 degree of lon is shorter by cos(lat))
+        max_segment_length = h3.edge_length(resolution, unit='m') / MAX_METERS_PER_DEGREE
+        boundary_coords = shapely.get_coordinates(
+            shapely.segmentize(shapely.boundary(polygons), max_segment_length)
+        )
+        boundary_cells = {h3.geo_to_h3(lat, lng, resolution) for lng, lat in boundary_coords.tolist()}
+        cells = [h3.k_ring(cell, 1) for cell in boundary_cells]
+        # a cell containing no boundary vertex can only intersect with a polygon when it is entirely within the
+        # polygon, so polyfill is only needed for polygons larger than a cell. 1 square degree is at most
+        # MAX_METERS_PER_DEGREE**2 * cos(lat) m^2, with lat the closest to the equator in the polygon
+        bounds = shapely.bounds(polygons)
+        min_lat, max_lat = bounds[:, 1], bounds[:, 3]
+        min_abs_lat = np.where(min_lat * max_lat <= 0, 0, np.minimum(np.abs(min_lat), np.abs(max_lat)))
+        min_area_to_polyfill = h3.hex_area(resolution, unit='m^2') / 2 / MAX_METERS_PER_DEGREE**2 / \
+                               np.cos(np.radians(min_abs_lat))
+        for polygon in polygons[shapely.area(polygons) >= min_area_to_polyfill]:
+            if polygon.geom_type == 'Polygon':
+                parts = [polygon]
+            elif polygon.geom_type == 'MultiPolygon':
+                parts = polygon.geoms
+            else:
+                parts = []
+            for part in parts:
+                cells.append(h3.polyfill(mapping(part), resolution, geo_json_conformant=True))
+        cells = np.unique(np.concatenate(cells)).astype(np.uint64)
+        return cells
+
+    @staticmethod
+    def _get_h3_shapely_objects(cells: np.ndarray) -> np.ndarray:
+        """
+        Build the hexagons of h3 cells as an array of shapely Polygon in epsg 4326
+        """
+        boundaries = [h3.h3_to_geo_boundary(cell, geo_json=True) for cell in cells.tolist()]
+        if all(len(boundary) == 7 for boundary in boundaries):
+            return shapely.polygons(np.asarray(boundaries, dtype=np.float64))
+        # pentagons
+        return np.asarray([Polygon(boundary) for boundary in boundaries], dtype=object)
+
+    @staticmethod
+    def _link_polygons_to_h3_using_strtree(polygons: np.ndarray, resolution: int) -> List[Dict[int, dict]]:
+        """
+        The "strtree" engine of link_to_h3_using_polygon_intersection()
+        :param polygons: array of shapely Polygon / MultiPolygon in epsg 4326, elements could be None
+        :param resolution: resolution of h3 cells to be linked with
+        :return: list of mapping-to-h3-cells info with the same order as polygons
+        """
+        polygons = np.asarray(polygons, dtype=object)
+        features_to_h3_cells = [{} for _ in range(len(polygons))]
+        valid = np.asarray([obj is not None for obj in polygons], dtype=bool)
+        valid[valid] = ~shapely.is_empty(polygons[valid].astype(object))
+        valid_idx = np.flatnonzero(valid)
+        if len(valid_idx) == 0:
+            return features_to_h3_cells
+        polygons = polygons[valid_idx]
+        cells = PolygonGeoData._get_candidate_h3_cells(polygons, resolution)
+        h3_shapely_objects = PolygonGeoData._get_h3_shapely_objects(cells)
+        h3_area = shapely.area(h3_shapely_objects)
+        tree = shapely.STRtree(h3_shapely_objects)
+        shapely.prepare(polygons)
+        polygon_pos, cell_pos = tree.query(polygons, predicate='intersects')
+        # cells within polygons need no intersection, which is the most of links for large polygons
+        polygon_pos_within, cell_pos_within = tree.query(polygons, predicate='contains')
+        within = np.isin(polygon_pos * len(cells) + cell_pos, polygon_pos_within * len(cells) + cell_pos_within)
+        intersection_area = h3_area[cell_pos]
+        intersection_area[~within] = shapely.area(
+            shapely.intersection(polygons[polygon_pos[~within]], h3_shapely_objects[cell_pos[~within]])
+        )
+        keep = intersection_area > 0
+        polygon_pos, cell_pos, intersection_area = polygon_pos[keep], cell_pos[keep], intersection_area[keep]
+        area_ratio_in_polygon = intersection_area / shapely.area(polygons)[polygon_pos]
+        area_ratio_in_h3 = intersection_area / h3_area[cell_pos]
+        for fea_idx, h3_cell, this_intersection_area, this_area_ratio_in_polygon, this_area_ratio_in_h3 in zip(
+                valid_idx[polygon_pos].tolist(), cells[cell_pos].tolist(), intersection_area.tolist(),
+                area_ratio_in_polygon.tolist(), area_ratio_in_h3.tolist()):
+            features_to_h3_cells[fea_idx][h3_cell] = {
+                'intersection_area': this_intersection_area,
+                'weight_in_raw_data': this_area_ratio_in_polygon,
+                'weight_in_new_data': this_area_ratio_in_h3,
+            }
+        return features_to_h3_cells
+
+    def _link_to_h3_in_process_pool(self, resolution: int, n_workers: int,
+                                    chunk_size: Optional[int]=None) -> List[Dict[int, dict]]:
+        polygons = self.shapely_objects[4326]
+        # group polygons by the coarse h3 cells of their representative points, so that chunks are spatially compact
+        # and their candidate cells rarely overlap
+        group_cells = np.zeros(len(polygons), dtype=np.uint64)
+        for idx, polygon in enumerate(polygons):
+            if polygon is not None and not polygon.is_empty:
+                point = polygon.representative_point()
+                group_cells[idx] = h3.geo_to_h3(point.y, point.x, max(resolution-4, 0))
+        order = np.argsort(group_cells, kind='stable')
+        polygons_wkb = shapely.to_wkb(np.asarray(polygons, dtype=object)[order])
+        ordered_rst = map_chunks_in_process_pool(_link_polygons_to_h3_worker, polygons_wkb, n_workers,
+                                                 chunk_size, resolution)
+        features_to_h3_cells = [None] * len(polygons)
+        for idx, h3_cells_detailed in zip(order.tolist(), ordered_rst):
+            features_to_h3_cells[idx] = h3_cells_detailed
+        return features_to_h3_cells
+
+    def _link_to_h3_using_polygon_intersection_python(self, resolution: int) -> List[Dict[int, dict]]:
         features_to_h3_cells = []
         h3_shapely_objects = {}
         buffer_dist = h3.edge_length(resolution, unit='m')
@@ -725,6 +1544,7 @@ class PolygonGeoData(GeoData):
             for h3_cell in h3_cells:
                 if h3_cell not in h3_shapely_objects:
                     h3_shapely_object = Polygon(h3.h3_to_geo_boundary(h3_cell, geo_json=True))
+                    h3_shapely_objects[h3_cell] = h3_shapely_object
                 else:
                     h3_shapely_object = h3_shapely_objects[h3_cell]
                 h3_area = h3_shapely_object.area
@@ -740,8 +1560,6 @@ class PolygonGeoData(GeoData):
                 }
             features_to_h3_cells.append(h3_cells_detailed)
             # print(fea_idx, ': ', sum([v['weight_in_raw_data'] for v in h3_cells_detailed.values()]))
-        if self_update:
-            self.map_to_h3_cells[resolution] = features_to_h3_cells
         return features_to_h3_cells
 
     def link_to_h3_using_centroid(self, resolution: int=11, self_update: bool=True) -> List[int]:
@@ -763,18 +1581,59 @@ class PolygonGeoData(GeoData):
             self.map_to_h3_cells[resolution] = features_to_h3_cells
         return features_to_h3_cells
 
-    def make_h3_stats(self, resolution: int, agg_attrs: Dict[str, str]={}) -> None:
+    def make_h3_stats(self, resolution: int, agg_attrs: Dict[str, str]={}, cache_dir: Optional[str]=None,
+                      engine: str='strtree') -> None:
         """
         Link this PolygonGeoData to h3 cells, then aggregate its attributes on h3 cells and make statistics
             for each h3 cell being linked with one or more polygons
         :param resolution: resolution of h3 cells to be linked with
         :param agg_attrs: defines which attributes of features should be aggregated to cells using what methods.
             See params agg_attrs of aggregate_attrs_to_cells() method for more information of available aggregation methods
-        :return: None, updates self.h3_stats[resolution] in place, see return of aggregate_attrs_to_cells() method
-            for how h3_stats as the results are formatted.
+        :param cache_dir: if not None, linking results and h3 stats are loaded from / saved to .npz files in this
+            directory, keyed by the fingerprint of source geojson file, resolution, linking method and engine and
+            aggregation spec. Note that a cached decomposition with floor assignments keeps its random draw.
+        :param engine: engine of linking based on polygon intersections, see link_to_h3_using_polygon_intersection()
+        :return: None, updates self.h3_stats[resolution] and self.h3_usage[resolution] in place, see return of
+            aggregate_attrs_to_cells() method for how h3_stats as the results are formatted.
         """
-        if resolution not in self.map_to_h3_cells:
-            self.link_to_h3(resolution)
+        agg_spec = {'agg_attrs': agg_attrs, 'use_weight': True}
+        if self._load_h3_stats_cache(resolution, agg_spec, cache_dir, engine):
+            return
+        self._link_to_h3_with_cache(resolution, cache_dir, engine)
         features_to_h3_cells = self.map_to_h3_cells[resolution]
-        h3_stats = self.aggregate_attrs_to_cells(features_to_h3_cells, self.features[self.crs['src']], agg_attrs, use_weight=True)
-        self.h3_stats[resolution] = h3_stats
\ No newline at end of file
+        h3_stats_columnar = self.aggregate_attrs_to_cells(features_to_h3_cells, self.features[self.crs['src']],
+                                                          agg_attrs, use_weight=True, as_dict=False)
+        self._set_h3_stats(resolution, h3_stats_columnar)
+        self._save_h3_stats_cache(resolution, agg_spec, h3_stats_columnar, cache_dir, engine)
+
+
+def _link_polygons_to_h3_worker(polygons_wkb: np.ndarray, resolution: int) -> List[Dict[int, dict]]:
+    """
+    Worker of PolygonGeoData.link_to_h3_using_polygon_intersection() in a process pool
+    """
+    return PolygonGeoData._link_polygons_to_h3_using_strtree(shapely.from_wkb(polygons_wkb), resolution)
+
+
+def _link_points_to_h3_worker(coords: List[tuple], resolution: int) -> List[int]:
+    """
+    Link points given as (lng, lat) to h3 cells, also the worker of PointGeoData.link_to_h3() in a process pool
+    """
+    return [h3.geo_to_h3(lat, lng, resolution) for lng, lat in coords]
+
+
+def _geometries_to_wkb_arrays(geometries: List['Geometry']) -> Dict[str, np.ndarray]:
+    # WKB of all geometries in one uint8 array, None (shapes failed to be converted) is kept
+    wkb_list = shapely.to_wkb(np.asarray(geometries, dtype=object)).tolist()
+    lengths = np.fromiter((len(wkb) if wkb is not None else 0 for wkb in wkb_list), dtype=np.int64, count=len(wkb_list))
+    return {
+        'wkb': np.frombuffer(b''.join(wkb for wkb in wkb_list if wkb is not None), dtype=np.uint8),
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]),
+        'missing': np.array([wkb is None for wkb in wkb_list], dtype=bool)
+    }
+
+
+def _wkb_arrays_to_geometries(arrays: Dict[str, np.ndarray]) -> List['Geometry']:
+    content, offsets = np.asarray(arrays['wkb']).tobytes(), arrays['offsets'].tolist()
+    wkb_list = [None if missing else content[start: end]
+                for start, end, missing in zip(offsets[:-1], offsets[1:], arrays['missing'].tolist())]
+    return shapely.from_wkb(np.asarray(wkb_list, dtype=object)).tolist()
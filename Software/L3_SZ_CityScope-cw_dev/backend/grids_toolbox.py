@@ -1,10 +1,14 @@
 import h3.api.numpy_int as h3
-import os, json, copy, re, random
+import os, json, copy, re, random, hashlib
 import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
 from collections import Counter
 from functools import reduce
+from itertools import chain
 from utils import *
-from geodata_toolbox import PolygonGeoData
+from geodata_toolbox import GeoData, PolygonGeoData, UsageDecomposition
 from population_toolbox import Population, HousingUnits
 
 
@@ -17,6 +21,10 @@ class TableGrids(PolygonGeoData):
         self.setup_grid_idx()
         self.setup_interactive_grid()
         self.density_spec = {}
+        self.interactive_usage = {}
+        self.grid_housing, self.grid_housing_states = {}, {}
+        self.grid_housing_changes = None
+        self.version = 0
 
         self.grid_centroids = [[obj.centroid.x, obj.centroid.y] for obj in self.shapely_objects[4326]]
         self.upstream_h3_cells = {}
@@ -29,6 +37,47 @@ class TableGrids(PolygonGeoData):
             self.H3 = H3Grids(h3_resolution, self.required_h3_cells[h3_resolution])
         self.values = {}
 
+    def _to_snapshot(self):
+        arrays, meta = super()._to_snapshot()
+        meta.update({
+            'spec': self.spec,
+            'land_type_def': self.land_type_def,
+            # json keys must be strings, so dicts with int keys are saved as lists of pairs
+            'density_spec': list(self.density_spec.items()),
+            'interactive_grid_layout': [[zone, list(zone_layout.items())]
+                                        for zone, zone_layout in self.interactive_grid_layout.items()],
+            'required_h3_cells': list(self.required_h3_cells.keys()),
+            'values': self.values,
+            'h3_resolution': self.H3.resolution
+        })
+        arrays['grid_centroids'] = np.asarray(self.grid_centroids, dtype=np.float64).reshape(-1, 2)
+        arrays['upstream_h3_cells'] = np.asarray(self.upstream_h3_cells, dtype=np.uint64)
+        for resolution, cells in self.required_h3_cells.items():
+            arrays[f'required_h3_cells:{resolution}'] = np.asarray(cells, dtype=np.uint64)
+        return arrays, meta
+
+    def _from_snapshot(self, arrays, meta, H3=None):
+        super()._from_snapshot(arrays, meta)
+        self.spec = meta['spec']
+        self.land_type_def = meta['land_type_def']
+        self.density_spec = dict(meta['density_spec'])
+        self.interactive_grid_layout = {zone: dict(zone_layout) for zone, zone_layout in meta['interactive_grid_layout']}
+        self.values = meta['values']
+        self.interactive_usage = {}
+        self.grid_housing, self.grid_housing_states = {}, {}
+        self.grid_housing_changes = None
+        self.version = 0
+        self.grid_centroids = arrays['grid_centroids'].tolist()
+        self.upstream_h3_cells = arrays['upstream_h3_cells'].tolist()
+        self.required_h3_cells = {resolution: arrays[f'required_h3_cells:{resolution}'].tolist()
+                                  for resolution in meta['required_h3_cells']}
+        h3_resolution = meta['h3_resolution']
+        if H3:
+            H3.required_cells = self.required_h3_cells[H3.resolution]
+            self.H3 = H3
+        else:
+            self.H3 = H3Grids(h3_resolution, required_cells=self.required_h3_cells[h3_resolution])
+
     def _get_spec(self, spec_json_path):
         use_spec_json_path = ''
         for try_spec_path in [spec_json_path,
@@ -79,85 +128,261 @@ class TableGrids(PolygonGeoData):
         self.update(layout_str)
         return layout_str, layout_ratio
 
-    def update(self, layout_str=None, changed_density=None):
+    def update(self, layout_str=None, changed_density=None, incremental=True):
+        """
+        Apply a new layout and/or density change of interactive grids, and update h3 stats and housing units
+        :param layout_str: layout string of one zone, or a list of them applied in order
+        :param incremental: if True, only interactive grids whose code or height changed since the last update are
+            mapped to h3 cells and assigned housing units again, the others keep their previous results
+        :return: set of h3 cells whose stats changed (also saved to H3.changed_cells), None if all cells were updated
+        """
+        # bumped first, so that tasks computing on the previous state can tell they are superseded
+        self.version += 1
         if layout_str is not None:
             # just change layout, all height set to None
-            self.update_interactive_grid_layout(layout_str)
+            for zone_layout_str in ([layout_str] if isinstance(layout_str, str) else layout_str):
+                self.update_interactive_grid_layout(zone_layout_str)
         if changed_density is not None:
             # just change density def
             self.update_interactive_grid_density(changed_density)
         self.apply_density_on_interactive_grid_layout()
-        self.map_interactive_grid_layout_to_h3_cells()
-        self.update_housing_and_population()
+        changed_h3_cells = self.map_interactive_grid_layout_to_h3_cells(incremental=incremental)
+        self.update_housing_and_population(incremental=incremental)
+        return changed_h3_cells
 
-    def map_interactive_grid_layout_to_h3_cells(self, resolution=None):
+    def get_update_diff(self, changed_h3_cells, resolution=None, full=False):
+        """
+        State changed by the last update(), to be applied to read-only copies of this TableGrids and its H3 with
+            apply_update_diff() instead of running update() again, e.g. in workers of indicator_toolbox.IndicatorPool.
+            Copies must apply the diffs of all updates in order.
+        :param changed_h3_cells: returned by update(), None if all cells were updated
+        :param full: the whole state updates change instead, for a copy which failed to apply a diff
+        :return: dict of picklable data: h3 stats of changed cells only, the sparse usage of interactive grids,
+            housing units of changed interactive grids only, layout and versions
+        """
+        H3 = self.H3
+        if not resolution:
+            resolution = H3.resolution
+        h3_stats, h3_stats_interactive = H3.h3_stats, self.h3_stats[resolution]
+        diff = {
+            'version': self.version,
+            'resolution': resolution,
+            'interactive_grid_layout': self.interactive_grid_layout,
+            'density_spec': self.density_spec,
+            'changed_cells': None,
+            'h3_stats': h3_stats,
+            'h3_stats_interactive': h3_stats_interactive,
+            # the combined usage is rebuilt from the base and interactive ones if possible, see combine_usage()
+            'usage': None if getattr(H3, 'usage_base', {}) else H3.usage,
+            'usage_interactive': H3.usage_interactive,
+            'versions': dict(H3.versions)
+        }
+        if changed_h3_cells is not None and not full:
+            diff['changed_cells'] = np.fromiter(changed_h3_cells, dtype=np.uint64, count=len(changed_h3_cells))
+            # None marks cells removed from h3 stats
+            diff['h3_stats'] = {h3_cell: h3_stats.get(h3_cell, None) for h3_cell in changed_h3_cells}
+            diff['h3_stats_interactive'] = {h3_cell: h3_stats_interactive.get(h3_cell, None)
+                                            for h3_cell in changed_h3_cells}
+        housing_resolution, changed_grids, removed_grids = self.grid_housing_changes or (resolution, [], [])
+        diff['housing_resolution'] = housing_resolution
+        diff['grid_housing'] = {cell_idx: self.grid_housing[housing_resolution][cell_idx] for cell_idx in changed_grids}
+        diff['removed_grids'] = removed_grids
+        diff['full'] = full
+        if full:
+            # None if housing units are not assigned yet
+            diff['grid_housing'] = self.grid_housing.get(housing_resolution, None)
+            diff['removed_grids'] = []
+        return diff
+
+    def apply_update_diff(self, diff):
+        """
+        Apply the state changed by update() on another copy, see get_update_diff()
+        """
+        H3 = self.H3
+        resolution = diff['resolution']
+        self.version = diff['version']
+        self.interactive_grid_layout = diff['interactive_grid_layout']
+        self.density_spec = diff['density_spec']
+        if diff['changed_cells'] is None:
+            H3.h3_stats = diff['h3_stats']
+            h3_stats_interactive = diff['h3_stats_interactive']
+            H3.changed_cells = None
+        else:
+            h3_stats_interactive = self.h3_stats[resolution]
+            for h3_stats, changed_stats in [(H3.h3_stats, diff['h3_stats']),
+                                            (h3_stats_interactive, diff['h3_stats_interactive'])]:
+                for h3_cell, stats in changed_stats.items():
+                    if stats is None:
+                        h3_stats.pop(h3_cell, None)
+                    else:
+                        h3_stats[h3_cell] = stats
+            H3.changed_cells = set(diff['changed_cells'].tolist())
+        self.h3_stats[resolution] = H3.h3_stats_interactive = h3_stats_interactive
+        self.h3_usage[resolution] = H3.usage_interactive = diff['usage_interactive']
+        H3.usage = H3.combine_usage([H3.usage_base, H3.usage_interactive]) if diff['usage'] is None else diff['usage']
+        # h3 stats may be updated in place, so class indexes are not invalidated by identity
+        H3.class_indexes = {}
+        H3.versions = diff['versions']
+        full = diff.get('full', False)
+        if (full and diff['grid_housing'] is not None) or diff['grid_housing'] or diff['removed_grids']:
+            housing_resolution = diff['housing_resolution']
+            if full:
+                self.grid_housing[housing_resolution] = {}
+            grid_housing = self.grid_housing.setdefault(housing_resolution, {})
+            grid_housing.update(diff['grid_housing'])
+            for cell_idx in diff['removed_grids']:
+                grid_housing.pop(cell_idx, None)
+            states = self._get_interactive_grid_states()
+            self.grid_housing_states[housing_resolution] = states
+            self._set_new_housing(housing_resolution, states)
+
+    def _get_interactive_grid_states(self):
+        """
+        :return: dict of interactive grid idx -> (code, height) of current layout
+        """
+        return {cell_idx: (cell_state['code'], cell_state['height'])
+                for zone_layout in self.interactive_grid_layout.values()
+                for cell_idx, cell_state in zone_layout.items()}
+
+    @staticmethod
+    def _diff_interactive_grid_states(states, prev_states):
+        return [cell_idx for cell_idx, state in states.items() if prev_states.get(cell_idx, None) != state]
+
+    def _get_interactive_grid_usage(self, state):
+        """
+        :param state: (code, height) of an interactive grid
+        :return: the usage attribute of this grid to be decomposed, None if it is empty or has unknown code
+        """
+        code, height = state
+        if code == -1:
+            return None
+        if str(code) not in self.land_type_def:
+            print(f'Cannot find type_def for code={code}')
+            return None
+        type_def = self.land_type_def[str(code)]
+        height = height if height else type_def['default_height']
+        return {
+            "parcel_area": self.spec.get('parcel_area', -1),
+            'height': height,
+            "sqm_pperson": type_def.get('sqm_pperson', -1),
+            "LBCS": type_def.get('LBCS', {}),
+            "NAICS": type_def.get('NAICS', {})
+        }
+
+    def map_interactive_grid_layout_to_h3_cells(self, resolution=None, incremental=False):
+        """
+        Decompose the usage of interactive grids to h3 cells and combine it with the base h3 stats of H3
+        :param incremental: if True, only interactive grids whose code or height changed since the last call are
+            decomposed again, and only h3 cells linked to them are updated in h3_stats of H3
+        :return: set of h3 cells whose stats changed (also saved to H3.changed_cells), None if all cells were updated
+        """
         H3 = self.H3
         if not resolution:
             resolution = H3.resolution
         if resolution not in self.map_to_h3_cells:
             self.link_to_h3(resolution)
         grids_to_h3_cells = self.map_to_h3_cells[resolution]
-        interactive_grids_to_h3_cells, interactive_features = [], []
-        for zone, zone_layout in self.interactive_grid_layout.items():
-            for cell_idx, cell_state in zone_layout.items():
-                if cell_state['code'] == -1:
-                    continue
-                if str(cell_state['code']) not in self.land_type_def:
-                    print(f'Cannot find type_def for code={cell_state["code"]}')
-                    continue
-                type_def = self.land_type_def[str(cell_state['code'])]
-                height = cell_state['height'] if cell_state['height'] else type_def['default_height']
-                interactive_grids_to_h3_cells.append(grids_to_h3_cells[cell_idx])
-                cell_stats = {
-                    "parcel_area": self.spec.get('parcel_area', -1),
-                    'height': height,
-                    "sqm_pperson": type_def.get('sqm_pperson', -1),
-                    "LBCS": type_def.get('LBCS', {}),
-                    "NAICS": type_def.get('NAICS', {})
-                }
-                # cell_stats = flatten_grid_cell_attributes(type_def, height,
-                #                                           attribute_names=attr_names,
-                #                                           area_per_floor=self.spec['cell_area'],
-                #                                           return_units=item_names)
-                interactive_features.append({'properties': {'usage': cell_stats}})
-        h3_stats = self.aggregate_attrs_to_cells(interactive_grids_to_h3_cells,
-                                                 interactive_features,
-                                                 agg_attrs = {'usage': 'decompose'},
-                                                 use_weight = True,
-                                                 agg_attr_names=['usage'],   # do not expand name with prefix & suffix
-                                                 decompose_spec_update={'assign_floors': True})
-        self.h3_stats[resolution] = h3_stats
-        H3.h3_stats = H3.combine_h3_stats([H3.h3_stats_base, h3_stats], agg='sum')
+        states = self._get_interactive_grid_states()
+        interactive_usage = self.interactive_usage.get(resolution, None)
+        # sparse usage could only be merged when the base one is also available
+        usage_base = getattr(H3, 'usage_base', {})
+        incremental = (incremental and interactive_usage is not None and bool(usage_base)
+                       and set(interactive_usage.grid_pos) == set(states) and H3.h3_stats is not H3.h3_stats_base)
+        if not incremental:
+            decompose_spec = copy.deepcopy(self.decompose_spec_default)
+            decompose_spec.update({'assign_floors': True})
+            interactive_usage = InteractiveUsage(list(states), [grids_to_h3_cells[cell_idx] for cell_idx in states],
+                                                 decompose_spec)
+            self.interactive_usage[resolution] = interactive_usage
+        changed_grids = self._diff_interactive_grid_states(states, interactive_usage.states)
+        changed_cells = interactive_usage.set_usages(changed_grids, [states[cell_idx] for cell_idx in changed_grids],
+                                                     [self._get_interactive_grid_usage(states[cell_idx])
+                                                      for cell_idx in changed_grids])
+        usage_interactive = {'usage': interactive_usage.get_decomposition()}
+        if not incremental:
+            h3_stats = self._set_h3_stats(resolution, {'cells': usage_interactive['usage'].cells,
+                                                       'attrs': usage_interactive})
+            h3_usage_list = [usage_base, usage_interactive] if usage_base else None
+            H3.h3_stats = H3.combine_h3_stats([H3.h3_stats_base, h3_stats], agg='sum', h3_usage_list=h3_usage_list)
+            changed_h3_cells = None
+        else:
+            h3_stats = self.h3_stats[resolution]
+            self.h3_usage[resolution] = usage_interactive
+            interactive_pos = H3DistLookup._index_of(usage_interactive['usage'].cells,
+                                                     np.argsort(usage_interactive['usage'].cells), changed_cells)
+            for h3_cell in changed_cells[interactive_pos < 0].tolist():
+                h3_stats.pop(h3_cell, None)
+            found = interactive_pos >= 0
+            for h3_cell, decomposition in zip(changed_cells[found].tolist(),
+                                              usage_interactive['usage'].take(interactive_pos[found]).to_dict_list()):
+                h3_stats[h3_cell] = {'usage': decomposition}
+            H3.update_combined_h3_stats([H3.h3_stats_base, h3_stats], [usage_base, usage_interactive], changed_cells)
+            changed_h3_cells = set(changed_cells.tolist())
         H3.h3_stats_interactive = h3_stats
+        H3.usage_interactive = usage_interactive
+        H3.changed_cells = changed_h3_cells
+        return changed_h3_cells
+
+    def _make_grid_housing_units(self, state, h3_cell_mapping):
+        """
+        :param state: (code, height) of an interactive grid
+        :param h3_cell_mapping: h3 cells linked to this grid, see GeoData.aggregate_attrs_to_cells
+        :return: list of new housing units on this grid
+        """
+        code, height = state
+        if code == -1:
+            return []
+        type_def = self.land_type_def[str(code)]
+        height = height if height else type_def['default_height']
+        if not type_def['function'].startswith('residential'):
+            # todo: population for non-residential lands
+            return []
+        housing_type_attrs = self.spec['housing_type_def'][type_def['function']]
+        num_housing_units = round(self.spec['parcel_area'] * height / housing_type_attrs['area'])
+        if num_housing_units == 0:
+            return []
+        h3_cell_assignments = random.choices(list(h3_cell_mapping.keys()),
+                                             weights=[h3_info['weight_in_raw_data']
+                                                      for h3_info in h3_cell_mapping.values()],
+                                             k=num_housing_units)
+        return self.H3.Housing.make_new_housing_units(housing_type=type_def['function'],
+                                                      h3_cells=h3_cell_assignments,
+                                                      housing_type_attrs=housing_type_attrs)
 
-    def update_housing_and_population(self, resolution=None):
+    def update_housing_and_population(self, resolution=None, incremental=False):
+        """
+        Assign new housing units to residential interactive grids
+        :param incremental: if True, only interactive grids whose code or height changed since the last call get
+            new housing units, the others keep their previous ones
+        """
         H3 = self.H3
         if not resolution:
             resolution = H3.resolution
         grids_to_h3_cells = self.map_to_h3_cells[resolution]
-        self.H3.Housing.new_housing.clear()
-        for zone, zone_layout in self.interactive_grid_layout.items():
-            for cell_idx, cell_state in zone_layout.items():
-                if cell_state['code'] == -1:
-                    continue
-                type_def = self.land_type_def[str(cell_state['code'])]
-                height = cell_state['height'] if cell_state['height'] else type_def['default_height']
-                h3_cell_mapping = grids_to_h3_cells[cell_idx]
-                if type_def['function'].startswith('residential'):
-                    housing_type_attrs = self.spec['housing_type_def'][type_def['function']]
-                    num_housing_units = round(self.spec['parcel_area'] * height / housing_type_attrs['area'])
-                    if num_housing_units == 0:
-                        continue
-                    h3_cell_assignments = random.choices(list(h3_cell_mapping.keys()),
-                                                         weights=[h3_info['weight_in_raw_data']
-                                                                  for h3_info in h3_cell_mapping.values()],
-                                                         k=num_housing_units)
-                    H3.Housing.add_new_housing_units(housing_type=type_def['function'],
-                                                     h3_cells=h3_cell_assignments,
-                                                     housing_type_attrs=housing_type_attrs)
-                else:
-                    # todo: population for non-residential lands
-                    pass
+        states = self._get_interactive_grid_states()
+        if not incremental or self.grid_housing_states.get(resolution, None) is None:
+            self.grid_housing[resolution], self.grid_housing_states[resolution] = {}, {}
+        grid_housing, prev_states = self.grid_housing[resolution], self.grid_housing_states[resolution]
+        changed_grids = self._diff_interactive_grid_states(states, prev_states)
+        removed_grids = set(grid_housing) - set(states)
+        # grids whose housing units are changed by this call, see get_update_diff()
+        self.grid_housing_changes = (resolution, changed_grids, list(removed_grids))
+        if not changed_grids and not removed_grids:
+            return
+        for cell_idx in changed_grids:
+            grid_housing[cell_idx] = self._make_grid_housing_units(states[cell_idx], grids_to_h3_cells[cell_idx])
+        for cell_idx in removed_grids:
+            del grid_housing[cell_idx]
+        self.grid_housing_states[resolution] = states
+        H3.bump_version('housing')
+        self._set_new_housing(resolution, states)
+
+    def _set_new_housing(self, resolution, states):
+        # new housing units of H3 are those of interactive grids in layout order
+        new_housing = [housing_unit for cell_idx in states for housing_unit in self.grid_housing[resolution][cell_idx]]
+        for idx, housing_unit in enumerate(new_housing):
+            housing_unit.idx = f'n{idx}'
+        self.H3.Housing.new_housing[:] = new_housing
         self.H3.Housing.all_housing = self.H3.Housing.base_housing + self.H3.Housing.new_housing
 
     def setup_grid_idx(self, save_to=True):
@@ -270,10 +495,13 @@ class TableGrids(PolygonGeoData):
         if len(this_layout) != len(grid_index_in_this_zone):
             print("#elements in the string ({}) does not match with #grids ({}), layout skipped.".format(
                 len(this_layout), len(indices)))
+        prev_codes = [cell_state['code'] for cell_state in self.interactive_grid_layout[this_zone].values()]
         self.interactive_grid_layout[this_zone] = {
             idx: {'code': type_code, 'height': None}
             for idx, type_code in zip(grid_index_in_this_zone, this_layout)
         }
+        if prev_codes != this_layout:
+            self.H3.bump_version('layout')
 
 
     def update_interactive_grid_density(self, changed_density, keep_symmetry=False):
@@ -291,6 +519,8 @@ class TableGrids(PolygonGeoData):
             scale_factor = lower_scale_factor + slider_value * (upper_scale_factor-lower_scale_factor) / 100
             new_height = default_height * scale_factor
             new_height = max(1, round(new_height))
+            if self.density_spec.get(land_type_code, None) != new_height:
+                self.H3.bump_version('density')
             self.density_spec[land_type_code] = new_height
 
 
@@ -321,6 +551,379 @@ class TableGrids(PolygonGeoData):
         return required_h3_cells
 
 
+class InteractiveUsage:
+    """
+    Decomposed usage of interactive grids kept per grid, so that a layout change only decomposes the changed grids
+    again: usage on h3 cells is link_matrix (h3 cells x grids) @ feature matrix (grids x classes) of each
+    (composition attribute, composition item) pair, see UsageDecomposition.from_features
+    """
+    def __init__(self, grid_idx, grids_to_h3_cells, decompose_spec):
+        """
+        :param grid_idx: list of interactive grid idx
+        :param grids_to_h3_cells: h3 cells linked to each grid, with the same order as grid_idx
+        :param decompose_spec: decompose specifications, see GeoData.set_default_decompose_spec
+        """
+        self.grid_pos = {cell_idx: i for i, cell_idx in enumerate(grid_idx)}
+        self.decompose_spec = decompose_spec
+        feature_idx, link_cells, link_weights = flatten_cells_to_map(grids_to_h3_cells)
+        self.cells, link_cell_pos = unique_in_order(link_cells)
+        self.link_matrix = sparse.csr_matrix((link_weights, (link_cell_pos, feature_idx)),
+                                             shape=(len(self.cells), len(self.grid_pos)))
+        self.link_matrix_csc = self.link_matrix.tocsc()
+        self.class_lookup = {}
+        self.feature_matrices = {}
+        self.active = np.zeros(len(self.grid_pos), dtype=bool)
+        self.states = {}
+
+    def set_usages(self, grid_idx, states, usages):
+        """
+        Decompose the usage of some grids again
+        :param grid_idx: list of grid idx to update
+        :param states: new state of each grid, kept to find changed grids next time
+        :param usages: new usage attribute of each grid, None for empty grids
+        :return: uint64 array of h3 cells linked to these grids
+        """
+        pos = np.array([self.grid_pos[cell_idx] for cell_idx in grid_idx], dtype=np.int64)
+        feature_matrices, self.class_lookup = UsageDecomposition.decompose_features(usages, self.decompose_spec,
+                                                                                    self.class_lookup)
+        keep = np.ones(len(self.grid_pos))
+        keep[pos] = 0
+        placement = sparse.csr_matrix((np.ones(len(pos)), (pos, np.arange(len(pos)))),
+                                      shape=(len(self.grid_pos), len(pos)))
+        for attr, items in feature_matrices.items():
+            for item, feature_matrix in items.items():
+                matrix = self.feature_matrices.get(attr, {}).get(item, None)
+                if matrix is None:
+                    matrix = sparse.csr_matrix((len(self.grid_pos), 0))
+                matrix = sparse.csr_matrix(sparse.diags(keep) @ matrix)
+                matrix.resize(len(self.grid_pos), feature_matrix.shape[1])
+                self.feature_matrices.setdefault(attr, {})[item] = (matrix + placement @ feature_matrix).tocsr()
+        self.active[pos] = [usage is not None for usage in usages]
+        self.states.update(zip(grid_idx, states))
+        changed_cell_pos = np.unique(np.concatenate(
+            [self.link_matrix_csc.indices[self.link_matrix_csc.indptr[p]: self.link_matrix_csc.indptr[p+1]]
+             for p in pos.tolist()] + [np.array([], dtype=np.int32)]))
+        return self.cells[changed_cell_pos]
+
+    def get_decomposition(self):
+        """
+        :return: UsageDecomposition on h3 cells linked to non-empty grids
+        """
+        active_cell_pos = np.flatnonzero(self.link_matrix @ self.active.astype(np.float64) > 0)
+        link_matrix = self.link_matrix[active_cell_pos]
+        matrices = {attr: {item: (link_matrix @ matrix).tocsr() for item, matrix in items.items()}
+                    for attr, items in self.feature_matrices.items()}
+        classes = {attr: list(class_lookup.keys()) for attr, class_lookup in self.class_lookup.items()}
+        return UsageDecomposition(self.cells[active_cell_pos], classes, matrices)
+
+
+class H3DistLookup:
+    """
+    Straight line distances (km) from a set of h3 cells (rows) to another set of h3 cells (columns), stored as a
+    dense float32 matrix with sorted index arrays to map cell id -> row / column. Rows are computed in blocks with a
+    vectorized haversine, either all at once or lazily on first access, and the matrix could be backed by a
+    memory-mapped .npy file. Distances involving cells out of the lookup are computed on the fly.
+    As before, the distance from a cell to itself is half of the edge length.
+    """
+    def __init__(self, resolution, from_cells, to_cells, lazy=False, mmap_path=None, block_size=256):
+        self.resolution = resolution
+        self.inner_dist = h3.edge_length(resolution) / 2
+        self.block_size = block_size
+        self.from_cells = unique_in_order(np.asarray(from_cells, dtype=np.uint64).ravel())[0]
+        self.to_cells = unique_in_order(np.asarray(to_cells, dtype=np.uint64).ravel())[0]
+        self.from_lat, self.from_lon = h3_cells_to_lat_lon(self.from_cells)
+        self.to_lat, self.to_lon = h3_cells_to_lat_lon(self.to_cells)
+        shape = (len(self.from_cells), len(self.to_cells))
+        if mmap_path:
+            os.makedirs(os.path.dirname(os.path.abspath(mmap_path)), exist_ok=True)
+            self.matrix = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            self.matrix = np.empty(shape, dtype=np.float32)
+        self.row_ready = np.zeros(shape[0], dtype=bool)
+        self._set_sorters()
+        if not lazy:
+            self._compute_rows(np.arange(shape[0]))
+
+    def _set_sorters(self):
+        self._from_sorter = np.argsort(self.from_cells, kind='stable')
+        self._to_sorter = np.argsort(self.to_cells, kind='stable')
+
+    def __len__(self):
+        return len(self.from_cells)
+
+    @staticmethod
+    def _index_of(cells, sorter, query_cells):
+        query_cells = np.asarray(query_cells, dtype=np.uint64).ravel()
+        if len(cells) == 0:
+            return np.full(len(query_cells), -1, dtype=np.int64)
+        pos = np.searchsorted(cells, query_cells, sorter=sorter).clip(max=len(cells) - 1)
+        idx = sorter[pos].astype(np.int64)
+        idx[cells[idx] != query_cells] = -1
+        return idx
+
+    def row_index(self, h3_cells):
+        """row of each cell in the matrix, -1 if out of this lookup"""
+        return self._index_of(self.from_cells, self._from_sorter, h3_cells)
+
+    def col_index(self, h3_cells):
+        """column of each cell in the matrix, -1 if out of this lookup"""
+        return self._index_of(self.to_cells, self._to_sorter, h3_cells)
+
+    def _dist_block(self, from_cells, from_lat, from_lon, to_cells, to_lat, to_lon):
+        block = haversine_dist(from_lat[:, None], from_lon[:, None], to_lat[None, :], to_lon[None, :])
+        block[from_cells[:, None] == to_cells[None, :]] = self.inner_dist
+        return block
+
+    def _compute_rows(self, rows):
+        rows = np.unique(rows)
+        rows = rows[~self.row_ready[rows]]
+        if len(rows) and not self.matrix.flags.writeable:
+            # e.g. loaded read-only from a snapshot with some rows never computed
+            self.matrix = np.array(self.matrix)
+        for start in range(0, len(rows), self.block_size):
+            block_rows = rows[start: start+self.block_size]
+            self.matrix[block_rows] = self._dist_block(self.from_cells[block_rows], self.from_lat[block_rows],
+                                                       self.from_lon[block_rows], self.to_cells,
+                                                       self.to_lat, self.to_lon)
+            self.row_ready[block_rows] = True
+
+    def get_dist_matrix(self, from_h3_cells, to_h3_cells):
+        """
+        Distances (km, float32) from each of from_h3_cells to each of to_h3_cells, shape (len(from), len(to))
+        """
+        from_h3_cells = np.asarray(from_h3_cells, dtype=np.uint64).ravel()
+        to_h3_cells = np.asarray(to_h3_cells, dtype=np.uint64).ravel()
+        rows, cols = self.row_index(from_h3_cells), self.col_index(to_h3_cells)
+        known_rows, known_cols = rows >= 0, cols >= 0
+        rst = np.empty((len(from_h3_cells), len(to_h3_cells)), dtype=np.float32)
+        if known_rows.any():
+            self._compute_rows(rows[known_rows])
+            if known_cols.any():
+                rst[np.ix_(known_rows, known_cols)] = self.matrix[np.ix_(rows[known_rows], cols[known_cols])]
+        if not known_rows.all() or not known_cols.all():
+            to_lat, to_lon = h3_cells_to_lat_lon(to_h3_cells)
+            if not known_rows.all():
+                from_cells = from_h3_cells[~known_rows]
+                rst[~known_rows] = self._dist_block(from_cells, *h3_cells_to_lat_lon(from_cells),
+                                                    to_h3_cells, to_lat, to_lon)
+            if known_rows.any() and not known_cols.all():
+                from_cells, to_cells = from_h3_cells[known_rows], to_h3_cells[~known_cols]
+                rst[np.ix_(known_rows, ~known_cols)] = self._dist_block(
+                    from_cells, *h3_cells_to_lat_lon(from_cells), to_cells, to_lat[~known_cols], to_lon[~known_cols])
+        return rst
+
+    def get_dists(self, from_h3_cell, to_h3_cells):
+        """
+        Distances (km, float32) from one cell to each of to_h3_cells
+        """
+        return self.get_dist_matrix([from_h3_cell], to_h3_cells)[0]
+
+    def iter_dist_blocks(self, from_h3_cells, to_h3_cells, block_size=None):
+        """
+        Iterate over get_dist_matrix() in blocks of rows, so that the full matrix is never held in memory
+        :return: generator of (start position in from_h3_cells, float32 distance block)
+        """
+        from_h3_cells = np.asarray(from_h3_cells, dtype=np.uint64).ravel()
+        block_size = block_size or self.block_size
+        for start in range(0, len(from_h3_cells), block_size):
+            yield start, self.get_dist_matrix(from_h3_cells[start: start+block_size], to_h3_cells)
+
+    def to_arrays(self, prefix=''):
+        return {f'{prefix}from_cells': self.from_cells, f'{prefix}to_cells': self.to_cells,
+                f'{prefix}from_lat': self.from_lat, f'{prefix}from_lon': self.from_lon,
+                f'{prefix}to_lat': self.to_lat, f'{prefix}to_lon': self.to_lon,
+                f'{prefix}matrix': self.matrix, f'{prefix}row_ready': self.row_ready}
+
+    @classmethod
+    def from_arrays(cls, arrays, resolution, prefix='', block_size=256):
+        """
+        Inverse of to_arrays(), the matrix is kept as given (e.g. memory-mapped)
+        """
+        self = cls.__new__(cls)
+        self.resolution = resolution
+        self.inner_dist = h3.edge_length(resolution) / 2
+        self.block_size = block_size
+        for name in ['from_cells', 'to_cells', 'from_lat', 'from_lon', 'to_lat', 'to_lon', 'matrix']:
+            setattr(self, name, arrays[f'{prefix}{name}'])
+        self.row_ready = np.array(arrays[f'{prefix}row_ready'])
+        self._set_sorters()
+        return self
+
+
+class H3KDTree:
+    """
+    cKDTree over centroids of h3 cells (e.g. target cells of a proximity indicator) on the unit sphere, answering
+    k-nearest and within-radius queries for a batch of cells in one call. Distances are great circle distances (km)
+    consistent with H3DistLookup, including half of the edge length from a cell to itself.
+    """
+    def __init__(self, resolution, h3_cells):
+        self.resolution = resolution
+        self.inner_dist = h3.edge_length(resolution) / 2
+        self.h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        self.tree = cKDTree(lat_lon_to_xyz(*h3_cells_to_lat_lon(self.h3_cells)))
+
+    def __len__(self):
+        return len(self.h3_cells)
+
+    def query_knn(self, h3_cells, k=1):
+        """
+        :return: dists (float64 km, shape (n, k), inf where fewer than k cells are indexed),
+            idx (positions in self.h3_cells, shape (n, k), len(self) where missing)
+        """
+        h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        if len(self) == 0:
+            return np.full((len(h3_cells), k), np.inf), np.full((len(h3_cells), k), 0, dtype=np.int64)
+        chords, idx = self.tree.query(lat_lon_to_xyz(*h3_cells_to_lat_lon(h3_cells)), k=list(range(1, k+1)))
+        dists = chord_to_dist(np.where(np.isinf(chords), 0, chords))
+        dists[np.isinf(chords)] = np.inf
+        # the same cell is always the nearest one, so replacing its zero distance keeps the order
+        same_cell = (idx < len(self)) & (self.h3_cells[np.minimum(idx, len(self) - 1)] == h3_cells[:, None])
+        dists[same_cell] = self.inner_dist
+        return dists, idx
+
+    def count_within(self, h3_cells, radius):
+        """
+        :param radius: great circle distance in km
+        :return: number of indexed cells within radius of each of h3_cells
+        """
+        h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        if len(self) == 0:
+            return np.zeros(len(h3_cells), dtype=np.int64)
+        counts = np.asarray(self.tree.query_ball_point(lat_lon_to_xyz(*h3_cells_to_lat_lon(h3_cells)),
+                                                       dist_to_chord(radius), return_length=True))
+        if radius < self.inner_dist:
+            # a cell is inner_dist away from itself instead of 0
+            counts = counts - np.isin(h3_cells, self.h3_cells)
+        return counts
+
+    def query_radius(self, h3_cells, radius):
+        """
+        :param radius: great circle distance in km, a cell itself is always included
+        :return: sorted positions in self.h3_cells of indexed cells within radius of any of h3_cells
+        """
+        h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        if len(self) == 0 or len(h3_cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if not np.isfinite(radius):
+            return np.arange(len(self))
+        idx_lists = self.tree.query_ball_point(lat_lon_to_xyz(*h3_cells_to_lat_lon(h3_cells)), dist_to_chord(radius))
+        return np.unique(np.fromiter(chain.from_iterable(idx_lists), dtype=np.int64))
+
+
+class H3KRingKernel:
+    """
+    Sparse convolution operator on the h3 lattice: a rows x cols matrix of weights w(d) from each row cell to every
+    cell within its k-ring, where d is the great circle distance (km, half of the edge length from a cell to itself).
+    A heatmap of target cells is then one sparse mat-vec, see apply().
+    Supported kernels: 'gaussian', w = exp(-d**2 / (2 * bandwidth**2)), and 'power', w = 1 / d**power
+    """
+    def __init__(self, resolution, h3_cells, k, kernel='gaussian', bandwidth=None, power=1.0):
+        self.resolution, self.k, self.kernel = resolution, k, kernel
+        self.inner_dist = h3.edge_length(resolution) / 2
+        self.bandwidth = bandwidth if bandwidth is not None else max(k, 1) * h3.edge_length(resolution) / 2
+        self.power = power
+        self.row_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        rings = [h3.k_ring(h3_cell, k) for h3_cell in self.row_cells.tolist()]
+        ring_cells = np.concatenate(rings).astype(np.uint64) if rings else np.zeros(0, dtype=np.uint64)
+        row_idx = np.repeat(np.arange(len(rings)), [len(ring) for ring in rings])
+        self.col_cells, col_idx = unique_in_order(ring_cells)
+        row_lat, row_lon = h3_cells_to_lat_lon(self.row_cells)
+        col_lat, col_lon = h3_cells_to_lat_lon(self.col_cells)
+        dists = haversine_dist(row_lat[row_idx], row_lon[row_idx], col_lat[col_idx], col_lon[col_idx])
+        dists[self.row_cells[row_idx] == ring_cells] = self.inner_dist
+        self.matrix = sparse.csr_matrix((self._weights(dists).astype(np.float32), (row_idx, col_idx)),
+                                        shape=(len(self.row_cells), len(self.col_cells)))
+        self._col_sorter = np.argsort(self.col_cells, kind='stable')
+
+    def _weights(self, dists):
+        if self.kernel == 'gaussian':
+            return np.exp(-dists ** 2 / (2 * self.bandwidth ** 2))
+        elif self.kernel == 'power':
+            return 1 / dists ** self.power
+        raise ValueError(f'Invalid kernel: {self.kernel}')
+
+    def target_vector(self, target_h3_cells, weights=None):
+        """
+        Column vector of target weights (1 by default), targets out of every k-ring of row cells are dropped
+        """
+        col_idx = H3DistLookup._index_of(self.col_cells, self._col_sorter, target_h3_cells)
+        weights = np.ones(len(col_idx)) if weights is None else np.asarray(weights, dtype=np.float64)
+        found = col_idx >= 0
+        return np.bincount(col_idx[found], weights[found], minlength=len(self.col_cells))
+
+    def apply(self, target_h3_cells, weights=None):
+        """
+        :return: sum of w(d) * target weight over targets within the k-ring of each row cell, float64 array
+        """
+        return self.matrix.dot(self.target_vector(target_h3_cells, weights)).astype(np.float64)
+
+
+class H3ClassIndex:
+    """
+    Inverted index from the classes of one (composition attribute, composition item) pair of a decomposed usage,
+    e.g. ("LBCS", "area"), to the cells containing them: a classes x cells sparse matrix, so that selecting the
+    cells of target classes reads a few matrix rows instead of iterating nested dicts of every cell
+    """
+    def __init__(self, usage, attr='LBCS', item='area'):
+        self.attr, self.item = attr, item
+        self.cells = usage.cells
+        self.classes = usage.classes.get(attr, np.array([], dtype=str))
+        matrix = usage.matrices.get(attr, {}).get(item, None)
+        if matrix is None:
+            matrix = sparse.csr_matrix((len(self.cells), len(self.classes)))
+        self.matrix = sparse.csr_matrix(matrix.T)
+        self.class_pos = {class_name: i for i, class_name in enumerate(self.classes.tolist())}
+        self.prefix_pos = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def class_rows(self, target_class, first_n_digits=None):
+        """
+        Rows of the classes matching target_class
+        :param first_n_digits: if not None, a class matches if its first n digits equal the target class
+        """
+        if not first_n_digits:
+            target_class = str(target_class)
+            return np.array([self.class_pos[target_class]] if target_class in self.class_pos else [], dtype=np.int64)
+        if first_n_digits not in self.prefix_pos:
+            prefix_pos = {}
+            for i, class_name in enumerate(self.classes.tolist()):
+                prefix_pos.setdefault(get_first_n_digits(class_name, first_n_digits), []).append(i)
+            self.prefix_pos[first_n_digits] = {prefix: np.array(rows, dtype=np.int64)
+                                               for prefix, rows in prefix_pos.items()}
+        return self.prefix_pos[first_n_digits].get(get_first_n_digits(target_class, first_n_digits),
+                                                   np.array([], dtype=np.int64))
+
+    def class_values(self, target_class, first_n_digits=None):
+        """
+        :return: (positions in self.cells, amount of target class) of cells containing it, classes matched by
+            prefix are summed per cell
+        """
+        rows = self.class_rows(target_class, first_n_digits)
+        indptr = self.matrix.indptr
+        if len(rows) == 1:
+            return (self.matrix.indices[indptr[rows[0]]: indptr[rows[0]+1]].astype(np.int64),
+                    self.matrix.data[indptr[rows[0]]: indptr[rows[0]+1]])
+        pos = np.concatenate([self.matrix.indices[indptr[row]: indptr[row+1]] for row in rows] + [[]]).astype(np.int64)
+        values = np.concatenate([self.matrix.data[indptr[row]: indptr[row+1]] for row in rows] + [[]])
+        pos, inverse = np.unique(pos, return_inverse=True)
+        return pos, np.bincount(inverse, values, minlength=len(pos))
+
+    def select(self, target_classes, threshold=0, first_n_digits=None):
+        """
+        Cells where the amount of any target class is larger than threshold
+        :return: uint64 array of cells without duplicates, in the order of self.cells
+        """
+        if type(target_classes) != list:
+            target_classes = [target_classes]
+        selected = []
+        for target_class in target_classes:
+            pos, values = self.class_values(target_class, first_n_digits)
+            selected.append(pos[values > threshold])
+        return self.cells[np.unique(np.concatenate(selected + [np.array([], dtype=np.int64)]))]
+
+
 class H3Grids:
     def __init__(self, resolution, Pop=None, Housing=None, required_cells=[]):
         self.resolution = resolution
@@ -332,9 +935,108 @@ class H3Grids:
         self.h3_stats = {}
         self.h3_stats_base = {}
         self.h3_stats_interactive = {}
+        self.usage = {}
+        self.usage_base = {}
+        self.usage_interactive = {}
         self.results = {}
-        self.dist_lookup = {}
+        self.dist_lookup = None
+        self.kring_kernels = {}
+        self.class_indexes = {}
+        self.changed_cells = None
+        self.versions = {}
+        self.memo = {}
         self.precooked_rsts = {}
+        self.boundary_cache = H3BoundaryCache()
+
+    def save_snapshot(self, snapshot_dir, with_population=True, with_housing=True):
+        """
+        Save this H3Grids to a snapshot directory, see utils.write_snapshot() for the format.
+        Population and housing units are saved to sub-directories "population" and "housing".
+        """
+        arrays = {'required_cells': np.asarray(self.required_cells, dtype=np.uint64)}
+        meta = {'resolution': self.resolution, 'h3_cell_area': self.h3_cell_area, 'h3_stats': [],
+                'results': self.results, 'values': [], 'precooked_rsts': []}
+        for name, usage_name in [('h3_stats', 'usage'), ('h3_stats_base', 'usage_base'),
+                                 ('h3_stats_interactive', 'usage_interactive')]:
+            h3_stats = getattr(self, name)
+            if name != 'h3_stats' and h3_stats is self.h3_stats:
+                # e.g. after set_current_h3_stats_as_base(), only saved once
+                meta['h3_stats'].append([name, 'h3_stats'])
+                continue
+            stats_arrays, stats_meta = GeoData.h3_stats_to_arrays(h3_stats, getattr(self, usage_name, {}))
+            arrays.update(prefix_arrays(stats_arrays, f'{name}:'))
+            meta['h3_stats'].append([name, stats_meta])
+        for i, (attr, cell_values) in enumerate(self.values.items()):
+            values = list(cell_values.values())
+            arrays[f'values:{i}:cells'] = np.fromiter(cell_values.keys(), dtype=np.uint64, count=len(cell_values))
+            if all(isinstance(v, (int, float, np.number)) for v in values):
+                arrays[f'values:{i}:values'] = np.asarray(values)
+                meta['values'].append([attr, 'array'])
+            else:
+                arrays[f'values:{i}:values'] = json_to_array(values)
+                meta['values'].append([attr, 'json'])
+        if self.dist_lookup is not None:
+            arrays.update(self.dist_lookup.to_arrays(prefix='dist_lookup:'))
+        arrays.update(self.boundary_cache.to_arrays(prefix='boundaries:'))
+        for i, (name, rst) in enumerate(self.precooked_rsts.items()):
+            if isinstance(rst, pd.DataFrame):
+                df_arrays, columns = dataframe_to_arrays(rst)
+                arrays.update(prefix_arrays(df_arrays, f'precooked_rsts:{i}:'))
+                meta['precooked_rsts'].append([name, 'dataframe', columns])
+            else:
+                meta['precooked_rsts'].append([name, 'json', rst])
+        write_snapshot(snapshot_dir, arrays, meta, kind=type(self).__name__)
+        if with_population:
+            self.Pop.save_snapshot(os.path.join(snapshot_dir, 'population'))
+        if with_housing:
+            self.Housing.save_snapshot(os.path.join(snapshot_dir, 'housing'))
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir, mmap=True, Pop=None, Housing=None):
+        """
+        Load a H3Grids saved by save_snapshot(). Population and housing units are loaded from the sub-directories
+        unless Pop / Housing are given.
+        """
+        arrays, meta = read_snapshot(snapshot_dir, kind=cls.__name__, mmap=mmap)
+        self = cls.__new__(cls)
+        self.resolution, self.h3_cell_area = meta['resolution'], meta['h3_cell_area']
+        if Pop is None and os.path.exists(os.path.join(snapshot_dir, 'population')):
+            Pop = Population.load_snapshot(os.path.join(snapshot_dir, 'population'), mmap=mmap)
+        if Housing is None and os.path.exists(os.path.join(snapshot_dir, 'housing')):
+            Housing = HousingUnits.load_snapshot(os.path.join(snapshot_dir, 'housing'), mmap=mmap)
+        self.set_population(Pop)
+        self.set_housing(Housing)
+        self.required_cells = arrays['required_cells'].tolist()
+        usage_names = {'h3_stats': 'usage', 'h3_stats_base': 'usage_base', 'h3_stats_interactive': 'usage_interactive'}
+        for name, stats_meta in meta['h3_stats']:
+            if stats_meta == 'h3_stats':
+                h3_stats, usage = self.h3_stats, self.usage
+            else:
+                h3_stats, usage = GeoData.arrays_to_h3_stats(select_arrays(arrays, f'{name}:'), stats_meta)
+            setattr(self, name, h3_stats)
+            setattr(self, usage_names[name], usage)
+        self.values = {}
+        for i, (attr, kind) in enumerate(meta['values']):
+            values = arrays[f'values:{i}:values']
+            values = values.tolist() if kind == 'array' else array_to_json(values)
+            self.values[attr] = dict(zip(arrays[f'values:{i}:cells'].tolist(), values))
+        self.dist_lookup = None
+        if 'dist_lookup:matrix' in arrays:
+            self.dist_lookup = H3DistLookup.from_arrays(arrays, self.resolution, prefix='dist_lookup:')
+        self.kring_kernels = {}
+        self.class_indexes = {}
+        self.changed_cells = None
+        self.versions = {}
+        self.memo = {}
+        self.precooked_rsts = {}
+        for i, (name, kind, content) in enumerate(meta['precooked_rsts']):
+            if kind == 'dataframe':
+                self.precooked_rsts[name] = arrays_to_dataframe(select_arrays(arrays, f'precooked_rsts:{i}:'), content)
+            else:
+                self.precooked_rsts[name] = content
+        self.boundary_cache = H3BoundaryCache.from_arrays(arrays, prefix='boundaries:')
+        self.results = meta['results']
+        return self
 
     def set_population(self, Pop):
         if Pop:
@@ -348,13 +1050,7 @@ class H3Grids:
         else:
             self.Housing = HousingUnits()
 
-    def combine_h3_stats(self, h3_stats_list, missing_value=0, remove_prefix=True, remove_suffix=True, agg='sum'):
-        h3_stats_list = [x for x in h3_stats_list if len(x)>0]   # get rid of empty h3_stats
-        h3_cells = reduce(lambda x,y: x+y, [list(h3_stats.keys()) for h3_stats in h3_stats_list], [])
-        h3_attrs = reduce(lambda x,y: x+y, [list(list(h3_stats.values())[0].keys()) for h3_stats in h3_stats_list], [])
-        # print('Original attribute names:')
-        # print(h3_attrs)
-        h3_attrs_raw = copy.deepcopy(h3_attrs)
+    def _clean_attr_names(self, h3_attrs, remove_prefix=True, remove_suffix=True):
         if remove_prefix:
             prefix_pattern = re.compile('^\[.*\]_(.*)')
             prefix_match = [prefix_pattern.findall(attr) for attr in h3_attrs]
@@ -363,6 +1059,29 @@ class H3Grids:
             suffix_pattern = re.compile('(.*)_\(.*\)$')
             suffix_match = [suffix_pattern.findall(attr) for attr in h3_attrs]
             h3_attrs = [match[0] if len(match)>0 else raw_attr for raw_attr, match in zip(h3_attrs, suffix_match)]
+        return h3_attrs
+
+    def combine_h3_stats(self, h3_stats_list, missing_value=0, remove_prefix=True, remove_suffix=True, agg='sum',
+                         h3_usage_list=None):
+        """
+        Combine h3 stats of different layers
+        :param h3_stats_list: list of h3_stats in dict view, see GeoData.aggregate_attrs_to_cells
+        :param missing_value: value of attributes on cells where a layer does not exist
+        :param remove_prefix: remove "[layer name]_" from attribute names
+        :param remove_suffix: remove "_(aggregation method)" from attribute names
+        :param agg: "sum" or "replace"
+        :param h3_usage_list: list of sparse decomposed attributes (dict of attribute name -> UsageDecomposition,
+            e.g. GeoData.h3_usage[resolution]) of the same layers. If given, decomposed attributes are merged by
+            sparse addition and saved to self.usage, otherwise they are merged in nested dicts and self.usage is reset.
+        :return: combined h3 stats in dict view
+        """
+        h3_stats_list = [x for x in h3_stats_list if len(x)>0]   # get rid of empty h3_stats
+        h3_cells = reduce(lambda x,y: x+y, [list(h3_stats.keys()) for h3_stats in h3_stats_list], [])
+        h3_attrs = reduce(lambda x,y: x+y, [list(list(h3_stats.values())[0].keys()) for h3_stats in h3_stats_list], [])
+        # print('Original attribute names:')
+        # print(h3_attrs)
+        h3_attrs_raw = copy.deepcopy(h3_attrs)
+        h3_attrs = self._clean_attr_names(h3_attrs, remove_prefix, remove_suffix)
         h3_attrs_lookup = {raw: new for raw, new in zip(h3_attrs_raw, h3_attrs)}
         h3_attrs = list(set(h3_attrs))   # get rid of duplicated attr names
         # print('\nCombined attribute names:')
@@ -371,6 +1090,13 @@ class H3Grids:
             h3_cell: {h3_attr: missing_value for h3_attr in h3_attrs}
             for h3_cell in h3_cells
         }
+        usage = {}
+        if h3_usage_list and agg == 'sum':
+            usage_to_combine = {}
+            for h3_usage in h3_usage_list:
+                for raw_attr, clean_attr in zip(h3_usage, self._clean_attr_names(list(h3_usage), remove_prefix, remove_suffix)):
+                    usage_to_combine.setdefault(clean_attr, []).append(h3_usage[raw_attr])
+            usage = {attr: UsageDecomposition.combine(x) for attr, x in usage_to_combine.items()}
         for this_h3_stats in h3_stats_list:
             for h3_cell, attrs_dict in this_h3_stats.items():
                 for attr, value in attrs_dict.items():
@@ -379,6 +1105,8 @@ class H3Grids:
                             combined_h3_stats[h3_cell][h3_attrs_lookup[attr]] += value
                         elif type(value) == dict:
                             # this is a decomposed attribute
+                            if h3_attrs_lookup[attr] in usage:
+                                continue   # filled from sparse results below
                             rst = combined_h3_stats[h3_cell][h3_attrs_lookup[attr]]
                             if type(rst) != dict:
                                 rst = copy.deepcopy(value)
@@ -398,21 +1126,140 @@ class H3Grids:
 
                     elif agg == 'replace':
                         combined_h3_stats[h3_cell][h3_attrs_lookup[attr]] = value
+        for attr, this_usage in usage.items():
+            for h3_cell, decomposition in zip(this_usage.cells.tolist(), this_usage.to_dict_list()):
+                combined_h3_stats[h3_cell][attr] = decomposition
         self.h3_stats = combined_h3_stats
+        self.usage = usage
+        self.class_indexes = {}
+        self.bump_version('h3_stats')
         return combined_h3_stats
 
+    def update_combined_h3_stats(self, h3_stats_list, h3_usage_list, changed_cells, missing_value=0):
+        """
+        Update the results of combine_h3_stats() (agg="sum", with sparse usage) on changed cells only, e.g. after a
+        layer changed on a few cells. Attribute names of layers must be clean already, as of h3_stats_base.
+        :param h3_stats_list: list of h3_stats in dict view, with their latest values
+        :param h3_usage_list: list of sparse decomposed attributes of the same layers
+        :param changed_cells: cells whose stats changed in any layer
+        :return: combined h3 stats in dict view, self.h3_stats updated in place
+        """
+        self.usage = self.combine_usage(h3_usage_list)
+        changed_cells = np.asarray(changed_cells, dtype=np.uint64).ravel()
+        usage_dicts = {}
+        for attr, this_usage in self.usage.items():
+            pos = H3DistLookup._index_of(this_usage.cells, np.argsort(this_usage.cells), changed_cells)
+            usage_dicts[attr] = dict(zip(changed_cells[pos >= 0].tolist(), this_usage.take(pos[pos >= 0]).to_dict_list()))
+        h3_attrs = list(next(iter(self.h3_stats.values())).keys()) if self.h3_stats else []
+        for h3_cell in changed_cells.tolist():
+            layers = [h3_stats[h3_cell] for h3_stats in h3_stats_list if h3_cell in h3_stats]
+            if not layers:
+                self.h3_stats.pop(h3_cell, None)
+                continue
+            combined = {h3_attr: missing_value for h3_attr in h3_attrs}
+            for attrs_dict in layers:
+                for attr, value in attrs_dict.items():
+                    if attr not in self.usage and parse_num(value) is not None:
+                        combined[attr] = combined.get(attr, missing_value) + value
+            for attr, this_usage_dicts in usage_dicts.items():
+                combined[attr] = this_usage_dicts.get(h3_cell, missing_value)
+            self.h3_stats[h3_cell] = combined
+        self.class_indexes = {}
+        if len(changed_cells) > 0:
+            self.bump_version('h3_stats')
+        return self.h3_stats
+
+    @staticmethod
+    def combine_usage(h3_usage_list):
+        """
+        Merge sparse decomposed attributes of layers by sparse addition, attribute names must be clean already
+        :param h3_usage_list: list of dict of attribute name -> UsageDecomposition
+        :return: dict of attribute name -> combined UsageDecomposition
+        """
+        usage_to_combine = {}
+        for h3_usage in h3_usage_list:
+            for attr, this_usage in h3_usage.items():
+                usage_to_combine.setdefault(attr, []).append(this_usage)
+        return {attr: UsageDecomposition.combine(x) for attr, x in usage_to_combine.items()}
+
+    def bump_version(self, *names):
+        """
+        Mark inputs of indicators as changed, e.g. "layout", "density", "h3_stats", "housing"
+        """
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def get_versions(self, names):
+        return tuple(self.versions.get(name, 0) for name in names)
+
+    def memoize(self, key, inputs, fun):
+        """
+        Get an intermediate result shared by indicators, computed by fun() once until any of its inputs changes
+        :param key: name of this intermediate result
+        :param inputs: list of version names this result depends on, see bump_version()
+        :param fun: function without arguments to compute the result
+        """
+        versions = self.get_versions(inputs)
+        memo = self.memo.get(key, None)
+        if memo is None or memo[0] != versions:
+            memo = (versions, fun())
+            self.memo[key] = memo
+        return memo[1]
+
+    def get_usage(self, usage_name='usage'):
+        """
+        Get the sparse decomposed usage of current h3_stats
+        :param usage_name: the name of decomposed usage attribute
+        :return: UsageDecomposition, built from the dict view of h3_stats if the sparse one is not maintained
+        """
+        usage = getattr(self, 'usage', {})
+        if usage_name in usage:
+            return usage[usage_name]
+        return UsageDecomposition.from_h3_stats(self.h3_stats, usage_name)
+
+    def get_class_index(self, attr='LBCS', item='area', usage_name='usage'):
+        """
+        Get the H3ClassIndex of current h3_stats, built once and kept until h3_stats are combined again
+        """
+        key = (usage_name, attr, item)
+        indexed_h3_stats, class_index = self.class_indexes.get(key, (None, None))
+        if indexed_h3_stats is not self.h3_stats:
+            class_index = H3ClassIndex(self.get_usage(usage_name), attr, item)
+            self.class_indexes[key] = (self.h3_stats, class_index)
+        return class_index
+
     def set_current_h3_stats_as_base(self):
         self.h3_stats_base = self.h3_stats
+        self.usage_base = self.usage
 
     def export_h3_features(self, save_to=None):
         if not self.h3_stats:
             print('Error: must have h3_info first')
             return
         h3_stats = self.h3_stats
-        h3_features = export_h3_features(h3_stats, save_to)
+        h3_features = export_h3_features(h3_stats, save_to, self.boundary_cache)
         return h3_features
 
-    def _get_h3_dist_lookup(self, from_h3_cells=None, to_h3_cells=None, Table=None, self_update=True):
+    def get_kring_kernel(self, k, kernel='gaussian', bandwidth=None, power=1.0, h3_cells=None):
+        """
+        Get the H3KRingKernel from h3_cells (default: required cells), built once and cached per parameters
+        """
+        if h3_cells is None:
+            h3_cells = self.required_cells
+        h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+        key = (k, kernel, bandwidth, power, hashlib.sha1(h3_cells.tobytes()).hexdigest())
+        if key not in self.kring_kernels:
+            self.kring_kernels[key] = H3KRingKernel(self.resolution, h3_cells, k, kernel, bandwidth, power)
+        return self.kring_kernels[key]
+
+    def _get_h3_dist_lookup(self, from_h3_cells=None, to_h3_cells=None, Table=None, self_update=True,
+                            lazy=False, mmap_path=None):
+        """
+        Build the H3DistLookup from from_h3_cells (default: required cells) to to_h3_cells (default: cells with
+        h3 stats and cells linked to Table)
+        :param lazy: if True, rows of the distance matrix are computed on first access instead of now
+        :param mmap_path: if given, the distance matrix is a memory-mapped .npy file at this path
+        """
         if not from_h3_cells:
             from_h3_cells = self.required_cells
         if not to_h3_cells:
@@ -422,20 +1269,9 @@ class H3Grids:
                     link_rst_list = Table.map_to_h3_cells[self.resolution]
                 else:
                     link_rst_list = Table.link_to_h3(self.resolution, self_update=False)
-                h3_cells_linked_to_table = reduce(lambda x,y: x+y,
-                                                  [list(link_rst.keys()) for link_rst in link_rst_list],
-                                                  [])
-                to_h3_cells += h3_cells_linked_to_table
-                to_h3_cells = list(set(to_h3_cells))
-
-        inner_dist = h3.edge_length(self.resolution) / 2
-        dist_lookup = {}
-        for from_h3_cell in from_h3_cells:
-            dist_lookup[from_h3_cell] = {
-                to_h3_cell: h3.point_dist(h3.h3_to_geo(from_h3_cell), h3.h3_to_geo(to_h3_cell))
-                if to_h3_cell != from_h3_cell else inner_dist
-                for to_h3_cell in to_h3_cells
-            }
+                h3_cells_linked_to_table = [h3_cell for link_rst in link_rst_list for h3_cell in link_rst]
+                to_h3_cells = list(set(to_h3_cells + h3_cells_linked_to_table))
+        dist_lookup = H3DistLookup(self.resolution, from_h3_cells, to_h3_cells, lazy=lazy, mmap_path=mmap_path)
         if self_update:
             self.dist_lookup = dist_lookup
         return dist_lookup
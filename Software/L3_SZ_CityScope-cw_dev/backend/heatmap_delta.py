@@ -0,0 +1,230 @@
+import hashlib, threading, time, zlib
+import numpy as np
+
+#======================================#
+#          Constants                   #
+#======================================#
+# seconds a receiver out of sync waits for the full message before asking again
+RESYNC_TIMEOUT = 5
+
+
+#======================================#
+#          Functions                   #
+#======================================#
+def round_values(values, round_digits):
+    """
+    Round as python round() does, which the text of heatmaps uses: np.round() differs at some halfway cases, so
+    values close to a halfway case are rounded by round() one by one
+    :param values: float array
+    :return: rounded float array, and the rounded values as integers of value * 10**round_digits (None if they
+        are not exact, i.e. round_digits is out of 0 ~ 22, or with non-finite values or -0.0)
+    """
+    if not 0 <= round_digits <= 22:
+        return np.array([round(value, round_digits) for value in values.tolist()]), None
+    scale = 10 ** round_digits
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = values * scale
+        ints = np.rint(scaled)
+        ambiguous = (np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-9 * np.maximum(1, np.abs(scaled))) | \
+                    (np.abs(scaled) >= 2**52)
+    ambiguous &= np.isfinite(values)
+    rounded = ints / scale
+    for idx in np.flatnonzero(ambiguous).tolist():
+        rounded[idx] = round(float(values[idx]), round_digits)
+        ints[idx] = round(rounded[idx] * scale)
+    if not (np.isfinite(rounded).all() and np.abs(ints).max(initial=0) < 2**53) or \
+            (np.signbit(rounded) & (rounded == 0)).any():
+        return rounded, None
+    return rounded, compact_ints(ints.astype(np.int64))
+
+
+def compact_ints(ints):
+    """
+    :return: integer array in the smallest dtype holding its values
+    """
+    if len(ints) == 0:
+        return ints.astype(np.uint8)
+    return ints.astype(np.result_type(np.min_scalar_type(ints.min()), np.min_scalar_type(ints.max())))
+
+
+def pack_keys(keys):
+    """
+    :return: uint8 array of the keys compressed with their bytes transposed, the high bytes of h3 cells or grid
+        indices being mostly the same
+    """
+    shuffled = np.ascontiguousarray(keys).view(np.uint8).reshape(-1, keys.dtype.itemsize).T
+    return np.frombuffer(zlib.compress(shuffled.tobytes()), dtype=np.uint8)
+
+
+def unpack_keys(packed, dtype):
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(np.asarray(packed, dtype=np.uint8).tobytes()), dtype=np.uint8)
+    return np.ascontiguousarray(shuffled.reshape(dtype.itemsize, -1).T).view(dtype).ravel()
+
+
+#======================================#
+#             Class                    #
+#======================================#
+class HeatmapFrame:
+    """
+    A heatmap result in delta mode (see Indicator.set_heatmap_delta): the text for the udp frontend, and the values
+    of the heatmap keyed by h3 cells or table grid indices, rounded as in the text
+    """
+    def __init__(self, text, keys, values, format_str='{}', round_digits=None):
+        self.text = text
+        self.keys = np.asarray(keys)
+        self.values = np.asarray(values)
+        if self.values.dtype.kind not in 'iuf':
+            self.values = self.values.astype(np.float64)
+        # sent as integers: integer values in their smallest dtype, and values rounded to round_digits as
+        # value * 10**value_digits
+        self.sent_values, self.value_digits = self.values, None
+        if self.values.dtype.kind in 'iu':
+            self.sent_values = compact_ints(self.values)
+        elif round_digits is not None:
+            self.values, scaled_values = round_values(self.values.astype(np.float64), round_digits)
+            self.sent_values = self.values
+            if scaled_values is not None:
+                self.sent_values, self.value_digits = scaled_values, round_digits
+        self.format_str = format_str
+        self.round_digits = round_digits
+
+
+class HeatmapDeltaEncoder:
+    """
+    Turn successive HeatmapFrames of one heatmap into messages: a full message with the keys (sent again only when
+    they change, identified by their content hash) and values, then delta messages of the positions and values of
+    changed cells only. Keys are sent compressed and rounded values as integers, see HeatmapDeltaDecoder. A
+    receiver out of sync asks for a full message again, see full_message()
+    """
+    def __init__(self, indicator_name, task_name):
+        self.indicator_name = indicator_name
+        self.task_name = task_name
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.keys = None
+        self.packed_keys = None
+        self.index_hash = None
+        self.values = None
+        self.sent_values, self.value_digits = None, None
+        self.format_str, self.round_digits = '{}', None
+        self.resync_requested = False
+
+    @staticmethod
+    def hash_index(keys, format_str, round_digits):
+        digest = hashlib.sha1(np.ascontiguousarray(keys).tobytes())
+        digest.update(f'{keys.dtype.str}|{format_str}|{round_digits}'.encode())
+        return digest.hexdigest()[:16]
+
+    def encode(self, frame):
+        """
+        :param frame: HeatmapFrame
+        :return: message dict, a full message if the keys changed or a resync was requested, otherwise a delta
+        """
+        with self.lock:
+            self.seq += 1
+            index_hash = self.hash_index(frame.keys, frame.format_str, frame.round_digits)
+            keys_changed = index_hash != self.index_hash
+            if self.resync_requested or keys_changed or frame.values.dtype != self.values.dtype:
+                if keys_changed:
+                    self.keys, self.packed_keys, self.index_hash = frame.keys, pack_keys(frame.keys), index_hash
+                self.values, self.sent_values, self.value_digits = frame.values, frame.sent_values, frame.value_digits
+                self.format_str, self.round_digits = frame.format_str, frame.round_digits
+                self.resync_requested = False
+                return self._full_message()
+            changed = ~((frame.values == self.values) | (np.isnan(frame.values) & np.isnan(self.values)))
+            positions = np.flatnonzero(changed)
+            self.values, self.sent_values, self.value_digits = frame.values, frame.sent_values, frame.value_digits
+            return {'type': 'heatmap_delta', 'indicator': self.indicator_name, 'task': self.task_name,
+                    'seq': self.seq, 'index_hash': self.index_hash,
+                    'positions': compact_ints(positions), 'value_digits': self.value_digits,
+                    'values': self.sent_values[positions]}
+
+    def full_message(self):
+        """
+        :return: full message of the latest values with the same seq, for a receiver asking to resync; None if
+            nothing is encoded yet
+        """
+        with self.lock:
+            if self.values is None:
+                self.resync_requested = True
+                return None
+            return self._full_message()
+
+    def _full_message(self):
+        return {'type': 'heatmap_full', 'indicator': self.indicator_name, 'task': self.task_name,
+                'seq': self.seq, 'index_hash': self.index_hash,
+                'keys': self.packed_keys, 'keys_dtype': self.keys.dtype.str, 'value_digits': self.value_digits,
+                'values': self.sent_values,
+                'format_str': self.format_str, 'round_digits': self.round_digits}
+
+
+class HeatmapDeltaDecoder:
+    """
+    Rebuild a heatmap from the messages of a HeatmapDeltaEncoder. The text of each value is kept, so that only those
+    of changed values are formatted again
+    """
+    def __init__(self, resync_timeout=RESYNC_TIMEOUT):
+        self.seq = None
+        self.index_hash = None
+        self.keys = None
+        self.values = None
+        self.value_texts = None
+        self.format_str, self.round_digits = '{}', None
+        self.resync_timeout = resync_timeout
+        self.resync_requested_at = None
+
+    @staticmethod
+    def is_heatmap_msg(msg_data):
+        return type(msg_data) == dict and msg_data.get('type', None) in ('heatmap_full', 'heatmap_delta')
+
+    @staticmethod
+    def _decode_values(msg_data):
+        values = np.asarray(msg_data['values'])
+        if msg_data['value_digits'] is not None:
+            return values / 10 ** msg_data['value_digits']
+        # copied, values of msgpack payloads are read-only, and integers widened to hold those of later deltas
+        return values.astype(np.int64 if values.dtype.kind in 'iu' else np.float64)
+
+    def apply(self, msg_data):
+        """
+        :return: True if the heatmap is up to date, False if a delta is missing or does not fit the keys held, then
+            a full message should be requested, see request_resync()
+        """
+        if msg_data['type'] == 'heatmap_full':
+            if msg_data['index_hash'] != self.index_hash:
+                self.keys = unpack_keys(msg_data['keys'], msg_data['keys_dtype'])
+            self.format_str, self.round_digits = msg_data['format_str'], msg_data['round_digits']
+            self.values = self._decode_values(msg_data)
+            self.value_texts = [str(value) for value in self.values.tolist()]
+            self.resync_requested_at = None
+        else:
+            if self.values is None or msg_data['index_hash'] != self.index_hash or msg_data['seq'] != self.seq + 1:
+                # the latest values are unknown until resynced
+                self.values = None
+                return False
+            positions = np.asarray(msg_data['positions'], dtype=np.int64)
+            values = self._decode_values(msg_data)
+            self.values[positions] = values
+            value_texts = self.value_texts
+            for position, value in zip(positions.tolist(), values.tolist()):
+                value_texts[position] = str(value)
+        self.seq, self.index_hash = msg_data['seq'], msg_data['index_hash']
+        return True
+
+    def request_resync(self):
+        """
+        :return: True if a full message should be requested now: none is requested yet, or the last request got
+            no answer within resync_timeout; deltas arriving in between are dropped without asking again
+        """
+        now = time.time()
+        if self.resync_requested_at is not None and now - self.resync_requested_at < self.resync_timeout:
+            return False
+        self.resync_requested_at = now
+        return True
+
+    def to_text(self):
+        """
+        :return: the text sent to the udp frontend in the former full mode
+        """
+        return self.format_str.format(' '.join(self.value_texts))
@@ -1,9 +1,12 @@
-import os, time, socket, threading, json, sys, traceback
+import os, gc, time, socket, threading, json, sys, traceback, pickle, multiprocessing, asyncio
 import paho.mqtt.client as mqtt
 import h3.api.numpy_int as h3
 import numpy as np
 from scipy import stats
-from grids_toolbox import H3Grids
+from grids_toolbox import H3Grids, H3KDTree
+from utils import LatencyHistogram
+from payload_codec import get_codec, decode_payload
+from heatmap_delta import HeatmapFrame, HeatmapDeltaEncoder, HeatmapDeltaDecoder
 import matplotlib.pyplot as plt
 
 def formatting_conditions(condition_list):
@@ -13,6 +16,13 @@ def formatting_conditions(condition_list):
     return condition_list
 
 
+class TaskSuperseded(Exception):
+    """
+    Raised by Indicator.check_superseded() to abort a task computing on a stale table version
+    """
+    pass
+
+
 class Indicator:
     def __init__(self, H3, name='', Table=None):
         self.H3 = H3
@@ -20,71 +30,206 @@ class Indicator:
         self.Table = Table
         self.work_dir = Table.work_dir if Table else None
         self.name = name
-        if not self.H3.dist_lookup:
+        if self.H3.dist_lookup is None:
             self.H3._get_h3_dist_lookup(Table=Table)
         self.mqtt = None
         self.udp = None
         self.scheduled_tasks = []
+        self.task_cache = {}
+        self.task_timings = {}
+        self.is_superseded = None
+        self.heatmap_delta = False
+        self.heatmap_encoders = {}
 
     def set_mqtt_communicator(self, mqtt_ip='localhost', mqtt_port=1883,
                               mqtt_update_topic='update',
-                              mqtt_results_topic='results'):
+                              mqtt_results_topic='results',
+                              mqtt_codec=None, mqtt_broker=None,
+                              mqtt_resync_topic='resync'):
         topics = {
             'update': mqtt_update_topic,
-            'results': mqtt_results_topic
+            'results': mqtt_results_topic,
+            'resync': mqtt_resync_topic
         }
-        self.mqtt = ClientMQTT(mqtt_ip, mqtt_port, topics)
+        self.mqtt = ClientMQTT(mqtt_ip, mqtt_port, topics, codec=mqtt_codec, broker=mqtt_broker)
         self.mqtt.connect_and_loop()
 
 
     def set_udp_communicator(self):
         pass
 
+    def set_heatmap_delta(self, enabled=True):
+        """
+        In delta mode, heatmap results (those with "round_digits", e.g. of ProximityIndicator) are published to mqtt
+        as a full message of their keys and values once, then as deltas of changed values only (see heatmap_delta).
+        A receiver out of sync publishes {'indicator': name, 'task': result name} to resync/<indicator>/<result>
+        to get a full message again, once until it arrives or heatmap_delta.RESYNC_TIMEOUT passes. Results sent to
+        the udp frontend are not changed.
+        """
+        self.heatmap_delta = enabled
+
 
     def set_scheduled_tasks(self, *args):
+        """
+        :param args: tuples of (condition, format_str, fun) or (condition, format_str, fun, inputs). condition is
+            the task token(s) triggering this task; format_str formats "to_frontend" of the result, or a dict of
+            result name -> format_str for tasks returning a list of results; inputs is a list of version names
+            of H3 read by fun, e.g. ['h3_stats', 'housing'] (see H3Grids.bump_version). A task with inputs is only
+            computed again when any of them changed since its last run, otherwise its last results are published
+            again; a task without inputs is always computed.
+        """
         for fun_tuple in args:
             self.scheduled_tasks.append(fun_tuple)
 
-    def run_scheduled_tasks(self):
-        def process_tasks(msg_data):
-            for fun_tuple in self.scheduled_tasks:
-                condition, format_str, fun = fun_tuple
-                skip_this_task = True
-                if not condition:
-                    skip_this_task = False
-                elif type(condition) == str:
-                    if condition in msg_data['task_tokens']:
-                        skip_this_task = False
-                elif type(condition) == list:
-                    # make condition to a list of list, with each inner-list being a AND operation
-                    # while the outer list being a OR operation
-                    any_conditions = formatting_conditions(condition)
-                    for all_conditions in any_conditions:
-                        if all([item in msg_data['task_tokens'] for item in all_conditions]):
-                            skip_this_task = False
-                            break
-                else:
-                    raise ValueError(f'Invalid condition: {condition}')
+    @staticmethod
+    def _is_triggered(condition, task_tokens):
+        if not condition:
+            return True
+        elif type(condition) == str:
+            return condition in task_tokens
+        elif type(condition) == list:
+            # make condition to a list of list, with each inner-list being a AND operation
+            # while the outer list being a OR operation
+            any_conditions = formatting_conditions(condition)
+            return any(all([item in task_tokens for item in all_conditions]) for all_conditions in any_conditions)
+        else:
+            raise ValueError(f'Invalid condition: {condition}')
+
+    def _superseded(self):
+        return self.is_superseded is not None and self.is_superseded()
 
-                if skip_this_task:
+    def check_superseded(self):
+        """
+        Cooperative cancellation point for long tasks: raise TaskSuperseded if the table version the running
+        tasks compute on is superseded by a newer one (see process_tasks)
+        """
+        if self._superseded():
+            raise TaskSuperseded()
+
+    def run_task(self, task_idx, task_tokens):
+        """
+        Run one scheduled task if it is triggered by task_tokens, results are not published
+        :return: None if not triggered or failed, otherwise (list of (result name, formatted result),
+            elapsed seconds, whether the cached results are reused)
+        """
+        condition, format_str, fun = self.scheduled_tasks[task_idx][:3]
+        inputs = self.scheduled_tasks[task_idx][3] if len(self.scheduled_tasks[task_idx]) > 3 else None
+        if not self._is_triggered(condition, task_tokens):
+            return None
+        # versions are read before running, so that changes made meanwhile trigger this task next time
+        versions = self.H3.get_versions(inputs) if inputs is not None else None
+        cached = self.task_cache.get(task_idx, None)
+        t0 = time.time()
+        if versions is not None and cached is not None and cached[0] == versions:
+            rst, skipped = cached[1], True
+        else:
+            try:
+                self.check_superseded()
+                rst = fun()
+            except TaskSuperseded:
+                return None
+            except Exception as e:
+                print('\n'+'='*50)
+                print(traceback.format_exc())
+                print('=' * 50 + '\n')
+                return None
+            skipped = False
+            if versions is not None:
+                self.task_cache[task_idx] = (versions, rst)
+        # a batched task (e.g. ProximityIndicator.batch_proximity) returns a list of results,
+        # with a dict of result name -> format_str
+        formatted = []
+        for this_rst in (rst if type(rst) == list else [rst]):
+            task_name = this_rst['name']
+            this_format_str = format_str[task_name] if type(format_str) == dict else format_str
+            formatted_rst = this_format_str.format(this_rst['to_frontend'])
+            if self.heatmap_delta and 'round_digits' in this_rst:
+                formatted_rst = self._make_heatmap_frame(this_rst, formatted_rst, this_format_str)
+            formatted.append((task_name, formatted_rst))
+        return formatted, time.time() - t0, skipped
+
+    @staticmethod
+    def _make_heatmap_frame(rst, text, format_str):
+        values = rst['normalized'] if rst.get('normalized', None) is not None else rst['raw']
+        if type(values) == dict:
+            keys, values = np.fromiter(values.keys(), dtype=np.uint64, count=len(values)), list(values.values())
+        else:
+            keys = np.arange(len(values))
+        return HeatmapFrame(text, keys, values, format_str, rst['round_digits'])
+
+    def process_tasks(self, task_tokens, is_superseded=None):
+        """
+        Run scheduled tasks triggered by task_tokens in order, and publish their results if mqtt is set
+        :param is_superseded: function returning True once the table version these tasks compute on is superseded,
+            then the running task is aborted at its next check_superseded() and no more results are published
+        :return: list of (result name, formatted result)
+        """
+        published = []
+        self.is_superseded = is_superseded
+        try:
+            for task_idx in range(len(self.scheduled_tasks)):
+                if self._superseded():
+                    break
+                task_rst = self.run_task(task_idx, task_tokens)
+                if task_rst is None or self._superseded():
                     continue
-                try:
-                    rst = fun()
-                    to_frontend = rst['to_frontend']
-                    task_name = rst['name']
-                except Exception as e:
-                    print('\n'+'='*50)
-                    print(traceback.format_exc())
-                    print('=' * 50 + '\n')
-                formatted_rst = format_str.format(to_frontend)
-                if self.mqtt:
-                    (rc, mid) = self.mqtt.client.publish(f"{self.mqtt.topics['results']}/{self.name}/{task_name}",
-                                                         json.dumps(formatted_rst))
+                formatted, elapsed, skipped = task_rst
+                self._record_task_timing(','.join(task_name for task_name, _ in formatted), elapsed, skipped)
+                for task_name, formatted_rst in formatted:
+                    self.publish(task_name, formatted_rst)
+                published += formatted
+        finally:
+            self.is_superseded = None
+        return published
+
+    def publish(self, task_name, formatted_rst):
+        if self.mqtt:
+            if isinstance(formatted_rst, HeatmapFrame):
+                formatted_rst = self.get_heatmap_encoder(task_name).encode(formatted_rst)
+            (rc, mid) = self.mqtt.publish_msg(f"{self.mqtt.topics['results']}/{self.name}/{task_name}", formatted_rst)
+
+    def get_heatmap_encoder(self, task_name):
+        if task_name not in self.heatmap_encoders:
+            self.heatmap_encoders[task_name] = HeatmapDeltaEncoder(self.name, task_name)
+        return self.heatmap_encoders[task_name]
+
+    def resync_heatmap(self, msg_data):
+        """
+        Publish a full message of a heatmap in delta mode again, on request of a receiver out of sync
+        :param msg_data: {'indicator': name of this indicator, 'task': result name}
+        """
+        if msg_data.get('indicator', None) != self.name or msg_data.get('task', None) not in self.heatmap_encoders:
+            return
+        full_msg = self.heatmap_encoders[msg_data['task']].full_message()
+        if full_msg is not None and self.mqtt:
+            self.mqtt.publish_msg(f"{self.mqtt.topics['results']}/{self.name}/{msg_data['task']}", full_msg)
+
+    def _record_task_timing(self, task_name, elapsed, skipped):
+        timing = self.task_timings.setdefault(task_name, {'last': 0, 'total': 0, 'runs': 0, 'skips': 0})
+        if skipped:
+            timing['skips'] += 1
+        else:
+            timing['last'] = elapsed
+            timing['total'] += elapsed
+            timing['runs'] += 1
+
+    def run_scheduled_tasks(self):
+        def process_tasks(msg_data):
+            version = msg_data.get('version', None)
+            is_superseded = None
+            if version is not None and self.Table is not None:
+                is_superseded = lambda: self.Table.version > version
+            self.process_tasks(msg_data['task_tokens'], is_superseded)
         try:
             if self.mqtt:
                 self.mqtt.register_handler(root_topic=self.mqtt.topics['update'],
                                            all_topics=self.mqtt.topics['update']+'/#',
                                            handler=process_tasks)
+                if self.heatmap_delta:
+                    resync_topic = self.mqtt.topics.get('resync', 'resync')
+                    self.mqtt.register_handler(root_topic=resync_topic,
+                                               all_topics=f'{resync_topic}/{self.name}/#',
+                                               handler=self.resync_heatmap)
                 while True:  # blocking
                     time.sleep(50)
             else:
@@ -96,42 +241,52 @@ class Indicator:
 
 
     def _get_straight_line_dist_to_h3_cells(self, start_h3_cell, target_h3_cells):
-        dist_list = [
-            self.H3.dist_lookup.get(start_h3_cell, {}).get(target_h3_cell, None)
-            for target_h3_cell in target_h3_cells
-        ]
-        inner_dist = h3.edge_length(self.H3.resolution) / 2
-        # in case distance is not in precooked lookup...
-        while not all(dist_list):
-            idx_of_none = dist_list.index(None)
-            # print(start_h3_cell,  target_h3_cells[idx_of_none], dist_list[idx_of_none])
-            target_h3_cell = target_h3_cells[idx_of_none]
-            this_dist = h3.point_dist(h3.h3_to_geo(start_h3_cell), h3.h3_to_geo(target_h3_cell)) \
-                if start_h3_cell != target_h3_cell else inner_dist
-            dist_list[idx_of_none] = this_dist
-            self.H3.dist_lookup.setdefault(start_h3_cell, {})[target_h3_cell] = this_dist
-            # print('Strange error, check 123')
-        assert min(dist_list) > 0
+        dist_list = self.H3.dist_lookup.get_dists(start_h3_cell, target_h3_cells).astype(np.float64)
+        assert len(dist_list) == 0 or dist_list.min() > 0
         return dist_list
 
+    def _iter_straight_line_dist_blocks(self, start_h3_cells, target_h3_cells, block_size=None):
+        """
+        Straight line distances from blocks of start cells to all target cells
+        :return: generator of (start cells of this block, float64 array of shape (len(block), len(target_h3_cells)))
+        """
+        start_h3_cells = list(start_h3_cells)
+        for start, dists in self.H3.dist_lookup.iter_dist_blocks(start_h3_cells, target_h3_cells, block_size):
+            self.check_superseded()
+            yield start_h3_cells[start: start+len(dists)], dists.astype(np.float64)
+
+    def _get_target_kdtree(self, target_h3_cells):
+        return H3KDTree(self.H3.resolution, target_h3_cells)
+
     def _get_network_dist_to_h3_cells(self, start_h3_cell, target_h3_cells):
         # to do: network distance calculation
         return []
 
+    def get_num_jobs(self, usage_name='usage'):
+        """
+        Total jobs (pop of all NAICS classes), shared by indicators until h3 stats change
+        """
+        return self.H3.memoize(('num_jobs', usage_name), ['h3_stats'],
+                               lambda: sum(self.H3.get_usage(usage_name).class_totals('NAICS', 'pop').values()))
+
+    def get_num_residents(self):
+        """
+        Total residents of base population and new housing units, shared by indicators until housing units change
+        """
+        Pop, Housing = self.H3.Pop, self.H3.Housing
+        return self.H3.memoize('num_residents', ['housing'],
+                               lambda: len(Pop.base_sim_pop) + Housing.get_tt_capacity('new'))
+
     def get_target_h3_cells(self, target_classes, attr_name='LBCS', item_name='area',
-                             usage_name='usage', minimum_ratio_th=0):
-        if type(target_classes) != list:
-            target_classes = [target_classes]
-        h3_cell_area = self.H3.h3_cell_area
-        target_h3_cells = []
-        for class_name in target_classes:
-            h3_cells_contain_this_class = [
-                h3_cell for h3_cell, h3_attrs in self.H3.h3_stats.items()
-                if h3_attrs[usage_name][attr_name][item_name].get(str(class_name), -1) > minimum_ratio_th * h3_cell_area
-            ]
-            target_h3_cells += h3_cells_contain_this_class
-        target_h3_cells = list(set(target_h3_cells))
-        return target_h3_cells
+                            usage_name='usage', minimum_ratio_th=0, first_n_digits=None):
+        """
+        Get cells where the amount of any target class is larger than minimum_ratio_th * cell area
+        :param first_n_digits: if not None, classes are matched by their first n digits, e.g. 2 for 2100 -> "21"
+        :return: list of cells, read from the class index of H3 (see H3Grids.get_class_index)
+        """
+        class_index = self.H3.get_class_index(attr_name, item_name, usage_name)
+        target_h3_cells = class_index.select(target_classes, minimum_ratio_th * self.H3.h3_cell_area, first_n_digits)
+        return target_h3_cells.tolist()
 
     def normalization(self, raw, minV='auto', maxV='auto', better='high'):
         if type(raw) not in [list, tuple, dict]:
@@ -211,6 +366,218 @@ class Indicator:
         Table.plot(value=table_grid_values, ax=ax, cmap=cmap)
 
 
+class _WriteTrackingDict(dict):
+    """
+    dict recording keys set by item assignment, so that IndicatorPool workers could return values saved by tasks
+    (e.g. heatmaps in H3.values) to the main process
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.written = set()
+
+    def __setitem__(self, key, value):
+        self.written.add(key)
+        super().__setitem__(key, value)
+
+    def pop_written(self):
+        """
+        :return: dict of keys set since the last call and their current values
+        """
+        written = {key: self[key] for key in self.written if key in self}
+        self.written = set()
+        return written
+
+
+def _indicator_pool_worker(conn, indicators, Table, value_owners, latest_version):
+    """
+    Loop of an IndicatorPool worker: indicators and Table are read-only copies inherited at fork time, which are
+    only changed by diffs of table updates from the main process. latest_version is shared with the main process.
+    Once a diff fails to apply, the worker runs no task until a full diff is applied (see IndicatorPool._resync),
+    and answers run requests with the error instead.
+    """
+    for indicator in indicators:
+        indicator.mqtt = None   # results are published by the main process
+    for owner in value_owners:
+        owner.values = _WriteTrackingDict(owner.values)
+    update_error = None
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'update':
+            try:
+                diff = pickle.loads(msg[1])
+                if update_error is None or diff.get('full', False):
+                    Table.apply_update_diff(diff)
+                    update_error = None
+            except Exception as e:
+                update_error = traceback.format_exc()
+        elif msg[0] == 'run':
+            if update_error is not None:
+                conn.send(('failed', update_error))
+                continue
+            task_tokens, tasks, version = msg[1:]
+            is_superseded = (lambda: latest_version.value > version) if version is not None else None
+            task_rsts = []
+            for indicator_idx, task_idx in tasks:
+                indicators[indicator_idx].is_superseded = is_superseded
+                try:
+                    task_rst = indicators[indicator_idx].run_task(task_idx, task_tokens)
+                    task_rsts.append((indicator_idx, task_idx, task_rst))
+                finally:
+                    indicators[indicator_idx].is_superseded = None
+            conn.send(('done', task_rsts, [owner.values.pop_written() for owner in value_owners]))
+        elif msg[0] == 'close':
+            break
+    conn.close()
+
+
+class IndicatorPool:
+    """
+    Run scheduled tasks of indicators in a pool of forked processes, so that CPU-bound tasks do not contend on the
+    GIL. Workers inherit H3, Table and indicators at fork time as a read-only snapshot: objects are frozen out of
+    garbage collection before forking so that their pages stay shared, and arrays of H3 and Table loaded with
+    load_snapshot(mmap=True) are shared through the page cache. Table is only updated in the main process; the
+    changed h3 stats, sparse usage and housing units (see TableGrids.get_update_diff) are pickled once and sent to
+    workers, which apply them without running the update again. Tasks are assigned to workers by their last
+    elapsed time. Results, and the values tasks save to H3 and Table (e.g. heatmaps in H3.values), are returned to
+    the main process, which publishes the results and applies the values. Tasks of a table version marked
+    superseded (see supersede) are aborted in workers and their results are not published. A worker which failed to
+    apply a diff is sent the full table state, and its tasks run in the main process if that fails too.
+    Must be created before any thread (e.g. of mqtt clients) is started.
+    """
+    def __init__(self, indicators, Table=None, n_workers=None):
+        self.indicators = list(indicators)
+        self.Table = Table
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.task_costs = {}
+        self.lock = threading.Lock()
+        # objects whose "values" are written by tasks, e.g. heatmaps saved to H3.values
+        self.value_owners = []
+        for owner in [Table, getattr(Table, 'H3', None)] + \
+                     [obj for indicator in self.indicators for obj in (indicator.H3, indicator.Table)]:
+            if isinstance(getattr(owner, 'values', None), dict) and \
+                    not any(owner is value_owner for value_owner in self.value_owners):
+                self.value_owners.append(owner)
+        ctx = multiprocessing.get_context('fork')
+        self.latest_version = ctx.RawValue('q', 0)
+        self.conns, self.workers = [], []
+        gc.freeze()
+        try:
+            for _ in range(self.n_workers):
+                parent_conn, child_conn = ctx.Pipe()
+                worker = ctx.Process(target=_indicator_pool_worker,
+                                     args=(child_conn, self.indicators, Table, self.value_owners,
+                                           self.latest_version),
+                                     daemon=True)
+                worker.start()
+                child_conn.close()
+                self.conns.append(parent_conn)
+                self.workers.append(worker)
+        finally:
+            gc.unfreeze()
+
+    def update(self, layout_str=None, changed_density=None):
+        """
+        Update Table (see TableGrids.update) in the main process, and send the diff to all workers
+        :return: set of changed h3 cells, see TableGrids.update
+        """
+        with self.lock:
+            changed_h3_cells = self.Table.update(layout_str=layout_str, changed_density=changed_density)
+            diff = self.Table.get_update_diff(changed_h3_cells)
+            payload = pickle.dumps(diff, protocol=pickle.HIGHEST_PROTOCOL)
+            for conn in self.conns:
+                conn.send(('update', payload))
+            return changed_h3_cells
+
+    def supersede(self, version):
+        """
+        Mark tasks computing on table versions older than version as superseded, can be called from any thread
+        """
+        self.latest_version.value = max(self.latest_version.value, version)
+
+    def process_tasks(self, task_tokens, version=None):
+        """
+        Run scheduled tasks of all indicators triggered by task_tokens in workers, and publish their results
+        :param version: table version these tasks compute on, they are aborted once it is superseded
+        :return: list of (indicator, result name, formatted result) in the order of indicators and their tasks
+        """
+        tasks = [(indicator_idx, task_idx)
+                 for indicator_idx, indicator in enumerate(self.indicators)
+                 for task_idx, fun_tuple in enumerate(indicator.scheduled_tasks)
+                 if indicator._is_triggered(fun_tuple[0], task_tokens)]
+        # longest tasks first, each to the least loaded worker; unknown tasks are assumed to be long
+        loads, assigned = [0] * self.n_workers, [[] for _ in range(self.n_workers)]
+        for task in sorted(tasks, key=lambda task: -self.task_costs.get(task, float('inf'))):
+            worker_idx = int(np.argmin(loads))
+            assigned[worker_idx].append(task)
+            loads[worker_idx] += self.task_costs.get(task, 1)
+        task_rsts = {}
+        with self.lock:
+            for conn, worker_tasks in zip(self.conns, assigned):
+                if worker_tasks:
+                    conn.send(('run', task_tokens, worker_tasks, version))
+            for worker_idx, (conn, worker_tasks) in enumerate(zip(self.conns, assigned)):
+                if worker_tasks:
+                    reply = conn.recv()
+                    if reply[0] == 'failed':
+                        reply = self._resync(worker_idx, reply[1], ('run', task_tokens, worker_tasks, version))
+                    if reply[0] == 'failed':
+                        print(f'IndicatorPool worker {worker_idx} failed to apply the full table again, running its '
+                              f'tasks in the main process:\n{reply[1]}')
+                        reply = ('done', self._run_in_main_process(task_tokens, worker_tasks, version), [])
+                    worker_rsts, written_values = reply[1:]
+                    for indicator_idx, task_idx, task_rst in worker_rsts:
+                        task_rsts[(indicator_idx, task_idx)] = task_rst
+                    for owner, values in zip(self.value_owners, written_values):
+                        owner.values.update(values)
+        published = []
+        if version is not None and self.latest_version.value > version:
+            return published
+        for indicator_idx, task_idx in tasks:
+            task_rst = task_rsts[(indicator_idx, task_idx)]
+            if task_rst is None:
+                continue
+            indicator = self.indicators[indicator_idx]
+            formatted, elapsed, skipped = task_rst
+            indicator._record_task_timing(','.join(task_name for task_name, _ in formatted), elapsed, skipped)
+            if not skipped:
+                self.task_costs[(indicator_idx, task_idx)] = elapsed
+            for task_name, formatted_rst in formatted:
+                indicator.publish(task_name, formatted_rst)
+                published.append((indicator, task_name, formatted_rst))
+        return published
+
+    def _resync(self, worker_idx, error, run_msg):
+        """
+        Send the full table state to a worker which failed to apply a diff, and run its tasks again
+        :return: reply of the worker to run_msg
+        """
+        print(f'IndicatorPool worker {worker_idx} failed to apply a table update, sending the full table:\n{error}')
+        conn = self.conns[worker_idx]
+        diff = self.Table.get_update_diff(None, full=True)
+        conn.send(('update', pickle.dumps(diff, protocol=pickle.HIGHEST_PROTOCOL)))
+        conn.send(run_msg)
+        return conn.recv()
+
+    def _run_in_main_process(self, task_tokens, tasks, version):
+        is_superseded = (lambda: self.latest_version.value > version) if version is not None else None
+        task_rsts = []
+        for indicator_idx, task_idx in tasks:
+            indicator = self.indicators[indicator_idx]
+            indicator.is_superseded = is_superseded
+            try:
+                task_rsts.append((indicator_idx, task_idx, indicator.run_task(task_idx, task_tokens)))
+            finally:
+                indicator.is_superseded = None
+        return task_rsts
+
+    def close(self):
+        with self.lock:
+            for conn, worker in zip(self.conns, self.workers):
+                conn.send(('close',))
+                conn.close()
+                worker.join()
+
+
 class Handler:
     def __init__(self, table='shenzhen',
                  udp_receiver_table_ip='0.0.0.0', udp_receiver_table_port=15800,
@@ -220,7 +587,16 @@ class Handler:
                  inner_communication='mqtt',
                  mqtt_broker_ip='localhost', mqtt_broker_port=1883,
                  mqtt_update_topic='update', mqtt_results_topic='results',
-                 buffer_size=1024*8):
+                 mqtt_resync_topic='resync', mqtt_codec=None, mqtt_broker=None, udp_network=None,
+                 heatmap_delta=False, buffer_size=1024*8):
+        """
+        :param mqtt_codec: name of the payload codec (see payload_codec) of messages published by this handler and
+            its indicators, defaults to msgpack; received messages are decoded whichever codec the sender uses
+        :param mqtt_broker: in-process broker (see loopback.LoopbackBroker) used instead of mqtt_broker_ip
+        :param udp_network: in-process network (see loopback.LoopbackNetwork) used instead of udp sockets
+        :param heatmap_delta: publish heatmap results of all indicators to mqtt in delta mode, see
+            Indicator.set_heatmap_delta
+        """
         self.table = table
         self._get_spec(tablet_spec_json_path)
         self.udp_receiver = {
@@ -238,20 +614,23 @@ class Handler:
             'ip': udp_sender_ip,
             'port': udp_sender_port
         }
-        self.udp_receiver['table']['socket'] = socket.socket(socket.AF_INET,
-                                                             socket.SOCK_DGRAM)
-        self.udp_receiver['tablet']['socket'] = socket.socket(socket.AF_INET,
-                                                              socket.SOCK_DGRAM)
-        self.udp_sender['socket'] = socket.socket(socket.AF_INET,
-                                                  socket.SOCK_DGRAM)
+        self.udp_network = udp_network
+        udp_socket = udp_network.socket if udp_network else socket.socket
+        self.udp_receiver['table']['socket'] = udp_socket(socket.AF_INET,
+                                                          socket.SOCK_DGRAM)
+        self.udp_receiver['tablet']['socket'] = udp_socket(socket.AF_INET,
+                                                           socket.SOCK_DGRAM)
+        self.udp_sender['socket'] = udp_socket(socket.AF_INET,
+                                               socket.SOCK_DGRAM)
 
         self.inner_communication = inner_communication
         if inner_communication == 'mqtt':
             topics = {
                 'update': mqtt_update_topic,
-                'results': mqtt_results_topic
+                'results': mqtt_results_topic,
+                'resync': mqtt_resync_topic
             }
-            self.mqtt = ClientMQTT(mqtt_broker_ip, mqtt_broker_port, topics)
+            self.mqtt = ClientMQTT(mqtt_broker_ip, mqtt_broker_port, topics, codec=mqtt_codec, broker=mqtt_broker)
         else:
             self.mqtt = None
 
@@ -259,6 +638,11 @@ class Handler:
         self.Table = None
         self.table_viz_content = None
         self.indicators = []
+        self.pool = None
+        self.heatmap_delta = heatmap_delta
+        # version of the latest table state requested, tasks of older versions are superseded
+        self.latest_version = 0
+        self.zone_layouts = {}
 
     def _get_spec(self, tablet_spec_json_path):
         use_tablet_spec_json_path = ''
@@ -288,9 +672,18 @@ class Handler:
         for indicator in args:
             if not isinstance(indicator, Indicator):
                 print(f'Warning: {indicator} is not a valid Indicator instance and ignored')
+            if self.heatmap_delta:
+                indicator.set_heatmap_delta()
             self.indicators.append(indicator)
 
-    def run(self):
+    def run(self, n_workers=None):
+        """
+        :param n_workers: if set, scheduled tasks of all indicators run in an IndicatorPool of n_workers forked
+            processes, otherwise each indicator runs its tasks in its own thread
+        """
+        if n_workers:
+            # fork before any thread is started
+            self.pool = IndicatorPool(self.indicators, self.Table, n_workers)
         # mqtt:
         if self.inner_communication == 'mqtt':
             self.mqtt.connect_and_loop()  # connect and loop forever if not running
@@ -298,7 +691,10 @@ class Handler:
                 indicator.set_mqtt_communicator(mqtt_ip=self.mqtt.ip,
                                                 mqtt_port=self.mqtt.port,
                                                 mqtt_update_topic=self.mqtt.topics['update'],
-                                                mqtt_results_topic=self.mqtt.topics['results'])
+                                                mqtt_results_topic=self.mqtt.topics['results'],
+                                                mqtt_resync_topic=self.mqtt.topics['resync'],
+                                                mqtt_codec=self.mqtt.codec,
+                                                mqtt_broker=self.mqtt.broker)
         thread_table = threading.Thread(target = self._listen_to_table,
                                         args = (self.config['buffer_size'], False),
                                         name = 'TableInteraction')
@@ -311,12 +707,109 @@ class Handler:
                                              args = (),
                                              name = 'thread_results')
         thread_results.start()
+        if self.pool:
+            thread_pool = threading.Thread(target = self._run_indicator_pool,
+                                           args = (),
+                                           name = 'thread_indicator_pool')
+            thread_pool.start()
+            return
         for idx, indicator in enumerate(self.indicators):
             thread_indicator = threading.Thread(target = indicator.run_scheduled_tasks,
                                                 args = (),
                                                 name = f'thread_indicator_{idx}_{indicator.name}')
             thread_indicator.start()
 
+    def _update_table(self, layout_str=None, changed_density=None):
+        if self.pool:
+            return self.pool.update(layout_str=layout_str, changed_density=changed_density)
+        return self.Table.update(layout_str=layout_str, changed_density=changed_density)
+
+    def _supersede(self, version):
+        self.latest_version = version
+        if self.pool:
+            self.pool.supersede(version)
+
+    def _is_new_layout(self, layout_str):
+        zone = layout_str.split(' ', 1)[0]
+        if self.zone_layouts.get(zone, None) == layout_str:
+            return False
+        self.zone_layouts[zone] = layout_str
+        return True
+
+    def _run_indicator_pool(self):
+        def process_tasks(msg_data):
+            self.pool.process_tasks(msg_data['task_tokens'], msg_data.get('version', None))
+        def resync_heatmap(msg_data):
+            for indicator in self.indicators:
+                indicator.resync_heatmap(msg_data)
+        client = None
+        try:
+            if self.mqtt:
+                client = ClientMQTT(self.mqtt.ip, self.mqtt.port, self.mqtt.topics, codec=self.mqtt.codec,
+                                    broker=self.mqtt.broker)
+                client.connect_and_loop()
+                client.register_handler(root_topic=client.topics['update'],
+                                        all_topics=client.topics['update']+'/#',
+                                        handler=process_tasks)
+                if self.heatmap_delta:
+                    # heatmaps are encoded by indicators of the main process, see IndicatorPool.process_tasks
+                    client.register_handler(root_topic=client.topics['resync'],
+                                            all_topics=client.topics['resync']+'/#',
+                                            handler=resync_heatmap)
+                while True:  # blocking
+                    time.sleep(50)
+        finally:
+            if client:
+                client.client.disconnect()
+            self.pool.close()
+
+    def _get_layout_task_tokens(self):
+        task_tokens = ['screen_all']
+        if self.table_viz_content:
+            task_tokens.append(self.table_viz_content)
+        else:
+            task_tokens.append('heatmaps_all')
+        return task_tokens
+
+    def _parse_tablet_msg(self, data, print_flag=False):
+        """
+        Parse a message from the tablet, a button switching the table viz content takes effect at once
+        :return: ('density', {land_type_code: value}, task_tokens) for a density slider,
+            ('table_viz_content', task_name, task_tokens) for a viz content button, or None if ignored
+        """
+        if data.startswith('/slider'):
+            tmp = data.split(' ')
+            slider_idx, slider_value = tmp[1], int(tmp[2])
+            if slider_idx in self.tablet_spec['sliders']:
+                slider_function = self.tablet_spec['sliders'][slider_idx]['function']
+                if slider_function == 'change density':
+                    if self.Table:
+                        land_type_code = self.tablet_spec['sliders'][slider_idx]['land_type_code']
+                        return 'density', {land_type_code: slider_value}, self._get_layout_task_tokens()
+                    elif print_flag:
+                        print('New slider message is ignored as no table exists')
+                elif slider_function == 'some other recognized functions':
+                    pass
+                elif print_flag:
+                    print(f'New slider message is ignored as its function is unrecognized: {slider_function}')
+            elif print_flag:
+                print(f'Message from slider {slider_idx} is ignored as this slider is undefined')
+        elif data.startswith('/button'):
+            tmp = data.split(' ')
+            button_idx, button_value = tmp[1], int(tmp[2])
+            if button_idx in self.tablet_spec['buttons']:
+                button_function = self.tablet_spec['buttons'][button_idx]['function']
+                if button_function == 'table_viz_content':
+                    if button_value == 1:
+                        self.table_viz_content = self.tablet_spec['buttons'][button_idx]['task_name']
+                        return 'table_viz_content', self.table_viz_content, [self.table_viz_content]
+                elif button_function == 'some other recognized functions':
+                    pass
+                elif print_flag:
+                    print(f'New button message is ignored as its function is unrecognized: {button_function}')
+            elif print_flag:
+                print(f'Message from button {button_idx} is ignored as this button is undefined')
+        return None
 
     def _listen_to_table(self, buffer_size, print_flag=False):
         receiver = self.udp_receiver['table']['socket']
@@ -326,24 +819,30 @@ class Handler:
                 data, addr = receiver.recvfrom(buffer_size)
                 data = data.strip().decode()
                 data_epoch = time.time()
-                task_tokens = ['screen_all']
-                if self.table_viz_content:
-                    task_tokens.append(self.table_viz_content)
-                else:
-                    task_tokens.append('heatmaps_all')
+                task_tokens = self._get_layout_task_tokens()
                 if print_flag:
                     print(f'\nNew table data received: {data}\n')
                 if self.Table:
-                    self.Table.update(layout_str=data)
+                    if not self._is_new_layout(data):
+                        if print_flag:
+                            print('Layout unchanged, no task is triggered')
+                        continue
+                    self._supersede(self.Table.version + 1)
+                    changed_h3_cells = self._update_table(layout_str=data)
+                    if changed_h3_cells is not None and not changed_h3_cells:
+                        if print_flag:
+                            print('Layout unchanged, no task is triggered')
+                        continue
                     if self.mqtt:
-                        self.mqtt.client.publish(
+                        self.mqtt.publish_msg(
                             self.mqtt.topics['update'] + '/table',
-                            json.dumps({
+                            {
                                 'task_tokens': task_tokens,
                                 'msg': 'table updated',
+                                'version': self.Table.version,
                                 'epoch': data_epoch,
                                 'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(data_epoch))
-                            })
+                            }
                         )
                     else:
                         # use pure udp way
@@ -367,68 +866,30 @@ class Handler:
                 data_epoch = time.time()
                 if print_flag:
                     print(f'\nNew tablet data received: {data}\n')
-                if data.startswith('/slider'):
-                    task_tokens = ['screen_all']
-                    if self.table_viz_content:
-                        task_tokens.append(self.table_viz_content)
-                    else:
-                        task_tokens.append('heatmaps_all')
-                    tmp = data.split(' ')
-                    slider_idx, slider_value = tmp[1], int(tmp[2])
-                    if slider_idx in self.tablet_spec['sliders']:
-                        slider_function = self.tablet_spec['sliders'][slider_idx]['function']
-                        if slider_function == 'change density':
-                            if self.Table:
-                                land_type_code = self.tablet_spec['sliders'][slider_idx]['land_type_code']
-                                self.Table.update(layout_str=None, changed_density={land_type_code: slider_value})
-                                if self.mqtt:
-                                    self.mqtt.client.publish(
-                                        self.mqtt.topics['update'] + '/density',
-                                        json.dumps({
-                                            'task_tokens': task_tokens,
-                                            'msg': 'density updated by tablet slider',
-                                            'epoch': data_epoch,
-                                            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(data_epoch))
-                                        })
-                                    )
-                                else:
-                                    # use pure udp way
-                                    pass
-                            elif print_flag:
-                                print('New slider message is ignored as no table exists')
-                        elif slider_function == 'some other recognized functions':
-                            pass
-                        elif print_flag:
-                            print(f'New slider message is ignored as its function is unrecognized: {slider_function}')
-                    elif print_flag:
-                        print(f'Message from slider {slider_idx} is ignored as this slider is undefined')
-                elif data.startswith('/button'):
-                    tmp = data.split(' ')
-                    button_idx, button_value = tmp[1], int(tmp[2])
-                    if button_idx in self.tablet_spec['buttons']:
-                        button_function = self.tablet_spec['buttons'][button_idx]['function']
-                        if button_function == 'table_viz_content':
-                            if button_value == 1:
-                                self.table_viz_content = self.tablet_spec['buttons'][button_idx]['task_name']
-                                if self.mqtt:
-                                    self.mqtt.client.publish(
-                                        self.mqtt.topics['update'] + '/table_viz_content',
-                                        json.dumps({
-                                            'task_tokens': [self.table_viz_content],
-                                            'msg': 'table viz content changed by tablet button',
-                                            'epoch': data_epoch,
-                                            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(data_epoch))
-                                        })
-                                    )
-                                else:
-                                    # use pure udp way
-                                    pass
-                        elif slider_function == 'some other recognized functions':
-                            pass
-                        elif print_flag:
-                            print(f'New button message is ignored as its function is unrecognized: {button_function}')
-                    elif print_flag:
-                        print(f'Message from button {button_idx} is ignored as this button is undefined')
+                parsed = self._parse_tablet_msg(data, print_flag)
+                if parsed is None:
+                    continue
+                kind, value, task_tokens = parsed
+                if kind == 'density':
+                    self._supersede(self.Table.version + 1)
+                    self._update_table(layout_str=None, changed_density=value)
+                    msg = 'density updated by tablet slider'
+                else:
+                    msg = 'table viz content changed by tablet button'
+                if self.mqtt:
+                    self.mqtt.publish_msg(
+                        self.mqtt.topics['update'] + '/' + kind,
+                        {
+                            'task_tokens': task_tokens,
+                            'msg': msg,
+                            'version': self.Table.version if self.Table else None,
+                            'epoch': data_epoch,
+                            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(data_epoch))
+                        }
+                    )
+                else:
+                    # use pure udp way
+                    pass
         finally:
             if self.mqtt:
                 self.mqtt.client.disconnect()
@@ -438,7 +899,19 @@ class Handler:
 
     def _listen_to_indicators(self):
         sender = self.udp_sender['socket']
+        heatmap_decoders = {}
         def send_to_frontend(msg_data):
+            if HeatmapDeltaDecoder.is_heatmap_msg(msg_data):
+                # the udp frontend takes the full text of heatmaps in delta mode
+                key = (msg_data['indicator'], msg_data['task'])
+                decoder = heatmap_decoders.setdefault(key, HeatmapDeltaDecoder())
+                if not decoder.apply(msg_data):
+                    # asked once, deltas are dropped until the full message arrives, see HeatmapDeltaDecoder
+                    if decoder.request_resync():
+                        self.mqtt.publish_msg(f"{self.mqtt.topics['resync']}/{key[0]}/{key[1]}",
+                                              {'indicator': key[0], 'task': key[1]})
+                    return
+                msg_data = decoder.to_text()
             # print(sender, type(sender), self.udp_sender['ip'], self.udp_sender['port'])
             sender.sendto(msg_data.encode(), (self.udp_sender['ip'], self.udp_sender['port']))
         try:
@@ -458,12 +931,21 @@ class Handler:
 
 
 class ClientMQTT:
-    def __init__(self, broker_ip, broker_port, topics=None, client_id=None, username=None, password=None):
+    def __init__(self, broker_ip, broker_port, topics=None, client_id=None, username=None, password=None,
+                 codec=None, broker=None):
+        """
+        :param codec: payload codec of published messages, name or PayloadCodec instance (see payload_codec.get_codec)
+        :param broker: in-process broker (see loopback.LoopbackBroker) to use instead of connecting to broker_ip
+        """
         self.ip = broker_ip
         self.port = broker_port
         if not client_id:
             client_id = 'client_'+str(int(np.random.rand()*1e20))
-        self.client = mqtt.Client(client_id, clean_session=False)
+        if broker:
+            self.client = broker.create_client(client_id, clean_session=False)
+        else:
+            self.client = mqtt.Client(client_id, clean_session=False)
+        self.broker = broker
 
         if username and password:
             self.client.username_pw_set(username, password)
@@ -472,6 +954,7 @@ class ClientMQTT:
         self.client.on_message = self.on_message
         self.callbacks = {}
         self.topics = topics
+        self.codec = get_codec(codec)
         self.connected = False
 
 
@@ -499,12 +982,12 @@ class ClientMQTT:
     def on_message(self, client, userdata, msg):
         try:
             root_topic = msg.topic.split('/')[0]
-            msg_data = eval(msg.payload.decode())
+            msg_data = decode_payload(msg.payload)
             self.callbacks[root_topic](msg_data)
         except Exception as e:
             print('\n' + '=' * 50)
             print(traceback.format_exc())
-            print(f'data: {msg.payload.decode()}')
+            print(f'data: {bytes(msg.payload[:1000])}')
             print('=' * 50 + '\n')
 
     def register_handler(self, root_topic, all_topics, handler):
@@ -520,6 +1003,242 @@ class ClientMQTT:
     def publish(self, *args, **kwargs):
         self.client.publish(*args, **kwargs)
 
+    def publish_msg(self, topic, msg_data, **kwargs):
+        """
+        Publish msg_data encoded by the codec of this client
+        """
+        return self.client.publish(topic, self.codec.encode(msg_data), **kwargs)
+
+
+class AsyncClientMQTT(ClientMQTT):
+    def __init__(self, loop, *args, **kwargs):
+        """
+        ClientMQTT for an asyncio event loop: paho runs its network loop in its own thread (loop_start), and every
+        received message is handed over to the event loop, so that handlers never race with it
+        :param loop: the running asyncio event loop
+        """
+        super().__init__(*args, **kwargs)
+        self.loop = loop
+
+    def connect_and_loop(self):
+        if not self.connected:
+            self.client.connect(self.ip, self.port)
+            self.connected = True
+            self.client.loop_start()
+
+    def on_message(self, client, userdata, msg):
+        self.loop.call_soon_threadsafe(ClientMQTT.on_message, self, client, userdata, msg)
+
+
+class _DatagramReceiver(asyncio.DatagramProtocol):
+    def __init__(self, on_data):
+        self.on_data = on_data
+
+    def datagram_received(self, data, addr):
+        self.on_data(data.strip().decode(), time.time())
+
+
+class AsyncHandler(Handler):
+    def __init__(self, *args, coalesce_window=0.05, **kwargs):
+        """
+        Handler serving the table and tablet in one asyncio event loop instead of threads blocking on sockets and
+        sleeping: bursts of messages are collapsed into one Table.update, after which the triggered tasks of all
+        indicators run (in the IndicatorPool if any) and their results are sent to the frontend directly. A new
+        layout or density supersedes the tasks still running, which are aborted so that only results of the
+        latest version are sent
+        :param coalesce_window: seconds to wait for further messages after the first one of a burst, all layouts
+            (the latest one of each zone) and density changes received meanwhile are applied in one update
+        :param args, kwargs: see Handler
+        """
+        super().__init__(*args, **kwargs)
+        for udp_socket in [self.udp_receiver['table'].pop('socket'),
+                           self.udp_receiver['tablet'].pop('socket'),
+                           self.udp_sender.pop('socket')]:
+            udp_socket.close()
+        self.coalesce_window = coalesce_window
+        # seconds from receipt of the first message of a burst to the end of Table.update / each result sent
+        self.latency = {'update': LatencyHistogram(), 'publish': LatencyHistogram()}
+        # number of flushes whose tasks were aborted as newer messages arrived
+        self.num_superseded = 0
+        self.loop = None
+        self.sender = None
+        self.transports = []
+        self._pending = self._new_pending()
+        self._flush_handle = None
+        self._flush_tasks = set()
+        self._busy = None
+        self._stopped = None
+
+    @staticmethod
+    def _new_pending():
+        return {'layouts': {}, 'density': {}, 'update_task_tokens': [], 'task_tokens': [], 'epochs': []}
+
+    def run(self, n_workers=None):
+        """
+        Serve until stop() is called
+        :param n_workers: if set, scheduled tasks of all indicators run in an IndicatorPool of n_workers forked
+            processes, otherwise in the executor thread of the event loop
+        """
+        if n_workers:
+            # fork before the event loop and its executor thread are started
+            self.pool = IndicatorPool(self.indicators, self.Table, n_workers)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._busy = asyncio.Lock()
+        self._stopped = asyncio.Event()
+        try:
+            for name, on_data in [('table', self.on_table_data), ('tablet', self.on_tablet_data)]:
+                local_addr = (self.udp_receiver[name]['ip'], self.udp_receiver[name]['port'])
+                if self.udp_network:
+                    # datagrams arrive in the thread of the sender
+                    def receiver(data, on_data=on_data):
+                        self.loop.call_soon_threadsafe(on_data, data.strip().decode(), time.time())
+                    transport = self.udp_network.bind(local_addr, receiver)
+                else:
+                    transport, _ = await self.loop.create_datagram_endpoint(
+                        lambda on_data=on_data: _DatagramReceiver(on_data), local_addr=local_addr)
+                self.transports.append(transport)
+            remote_addr = (self.udp_sender['ip'], self.udp_sender['port'])
+            if self.udp_network:
+                self.sender = self.udp_network.connect(remote_addr)
+            else:
+                self.sender, _ = await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                                          remote_addr=remote_addr)
+            self.transports.append(self.sender)
+            if self.inner_communication == 'mqtt':
+                self.mqtt = AsyncClientMQTT(self.loop, self.mqtt.ip, self.mqtt.port, self.mqtt.topics,
+                                            codec=self.mqtt.codec, broker=self.mqtt.broker)
+                self.mqtt.connect_and_loop()
+                # tasks may also be triggered by other components publishing to the update topic
+                self.mqtt.register_handler(root_topic=self.mqtt.topics['update'],
+                                           all_topics=self.mqtt.topics['update']+'/#',
+                                           handler=self._on_update_msg)
+                if self.heatmap_delta:
+                    self.mqtt.register_handler(root_topic=self.mqtt.topics['resync'],
+                                               all_topics=self.mqtt.topics['resync']+'/#',
+                                               handler=self._on_resync_msg)
+            await self._stopped.wait()
+        finally:
+            if self._flush_handle:
+                self._flush_handle.cancel()
+            if self._flush_tasks:
+                await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+            for transport in self.transports:
+                transport.close()
+            self.transports = []
+            if self.mqtt and self.mqtt.connected:
+                self.mqtt.disconnect()
+            if self.pool:
+                self.pool.close()
+
+    def stop(self):
+        """
+        Stop serving, can be called from any thread
+        """
+        self.loop.call_soon_threadsafe(self._stopped.set)
+
+    def on_table_data(self, data, data_epoch):
+        if not self.Table or not self._is_new_layout(data):
+            return
+        self._supersede(self.latest_version + 1)
+        # the latest layout of each zone wins within a burst
+        self._pending['layouts'][data.split(' ', 1)[0]] = data
+        self._pending['update_task_tokens'] += self._get_layout_task_tokens()
+        self._pending['epochs'].append(data_epoch)
+        self._schedule_flush()
+
+    def on_tablet_data(self, data, data_epoch):
+        parsed = self._parse_tablet_msg(data)
+        if parsed is None:
+            return
+        kind, value, task_tokens = parsed
+        if kind == 'density':
+            self._supersede(self.latest_version + 1)
+            self._pending['density'].update(value)
+            self._pending['update_task_tokens'] += task_tokens
+        else:
+            self._pending['task_tokens'] += task_tokens
+        self._pending['epochs'].append(data_epoch)
+        self._schedule_flush()
+
+    def _on_update_msg(self, msg_data):
+        self._pending['task_tokens'] += msg_data['task_tokens']
+        self._pending['epochs'].append(msg_data.get('epoch', time.time()))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.coalesce_window, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        flush_task = self.loop.create_task(self._flush())
+        self._flush_tasks.add(flush_task)
+        flush_task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self):
+        # messages received while a flush is running are collapsed into the next one
+        async with self._busy:
+            pending, self._pending = self._pending, self._new_pending()
+            if not pending['epochs']:
+                return
+            try:
+                await self._apply_pending(pending)
+            except Exception as e:
+                print('\n' + '=' * 50)
+                print(traceback.format_exc())
+                print('=' * 50 + '\n')
+
+    async def _apply_pending(self, pending):
+        first_epoch = min(pending['epochs'])
+        version = self.latest_version
+        task_tokens = pending['task_tokens']
+        if pending['layouts'] or pending['density']:
+            changed_h3_cells = await self.loop.run_in_executor(
+                None, self._update_table,
+                list(pending['layouts'].values()) or None, pending['density'] or None)
+            self.latency['update'].record(time.time() - first_epoch)
+            if pending['density'] or changed_h3_cells is None or changed_h3_cells:
+                task_tokens = pending['update_task_tokens'] + task_tokens
+        task_tokens = list(dict.fromkeys(task_tokens))
+        if not task_tokens:
+            return
+        published = await self.loop.run_in_executor(None, self._process_tasks, task_tokens, version)
+        if self.latest_version > version:
+            # aborted, the next flush runs these tasks again on the latest version
+            self.num_superseded += 1
+            self._pending['task_tokens'] = task_tokens + self._pending['task_tokens']
+            return
+        for indicator, task_name, formatted_rst in published:
+            self._send_result(indicator, task_name, formatted_rst)
+            self.latency['publish'].record(time.time() - first_epoch)
+
+    def _process_tasks(self, task_tokens, version):
+        """
+        :return: list of (indicator, result name, formatted result), see IndicatorPool.process_tasks
+        """
+        if self.pool:
+            return self.pool.process_tasks(task_tokens, version)
+        is_superseded = lambda: self.latest_version > version
+        return [(indicator, task_name, formatted_rst)
+                for indicator in self.indicators
+                for task_name, formatted_rst in indicator.process_tasks(task_tokens, is_superseded)]
+
+    def _send_result(self, indicator, task_name, formatted_rst):
+        if isinstance(formatted_rst, HeatmapFrame):
+            self.sender.sendto(formatted_rst.text.encode())
+            formatted_rst = indicator.get_heatmap_encoder(task_name).encode(formatted_rst)
+        else:
+            self.sender.sendto(formatted_rst.encode())
+        if self.mqtt and self.mqtt.connected:
+            self.mqtt.publish_msg(f"{self.mqtt.topics['results']}/{indicator.name}/{task_name}", formatted_rst)
+
+    def _on_resync_msg(self, msg_data):
+        for indicator in self.indicators:
+            indicator.resync_heatmap(msg_data)
+
 
 def dist_unit_converter(raw_value, raw_unit, return_unit, speed=None):
     assert raw_unit in ['m', 'km', 'sec', 'min', 'h']
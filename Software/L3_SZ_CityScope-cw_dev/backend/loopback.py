@@ -0,0 +1,274 @@
+import time, json, queue, socket, bisect, threading, itertools
+from types import SimpleNamespace
+import paho.mqtt.client as mqtt
+from utils import LatencyHistogram
+
+
+#======================================#
+#             Class                    #
+#======================================#
+class LoopbackBroker:
+    """
+    In-process stand-in of an mqtt broker for ClientMQTT (see its broker parameter): a message published by one
+    client is delivered to every client subscribed to a matching topic, in the dispatch thread of that client as
+    paho does in its network loop
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.mids = itertools.count(1)
+
+    def create_client(self, client_id=None, *args, **kwargs):
+        return LoopbackMQTTClient(self, client_id)
+
+    def subscribe(self, client, topic):
+        with self.lock:
+            self.subscriptions.setdefault(client, set()).add(topic)
+
+    def unsubscribe_all(self, client):
+        with self.lock:
+            self.subscriptions.pop(client, None)
+
+    def publish(self, topic, payload):
+        with self.lock:
+            receivers = [client for client, topics in self.subscriptions.items()
+                         if any(mqtt.topic_matches_sub(sub, topic) for sub in topics)]
+        for client in receivers:
+            client.deliver(topic, payload)
+        return next(self.mids)
+
+
+class LoopbackMQTTClient:
+    """
+    The part of paho.mqtt.client.Client used by ClientMQTT, connected to a LoopbackBroker
+    """
+    def __init__(self, broker, client_id=None):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_subscribe = None
+        self.on_message = None
+        self.messages = queue.Queue()
+        self.thread = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def loop_start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._dispatch, name=f'loopback_mqtt_{self.client_id}', daemon=True)
+            self.thread.start()
+
+    def loop_stop(self, *args, **kwargs):
+        if self.thread is not None:
+            self.messages.put(None)
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.thread = None
+
+    def _dispatch(self):
+        while True:
+            msg = self.messages.get()
+            if msg is None:
+                break
+            if self.on_message:
+                self.on_message(self, None, msg)
+
+    def disconnect(self, *args, **kwargs):
+        self.broker.unsubscribe_all(self)
+        return 0
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        self.broker.subscribe(self, topic)
+        mid = next(self.broker.mids)
+        if self.on_subscribe:
+            self.on_subscribe(self, None, mid, (qos,))
+        return 0, mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False, *args, **kwargs):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return 0, self.broker.publish(topic, payload)
+
+    def deliver(self, topic, payload):
+        self.messages.put(SimpleNamespace(topic=topic, payload=payload, qos=0, retain=False))
+
+
+class LoopbackNetwork:
+    """
+    In-process stand-in of the udp network between the table, tablet, Handler and frontend (see the udp_network
+    parameter of Handler). Addresses are matched by port only, so that a socket bound to 0.0.0.0 receives what is
+    sent to 127.0.0.1; datagrams sent to a port nobody is bound to are dropped as with udp.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bound = {}
+
+    def socket(self, *args, **kwargs):
+        """
+        Same signature as socket.socket, for Handler
+        """
+        return LoopbackUDPSocket(self)
+
+    def bind(self, addr, receiver):
+        """
+        :param receiver: function called with the bytes of each datagram received, in the thread of the sender
+        :return: bound LoopbackUDPSocket, close it to unbind
+        """
+        sock = LoopbackUDPSocket(self, receiver=receiver)
+        sock.bind(addr)
+        return sock
+
+    def connect(self, addr):
+        """
+        :return: LoopbackUDPSocket whose sendto() sends to addr by default, like a connected datagram transport
+        """
+        return LoopbackUDPSocket(self, remote_addr=addr)
+
+    def _bind(self, port, sock):
+        with self.lock:
+            if port in self.bound:
+                raise OSError(f'Port {port} is already bound in this loopback network')
+            self.bound[port] = sock
+
+    def _unbind(self, port, sock):
+        with self.lock:
+            if self.bound.get(port, None) is sock:
+                del self.bound[port]
+
+    def sendto(self, data, addr):
+        with self.lock:
+            sock = self.bound.get(addr[1], None)
+        if sock is not None:
+            sock.deliver(bytes(data))
+        return len(data)
+
+
+class LoopbackUDPSocket:
+    """
+    The part of a udp socket.socket used by Handler, in a LoopbackNetwork
+    """
+    def __init__(self, network, receiver=None, remote_addr=None):
+        self.network = network
+        self.receiver = receiver
+        self.remote_addr = remote_addr
+        self.port = None
+        self.timeout = None
+        self.datagrams = queue.Queue()
+        self.closed = False
+
+    def bind(self, addr):
+        self.network._bind(addr[1], self)
+        self.port = addr[1]
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def deliver(self, data):
+        if self.receiver is not None:
+            self.receiver(data)
+        else:
+            self.datagrams.put(data)
+
+    def recvfrom(self, buffer_size):
+        if self.closed:
+            raise OSError('Loopback socket is closed')
+        try:
+            data = self.datagrams.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout('timed out')
+        if data is None:
+            raise OSError('Loopback socket is closed')
+        return data[:buffer_size], ('127.0.0.1', 0)
+
+    def sendto(self, data, addr=None):
+        return self.network.sendto(data, addr if addr is not None else self.remote_addr)
+
+    def shutdown(self, how=None):
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.port is not None:
+                self.network._unbind(self.port, self)
+            self.datagrams.put(None)
+
+
+#======================================#
+#          Functions                   #
+#======================================#
+def load_replay(path):
+    """
+    :param path: json lines of {"t": seconds since the first event, "channel": "table" or "tablet", "data": str},
+        as written by udp_mqtt_utils/udp_recorder.py
+    :return: list of events
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(events, network, broker, table_addr, tablet_addr, results_topic='results', pace='closed',
+           settle=1.0, speed=1.0, timeout=30):
+    """
+    Replay table and tablet events into a Handler served on network and broker, and measure the latency from
+    sending each event to each result published on results_topic/<indicator>/<task>
+    :param pace: 'closed' sends the next event once results of the previous one settle, so that each result is
+        attributed to the event triggering it; 'recorded' sends events at their recorded times (divided by speed)
+        and attributes each result to the latest event sent before it, i.e. how stale the screen is under
+        continuous interaction
+    :param settle: seconds without any new result after which the results of an event are considered complete,
+        once its first result is received in closed pace
+    :param timeout: seconds to wait for the results of an event at most, in closed pace
+    :return: dict of "<indicator>/<task>" -> LatencyHistogram, and the number of events without any result
+    """
+    received = queue.Queue()
+    subscriber = broker.create_client('loopback_replay')
+    subscriber.on_message = lambda client, userdata, msg: received.put((msg.topic, time.time()))
+    subscriber.subscribe(results_topic + '/#')
+    subscriber.loop_start()
+    latency, num_events_without_results = {}, 0
+    sent_epochs = []
+
+    def record(topic, epoch):
+        name = topic[len(results_topic) + 1:]
+        sent_epoch = sent_epochs[max(bisect.bisect_right(sent_epochs, epoch) - 1, 0)]
+        latency.setdefault(name, LatencyHistogram()).record(epoch - sent_epoch)
+
+    try:
+        t0 = time.time()
+        for event in events:
+            if pace == 'recorded':
+                time.sleep(max(0, t0 + event['t'] / speed - time.time()))
+            addr = table_addr if event['channel'] == 'table' else tablet_addr
+            sent_epochs.append(time.time())
+            network.sendto(event['data'].encode(), addr)
+            if pace == 'closed':
+                num_results, deadline = 0, time.time() + timeout
+                while time.time() < deadline:
+                    # the first result is waited for up to the deadline, later ones up to settle
+                    wait = deadline - time.time() if num_results == 0 else min(settle, deadline - time.time())
+                    try:
+                        record(*received.get(timeout=max(wait, 0)))
+                        num_results += 1
+                    except queue.Empty:
+                        break
+                num_events_without_results += num_results == 0
+            else:
+                while not received.empty():
+                    record(*received.get())
+        if pace == 'recorded':
+            while True:
+                try:
+                    record(*received.get(timeout=settle))
+                except queue.Empty:
+                    break
+    finally:
+        subscriber.disconnect()
+        subscriber.loop_stop()
+    return latency, num_events_without_results
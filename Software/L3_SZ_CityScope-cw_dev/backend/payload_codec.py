@@ -0,0 +1,141 @@
+import json, ast
+import numpy as np
+import msgpack
+from numpyencoder import NumpyEncoder
+
+#======================================#
+#          Constants                   #
+#======================================#
+# an encoded payload is PAYLOAD_MAGIC + codec id (1 byte) + schema version (1 byte) + body
+PAYLOAD_MAGIC = b'CS'
+# bump it when the layout of update or result messages changes, see decode_payload()
+SCHEMA_VERSION = 1
+# msgpack extension type of numpy arrays
+NDARRAY_EXT_TYPE = 1
+
+
+#======================================#
+#             Class                    #
+#======================================#
+class PayloadCodec:
+    """
+    Codec of mqtt payloads, subclasses define a unique codec_id and name and encode/decode the body. Payloads are
+    framed with the codec id and schema version, so that decode_payload() reads them whichever codec the
+    sender uses.
+    """
+    codec_id = None
+    name = None
+
+    def encode(self, msg_data):
+        return PAYLOAD_MAGIC + bytes([self.codec_id, SCHEMA_VERSION]) + self.encode_body(msg_data)
+
+    def encode_body(self, msg_data):
+        raise NotImplementedError
+
+    def decode_body(self, body):
+        raise NotImplementedError
+
+
+class JSONCodec(PayloadCodec):
+    """
+    Human-readable, numpy arrays are decoded as lists
+    """
+    codec_id = 1
+    name = 'json'
+
+    def encode_body(self, msg_data):
+        return json.dumps(msg_data, cls=NumpyEncoder).encode()
+
+    def decode_body(self, body):
+        return json.loads(bytes(body))
+
+
+class MsgpackCodec(PayloadCodec):
+    """
+    Compact binary, numpy arrays are packed as their raw buffer with dtype and shape and decoded as arrays
+    """
+    codec_id = 2
+    name = 'msgpack'
+
+    @staticmethod
+    def _pack_default(obj):
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            return msgpack.ExtType(NDARRAY_EXT_TYPE,
+                                   msgpack.packb([obj.dtype.str, list(obj.shape), np.ascontiguousarray(obj).tobytes()],
+                                                 use_bin_type=True))
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f'Cannot pack object of type {type(obj)}')
+
+    @staticmethod
+    def _unpack_ext(code, data):
+        if code == NDARRAY_EXT_TYPE:
+            dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+            return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+        return msgpack.ExtType(code, data)
+
+    def encode_body(self, msg_data):
+        return msgpack.packb(msg_data, default=self._pack_default, use_bin_type=True)
+
+    def decode_body(self, body):
+        return msgpack.unpackb(body, ext_hook=self._unpack_ext, raw=False, strict_map_key=False)
+
+
+#======================================#
+#          Functions                   #
+#======================================#
+codecs_by_name = {}
+codecs_by_id = {}
+
+
+def register_codec(codec):
+    """
+    :param codec: PayloadCodec instance, replaces any registered codec with the same name or id
+    """
+    codecs_by_name[codec.name] = codec
+    codecs_by_id[codec.codec_id] = codec
+    return codec
+
+
+def get_codec(codec=None):
+    """
+    :param codec: name of a registered codec or a PayloadCodec instance, defaults to msgpack
+    :return: PayloadCodec instance
+    """
+    if codec is None:
+        codec = MsgpackCodec.name
+    if isinstance(codec, PayloadCodec):
+        return codec
+    if codec not in codecs_by_name:
+        raise ValueError(f'Unknown payload codec: {codec}, available: {list(codecs_by_name.keys())}')
+    return codecs_by_name[codec]
+
+
+def decode_payload(payload):
+    """
+    Decode an mqtt payload without evaluating it as code
+    :param payload: bytes of an encoded payload (see PayloadCodec.encode), or an unframed payload of the former
+        format (json or python literals) sent by older components
+    :return: decoded message data
+    """
+    payload = bytes(payload)
+    if payload[:len(PAYLOAD_MAGIC)] == PAYLOAD_MAGIC:
+        header_size = len(PAYLOAD_MAGIC) + 2
+        codec_id, schema_version = payload[len(PAYLOAD_MAGIC)], payload[len(PAYLOAD_MAGIC) + 1]
+        if schema_version > SCHEMA_VERSION:
+            raise ValueError(f'Unsupported payload schema version {schema_version}, '
+                             f'the latest supported is {SCHEMA_VERSION}')
+        if codec_id not in codecs_by_id:
+            raise ValueError(f'Unknown payload codec id: {codec_id}')
+        return codecs_by_id[codec_id].decode_body(memoryview(payload)[header_size:])
+    text = payload.decode()
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+register_codec(JSONCodec())
+register_codec(MsgpackCodec())
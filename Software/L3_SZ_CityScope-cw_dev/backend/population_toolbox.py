@@ -1,9 +1,10 @@
-import os, time, datetime, random, pickle
+import os, copy, time, datetime, random, pickle
 import pandas as pd
 import numpy as np
 from pyproj import Transformer, CRS
 import h3.api.numpy_int as h3
 from collections import Counter
+from collections.abc import Sequence
 from geodata_toolbox import PolygonGeoData
 from utils import *
 
@@ -94,7 +95,7 @@ individual_pop_attr_lookup = {
 class HomeWorkplaceAssigner:
     def __init__(self, pickled_taz_path=None, taz_geojson_path=None, commuting_od_path=None,
                  save_path=None, table='shenzhen', proj_crs=None, resolution=11, target_taz_list=None,
-                 in_sim_area_taz_list=[1029, 1020, 1054], quick_assign=True):
+                 in_sim_area_taz_list=[1029, 1020, 1054], quick_assign=True, n_workers=1):
         self.table = table
         self.resolution = resolution
         self.quick_assign = quick_assign
@@ -110,7 +111,7 @@ class HomeWorkplaceAssigner:
         else:
             self.TAZ = PolygonGeoData(name='taz', src_geojson_path=taz_geojson_path, table=table,
                                       proj_crs=proj_crs, link_to_h3_method='polygon_intersection')
-            self.TAZ.link_to_h3(resolution, True)
+            self.TAZ.link_to_h3(resolution, True, n_workers=n_workers)
             self.TAZ.transformer = None   # avoid unpickable error
             pickle.dump(self.TAZ, open(pickled_taz_path, 'wb'))
         self.commuting_od_df = pd.read_csv(commuting_od_path)
@@ -161,6 +162,10 @@ class HomeWorkplaceAssigner:
 
 
     def assign_workplace(self, persons, location_setter=None):
+        store, rows = Population._get_store_rows(persons)
+        if store is not None:
+            self._assign_workplace_columns(store, rows, location_setter)
+            return
         taz_to_persons = {}
         for person in persons:
             this_home_taz = self.h3_cell_to_taz[person.home['h3'][self.resolution]]['taz']
@@ -190,6 +195,44 @@ class HomeWorkplaceAssigner:
                                     location_setter=location_setter)
 
 
+    def _assign_workplace_columns(self, store, rows=None, location_setter=None):
+        """
+        assign_workplace() of persons in a PersonStore, drawing workplaces of all persons of a taz at once
+        :param rows: rows of the persons (default: all)
+        """
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows)
+        home_cells, cell_pos = np.unique(store.get_h3_cells('home', self.resolution, rows), return_inverse=True)
+        taz_ids = {}
+        cell_taz_ids = np.array([taz_ids.setdefault(self.h3_cell_to_taz[h3_cell]['taz'], len(taz_ids))
+                                 for h3_cell in home_cells.tolist()], dtype=np.int64)
+        taz_list, person_taz_ids = list(taz_ids.keys()), cell_taz_ids[cell_pos]
+        # home taz in order of their first person, drawn as by the loop over persons
+        taz_ids_in_order, first_pos = np.unique(person_taz_ids, return_index=True)
+        persons_order = np.argsort(person_taz_ids, kind='stable')
+        persons_by_taz = np.split(persons_order, np.cumsum(np.bincount(person_taz_ids, minlength=len(taz_list)))[:-1])
+        des_taz_of_persons = np.empty(len(rows), dtype=object)
+        for taz_id in taz_ids_in_order[np.argsort(first_pos)].tolist():
+            positions = persons_by_taz[taz_id]
+            des_ratio = self.from_ratio[taz_list[taz_id]]
+            des_taz_of_persons[positions] = list(np.random.choice(list(des_ratio.keys()), size=len(positions),
+                                                                  replace=True, p=list(des_ratio.values())))
+        h3_cells = np.zeros(len(rows), dtype=np.uint64)
+        for des_taz, positions in pd.Series(des_taz_of_persons).groupby(des_taz_of_persons).indices.items():
+            des_cells = self.taz_to_h3_cell[des_taz]
+            cells = np.fromiter(des_cells.keys(), dtype=np.uint64, count=len(des_cells))
+            if self.quick_assign:
+                h3_cells[positions] = cells[np.random.randint(len(cells), size=len(positions))]
+            else:
+                h3_cells[positions] = np.random.choice(cells, size=len(positions), p=list(des_cells.values()))
+        if location_setter:
+            locations = location_setter.set_locations(h3_cells=h3_cells, resolution=self.resolution)
+        else:
+            lat, lon = h3_cells_to_lat_lon(h3_cells)
+            locations = {'coords': np.column_stack([lon, lat]), 'h3': {self.resolution: h3_cells},
+                         'in_sim_area': np.isin(des_taz_of_persons, self.in_sim_area_taz_list)}
+        store.set_locations('workplace', rows, locations)
+
+
     def assign_home(self, persons, location_setter=None):
         taz_to_persons = {}
         for person in persons:
@@ -259,14 +302,10 @@ class Population:
         self.base_sim_pop = []
         self.base_floating_pop = []
         self.sim_pop = []
+        self.person_store = None
         self.h3_count_base_sim_pop = {}
         self.h3_count_sim_pop = {}
-        if home_workplace_assigner_path is None:
-            home_workplace_assigner_path = os.path.join('cities', table, 'models', 'home_workplace_assigner.p')
-        if os.path.exists(home_workplace_assigner_path):
-            self.home_workplace_assigner = pickle.load(open(home_workplace_assigner_path, 'rb'))
-        else:
-            self.home_workplace_assigner = None
+        self.load_home_workplace_assigner(home_workplace_assigner_path)
         if location_setter:
             self.location_setter = location_setter
         else:
@@ -276,27 +315,172 @@ class Population:
             except Exception as e:
                 raise ValueError(f'Error: failed to create a location setter\n{e}')
 
+    def load_home_workplace_assigner(self, home_workplace_assigner_path=None):
+        if home_workplace_assigner_path is None:
+            home_workplace_assigner_path = os.path.join('cities', self.table, 'models', 'home_workplace_assigner.p')
+        if os.path.exists(home_workplace_assigner_path):
+            self.home_workplace_assigner = pickle.load(open(home_workplace_assigner_path, 'rb'))
+        else:
+            self.home_workplace_assigner = None
+
+    def save_snapshot(self, snapshot_dir):
+        """
+        Save persons and h3 counts to a snapshot directory, see utils.write_snapshot() for the format.
+        Person attributes are kept as json, locations as columns; trips are simulation results and not saved.
+        The person_store is saved as its columns, views of its rows are saved as members -(row + 1).
+        The home_workplace_assigner is a separately pickled model and is reloaded from its own path by load_snapshot().
+        """
+        store = getattr(self, 'person_store', None)
+        persons, person_pos, members = [], {}, {}
+
+        def get_pos(person):
+            if id(person) not in person_pos:
+                if store is not None and person._store is store:
+                    person_pos[id(person)] = -(person._row + 1)
+                else:
+                    person_pos[id(person)] = len(persons)
+                    persons.append(person)
+            return person_pos[id(person)]
+
+        for name in ['base_sim_pop', 'sim_pop', 'base_floating_pop']:
+            population = getattr(self, name)
+            if isinstance(population, PersonViews) and population.store is store:
+                # rows are saved without creating their views
+                members[name] = np.concatenate([-(population.rows + 1),
+                                                np.array([get_pos(person) for person in population.others],
+                                                         dtype=np.int64)])
+            else:
+                members[name] = np.array([get_pos(person) for person in population], dtype=np.int64)
+        arrays = {
+            'idx': np.array([str(person.idx) for person in persons]),
+            'attrs': json_to_array([person.attrs for person in persons])
+        }
+        for name in ['base_sim_pop', 'sim_pop', 'base_floating_pop']:
+            arrays[f'members:{name}'] = members[name]
+        location_resolutions = {}
+        for location_type in ['home', 'workplace']:
+            locations = [getattr(person, location_type) for person in persons]
+            arrays.update(prefix_arrays(_locations_to_arrays(locations), f'{location_type}:'))
+            location_resolutions[location_type] = sorted({res for loc in locations for res in loc.get('h3', {})})
+        h3_counts = []
+        for count_name in ['h3_count_base_sim_pop', 'h3_count_sim_pop']:
+            for location_type, counts_by_res in getattr(self, count_name).items():
+                for res, counts in counts_by_res.items():
+                    prefix = f'{count_name}:{len(h3_counts)}:'
+                    arrays[prefix + 'cells'] = np.fromiter(counts.keys(), dtype=np.uint64, count=len(counts))
+                    arrays[prefix + 'counts'] = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+                    h3_counts.append([count_name, location_type, res])
+        store_meta = None
+        if store is not None:
+            store_arrays, store_meta = store.to_arrays()
+            arrays.update(prefix_arrays(store_arrays, 'store:'))
+        meta = {
+            'table': self.table, 'work_dir': self.work_dir, 'resolution': self.resolution,
+            'person_attr_spec': self.person_attr_spec, 'person_store': store_meta,
+            'base_sim_pop_geojson_path': self.base_sim_pop_geojson_path,
+            'base_floating_pop_json_path': self.base_floating_pop_json_path,
+            'location_resolutions': location_resolutions,
+            'h3_counts': h3_counts
+        }
+        location_setter = getattr(self, 'location_setter', None)
+        if location_setter is not None:
+            meta['location_setter'] = {
+                'resolution_in': location_setter.resolution_in,
+                'resolution_out': location_setter.resolution_out,
+                'num_close_nodes': location_setter.num_close_nodes,
+                'resolutions': list(location_setter.h3_cells_in.keys())
+            }
+            for res, cells in location_setter.h3_cells_in.items():
+                arrays[f'location_setter:{res}'] = np.asarray(cells, dtype=np.uint64)
+        write_snapshot(snapshot_dir, arrays, meta, kind=type(self).__name__)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir, mmap=True, home_workplace_assigner_path=None, location_setter=None):
+        """
+        Load a Population saved by save_snapshot(), without reading source data and setting locations again.
+        The transport network of the location setter is not saved, pass location_setter to use one with it.
+        """
+        arrays, meta = read_snapshot(snapshot_dir, kind=cls.__name__, mmap=mmap)
+        self = cls.__new__(cls)
+        for attr in ['table', 'work_dir', 'resolution', 'person_attr_spec',
+                     'base_sim_pop_geojson_path', 'base_floating_pop_json_path']:
+            setattr(self, attr, meta[attr])
+        person_attrs = array_to_json(arrays['attrs'])
+        locations = {
+            location_type: _arrays_to_locations(select_arrays(arrays, f'{location_type}:'),
+                                                meta['location_resolutions'][location_type])
+            for location_type in ['home', 'workplace']
+        }
+        persons = []
+        for idx, attrs, home, workplace in zip(arrays['idx'].tolist(), person_attrs,
+                                               locations['home'], locations['workplace']):
+            person = Person(idx)
+            person.attrs, person.home, person.workplace = attrs, home, workplace
+            persons.append(person)
+        self.person_store = None
+        if meta.get('person_store', None) is not None:
+            self.person_store = PersonStore.from_arrays(select_arrays(arrays, 'store:'), meta['person_store'])
+        for name in ['base_sim_pop', 'sim_pop', 'base_floating_pop']:
+            positions = np.asarray(arrays[f'members:{name}'])
+            num_views = int(np.argmax(positions >= 0)) if (positions >= 0).any() else len(positions)
+            if num_views and (positions[num_views:] >= 0).all():
+                members = PersonViews(self.person_store, -positions[:num_views] - 1)
+                members.extend(persons[pos] for pos in positions[num_views:].tolist())
+            else:
+                members = [persons[pos] if pos >= 0 else self.person_store.person(-pos - 1)
+                           for pos in positions.tolist()]
+            setattr(self, name, members)
+        self.h3_count_base_sim_pop, self.h3_count_sim_pop = {}, {}
+        for i, (count_name, location_type, res) in enumerate(meta['h3_counts']):
+            prefix = f'{count_name}:{i}:'
+            getattr(self, count_name).setdefault(location_type, {})[res] = dict(
+                zip(arrays[prefix + 'cells'].tolist(), arrays[prefix + 'counts'].tolist()))
+        self.load_home_workplace_assigner(home_workplace_assigner_path)
+        if location_setter is None and 'location_setter' in meta:
+            spec = meta['location_setter']
+            location_setter = LocationSetter.__new__(LocationSetter)
+            location_setter.h3_cells_in = {res: arrays[f'location_setter:{res}'].tolist()
+                                           for res in spec['resolutions']}
+            location_setter.resolution_in = spec['resolution_in']
+            location_setter.resolution_out = spec['resolution_out']
+            location_setter.set_tn(None, spec['num_close_nodes'])
+        self.location_setter = location_setter
+        return self
+
     def set_base_sim_population(self):
+        """
+        Persons of the base simulation population are kept in columns of self.person_store, base_sim_pop and
+        sim_pop are PersonViews of its rows
+        """
         features, src_crs = load_geojsons(self.base_sim_pop_geojson_path)
-        transformer = Transformer.from_crs(src_crs, 4326) if src_crs != 4326 else None
         num_persons = len(features)
-        random_persons_pool = self.generate_random_persons_pool(num_persons)
+        # this is just random attr combination as placeholder
+        person_attrs = self.generate_random_persons_columns(num_persons)
         for idx, fea in enumerate(features):
-            person_idx = f'b{idx}'
-            this_person_attrs = random_persons_pool[idx]   # this is just random attr combination as placeholder
-            this_person_attrs_true = self.parse_person_attrs_from_individual_label_data(fea['properties'])
-            this_person_attrs.update(this_person_attrs_true)
-            thisPerson = Person(person_idx)
-            thisPerson.set_person_attrs(this_person_attrs)
-            coord = fea['geometry']['coordinates']
-            if fea['geometry']['type'] == 'MultiPoint':
-                coord = coord[0]
-            if transformer:
-                new_coord = transformer.transform(coord[1], coord[0])
-                coord[0], coord[1] = new_coord[1], new_coord[0]
-            thisPerson.set_location(self.location_setter, coord=coord, resolution=self.resolution, location_type='home')
-            self.base_sim_pop.append(thisPerson)
-            self.sim_pop.append(thisPerson)
+            for attr, value in self.parse_person_attrs_from_individual_label_data(fea['properties']).items():
+                if attr not in person_attrs:
+                    person_attrs[attr] = [None] * num_persons
+                person_attrs[attr][idx] = value
+        coords = np.array([
+            (fea['geometry']['coordinates'][0] if fea['geometry']['type'] == 'MultiPoint'
+             else fea['geometry']['coordinates'])[:2]
+            for fea in features
+        ], dtype=np.float64).reshape(-1, 2)
+        if src_crs != 4326:
+            transformer = Transformer.from_crs(src_crs, 4326)
+            new_coords = transformer.transform(coords[:, 1], coords[:, 0])
+            coords = np.column_stack([new_coords[1], new_coords[0]])
+        store = PersonStore([f'b{idx}' for idx in range(num_persons)], person_attrs)
+        if self.location_setter:
+            locations = self.location_setter.set_locations(coords=coords, resolution=self.resolution)
+        else:
+            h3_cells = np.fromiter((h3.geo_to_h3(lat, lon, self.resolution) for lon, lat in coords.tolist()),
+                                   dtype=np.uint64, count=num_persons)
+            locations = {'coords': coords, 'h3': {self.resolution: h3_cells}}
+        store.set_locations('home', np.arange(num_persons), locations)
+        self.person_store = store
+        self.base_sim_pop = PersonViews(store)
+        self.sim_pop = PersonViews(store)
         if self.home_workplace_assigner:
             self.home_workplace_assigner.assign_workplace(self.sim_pop, location_setter=self.location_setter)
         self.h3_count_base_sim_pop['home'] = {
@@ -307,17 +491,28 @@ class Population:
         pass
 
     def count_population_on_h3(self, population, resolution, location_type='home', self_update=True):
+        """
+        :param population: list of Person, PersonViews or a PersonStore; persons which are all views of one
+            PersonStore are counted from its columns
+        """
         # todo: add filter
         if location_type not in self.h3_count_sim_pop:
             self.h3_count_sim_pop[location_type] = {}
         if resolution not in self.h3_count_sim_pop[location_type]:
             self.h3_count_sim_pop[location_type][resolution] = {}
-        features_to_h3_cells = [
-            getattr(person, location_type, {}).get('h3', {}).get(resolution, None)
-            for person in population
-        ]
-        features_to_h3_cells = [h3_cell for h3_cell in features_to_h3_cells if h3_cell]
-        counter = Counter(features_to_h3_cells)
+        store, rows = self._get_store_rows(population)
+        if store is not None:
+            h3_cells = store.get_h3_cells(location_type, resolution, rows)
+            h3_cells = h3_cells[h3_cells != 0]
+            unique_cells, cell_pos = np.unique(h3_cells, return_inverse=True)
+            counter = dict(zip(unique_cells.tolist(), np.bincount(cell_pos, minlength=len(unique_cells)).tolist()))
+        else:
+            features_to_h3_cells = [
+                getattr(person, location_type, {}).get('h3', {}).get(resolution, None)
+                for person in population
+            ]
+            features_to_h3_cells = [h3_cell for h3_cell in features_to_h3_cells if h3_cell]
+            counter = Counter(features_to_h3_cells)
         if self_update:
             for h3_cell, num in counter.items():
                 self.h3_count_sim_pop[location_type][resolution][h3_cell] = \
@@ -325,6 +520,35 @@ class Population:
                         resolution, {}).setdefault(h3_cell, 0) + num
         return dict(counter)
 
+    @staticmethod
+    def _get_store_rows(population):
+        """
+        :return: PersonStore and rows of population if they are all in the same store, otherwise None, None
+        """
+        if isinstance(population, PersonStore):
+            return population, None
+        if isinstance(population, PersonViews) and not population.others:
+            return population.store, population.rows
+        store = population[0]._store if len(population) and isinstance(population[0], Person) else None
+        if store is None or not all(isinstance(person, Person) and person._store is store for person in population):
+            return None, None
+        return store, np.fromiter((person._row for person in population), dtype=np.int64, count=len(population))
+
+    def generate_random_persons_columns(self, num_persons, person_attr_spec=None):
+        """
+        Like generate_random_persons_pool(), as dict of attribute name -> list of values of all persons
+        """
+        if not person_attr_spec:
+            person_attr_spec = self.person_attr_spec
+        attr_sampled_values = {}
+        for attr_name, attr_spec in person_attr_spec.items():
+            if type(attr_spec) == list:
+                values = sample_by_p(attr_spec, num_persons) if num_persons else []
+                attr_sampled_values[attr_name] = values if num_persons != 1 else [values]
+            else:
+                attr_sampled_values[attr_name] = [attr_spec] * num_persons
+        return attr_sampled_values
+
     def generate_random_persons_pool(self, num_persons, person_attr_spec=None):
         if not person_attr_spec:
             person_attr_spec = self.person_attr_spec
@@ -363,14 +587,408 @@ class Population:
         return person_attrs
 
 
+class PersonStore:
+    """
+    Columnar store of persons: one array per attribute (strings as codes of categories, numbers as int or float,
+    others as objects) and per field of home and workplace locations (lon, lat, h3 cell of each resolution,
+    in_sim_area). Person objects created by person() are views of a row, reading and writing the columns, created on
+    first access and kept (with attributes set on them, e.g. trips).
+    Missing values: NaN in float columns, -1 codes, 0 h3 cells (not a valid h3 index), -1 in in_sim_area.
+    """
+    location_types = ['home', 'workplace']
+    location_keys = {'coord', 'h3', 'in_sim_area', 'close_nodes'}
+
+    def __init__(self, idx, attrs=None):
+        """
+        :param idx: person indices
+        :param attrs: dict of attribute name -> values of all persons, None for missing values
+        """
+        self.idx = np.asarray(idx, dtype=str)
+        self.num_persons = len(self.idx)
+        self.attr_columns = {}
+        for name, values in (attrs or {}).items():
+            self.attr_columns[name] = self._make_column(values)
+        self.locations = {location_type: self._empty_locations() for location_type in self.location_types}
+        self._views = {}
+
+    def __len__(self):
+        return self.num_persons
+
+    def __getstate__(self):
+        # views are pickled as their own attributes, the rest is read from the columns
+        state = dict(self.__dict__)
+        state['_views'] = {row: {key: value for key, value in view.__dict__.items() if key not in ('_store', '_row')}
+                           for row, view in self._views.items()}
+        return state
+
+    def __setstate__(self, state):
+        view_states = state.pop('_views', {})
+        self.__dict__.update(state)
+        self._views = {}
+        for row, view_state in view_states.items():
+            self.person(row).__dict__.update(view_state)
+
+    def _empty_locations(self):
+        return {
+            'lon': np.full(self.num_persons, np.nan),
+            'lat': np.full(self.num_persons, np.nan),
+            'h3': {},
+            'in_sim_area': np.full(self.num_persons, -1, dtype=np.int8),
+            # sparse: row -> value
+            'close_nodes': {},
+            # row -> location dict not fitting the columns (e.g. with other keys), returned as it is
+            'others': {}
+        }
+
+    @staticmethod
+    def _make_column(values):
+        values = list(values)
+        present = [value for value in values if value is not None]
+        if all(isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+               for value in present):
+            if len(present) == len(values) and all(isinstance(value, (int, np.integer)) for value in present):
+                return {'kind': 'int', 'values': np.asarray(values, dtype=np.int64)}
+            return {'kind': 'float',
+                    'values': np.array([np.nan if value is None else value for value in values], dtype=np.float64)}
+        if all(isinstance(value, str) for value in present):
+            categorical = pd.Categorical([None if value is None else str(value) for value in values])
+            return {'kind': 'category', 'values': np.asarray(categorical.codes, dtype=np.int32),
+                    'categories': categorical.categories.tolist()}
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return {'kind': 'object', 'values': column}
+
+    def _get_value(self, column, row):
+        value = column['values'][row]
+        if column['kind'] == 'category':
+            return column['categories'][value] if value >= 0 else None
+        if column['kind'] == 'float':
+            return None if value != value else float(value)
+        if column['kind'] == 'int':
+            return int(value)
+        return value
+
+    def _set_value(self, name, row, value):
+        column = self.attr_columns.get(name, None)
+        if column is None:
+            column = self.attr_columns[name] = self._make_column([None] * self.num_persons)
+        if column['kind'] == 'category' and (value is None or isinstance(value, str)):
+            if value is None:
+                column['values'][row] = -1
+                return
+            if value not in column['categories']:
+                column['categories'].append(str(value))
+            column['values'][row] = column['categories'].index(value)
+        elif column['kind'] in ('int', 'float') and isinstance(value, (int, float, np.integer, np.floating)) \
+                and not isinstance(value, (bool, np.bool_)):
+            if column['kind'] == 'int' and not isinstance(value, (int, np.integer)):
+                column['kind'], column['values'] = 'float', column['values'].astype(np.float64)
+            column['values'][row] = value
+        elif column['kind'] == 'object':
+            column['values'][row] = value
+        else:
+            # a value of another type, e.g. a float in an int column, or a number in a column of strings
+            values = [self._get_value(column, i) for i in range(self.num_persons)]
+            values[row] = value
+            self.attr_columns[name] = self._make_column(values)
+
+    def get_attrs(self, row):
+        """
+        :return: dict of the attributes of a person, without missing ones
+        """
+        attrs = {}
+        for name, column in self.attr_columns.items():
+            value = self._get_value(column, row)
+            if value is not None:
+                attrs[name] = value
+        return attrs
+
+    def set_attrs(self, row, attrs):
+        for name in self.attr_columns:
+            if name not in attrs:
+                self._set_value(name, row, None)
+        for name, value in attrs.items():
+            self._set_value(name, row, value)
+
+    def get_attr_column(self, name):
+        """
+        :return: values of an attribute of all persons as an array, categories decoded (None for missing values)
+        """
+        column = self.attr_columns[name]
+        if column['kind'] == 'category':
+            categories = np.array(column['categories'] + [None], dtype=object)
+            return categories[column['values']]
+        return column['values']
+
+    def get_location(self, location_type, row):
+        locations = self.locations[location_type]
+        if row in locations['others']:
+            return locations['others'][row]
+        lon = locations['lon'][row]
+        in_sim_area = int(locations['in_sim_area'][row])
+        return {'h3': {res: cell for res, cells in locations['h3'].items() for cell in [int(cells[row])] if cell},
+                'coord': None if lon != lon else [float(lon), float(locations['lat'][row])],
+                'in_sim_area': None if in_sim_area < 0 else bool(in_sim_area),
+                'close_nodes': locations['close_nodes'].get(row, None)}
+
+    def set_location(self, location_type, row, location):
+        """
+        :param location: dict like the one of LocationSetter.set_location()
+        """
+        locations = self.locations[location_type]
+        h3_cells = location.get('h3', {}) if isinstance(location, dict) else None
+        coord = location.get('coord', None) if isinstance(location, dict) else None
+        if not isinstance(h3_cells, dict) or not set(location.keys()) <= self.location_keys or \
+                (coord is not None and len(coord) != 2):
+            locations['others'][row] = location
+            return
+        locations['others'].pop(row, None)
+        rows = np.array([row])
+        self.set_locations(location_type, rows, {
+            'coords': np.array([coord if coord is not None else [np.nan, np.nan]], dtype=np.float64),
+            'h3': {res: np.array([cell or 0], dtype=np.uint64) for res, cell in h3_cells.items()},
+            'in_sim_area': np.array([-1 if location.get('in_sim_area', None) is None
+                                     else int(bool(location['in_sim_area']))], dtype=np.int8),
+            'close_nodes': [location.get('close_nodes', None)]
+        })
+        for res, cells in locations['h3'].items():
+            if res not in h3_cells:
+                cells[row] = 0
+
+    def set_locations(self, location_type, rows, locations_columns):
+        """
+        Set locations of many persons at once
+        :param rows: rows of the persons
+        :param locations_columns: dict like the one of LocationSetter.set_locations()
+        """
+        locations = self.locations[location_type]
+        coords = np.asarray(locations_columns['coords'], dtype=np.float64).reshape(-1, 2)
+        locations['lon'][rows], locations['lat'][rows] = coords[:, 0], coords[:, 1]
+        for res, cells in locations_columns['h3'].items():
+            if res not in locations['h3']:
+                locations['h3'][res] = np.zeros(self.num_persons, dtype=np.uint64)
+            locations['h3'][res][rows] = cells
+        in_sim_area = locations_columns.get('in_sim_area', None)
+        locations['in_sim_area'][rows] = -1 if in_sim_area is None else in_sim_area
+        close_nodes = locations_columns.get('close_nodes', None)
+        for row, nodes in zip(np.asarray(rows).tolist(), close_nodes or [None] * len(coords)):
+            if nodes is None:
+                locations['close_nodes'].pop(row, None)
+            else:
+                locations['close_nodes'][row] = nodes
+
+    def get_h3_cells(self, location_type, resolution, rows=None):
+        """
+        :return: h3 cells of persons at resolution, 0 for persons not located at it
+        """
+        cells = self.locations[location_type]['h3'].get(resolution, None)
+        if cells is None:
+            cells = np.zeros(self.num_persons, dtype=np.uint64)
+        cells = cells if rows is None else cells[rows]
+        others = self.locations[location_type]['others']
+        if others:
+            cells = cells.copy()
+            positions = np.arange(self.num_persons) if rows is None else np.asarray(rows)
+            for i, row in enumerate(positions.tolist()):
+                if row in others:
+                    h3_cells = others[row].get('h3', None) if isinstance(others[row], dict) else None
+                    cell = h3_cells.get(resolution, 0) if isinstance(h3_cells, dict) else 0
+                    cells[i] = cell if isinstance(cell, (int, np.integer)) else 0
+        return cells
+
+    def person(self, row):
+        """
+        :return: Person view of a row, the same one on each call
+        """
+        view = self._views.get(row, None)
+        if view is None:
+            view = self._views[row] = Person(None, store=self, row=row)
+        return view
+
+    def persons(self, rows=None):
+        """
+        :return: list of Person views of rows (default: all)
+        """
+        rows = range(self.num_persons) if rows is None else np.asarray(rows).tolist()
+        return [self.person(row) for row in rows]
+
+    def to_arrays(self):
+        """
+        Flatten this store to arrays and json-serializable meta for snapshots
+        """
+        arrays = {'idx': self.idx}
+        meta = {'attrs': [], 'location_resolutions': {}}
+        for i, (name, column) in enumerate(self.attr_columns.items()):
+            if column['kind'] == 'object':
+                arrays[f'attr:{i}'] = json_to_array(column['values'].tolist())
+            else:
+                arrays[f'attr:{i}'] = column['values']
+            meta['attrs'].append([name, column['kind'], column.get('categories', None)])
+        for location_type, locations in self.locations.items():
+            prefix = f'{location_type}:'
+            for key in ['lon', 'lat', 'in_sim_area']:
+                arrays[prefix + key] = locations[key]
+            for res, cells in locations['h3'].items():
+                arrays[f'{prefix}h3:{res}'] = cells
+            meta['location_resolutions'][location_type] = list(locations['h3'].keys())
+            for key in ['close_nodes', 'others']:
+                arrays[f'{prefix}{key}:rows'] = np.fromiter(locations[key].keys(), dtype=np.int64,
+                                                            count=len(locations[key]))
+                arrays[f'{prefix}{key}:values'] = json_to_array(list(locations[key].values()))
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        """
+        Inverse of to_arrays()
+        """
+        self = cls.__new__(cls)
+        self.idx = np.asarray(arrays['idx'])
+        self.num_persons = len(self.idx)
+        self.attr_columns = {}
+        for i, (name, kind, categories) in enumerate(meta['attrs']):
+            if kind == 'object':
+                values = np.empty(self.num_persons, dtype=object)
+                values[:] = array_to_json(arrays[f'attr:{i}'])
+            else:
+                # copied, views write to the columns
+                values = np.array(arrays[f'attr:{i}'])
+            self.attr_columns[name] = {'kind': kind, 'values': values}
+            if kind == 'category':
+                self.attr_columns[name]['categories'] = categories
+        self.locations = {}
+        for location_type in self.location_types:
+            prefix = f'{location_type}:'
+            locations = {key: np.array(arrays[prefix + key]) for key in ['lon', 'lat', 'in_sim_area']}
+            locations['h3'] = {res: np.array(arrays[f'{prefix}h3:{res}'])
+                               for res in meta['location_resolutions'][location_type]}
+            for key in ['close_nodes', 'others']:
+                locations[key] = dict(zip(arrays[f'{prefix}{key}:rows'].tolist(),
+                                          array_to_json(arrays[f'{prefix}{key}:values'])))
+            self.locations[location_type] = locations
+        self._views = {}
+        return self
+
+
+class PersonViews(Sequence):
+    """
+    List of the persons of rows of a PersonStore, the Person views are created on access (see PersonStore.person()).
+    Persons appended to it are kept after them
+    """
+    def __init__(self, store, rows=None):
+        """
+        :param rows: rows of the persons (default: all)
+        """
+        self.store = store
+        self.rows = np.arange(len(store)) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.others = []
+
+    def __len__(self):
+        return len(self.rows) + len(self.others)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('person index out of range')
+        if idx < len(self.rows):
+            return self.store.person(int(self.rows[idx]))
+        return self.others[idx - len(self.rows)]
+
+    def __iter__(self):
+        for row in self.rows.tolist():
+            yield self.store.person(row)
+        yield from self.others
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __deepcopy__(self, memo):
+        # like a deep-copied list of views, persons detached from the store
+        return [copy.deepcopy(person, memo) for person in self]
+
+    def append(self, person):
+        self.others.append(person)
+
+    def extend(self, persons):
+        self.others.extend(persons)
+
+
 class Person:
-    def __init__(self, person_idx):
-        self.idx = person_idx
-        self.home = {'coord':None, 'h3': {}}
-        self.workplace = {'coord':None, 'h3': {}}
-        self.attrs = {}
+    def __init__(self, person_idx, store=None, row=None):
+        """
+        :param store: PersonStore of which this person is a view of the row, if None, the person keeps its own
+            idx, attrs, home and workplace
+        """
+        self._store, self._row = store, row
+        if store is None:
+            self._idx = person_idx
+            self._home = {'coord':None, 'h3': {}}
+            self._workplace = {'coord':None, 'h3': {}}
+            self._attrs = {}
         self.trips = []
 
+    def __getstate__(self):
+        # pickled or deep-copied views are detached from the store
+        state = dict(self.__dict__)
+        if self._store is not None:
+            state.update(_store=None, _row=None, _idx=self.idx, _home=self.home, _workplace=self.workplace,
+                         _attrs=self.attrs)
+        return state
+
+    def __setstate__(self, state):
+        if '_store' not in state:
+            # pickled before persons could be views of a PersonStore
+            state = {('_' + key if key in ('idx', 'home', 'workplace', 'attrs') else key): value
+                     for key, value in state.items()}
+            state.update(_store=None, _row=None)
+        self.__dict__.update(state)
+
+    @property
+    def idx(self):
+        return self._idx if self._store is None else str(self._store.idx[self._row])
+
+    @property
+    def attrs(self):
+        """
+        Of a view, a new dict of the row, to change attributes assign a whole dict with set_person_attrs()
+        """
+        return self._attrs if self._store is None else self._store.get_attrs(self._row)
+
+    @attrs.setter
+    def attrs(self, person_attrs):
+        if self._store is None:
+            self._attrs = person_attrs
+        else:
+            self._store.set_attrs(self._row, person_attrs)
+
+    @property
+    def home(self):
+        return self._home if self._store is None else self._store.get_location('home', self._row)
+
+    @home.setter
+    def home(self, location):
+        if self._store is None:
+            self._home = location
+        else:
+            self._store.set_location('home', self._row, location)
+
+    @property
+    def workplace(self):
+        return self._workplace if self._store is None else self._store.get_location('workplace', self._row)
+
+    @workplace.setter
+    def workplace(self, location):
+        if self._store is None:
+            self._workplace = location
+        else:
+            self._store.set_location('workplace', self._row, location)
+
 
     def set_person_attrs(self, person_attrs):
     # def set_person_attrs(self, person_attrs, src_data_object=None, default_value=None, datetime_format='%Y/%m/%d', crt_year=None):
@@ -424,14 +1042,19 @@ class Person:
                 coord = h3.h3_to_geo(h3_cell)[::-1]
             else:
                 raise ValueError(f'coord and h3_cell cannot be both None')
+            # assigned back, locations of views are copies
             if location_type == 'home':
-                self.home['coord'] = coord
-                self.home['h3'].update({resolution: h3_cell})
-                self.home['in_sim_area'] = in_sim_area
+                location = self.home
+                location['coord'] = coord
+                location['h3'].update({resolution: h3_cell})
+                location['in_sim_area'] = in_sim_area
+                self.home = location
             elif location_type == 'workplace':
-                self.workplace['coord'] = coord
-                self.workplace['h3'].update({resolution: h3_cell})
-                self.workplace['in_sim_area'] = in_sim_area
+                location = self.workplace
+                location['coord'] = coord
+                location['h3'].update({resolution: h3_cell})
+                location['in_sim_area'] = in_sim_area
+                self.workplace = location
 
     def trips_to_list(self):
         trips_list = []
@@ -535,18 +1158,64 @@ class HousingUnits:
         self.all_housing = self.base_housing + self.new_housing
 
 
+    def save_snapshot(self, snapshot_dir):
+        """
+        Save housing units to a snapshot directory as columns, see utils.write_snapshot() for the format
+        """
+        arrays, meta = {}, {'table': self.table, 'resolution': self.resolution,
+                            'housing_type_def': self.housing_type_def, 'location_resolutions': {}}
+        for name in ['base_housing', 'new_housing']:
+            housing_units = getattr(self, name)
+            arrays[f'{name}:idx'] = np.array([str(h.idx) for h in housing_units])
+            arrays[f'{name}:housing_type'] = np.array([str(h.housing_type) for h in housing_units])
+            arrays[f'{name}:vacant'] = np.array([bool(h.vacant) for h in housing_units], dtype=bool)
+            locations = [h.loc for h in housing_units]
+            arrays.update(prefix_arrays(_locations_to_arrays(locations), f'{name}:loc:'))
+            meta['location_resolutions'][name] = sorted({res for loc in locations for res in loc['h3']})
+        write_snapshot(snapshot_dir, arrays, meta, kind=type(self).__name__)
+
+    @classmethod
+    def load_snapshot(cls, snapshot_dir, mmap=True):
+        arrays, meta = read_snapshot(snapshot_dir, kind=cls.__name__, mmap=mmap)
+        self = cls.__new__(cls)
+        self.table, self.resolution, self.housing_type_def = meta['table'], meta['resolution'], meta['housing_type_def']
+        for name in ['base_housing', 'new_housing']:
+            locations = _arrays_to_locations(select_arrays(arrays, f'{name}:loc:'), meta['location_resolutions'][name])
+            housing_units = []
+            for idx, housing_type, vacant, loc in zip(arrays[f'{name}:idx'].tolist(),
+                                                      arrays[f'{name}:housing_type'].tolist(),
+                                                      arrays[f'{name}:vacant'].tolist(), locations):
+                housing_unit = HousingUnit(idx, housing_type, vacant)
+                housing_unit.loc = loc
+                housing_units.append(housing_unit)
+            setattr(self, name, housing_units)
+        self.all_housing = self.base_housing + self.new_housing
+        return self
+
     def add_new_housing_units(self, housing_type, h3_cells, housing_type_attrs=None):
-        crt_idx = len(self.new_housing)
+        self.new_housing.extend(self.make_new_housing_units(housing_type, h3_cells, housing_type_attrs))
+
+    def make_new_housing_units(self, housing_type, h3_cells, housing_type_attrs=None, start_idx=None):
+        """
+        Build new housing units without appending them to self.new_housing
+        :param housing_type: housing type of the new units, its attributes are registered if missing
+        :param h3_cells: one h3 cell for each new unit
+        :param housing_type_attrs: attributes of housing_type, see self.housing_type_def
+        :param start_idx: units are indexed "n{start_idx}", "n{start_idx+1}"..., if None, len(self.new_housing)
+        :return: list of new HousingUnit
+        """
+        if start_idx is None:
+            start_idx = len(self.new_housing)
         if housing_type_attrs and housing_type not in self.housing_type_def:
             self.housing_type_def[housing_type] = housing_type_attrs
-        self.new_housing.extend([
-            HousingUnit(housing_idx=f'n{crt_idx+idx}',
+        return [
+            HousingUnit(housing_idx=f'n{start_idx+idx}',
                         housing_type=housing_type,
                         vacant=True,
                         h3_cell=h3_cell,
                         resolution=self.resolution)
             for idx, h3_cell in enumerate(h3_cells)
-        ])
+        ]
 
     def get_tt_capacity(self, housing_units, default_capacity=3):
         if type(housing_units) == str:
@@ -581,3 +1250,37 @@ class HousingUnit:
             raise ValueError(f'coord and h3_cell cannot be both None')
         self.loc['coord'] = coord
         self.loc['h3'].update({resolution: h3_cell})
+
+
+def _locations_to_arrays(locations):
+    # locations are dicts like Person.home or HousingUnit.loc: {'coord': [lon, lat] or None, 'h3': {res: cell}, ...}
+    coords = [loc.get('coord') for loc in locations]
+    arrays = {
+        'lon': np.array([coord[0] if coord is not None else np.nan for coord in coords], dtype=np.float64),
+        'lat': np.array([coord[1] if coord is not None else np.nan for coord in coords], dtype=np.float64),
+        'coord_is_tuple': np.array([isinstance(coord, tuple) for coord in coords], dtype=bool),
+        # other keys, e.g. in_sim_area and close_nodes set by LocationSetter
+        'extra': json_to_array([{key: value for key, value in loc.items() if key not in ('coord', 'h3')}
+                                for loc in locations])
+    }
+    for res in sorted({res for loc in locations for res in loc.get('h3', {})}):
+        # 0 is not a valid h3 index and marks a location not linked at this resolution
+        arrays[f'h3:{res}'] = np.array([loc.get('h3', {}).get(res) or 0 for loc in locations], dtype=np.uint64)
+    return arrays
+
+
+def _arrays_to_locations(arrays, resolutions):
+    columns = [arrays['lon'].tolist(), arrays['lat'].tolist(), arrays['coord_is_tuple'].tolist(),
+               array_to_json(arrays['extra'])]
+    h3_rows = zip(*[arrays[f'h3:{res}'].tolist() for res in resolutions]) if resolutions else [()] * len(columns[0])
+    locations = []
+    with gc_paused():
+        for lon, lat, coord_is_tuple, extra, cells in zip(*columns, h3_rows):
+            if lon != lon:
+                coord = None
+            else:
+                coord = (lon, lat) if coord_is_tuple else [lon, lat]
+            loc = {'h3': {res: cell for res, cell in zip(resolutions, cells) if cell}, 'coord': coord}
+            loc.update(extra)
+            locations.append(loc)
+    return locations
@@ -2,109 +2,379 @@ import os
 import h3.api.numpy_int as h3
 import numpy as np
 from scipy import stats
-from grids_toolbox import H3Grids
+from grids_toolbox import H3Grids, H3KDTree
 from indicator_toolbox import Indicator, dist_unit_converter
+from utils import h3_cells_to_lat_lon, binned_kde, unique_in_order
+
+
+class IncrementalProximity:
+    """
+    Proximity state of required cells to a changing set of target cells, which is updated with the difference of
+    target cells instead of recomputed against all targets:
+        - with nearest_k, each required cell keeps the distances and ids of its nearest_k targets. An added target
+          only affects cells closer to it than their current k-th target (found with a kd-tree of required cells),
+          a removed target only affects cells having it among their nearest targets
+        - without nearest_k, each required cell keeps the sum of 1/d**power over all targets, so an added or removed
+          target adds or subtracts its own contribution
+    """
+    def __init__(self, H3, required_cells, nearest_k=None, power=1.0):
+        self.H3 = H3
+        self.required_cells = np.asarray(required_cells, dtype=np.uint64).ravel()
+        self.nearest_k = nearest_k
+        self.power = power
+        self.target_h3_cells = set()
+        self.dists, self.target_ids, self.sums = None, None, None
+        self.changed = np.zeros(len(self.required_cells), dtype=bool)
+        self._required_kdtree = None
+
+    def matches(self, required_cells, nearest_k, power):
+        return self.nearest_k == nearest_k and self.power == power and \
+               np.array_equal(self.required_cells, np.asarray(required_cells, dtype=np.uint64).ravel())
+
+    def _get_dist_matrix(self, rows, target_h3_cells):
+        return self.H3.dist_lookup.get_dist_matrix(self.required_cells[rows], target_h3_cells).astype(np.float64)
+
+    def _query_knn(self, rows, target_h3_cells):
+        target_h3_cells = np.asarray(list(target_h3_cells), dtype=np.uint64)
+        dists, idx = H3KDTree(self.H3.resolution, target_h3_cells).query_knn(self.required_cells[rows],
+                                                                            self.nearest_k)
+        target_ids = np.zeros(idx.shape, dtype=np.uint64)   # 0 is not a valid h3 cell
+        found = idx < len(target_h3_cells)
+        target_ids[found] = target_h3_cells[idx[found]]
+        return dists, target_ids
+
+    def reset(self, target_h3_cells):
+        self.target_h3_cells = set(target_h3_cells)
+        all_rows = np.arange(len(self.required_cells))
+        if self.nearest_k:
+            self.dists, self.target_ids = self._query_knn(all_rows, self.target_h3_cells)
+        else:
+            self.sums = np.zeros(len(self.required_cells))
+            if self.target_h3_cells:
+                for start, dists in self.H3.dist_lookup.iter_dist_blocks(self.required_cells,
+                                                                         list(self.target_h3_cells)):
+                    self.sums[start: start+len(dists)] = (1 / dists.astype(np.float64) ** self.power).sum(axis=1)
+        self.changed = np.ones(len(self.required_cells), dtype=bool)
+        return self.changed
+
+    def update(self, target_h3_cells):
+        """
+        :return: bool mask of required cells whose proximity changed
+        """
+        target_h3_cells = set(target_h3_cells)
+        added = list(target_h3_cells - self.target_h3_cells)
+        removed = list(self.target_h3_cells - target_h3_cells)
+        self.target_h3_cells = target_h3_cells
+        self.changed = np.zeros(len(self.required_cells), dtype=bool)
+        if not added and not removed:
+            return self.changed
+        if not self.nearest_k:
+            if added:
+                self.sums += (1 / self._get_dist_matrix(slice(None), added) ** self.power).sum(axis=1)
+            if removed:
+                self.sums -= (1 / self._get_dist_matrix(slice(None), removed) ** self.power).sum(axis=1)
+            self.changed[:] = True
+            return self.changed
+        requeried = np.zeros(len(self.required_cells), dtype=bool)
+        if removed:
+            # cells losing one of their nearest targets are queried again against the new targets
+            requeried = np.isin(self.target_ids, np.asarray(removed, dtype=np.uint64)).any(axis=1)
+            rows = np.flatnonzero(requeried)
+            if len(rows):
+                self.dists[rows], self.target_ids[rows] = self._query_knn(rows, target_h3_cells)
+                self.changed[rows] = True
+        if added:
+            # an added target could only enter the nearest targets of cells within the largest k-th distance
+            radius = self.dists[~requeried, -1].max() if (~requeried).any() else 0
+            if self._required_kdtree is None:
+                self._required_kdtree = H3KDTree(self.H3.resolution, self.required_cells)
+            rows = self._required_kdtree.query_radius(added, radius)
+            rows = rows[~requeried[rows]]
+            if len(rows):
+                added_ids = np.asarray(added, dtype=np.uint64)
+                merged_dists = np.hstack([self.dists[rows], self._get_dist_matrix(rows, added_ids)])
+                merged_ids = np.hstack([self.target_ids[rows], np.broadcast_to(added_ids, (len(rows), len(added)))])
+                order = np.argsort(merged_dists, axis=1, kind='stable')[:, :self.nearest_k]
+                new_ids = np.take_along_axis(merged_ids, order, axis=1)
+                self.changed[rows[(new_ids != self.target_ids[rows]).any(axis=1)]] = True
+                self.dists[rows] = np.take_along_axis(merged_dists, order, axis=1)
+                self.target_ids[rows] = new_ids
+        return self.changed
+
+    def closeness(self):
+        num_targets = len(self.target_h3_cells)
+        if num_targets == 0:
+            return np.zeros(len(self.required_cells))
+        if self.nearest_k:
+            return (1 / self.dists[:, :min(self.nearest_k, num_targets)] ** self.power).mean(axis=1)
+        return self.sums / num_targets
+
+    def kth_dist(self, kth):
+        if len(self.target_h3_cells) == 0:
+            return np.full(len(self.required_cells), -1.0)
+        return self.dists[:, kth-1]
 
 
 class ProximityIndicator(Indicator):
     def __init__(self, H3, name='proximity', Table=None):
         super().__init__(H3, name, Table)
+        self.incremental_states = {}
 
-    def kde(self, name, target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
-            minimum_ratio_th=0.0, bandwidth_multiplier=None, normalization=True,
-            required_cells=None, round_digits=3, Table_to_map=None, self_update=True):
-        target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name, minimum_ratio_th)
-        sim_points = []
-        for h3_cell in target_h3_cells:
-            lat, lon = h3.h3_to_geo(h3_cell)
-            sim_points.append([lon, lat])
-        sim_points = np.asarray(sim_points).T
-        kernel = stats.gaussian_kde(sim_points, 'scott')
-        if bandwidth_multiplier is not None:
-            kernel.set_bandwidth(bw_method=kernel.factor * bandwidth_multiplier)
-        kde_rst = {}
-        if not required_cells:
-            required_cells = self.H3.required_cells
-        for h3_cell in required_cells:
-            lat, lon = h3.h3_to_geo(h3_cell)
-            kde_rst[h3_cell] = kernel([lon, lat])[0]
+    def _update_incremental_state(self, name, required_cells, target_h3_cells, nearest_k=None, power=1.0):
+        state = self.incremental_states.get(name, None)
+        if state is None or not state.matches(required_cells, nearest_k, power):
+            state = IncrementalProximity(self.H3, required_cells, nearest_k, power)
+            self.incremental_states[name] = state
+            state.reset(target_h3_cells)
+        else:
+            state.update(target_h3_cells)
+        return state
+
+    def _incremental_rst(self, name, state, values, self_update):
+        # with self_update, the dict in H3.values is patched in place for changed cells only
+        rst = self.H3.values.get(name, None) if self_update else None
+        if rst is None or state.changed.all():
+            return dict(zip(state.required_cells.tolist(), values.tolist()))
+        rst.update(zip(state.required_cells[state.changed].tolist(), values[state.changed].tolist()))
+        return rst
+
+    def _heatmap_rst(self, name, rst, normalization, round_digits, Table_to_map, self_update):
         if self_update:
-            self.H3.values[name] = kde_rst
+            self.H3.values[name] = rst
         if Table_to_map:
-            kde_rst = Table_to_map.get_grid_value_from_h3_cells(self.H3.resolution, name, self_update)
+            rst = Table_to_map.get_grid_value_from_h3_cells(self.H3.resolution, name, self_update)
         if normalization:
-            normalized_rst = self.normalization(kde_rst, minV='auto', maxV='auto', better='high')
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in normalized_rst])
+            normalized_rst = self.normalization(rst, minV='auto', maxV='auto', better='high')
+            values = normalized_rst
         else:
             normalized_rst = None
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in kde_rst])
+            values = rst
+        # values of h3 cells come as a dict
+        values = values.values() if type(values) == dict else values
+        to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in values])
         return {'name': name,
-                'raw': kde_rst,
+                'raw': rst,
                 'normalized': normalized_rst,
+                'round_digits': round_digits,
                 'to_frontend': to_frontend_rst}
 
+    def kde(self, name, target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
+            minimum_ratio_th=0.0, bandwidth_multiplier=None, normalization=True,
+            required_cells=None, round_digits=3, Table_to_map=None, self_update=True, exact=False):
+        """
+        :param exact: if False, the kernel density is approximated on a regular grid by FFT (see utils.binned_kde),
+            otherwise the kernel is evaluated at all required cells in one call
+        """
+        target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name, minimum_ratio_th)
+        target_lat, target_lon = h3_cells_to_lat_lon(target_h3_cells)
+        kernel = stats.gaussian_kde(np.vstack([target_lon, target_lat]), 'scott')
+        if bandwidth_multiplier is not None:
+            kernel.set_bandwidth(bw_method=kernel.factor * bandwidth_multiplier)
+        if not required_cells:
+            required_cells = self.H3.required_cells
+        lat, lon = h3_cells_to_lat_lon(required_cells)
+        eval_points = np.vstack([lon, lat])
+        densities = kernel(eval_points) if exact else binned_kde(kernel, eval_points)
+        kde_rst = dict(zip(required_cells, densities.tolist()))
+        return self._heatmap_rst(name, kde_rst, normalization, round_digits, Table_to_map, self_update)
+
     def closeness(self, name, target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
                   minimum_ratio_th=0.0, power=1.0, nearest_k=None, normalization=True,
-                  required_cells=None,  round_digits=3, Table_to_map=None, self_update=True):
+                  required_cells=None,  round_digits=3, Table_to_map=None, self_update=True, incremental=False):
+        """
+        :param incremental: if True, keep an IncrementalProximity state under this name and only update cells
+            affected by targets added or removed since the last call
+        """
         target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name, minimum_ratio_th)
         closeness_rst = {}
         if not required_cells:
             required_cells = self.H3.required_cells
-        for start_h3_cell in required_cells:
-            dist_list = self._get_straight_line_dist_to_h3_cells(start_h3_cell, target_h3_cells)
-            if nearest_k:
-                dist_list.sort()
-                dist_list = dist_list[:nearest_k]
-            if len(dist_list) == 0:
-                closeness_rst[start_h3_cell] = 0
-            else:
-                closeness_rst[start_h3_cell] = sum([1/(d**power) for d in dist_list]) / len(dist_list)
-        if self_update:
-            self.H3.values[name] = closeness_rst
-        if Table_to_map:
-            closeness_rst = Table_to_map.get_grid_value_from_h3_cells(self.H3.resolution, name, self_update)
-        if normalization:
-            normalized_rst = self.normalization(closeness_rst, minV='auto', maxV='auto', better='high')
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in normalized_rst])
+        if incremental:
+            state = self._update_incremental_state(name, required_cells, target_h3_cells, nearest_k, power)
+            closeness_rst = self._incremental_rst(name, state, state.closeness(), self_update)
+        elif len(target_h3_cells) == 0:
+            closeness_rst = dict.fromkeys(required_cells, 0)
+        elif nearest_k:
+            # only the nearest k targets matter, answered by one batched kd-tree query
+            dists, _ = self._get_target_kdtree(target_h3_cells).query_knn(required_cells,
+                                                                            min(nearest_k, len(target_h3_cells)))
+            closeness_rst = dict(zip(required_cells, (1 / dists ** power).mean(axis=1).tolist()))
         else:
-            normalized_rst = None
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in closeness_rst])
-        return {'name': name,
-                'raw': closeness_rst,
-                'normalized': normalized_rst,
-                'to_frontend': to_frontend_rst}
+            for start_h3_cells, dists in self._iter_straight_line_dist_blocks(required_cells, target_h3_cells):
+                closeness_rst.update(zip(start_h3_cells, (1 / dists ** power).mean(axis=1).tolist()))
+        return self._heatmap_rst(name, closeness_rst, normalization, round_digits, Table_to_map, self_update)
+
+    def kring_heatmap(self, name, target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
+                      minimum_ratio_th=0.0, k=10, kernel='gaussian', bandwidth=None, power=1.0, average=False,
+                      normalization=True, required_cells=None, round_digits=3, Table_to_map=None, self_update=True):
+        """
+        Heatmap of target cells as a sparse convolution over k-ring neighborhoods. The kernel matrix is built once
+        per parameters and cached on H3 (see H3Grids.get_kring_kernel), so each call is one sparse mat-vec.
+        Targets farther than k rings away do not contribute.
+        :param kernel: 'gaussian' with bandwidth (km), or 'power' for 1/d**power as in closeness()
+        :param average: if True, divide by the number of targets, so that kernel='power' gives closeness() with
+            targets truncated to k rings
+        """
+        target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name, minimum_ratio_th)
+        if not required_cells:
+            required_cells = self.H3.required_cells
+        kring_kernel = self.H3.get_kring_kernel(k, kernel, bandwidth, power, required_cells)
+        values = kring_kernel.apply(target_h3_cells)
+        if average and len(target_h3_cells) > 0:
+            values = values / len(target_h3_cells)
+        heatmap_rst = dict(zip(kring_kernel.row_cells.tolist(), values.tolist()))
+        return self._heatmap_rst(name, heatmap_rst, normalization, round_digits, Table_to_map, self_update)
 
     def nearest_dist(self, name, target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
                      minimum_ratio_th=0.0, kth=1, dist_method='straight_line', normalization=True,
-                     required_cells=None, round_digits=3, Table_to_map=None, self_update=True):
+                     required_cells=None, round_digits=3, Table_to_map=None, self_update=True, incremental=False):
+        """
+        :param incremental: see closeness(), only for dist_method='straight_line'
+        """
         target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name, minimum_ratio_th)
         nearest_dist_rst = {}
         if not required_cells:
             required_cells = self.H3.required_cells
-        for start_h3_cell in required_cells:
-            if dist_method == 'straight_line':
-                dist_list = self._get_straight_line_dist_to_h3_cells(start_h3_cell, target_h3_cells)
-            elif dist_method == 'network':
+        if dist_method == 'straight_line' and incremental:
+            state = self._update_incremental_state(name, required_cells, target_h3_cells, nearest_k=kth)
+            nearest_dist_rst = self._incremental_rst(name, state, state.kth_dist(kth), self_update)
+        elif dist_method == 'straight_line':
+            if len(target_h3_cells) == 0:
+                nearest_dist_rst = dict.fromkeys(required_cells, -1)
+            else:
+                dists, _ = self._get_target_kdtree(target_h3_cells).query_knn(required_cells, kth)
+                nearest_dist_rst = dict(zip(required_cells, dists[:, kth-1].tolist()))
+        elif dist_method == 'network':
+            for start_h3_cell in required_cells:
                 dist_list = self._get_network_dist_to_h3_cells(start_h3_cell, target_h3_cells)
-            dist_list.sort()
-            if len(dist_list) == 0:
-                nearest_dist_rst[start_h3_cell] = -1
+                dist_list.sort()
+                if len(dist_list) == 0:
+                    nearest_dist_rst[start_h3_cell] = -1
+                else:
+                    nearest_dist_rst[start_h3_cell] = dist_list[kth-1]
+        return self._heatmap_rst(name, nearest_dist_rst, normalization, round_digits, Table_to_map, self_update)
+
+    def batch_proximity(self, groups, required_cells=None, round_digits=3, Table_to_map=None, self_update=True):
+        """
+        Evaluate many target groups together, sharing the work between them: target cells are selected once per
+        distinct selection, one kd-tree query (with the largest k needed) answers all nearest-based groups of a
+        selection, and all closeness groups over all targets share one scan of distance blocks.
+        :param groups: list of dict, each with
+            "kind": "closeness" (with "power", "nearest_k"), "nearest_dist" (with "kth"), or "accessibility" (with
+                "population_attr", "kth", "dist_threshold", "dist_unit", "speed"), defaults as in closeness(),
+                nearest_dist() and return_accessibility_within_dist()
+            "name", "target_classes", and optionally "attr_name", "item_name", "usage_name", "minimum_ratio_th"
+                to select target cells as in get_target_h3_cells(); heatmaps also accept "normalization"
+        :param required_cells, round_digits, Table_to_map, self_update: as in closeness(), for heatmap groups
+        :return: list of results in the order of groups
+        """
+        if not required_cells:
+            required_cells = self.H3.required_cells
+        required_cells = list(required_cells)
+        selections, group_selections = {}, []
+        for group in groups:
+            selection = (tuple(np.atleast_1d(group['target_classes']).tolist()), group.get('attr_name', 'LBCS'),
+                         group.get('item_name', 'area'), group.get('usage_name', 'usage'),
+                         group.get('minimum_ratio_th', 0.0))
+            if selection not in selections:
+                selections[selection] = self.get_target_h3_cells(list(selection[0]), *selection[1:])
+            group_selections.append(selection)
+
+        # rows of each accessibility population, and the largest k needed per selection
+        pop_rows, max_k = {}, {}
+        for group, selection in zip(groups, group_selections):
+            if group['kind'] == 'accessibility':
+                population_attr = group.get('population_attr', 'tt_pop')
+                if population_attr not in pop_rows:
+                    pop_rows[population_attr] = [h3_cell for h3_cell, h3_attrs in self.H3.h3_stats.items()
+                                                 if h3_attrs.get(population_attr, -1) > 0]
+                k = group.get('kth', 1)
+            elif group['kind'] == 'nearest_dist':
+                k = group.get('kth', 1)
+            elif group['kind'] == 'closeness':
+                k = group.get('nearest_k', None) or 0
             else:
-                nearest_dist_rst[start_h3_cell] = dist_list[kth-1]
-        if self_update:
-            self.H3.values[name] = nearest_dist_rst
-        if Table_to_map:
-            nearest_dist_rst = Table_to_map.get_grid_value_from_h3_cells(self.H3.resolution, name, self_update)
-        if normalization:
-            normalized_rst = self.normalization(nearest_dist_rst, minV='auto', maxV='auto', better='high')
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in normalized_rst])
-        else:
-            normalized_rst = None
-            to_frontend_rst = ' '.join([str(round(d, round_digits)) for d in nearest_dist_rst])
-        return {'name': name,
-                'raw': nearest_dist_rst,
-                'normalized': normalized_rst,
-                'to_frontend': to_frontend_rst}
+                raise ValueError(f'Invalid kind of proximity group: {group["kind"]}')
+            if k:
+                max_k[selection] = max(max_k.get(selection, 0), k)
+
+        # one kd-tree query per selection for all rows, from heatmap cells and accessibility populations
+        all_rows = unique_in_order(np.asarray(required_cells + [h3_cell for rows in pop_rows.values()
+                                                                for h3_cell in rows], dtype=np.uint64))[0]
+        knn_dists = {}
+        for selection, k in max_k.items():
+            target_h3_cells = selections[selection]
+            if len(target_h3_cells):
+                knn_dists[selection] = self._get_target_kdtree(target_h3_cells).query_knn(all_rows, k)[0]
+        row_pos = {h3_cell: pos for pos, h3_cell in enumerate(all_rows.tolist())}
+        required_pos = np.array([row_pos[h3_cell] for h3_cell in required_cells], dtype=np.int64)
+
+        # closeness over all targets: one scan of distance blocks to the union of their targets
+        closeness_groups = [i for i, group in enumerate(groups)
+                            if group['kind'] == 'closeness' and not group.get('nearest_k', None)
+                            and len(selections[group_selections[i]])]
+        closeness_values = {i: np.zeros(len(required_cells)) for i in closeness_groups}
+        if closeness_groups:
+            union_targets = unique_in_order(np.asarray([h3_cell for i in closeness_groups
+                                                        for h3_cell in selections[group_selections[i]]],
+                                                       dtype=np.uint64))[0]
+            union_sorter = np.argsort(union_targets)
+            # for each distinct power, closeness of all its groups is (1/d**power) @ (targets x groups averaging matrix)
+            powers = {}
+            for i in closeness_groups:
+                powers.setdefault(groups[i].get('power', 1.0), []).append(i)
+            averaging = {}
+            for power, power_groups in powers.items():
+                averaging[power] = np.zeros((len(union_targets), len(power_groups)))
+                for j, i in enumerate(power_groups):
+                    target_h3_cells = np.asarray(selections[group_selections[i]], dtype=np.uint64)
+                    cols = union_sorter[np.searchsorted(union_targets, target_h3_cells, sorter=union_sorter)]
+                    averaging[power][cols, j] = 1 / len(target_h3_cells)
+            for start, dists in self.H3.dist_lookup.iter_dist_blocks(required_cells, union_targets):
+                self.check_superseded()
+                dists = dists.astype(np.float64)
+                for power, power_groups in powers.items():
+                    block_values = (dists ** -power) @ averaging[power]
+                    for j, i in enumerate(power_groups):
+                        closeness_values[i][start: start+len(dists)] = block_values[:, j]
+
+        rsts = []
+        for i, (group, selection) in enumerate(zip(groups, group_selections)):
+            num_targets = len(selections[selection])
+            kind, name = group['kind'], group['name']
+            if kind == 'accessibility':
+                kth = group.get('kth', 1)
+                rows = pop_rows[group.get('population_attr', 'tt_pop')]
+                pop = np.array([self.H3.h3_stats[h3_cell][group.get('population_attr', 'tt_pop')] for h3_cell in rows])
+                dist_threshold_km = dist_unit_converter(group.get('dist_threshold', 500.0), group.get('dist_unit', 'm'),
+                                                        return_unit='km', speed=group.get('speed', 3.6))
+                if num_targets:
+                    kth_dists = knn_dists[selection][[row_pos[h3_cell] for h3_cell in rows], kth-1]
+                    accessibile_pop = pop[kth_dists <= dist_threshold_km].sum().item()
+                else:
+                    accessibile_pop = 0
+                rsts.append(self._accessibility_rst(name, accessibile_pop, pop.sum().item()))
+                continue
+            if num_targets == 0:
+                values = np.zeros(len(required_cells)) if kind == 'closeness' else np.full(len(required_cells), -1)
+            elif kind == 'nearest_dist':
+                values = knn_dists[selection][required_pos, group.get('kth', 1) - 1]
+            elif group.get('nearest_k', None):
+                k = min(group['nearest_k'], num_targets)
+                values = (1 / knn_dists[selection][required_pos, :k] ** group.get('power', 1.0)).mean(axis=1)
+            else:
+                values = closeness_values[i]
+            rsts.append(self._heatmap_rst(name, dict(zip(required_cells, values.tolist())),
+                                          group.get('normalization', True), round_digits, Table_to_map, self_update))
+        return rsts
+
+    def _accessibility_rst(self, name, accessibile_pop, tt_pop):
+        return {
+            'name': name,
+            'raw': accessibile_pop,
+            'normalized': accessibile_pop/tt_pop,
+            'to_frontend': accessibile_pop/tt_pop
+        }
 
     def return_accessibility_within_dist(self, name, population_attr,
                                          target_classes, attr_name='LBCS', item_name='area', usage_name='usage',
@@ -115,28 +385,29 @@ class ProximityIndicator(Indicator):
             h3_cell for h3_cell, h3_attrs in self.H3.h3_stats.items()
             if h3_attrs.get(population_attr, -1) > 0
         ]
-        nearest_dist_rst = self.nearest_dist(name, target_classes, attr_name, item_name, usage_name,
-                                             minimum_ratio_th, kth, dist_method,
-                                             required_cells=required_cells, Table_to_map=None,
-                                             normalization=False, self_update=False)['raw']
-        if dist_unit != 'km':
-            nearest_dist_rst = {
-                h3_cell: dist_unit_converter(raw_value, 'km', return_unit=dist_unit, speed=speed)
-                for h3_cell, raw_value in nearest_dist_rst.items()
-            }
-        tt_pop, accessibile_pop = 0, 0
-        for h3_cell in required_cells:
-            this_pop = self.H3.h3_stats[h3_cell][population_attr]
-            tt_pop += this_pop
-            if nearest_dist_rst[h3_cell] <= dist_threshold:
-                accessibile_pop += this_pop
-        rst = {
-            'name': name,
-            'raw': accessibile_pop,
-            'normalized': accessibile_pop/tt_pop,
-            'to_frontend': accessibile_pop/tt_pop
-        }
-        return rst
+        pop = np.array([self.H3.h3_stats[h3_cell][population_attr] for h3_cell in required_cells])
+        tt_pop = pop.sum().item()
+        if dist_method == 'straight_line':
+            # a cell is accessible if at least kth targets are within the threshold: one batched radius query
+            target_h3_cells = self.get_target_h3_cells(target_classes, attr_name, item_name, usage_name,
+                                                       minimum_ratio_th)
+            dist_threshold_km = dist_unit_converter(dist_threshold, dist_unit, return_unit='km', speed=speed)
+            num_targets_within = self._get_target_kdtree(target_h3_cells).count_within(required_cells,
+                                                                                     dist_threshold_km)
+            accessibile_pop = pop[num_targets_within >= kth].sum().item()
+        else:
+            nearest_dist_rst = self.nearest_dist(name, target_classes, attr_name, item_name, usage_name,
+                                                 minimum_ratio_th, kth, dist_method,
+                                                 required_cells=required_cells, Table_to_map=None,
+                                                 normalization=False, self_update=False)['raw']
+            if dist_unit != 'km':
+                nearest_dist_rst = {
+                    h3_cell: dist_unit_converter(raw_value, 'km', return_unit=dist_unit, speed=speed)
+                    for h3_cell, raw_value in nearest_dist_rst.items()
+                }
+            accessibile_pop = pop[np.array([nearest_dist_rst[h3_cell] <= dist_threshold
+                                            for h3_cell in required_cells], dtype=bool)].sum().item()
+        return self._accessibility_rst(name, accessibile_pop, tt_pop)
 
 
 def test(num_trials=3):
@@ -1,5 +1,8 @@
 import paho.mqtt.client as mqtt_client
-import time, random, jsonpickle
+import os, sys, time, random, jsonpickle
+# payload_codec is in the backend folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from payload_codec import decode_payload
 
 def connect_mqtt(broker, port, client_id=None, username=None, password=None):
     def on_connect(client, userdata, flags, rc):
@@ -11,7 +14,7 @@ def connect_mqtt(broker, port, client_id=None, username=None, password=None):
     
     def on_message(client, userdata, msg):
         # print(msg.payload)
-        data = eval(msg.payload.decode())
+        data = decode_payload(msg.payload)
         # print(msg.payload)
         # data = jsonpickle.decode(msg.payload)
         print(data)
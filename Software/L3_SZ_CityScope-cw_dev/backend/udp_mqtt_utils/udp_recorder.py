@@ -0,0 +1,29 @@
+import socket, select, json, time, sys
+
+# record what the table and tablet send to the backend, for loopback.replay() (see benchmarks.py loopback_replay)
+UDP_IP = "0.0.0.0"
+UDP_PORTS = {'table': 15800, 'tablet': 15900}
+SAVE_TO = sys.argv[1] if len(sys.argv) > 1 else 'replay.jsonl'
+
+socks = {}
+for channel, port in UDP_PORTS.items():
+    sock = socket.socket(socket.AF_INET, # Internet
+                         socket.SOCK_DGRAM) # UDP
+    sock.bind((UDP_IP, port))
+    socks[sock] = channel
+
+t0 = None
+with open(SAVE_TO, 'w') as f:
+    try:
+        while True:
+            readable, _, _ = select.select(list(socks.keys()), [], [])
+            for sock in readable:
+                data, addr = sock.recvfrom(1024*200) # buffer size in bytes
+                if t0 is None:
+                    t0 = time.time()
+                event = {'t': round(time.time() - t0, 4), 'channel': socks[sock], 'data': data.strip().decode()}
+                f.write(json.dumps(event) + '\n')
+                f.flush()
+                print("recorded %s message: %s" % (event['channel'], event['data']))
+    except KeyboardInterrupt:
+        pass
@@ -1,8 +1,14 @@
 import h3.api.numpy_int as h3
-import os, json, copy, random
+import os, gc, json, copy, random, hashlib, shutil
 import numpy as np
+import pandas as pd
+from scipy import signal, ndimage
 from collections import Counter
+from collections.abc import MutableMapping
 from functools import reduce
+from itertools import chain
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from numpyencoder import NumpyEncoder
 
 #======================================#
@@ -13,6 +19,19 @@ crs_lookup_name_to_code = {
     'urn:ogc:def:crs:EPSG::4547': 4547
 }
 crs_lookup_code_to_name = {v:k for k,v in crs_lookup_name_to_code.items()}
+# mean earth radius used by h3.point_dist()
+EARTH_RADIUS_KM = 6371.007180918475
+# bump it when the layout of snapshots changes, see write_snapshot()
+SNAPSHOT_VERSION = 1
+# nesting depth of the position sequences in geojson "coordinates", a Point is treated as a sequence of one position
+geojson_coords_depth = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3
+}
 
 
 #======================================#
@@ -56,11 +75,206 @@ class LocationSetter:
                 'in_sim_area': in_sim_area,
                 'close_nodes': close_nodes}
 
+    def set_locations(self, coords=None, h3_cells=None, in_sim_area=None, resolution=None):
+        """
+        set_location() of many locations at once, in columns (see population_toolbox.PersonStore)
+        :param coords: array of shape (n, 2) of [lon, lat]
+        :param h3_cells: array of h3 cells, used if coords is None
+        :param in_sim_area: bool or array of bool, if None, whether the h3 cells are in the simulation area
+        :return: dict of 'coords' (n, 2) array, 'h3' {resolution: h3 cells}, 'in_sim_area' bool array and
+            'close_nodes' list (None out of the simulation area or without transport network)
+        """
+        if not resolution:
+            resolution = self.resolution_in
+        if resolution not in self.h3_cells_in:
+            raise ValueError(f'Invalid resolution: {resolution}')
+        if coords is not None:
+            coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+            h3_cells = np.fromiter((h3.geo_to_h3(lat, lon, resolution) for lon, lat in coords.tolist()),
+                                   dtype=np.uint64, count=len(coords))
+        elif h3_cells is not None:
+            h3_cells = np.asarray(h3_cells, dtype=np.uint64)
+            lat, lon = h3_cells_to_lat_lon(h3_cells)
+            coords = np.column_stack([lon, lat])
+        else:
+            raise ValueError(f'coords and h3_cells cannot be both None')
+        if in_sim_area is None:
+            in_sim_area = np.isin(h3_cells, np.asarray(self.h3_cells_in[resolution], dtype=np.uint64))
+        else:
+            in_sim_area = np.broadcast_to(np.asarray(in_sim_area, dtype=bool), h3_cells.shape)
+        close_nodes = None
+        if self.TN and in_sim_area.any():
+            close_nodes = [self.TN.get_closest_internal_nodes(coord, self.num_close_nodes) if is_in else None
+                           for coord, is_in in zip(coords.tolist(), in_sim_area.tolist())]
+        return {'h3': {resolution: h3_cells},
+                'coords': coords,
+                'in_sim_area': in_sim_area,
+                'close_nodes': close_nodes}
+
     def set_tn(self, TN, num_close_nodes):
         self.TN = TN
         self.num_close_nodes = num_close_nodes
 
 
+class LatencyHistogram:
+    def __init__(self, min_latency=1e-4, max_latency=100, buckets_per_decade=20):
+        """
+        Histogram of latencies in seconds with log-spaced buckets, percentiles are read at bucket upper edges
+        :param min_latency: upper edge of the first bucket, smaller latencies fall into it
+        :param max_latency: latencies above it fall into an overflow bucket reported as the max seen
+        :param buckets_per_decade: resolution of the buckets, 20 gives a relative error below 13%
+        """
+        num_buckets = int(np.ceil(np.log10(max_latency / min_latency) * buckets_per_decade))
+        self.edges = np.logspace(np.log10(min_latency), np.log10(max_latency), num_buckets + 1)
+        self.counts = np.zeros(len(self.edges) + 1, dtype='int64')
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        self.counts[np.searchsorted(self.edges, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """
+        :param q: percentile in [0, 100]
+        :return: upper edge of the bucket holding the q-th percentile, or None if nothing is recorded
+        """
+        if not self.count:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.counts), max(q / 100 * self.count, 1)))
+        if bucket >= len(self.edges):
+            return self.max
+        return min(float(self.edges[bucket]), self.max)
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max if self.count else None}
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class H3BoundaryCache:
+    """
+    Boundaries of h3 cells in geojson order ([lng, lat], closed ring), computed once per cell and kept both as
+    coordinate arrays and as serialized geojson geometry fragments, for export_h3_features() and write_h3_geojson()
+    """
+    def __init__(self):
+        self.boundaries = {}
+        self.fragments = {}
+
+    def __len__(self):
+        return len(self.boundaries)
+
+    def __contains__(self, h3_cell):
+        return h3_cell in self.boundaries
+
+    def add(self, h3_cells):
+        with gc_paused():
+            for h3_cell in h3_cells:
+                if h3_cell not in self.boundaries:
+                    self.boundaries[h3_cell] = np.array(h3.h3_to_geo_boundary(h3_cell, geo_json=True),
+                                                        dtype=np.float64)
+
+    def boundary(self, h3_cell):
+        """
+        :return: array of shape (number of vertices + 1, 2), read-only use
+        """
+        if h3_cell not in self.boundaries:
+            self.add([h3_cell])
+        return self.boundaries[h3_cell]
+
+    def geometry_fragment(self, h3_cell):
+        """
+        :return: geojson text of the Polygon geometry of h3_cell
+        """
+        fragment = self.fragments.get(h3_cell, None)
+        if fragment is None:
+            fragment = '{"type": "Polygon", "coordinates": [%s]}' % json.dumps(self.boundary(h3_cell).tolist())
+            self.fragments[h3_cell] = fragment
+        return fragment
+
+    def to_arrays(self, prefix=''):
+        boundaries = list(self.boundaries.values())
+        offsets = np.cumsum([0] + [len(boundary) for boundary in boundaries])
+        coords = np.concatenate(boundaries) if boundaries else np.empty((0, 2), dtype=np.float64)
+        return {f'{prefix}cells': np.fromiter(self.boundaries.keys(), dtype=np.uint64, count=len(boundaries)),
+                f'{prefix}offsets': offsets.astype(np.int64), f'{prefix}coords': coords}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        """
+        Inverse of to_arrays(), an empty cache if the arrays are missing (e.g. snapshots saved before the cache)
+        """
+        self = cls()
+        if f'{prefix}cells' not in arrays:
+            return self
+        coords = np.array(arrays[f'{prefix}coords'])
+        offsets = arrays[f'{prefix}offsets'].tolist()
+        for h3_cell, start, end in zip(arrays[f'{prefix}cells'].tolist(), offsets[:-1], offsets[1:]):
+            self.boundaries[h3_cell] = coords[start:end]
+        return self
+
+
+class LazyDict(MutableMapping):
+    """
+    Dict whose values are built by their loaders on first access, e.g. features of a GeoData loaded from a snapshot
+        are only rebuilt from arrays when they are used. Loaded values are kept, and pickling or copying gives a
+        plain dict with all values loaded.
+    """
+    def __init__(self, loaders=None):
+        """
+        :param loaders: dict of key -> function without arguments returning the value, keys keep their order
+        """
+        self._data = {key: _LazyValue(loader) for key, loader in (loaders or {}).items()}
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, _LazyValue):
+            value = value.loader()
+            self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __reduce__(self):
+        return dict, (dict(self.items()),)
+
+    def __repr__(self):
+        return repr({key: '<not loaded>' if isinstance(value, _LazyValue) else value
+                     for key, value in self._data.items()})
+
+    def is_loaded(self, key):
+        return not isinstance(self._data[key], _LazyValue)
+
+
+class _LazyValue:
+    __slots__ = ['loader']
+
+    def __init__(self, loader):
+        self.loader = loader
+
+
 
 #======================================#
 #          Functions                   #
@@ -124,40 +338,234 @@ def load_geojsons(geojson_path, idx_attr='idx', sort_by_idx=True):
     return features, src_crs
 
 
-def export_h3_features(h3_stats, save_to=None):
+def export_h3_features(h3_stats, save_to=None, boundary_cache=None):
+    """
+    :param h3_stats: dict of h3 cell -> properties, or list of h3 cells
+    :param save_to: the path to save the features to a local geojson file with write_h3_geojson(), if None, then
+        do not save
+    :param boundary_cache: H3BoundaryCache to take boundaries from and add missing ones to, if None, then
+        boundaries are computed for this export only
+    :return: list of geojson features
+    """
     if type(h3_stats) == list:
         h3_stats = {h3_cell:{} for h3_cell in h3_stats}
+    if boundary_cache is None:
+        boundary_cache = H3BoundaryCache()
+    boundary_cache.add(h3_stats.keys())
     h3_features = []
-    for h3_cell, properties in h3_stats.items():
-        h3_boundary = h3.h3_to_geo_boundary(h3_cell, geo_json=True)
-        h3_boundary = [list(coord) for coord in h3_boundary]  # tuple -> list
-        properties['h3_id'] = h3_cell
-        h3_features.append({
-            "type": "Feature",
-            "properties": properties,
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [h3_boundary]
-            }
-        })
-    if save_to:
-        save_fname = os.path.basename(save_to).split('.')[0]
-        h3_geojson_content = {
-            "type": "FeatureCollection",
-            "name": save_fname,
-            "crs": {
-                "type": "name",
-                "properties": {
-                    "name": "urn:ogc:def:crs:OGC:1.3:CRS84"
+    with gc_paused():
+        for h3_cell, properties in h3_stats.items():
+            properties['h3_id'] = h3_cell
+            h3_features.append({
+                "type": "Feature",
+                "properties": properties,
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [boundary_cache.boundaries[h3_cell].tolist()]
                 }
-            },
-            "features": h3_features
-        }
-        json.dump(h3_geojson_content, open(save_to, 'w', encoding='utf-8'),
-                  indent=4, ensure_ascii=False, cls=NumpyEncoder)
+            })
+    if save_to:
+        write_h3_geojson(h3_stats, save_to, boundary_cache)
     return h3_features
 
 
+def write_h3_geojson(h3_stats, save_to, boundary_cache):
+    """
+    Write h3 cells to a geojson FeatureCollection, one feature per line, stitching the cached geometry fragments
+    of boundary_cache with the properties serialized for this write
+    :param h3_stats: dict of h3 cell -> properties
+    :param save_to: the path of the geojson file
+    :param boundary_cache: H3BoundaryCache, missing boundaries are added to it
+    :return: None
+    """
+    save_fname = os.path.basename(save_to).split('.')[0]
+    header = {
+        "type": "FeatureCollection",
+        "name": save_fname,
+        "crs": {
+            "type": "name",
+            "properties": {
+                "name": "urn:ogc:def:crs:OGC:1.3:CRS84"
+            }
+        }
+    }
+    encode = NumpyEncoder(ensure_ascii=False).encode
+    geometry_fragment = boundary_cache.geometry_fragment
+    with gc_paused():
+        features = [
+            '{"type": "Feature", "properties": %s, "geometry": %s}' % (encode(properties), geometry_fragment(h3_cell))
+            for h3_cell, properties in h3_stats.items()
+        ]
+    with open(save_to, 'w', encoding='utf-8') as f:
+        f.write(encode(header)[:-1] + ', "features": [\n')
+        f.write(',\n'.join(features))
+        f.write('\n]}\n')
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector while building many small python objects (eg, lists of coordinates), which
+    would otherwise trigger lots of useless collections
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def _collect_position_sequences(coordinates, depth, sequences):
+    if depth <= 1:
+        sequences.append([coordinates] if depth == 0 else coordinates)
+    else:
+        for sub_coordinates in coordinates:
+            _collect_position_sequences(sub_coordinates, depth-1, sequences)
+
+
+def _rebuild_coordinates(coordinates, depth, new_sequences):
+    if depth == 0:
+        return next(new_sequences)[0]
+    if depth == 1:
+        return next(new_sequences)
+    return [_rebuild_coordinates(sub_coordinates, depth-1, new_sequences) for sub_coordinates in coordinates]
+
+
+def transform_geojson_geometries(geometries, transform_func):
+    """
+    Transform the coordinates of many geojson geometries with one vectorized call: all vertices are gathered into
+    flat numpy arrays, transformed together, and scattered back into new coordinate lists
+    :param geometries: list of geojson geometry dicts, geometries of unsupported types (eg, GeometryCollection) or None
+        are returned as their deep copies without transformation
+    :param transform_func: function(xs, ys) -> (new_xs, new_ys) working on 1d float arrays
+    :return: list of new geometry dicts with the same order as geometries, the input geometries are not modified.
+        Extra dimensions of positions (eg, z) are kept as is.
+    """
+    sequences, depths = [], []
+    for geometry in geometries:
+        depth = geojson_coords_depth.get(geometry['type'], None) if geometry else None
+        depths.append(depth)
+        if depth is not None:
+            _collect_position_sequences(geometry['coordinates'], depth, sequences)
+    positions = list(chain.from_iterable(sequences))
+    with gc_paused():
+        position_dims = np.fromiter(map(len, positions), dtype=np.int64, count=len(positions))
+        has_extra_dims = bool((position_dims > 2).any())
+        if has_extra_dims:
+            positions_2d = (position[:2] for position in positions)
+        else:
+            positions_2d = positions
+        xy = np.fromiter(chain.from_iterable(positions_2d), dtype=np.float64,
+                         count=2*len(positions)).reshape(-1, 2)
+        if len(xy) > 0:
+            new_xs, new_ys = transform_func(xy[:, 0], xy[:, 1])
+            xy = np.column_stack([np.asarray(new_xs, dtype=np.float64), np.asarray(new_ys, dtype=np.float64)])
+        new_positions = xy.tolist()
+        if has_extra_dims:
+            for new_position, position in zip(new_positions, positions):
+                new_position.extend(position[2:])
+        offsets = np.cumsum([0] + [len(sequence) for sequence in sequences]).tolist()
+        new_sequences = iter([new_positions[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+        new_geometries = []
+        for geometry, depth in zip(geometries, depths):
+            if depth is None:
+                new_geometries.append(copy.deepcopy(geometry))
+                continue
+            new_geometry = {k: v for k, v in geometry.items() if k != 'coordinates'}
+            new_geometry['coordinates'] = _rebuild_coordinates(geometry['coordinates'], depth, new_sequences)
+            new_geometries.append(new_geometry)
+    return new_geometries
+
+
+def flatten_cells_to_map(cells_to_map, weight_attr='weight_in_raw_data'):
+    """
+    Flatten the feature -> cells mapping into columnar arrays, one element for each feature-cell link
+    :param cells_to_map: list with the same order as features, each element is either a dict (keys are cell index
+        and values are weight information, see GeoData.aggregate_attrs_to_cells) or a single cell index whose weight is 1
+    :param weight_attr: the key of weight in the weight information dict
+    :return: feature_idx (int64 array), cells (uint64 array), weights (float64 array)
+    """
+    cells_to_map = [cells_info if isinstance(cells_info, dict) else {cells_info: {weight_attr: 1}}
+                    for cells_info in cells_to_map]
+    num_links = [len(cells_info) for cells_info in cells_to_map]
+    feature_idx = np.repeat(np.arange(len(cells_to_map), dtype=np.int64), num_links)
+    cells = np.fromiter(chain.from_iterable(cells_to_map), dtype=np.uint64, count=len(feature_idx))
+    weights = np.fromiter((info.get(weight_attr, 1) for cells_info in cells_to_map for info in cells_info.values()),
+                          dtype=np.float64, count=len(feature_idx))
+    return feature_idx, cells, weights
+
+
+def unique_in_order(values):
+    """
+    np.unique() which keeps the order of first appearance instead of sorting
+    :param values: 1d array
+    :return: unique values, and the inverse index such that unique_values[inverse] == values
+    """
+    unique_sorted, first_idx, inverse_sorted = np.unique(values, return_index=True, return_inverse=True)
+    order = np.argsort(first_idx, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return unique_sorted[order], rank[inverse_sorted.ravel()]
+
+
+def group_reduce(group_idx, values, num_groups, method):
+    """
+    Reduce values by groups using numpy vectorized operations
+    :param group_idx: int array, the group index (0 ~ num_groups-1) of each value
+    :param values: float array with the same length as group_idx, NaN values are ignored
+    :param num_groups: number of groups
+    :param method: one of "count", "sum", "mean", "min", "max". "count" is the number of valid values, and "mean"
+        is the sum divided by the count. Groups without any valid value get 0 for "count" and "sum", NaN for others.
+    :return: float array of length num_groups
+    """
+    valid = ~np.isnan(values)
+    group_idx, values = group_idx[valid], values[valid]
+    if method == 'count':
+        return np.bincount(group_idx, minlength=num_groups).astype(np.float64)
+    if method == 'sum':
+        return np.bincount(group_idx, weights=values, minlength=num_groups)
+    if method == 'mean':
+        counts = np.bincount(group_idx, minlength=num_groups)
+        sums = np.bincount(group_idx, weights=values, minlength=num_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    if method in ['min', 'max']:
+        rst = np.full(num_groups, np.nan)
+        if len(values) == 0:
+            return rst
+        order = np.argsort(group_idx, kind='stable')
+        sorted_groups, sorted_values = group_idx[order], values[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        ufunc = np.minimum if method == 'min' else np.maximum
+        rst[sorted_groups[starts]] = ufunc.reduceat(sorted_values, starts)
+        return rst
+    raise ValueError(f'Unrecognised reduce method "{method}"')
+
+
+def columnar_h3_stats_to_dict(h3_stats_columnar):
+    """
+    Make the dict view of columnar h3 stats, see GeoData.aggregate_attrs_to_cells() for both formats
+    :param h3_stats_columnar: dict with key "cells" (array of cell index) and key "attrs" (dict of attribute name ->
+        array or list with the same order as "cells")
+    :return: dict of cell index -> dict of attribute name -> value
+    """
+    cells = h3_stats_columnar['cells'].tolist()
+    attrs = {}
+    for attr, values in h3_stats_columnar['attrs'].items():
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        elif hasattr(values, 'to_dict_list'):
+            # UsageDecomposition
+            values = values.to_dict_list()
+        attrs[attr] = values
+    return {
+        cell: {attr: values[i] for attr, values in attrs.items()}
+        for i, cell in enumerate(cells)
+    }
+
+
 def flatten_grid_cell_attributes(type_def, height, attribute_names,
                                  area_per_floor, return_units=['area','pop']):
     """
@@ -210,6 +618,317 @@ def flatten_grid_cell_attributes(type_def, height, attribute_names,
     return rst
 
 
+def resolve_n_workers(n_workers, num_items, min_items_per_worker):
+    """
+    Decide how many worker processes are worth starting for num_items items
+    :param n_workers: requested number of workers, None for as many as the CPUs allow (callers default to 1, so
+        that worker processes are only started on request)
+    :param num_items: number of items to be processed
+    :param min_items_per_worker: each worker should get at least this many items to pay off its start-up and
+        pickling costs, otherwise fewer workers are used
+    :return: number of workers, capped by os.cpu_count(); 1 means the items should be processed serially
+    """
+    num_cpus = os.cpu_count() or 1
+    n_workers = num_cpus if n_workers is None else min(n_workers, num_cpus)
+    n_workers = min(n_workers, num_items // max(min_items_per_worker, 1))
+    return max(n_workers, 1)
+
+
+def map_chunks_in_process_pool(func, items, n_workers, chunk_size=None, *args):
+    """
+    Split items into chunks, call func(chunk, *args) for each chunk in a pool of processes, and concatenate the results
+    :param func: module-level function (so that it is picklable) which returns a list with the same length as chunk
+    :param items: list or array to be split
+    :param n_workers: number of worker processes
+    :param chunk_size: number of items in a chunk, if None, each worker gets about 4 chunks
+    :param args: other arguments of func
+    :return: list of results with the same order as items
+    Worker processes are started with the default start method of the platform. Under "spawn" (the default on
+    macOS and Windows) they import the __main__ module again, so a script calling this must run its pipeline under
+    if __name__ == '__main__'.
+    """
+    num_items = len(items)
+    if num_items == 0:
+        return []
+    if chunk_size is None:
+        chunk_size = int(np.ceil(num_items / (n_workers * 4)))
+    chunks = [items[start: start+chunk_size] for start in range(0, num_items, chunk_size)]
+    rst = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for chunk_rst in executor.map(func, chunks, *[[arg] * len(chunks) for arg in args]):
+            rst.extend(chunk_rst)
+    return rst
+
+
+def h3_cells_to_lat_lon(h3_cells):
+    """
+    Centroids of h3 cells as two float64 arrays (lat, lon) in degrees
+    """
+    h3_cells = np.asarray(h3_cells, dtype=np.uint64).ravel()
+    lat_lon = np.empty((len(h3_cells), 2), dtype=np.float64)
+    for i, h3_cell in enumerate(h3_cells.tolist()):
+        lat_lon[i] = h3.h3_to_geo(h3_cell)
+    return lat_lon[:, 0], lat_lon[:, 1]
+
+
+def haversine_dist(lat1, lon1, lat2, lon2, dtype=np.float64):
+    """
+    Vectorized great circle distance in km, arguments (in degrees) are broadcast against each other,
+    e.g. haversine_dist(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :]) gives a distance matrix
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=dtype)) for x in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return (2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))).astype(dtype, copy=False)
+
+
+def lat_lon_to_xyz(lat, lon):
+    """
+    Unit vectors on the sphere for points in degrees, shape (n, 3). The chord length between two unit vectors is
+    monotonic in their great circle distance, so euclidean spatial indices (e.g. cKDTree) give exact nearest points
+    """
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord_to_dist(chord):
+    """great circle distance (km) of chord lengths on the unit sphere"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def dist_to_chord(dist):
+    """inverse of chord_to_dist(), distances beyond half of the circumference are clipped"""
+    return 2 * np.sin(np.clip(np.asarray(dist) / (2 * EARTH_RADIUS_KM), 0, np.pi / 2))
+
+
+def binned_kde(kernel, eval_points, cells_per_bandwidth=5, truncate=4.0, max_grid_size=2048):
+    """
+    Approximate kernel(eval_points) of a 2-d scipy.stats.gaussian_kde: points of the kernel are linearly binned onto a
+    regular grid covering eval_points, the grid is convolved with the gaussian kernel by FFT, and the density is
+    sampled at eval_points by bilinear interpolation. Cost is O(grid log grid + n + m) instead of O(n * m).
+    :param kernel: scipy.stats.gaussian_kde of 2-d points
+    :param eval_points: array of shape (2, n)
+    :param cells_per_bandwidth: grid step is the kernel std / cells_per_bandwidth along each axis
+    :param truncate: the gaussian kernel is truncated at truncate * std along each axis, points farther than that
+        from the bounding box of eval_points are ignored
+    :param max_grid_size: the grid step is enlarged if the grid would have more cells than this along an axis
+    :return: densities, array of shape (n,)
+    """
+    eval_points = np.asarray(eval_points, dtype=np.float64).reshape(2, -1)
+    if eval_points.shape[1] == 0:
+        return np.zeros(0)
+    cov = np.asarray(kernel.covariance, dtype=np.float64)
+    std = np.sqrt(np.diag(cov))
+    step = std / cells_per_bandwidth
+    lower = eval_points.min(axis=1) - truncate * std
+    upper = eval_points.max(axis=1) + truncate * std
+    step = np.maximum(step, (upper - lower) / (max_grid_size - 1))
+    shape = np.ceil((upper - lower) / step).astype(int) + 2
+    # linear binning of weighted points onto grid nodes
+    grid_coords = (np.asarray(kernel.dataset, dtype=np.float64) - lower[:, None]) / step[:, None]
+    base = np.floor(grid_coords).astype(np.int64)
+    frac = grid_coords - base
+    inside = np.all((base >= 0) & (base < shape[:, None] - 1), axis=0)
+    base, frac, weights = base[:, inside], frac[:, inside], np.asarray(kernel.weights)[inside]
+    binned = np.zeros(shape[0] * shape[1])
+    for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        corner_weights = weights * (frac[0] if dx else 1 - frac[0]) * (frac[1] if dy else 1 - frac[1])
+        binned += np.bincount((base[0] + dx) * shape[1] + base[1] + dy, corner_weights, minlength=len(binned))
+    binned = binned.reshape(shape)
+    # gaussian kernel on grid offsets
+    half_size = np.ceil(truncate * std / step).astype(int)
+    offsets = np.stack(np.meshgrid(np.arange(-half_size[0], half_size[0] + 1) * step[0],
+                                   np.arange(-half_size[1], half_size[1] + 1) * step[1], indexing='ij'))
+    inv_cov = np.linalg.inv(cov)
+    mahalanobis = np.einsum('i...,ij,j...->...', offsets, inv_cov, offsets)
+    kernel_grid = np.exp(-0.5 * mahalanobis) / (2 * np.pi * np.sqrt(np.linalg.det(cov)))
+    density = signal.fftconvolve(binned, kernel_grid, mode='same')
+    return ndimage.map_coordinates(density, (eval_points - lower[:, None]) / step[:, None], order=1, mode='nearest')
+
+
+def fingerprint_file(path, chunk_size=1<<20):
+    """
+    The sha1 hex digest of the bytes of a file, which identifies its content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def make_cache_key(**parts):
+    """
+    The sha1 hex digest of json-serializable parts (e.g. data fingerprint, resolution, aggregation spec)
+    """
+    content = json.dumps(parts, sort_keys=True, ensure_ascii=False, cls=NumpyEncoder, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def save_arrays(path, arrays, meta=None):
+    """
+    Save a dict of numpy arrays, and optionally a json-serializable meta dict, to a .npz file
+    :param path: path of the .npz file, the file is written to a temporary file first and then renamed so that a
+        broken file is never left in place
+    :param arrays: dict of array name -> numpy array (no object arrays)
+    :param meta: json-serializable dict saved as array "__meta__"
+    :return: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    arrays = dict(arrays)
+    if meta is not None:
+        arrays['__meta__'] = np.array(json.dumps(meta, ensure_ascii=False, cls=NumpyEncoder))
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path):
+    """
+    Load the dict of numpy arrays and the meta dict saved by save_arrays()
+    :return: arrays (dict), meta (dict or None)
+    """
+    with np.load(path, allow_pickle=False) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    meta = arrays.pop('__meta__', None)
+    if meta is not None:
+        meta = json.loads(str(meta))
+    return arrays, meta
+
+
+def cells_to_map_to_arrays(cells_to_map):
+    """
+    Convert the feature -> cells mapping (see GeoData.aggregate_attrs_to_cells) to columnar arrays
+    :param cells_to_map: list of dict (cell index -> weight information) or list of single cell index
+    :return: dict of arrays. If elements are single cell index, only "cells" is included; otherwise "feature_idx",
+        "cells" and one float array for each key of weight information
+    """
+    if all(not isinstance(cells_info, dict) for cells_info in cells_to_map):
+        return {'cells': np.asarray(cells_to_map, dtype=np.uint64)}
+    feature_idx, cells, _ = flatten_cells_to_map(cells_to_map)
+    weight_keys = list(dict.fromkeys(key for cells_info in cells_to_map if isinstance(cells_info, dict)
+                                     for info in cells_info.values() for key in info))
+    arrays = {'feature_idx': feature_idx, 'cells': cells, 'num_features': np.array(len(cells_to_map))}
+    for key in weight_keys:
+        arrays[f'weight:{key}'] = flatten_cells_to_map(cells_to_map, weight_attr=key)[2]
+    return arrays
+
+
+def arrays_to_cells_to_map(arrays):
+    """
+    Inverse of cells_to_map_to_arrays()
+    """
+    if 'feature_idx' not in arrays:
+        return arrays['cells'].tolist()
+    weight_keys = [name for name in arrays if name.startswith('weight:')]
+    cells_to_map = [{} for _ in range(int(arrays['num_features']))]
+    columns = [arrays['feature_idx'].tolist(), arrays['cells'].tolist()] + [arrays[name].tolist() for name in weight_keys]
+    weight_keys = [name[len('weight:'):] for name in weight_keys]
+    with gc_paused():
+        for fea_idx, cell, *weights in zip(*columns):
+            cells_to_map[fea_idx][cell] = dict(zip(weight_keys, weights))
+    return cells_to_map
+
+
+def write_snapshot(snapshot_dir, arrays, meta, kind):
+    """
+    Write a snapshot directory: one .npy file for each array, which could be reopened lazily with mmap, and a small
+    meta.json describing the object. The directory is written aside and then renamed, so that a broken snapshot
+    never replaces a good one.
+    :param snapshot_dir: path of the snapshot directory
+    :param arrays: dict of array name -> numpy array (no object arrays)
+    :param meta: json-serializable dict
+    :param kind: the kind of snapshot, e.g. the class name, checked by read_snapshot()
+    :return: None
+    """
+    snapshot_dir = os.path.abspath(snapshot_dir)
+    tmp_dir, old_dir = snapshot_dir + '.tmp', snapshot_dir + '.old'
+    for path in [tmp_dir, old_dir]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(tmp_dir)
+    array_files = {}
+    for i, (name, array) in enumerate(arrays.items()):
+        array_files[name] = f'{i:04d}.npy'
+        np.save(os.path.join(tmp_dir, array_files[name]), np.asarray(array), allow_pickle=False)
+    meta = dict(meta, kind=kind, snapshot_version=SNAPSHOT_VERSION, arrays=array_files)
+    json.dump(meta, open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8'), ensure_ascii=False, cls=NumpyEncoder)
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old_dir)
+    os.rename(tmp_dir, snapshot_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def read_snapshot(snapshot_dir, kind=None, mmap=True):
+    """
+    Read a snapshot directory written by write_snapshot()
+    :param snapshot_dir: path of the snapshot directory
+    :param kind: if given, the kind of snapshot must match it
+    :param mmap: whether to open arrays as read-only memory maps, so that they are only read from disk when used
+    :return: arrays (dict), meta (dict)
+    """
+    meta = json.load(open(os.path.join(snapshot_dir, 'meta.json'), 'r', encoding='utf-8'))
+    if meta.get('snapshot_version') != SNAPSHOT_VERSION:
+        raise ValueError(f'Unsupported snapshot version {meta.get("snapshot_version")} in {snapshot_dir}, '
+                         f'expected {SNAPSHOT_VERSION}')
+    if kind is not None and meta['kind'] != kind:
+        raise ValueError(f'Snapshot in {snapshot_dir} is a {meta["kind"]}, not a {kind}')
+    arrays = {
+        name: np.load(os.path.join(snapshot_dir, fname), mmap_mode='r' if mmap else None, allow_pickle=False)
+        for name, fname in meta.pop('arrays').items()
+    }
+    return arrays, meta
+
+
+def select_arrays(arrays, prefix):
+    """
+    Get arrays whose names start with prefix, with the prefix removed from names
+    """
+    return {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+
+
+def prefix_arrays(arrays, prefix):
+    return {f'{prefix}{name}': array for name, array in arrays.items()}
+
+
+def json_to_array(obj):
+    """
+    Dump a json-serializable object to an uint8 array of utf-8 bytes, e.g. for feature properties in snapshots
+    """
+    content = json.dumps(obj, ensure_ascii=False, cls=NumpyEncoder).encode('utf-8')
+    return np.frombuffer(content, dtype=np.uint8)
+
+
+def array_to_json(array):
+    """
+    Inverse of json_to_array()
+    """
+    return json.loads(np.asarray(array).tobytes().decode('utf-8'))
+
+
+def dataframe_to_arrays(df):
+    """
+    Convert a pandas DataFrame to a dict of column arrays, object columns are stored as strings
+    :return: arrays (dict), columns (list of [column name, dtype name])
+    """
+    arrays, columns = {}, []
+    for i, col in enumerate(df.columns):
+        values = df[col].to_numpy()
+        if values.dtype.kind not in 'biufcMmU':
+            values = values.astype(str)
+        arrays[f'col{i}'] = values
+        columns.append([col, str(df[col].dtype)])
+    return arrays, columns
+
+
+def arrays_to_dataframe(arrays, columns):
+    """
+    Inverse of dataframe_to_arrays()
+    """
+    return pd.DataFrame({col: np.asarray(arrays[f'col{i}']) for i, (col, _) in enumerate(columns)},
+                        columns=[col for col, _ in columns])
+
+
 def num_neighbours_in_digraph(G, node):
     predecessors = list(G.predecessors(node))
     successors = list(G.successors(node))
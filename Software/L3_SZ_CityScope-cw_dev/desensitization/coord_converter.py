@@ -1,58 +1,21 @@
 import json, os, sys
-from coordTransform_utils import bd09_to_wgs84, wgs84_to_bd09
 import numpy as np
 import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+from geometry_coords import GEOJSON_COORDS_DEPTH, transform_geojson_data, wgs84_to_bd09
 
 
 def geojson_coord_convert_wgs84_to_bd09(source_file, save_file, name_append=None):
     data = json.load(open(source_file, 'r', encoding='utf-8'))
     data['crs']['properties']['name'] = 'urn:ogc:def:crs:OGC:1.3:CRS84'
     features = data['features']
-    # starting convert coords
-    for idx, feature in enumerate(features):
+    for feature in features:
         ftype = feature['geometry']['type']
-        coords = feature['geometry']['coordinates']
-        if ftype == 'MultiPoint':
-            new_coords = [wgs84_to_bd09(coords[0][0], coords[0][1])]
-        elif ftype == 'MultiPolygon':
-            new_coords = []
-            for mpolygon in coords:
-                new_mpolygon = []
-                for polygon in mpolygon:
-                    new_polygon = []
-                    for this_coord in polygon:
-                        this_new_coord = wgs84_to_bd09(this_coord[0], this_coord[1])
-                        new_polygon.append(this_new_coord)
-                    new_mpolygon.append(new_polygon)
-                new_coords.append(new_mpolygon)
-        elif ftype == 'Polygon':
-            new_coords = []
-            for polygon in coords:
-                new_polygon = []
-                for this_coord in polygon:
-                    this_new_coord = wgs84_to_bd09(this_coord[0], this_coord[1])
-                    new_polygon.append(this_new_coord)
-            new_coords.append(new_polygon)
-        elif ftype == 'LineString':
-            new_coords = []
-            for this_coord in coords:
-                this_new_coord = wgs84_to_bd09(this_coord[0], this_coord[1])
-                new_coords.append(this_new_coord)
-        elif ftype == 'MultiLineString':
-            new_coords = []
-            for line in coords:
-                new_line = []
-                for this_coord in line:
-                    this_new_coord = wgs84_to_bd09(this_coord[0], this_coord[1])
-                    new_line.append(this_new_coord)
-                new_coords.append(new_line)
-        elif ftype == 'Point':
-            new_coords = wgs84_to_bd09(coords[0], coords[1])
-        else:
+        if ftype not in GEOJSON_COORDS_DEPTH:
             print('Invalid geometry type: {}, converting failed'.format(ftype))
             exit()
-        features[idx]['geometry']['coordinates'] = new_coords
-    data['features'] = features
+    # starting convert coords, all vertices at once
+    transform_geojson_data(data, wgs84_to_bd09)
     if name_append is not None:
         data['name'] = data['name'] + '_' + name_append
     if not os.path.exists(os.path.dirname(save_file)):
@@ -90,14 +53,11 @@ def csv_coord_convert_wgs84_to_bd09(source_file, save_file, columns=[], name_app
             use_columns.append((lng_c, lat_c))
         else: print('Warning: column {} and/or {} is not in data'.format(lng_c, lat_c))
     # use_columns = [x for x in columns if x in df.columns]
-    records = df.to_dict(orient='records')
-    for r in records:
-        for lng_c, lat_c in use_columns:
-            this_lng, this_lat = r[lng_c], r[lat_c]
-            this_new_coord = wgs84_to_bd09(this_lng, this_lat)
-            r[lng_c] = this_new_coord[0]
-            r[lat_c] = this_new_coord[1]
-    new_df = pd.DataFrame(records)
+    new_df = df.copy()
+    for lng_c, lat_c in use_columns:
+        new_lngs, new_lats = wgs84_to_bd09(df[lng_c].to_numpy(dtype=np.float64), df[lat_c].to_numpy(dtype=np.float64))
+        new_df[lng_c] = new_lngs
+        new_df[lat_c] = new_lats
     new_df.to_csv(save_file, encoding='utf-8', index=False)
     print('Coords converting finished, new file saved to: \n{}'.format(os.path.abspath(save_file)))
     return new_df
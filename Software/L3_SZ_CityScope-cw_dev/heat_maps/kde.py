@@ -2,7 +2,7 @@ import os, sys, json, time, argparse
 import pandas as pd
 import numpy as np
 import geopandas as gpd
-from utils import get_epsg
+from utils import get_epsg, binned_kde
 
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
@@ -11,9 +11,11 @@ from scipy import stats
 
 def get_kde(grid_file_path, target_file_name_list, target_folder, 
     save_path='same', save_flag=True, print_flag=True, 
-    bandwidth_method=None, bandwidth_multiplier=None):
+    bandwidth_method=None, bandwidth_multiplier=None, exact=False):
     """
     target features should be points
+    if exact is False, the kernel density is approximated on a regular grid by FFT (see utils.binned_kde), 
+    otherwise the kernel is evaluated at all cell centroids in one call
     """
     ta = time.time()
     cells_full_content = json.load(open(grid_file_path, encoding='utf-8'))
@@ -43,10 +45,12 @@ def get_kde(grid_file_path, target_file_name_list, target_folder,
             print('CRS of cells and targets do not match, might need to check it again.')
             print(f'CRS of cells: epsg {cell_epsg}\nCRS of targets ({target_file_name}): epsg {targets_epsg}\n')
     
-        for cell in cells:
+        cell_coords = np.asarray([[cell['properties']['centroid_x'], cell['properties']['centroid_y']] 
+            for cell in cells]).reshape(-1, 2).T
+        cell_kde = kernel(cell_coords) if exact else binned_kde(kernel, cell_coords)
+        for cell, kde_value in zip(cells, cell_kde.tolist()):
             cell['properties'] = {'centroid_x': cell['properties']['centroid_x'], 'centroid_y': cell['properties']['centroid_y']}   # speed up saving
-            cell_coord = [cell['properties']['centroid_x'], cell['properties']['centroid_y']]
-            cell['properties'][attr] = kernel(cell_coord)[0]
+            cell['properties'][attr] = kde_value
         t2 = time.time()
         if print_flag: print('{:4.4f} seconds elasped for generating {}'.format(t2-t1, attr))
     
@@ -84,6 +88,8 @@ def main():
         if you find kde is too global, use a <1 multiplier, vice versa
         (1~0.01 seems to be good)''')
     parser.add_argument('-pf', default='t', help='''print_flag, default="t"''')
+    parser.add_argument('-ex', default='f', help='''exact, default="f", i.e., approximate kde on a regular grid by FFT, 
+        if "t", evaluate the kernel at every cell exactly''')
     
     args = parser.parse_args()
     grid_file_path = args.gfp
@@ -108,14 +114,15 @@ def main():
             bandwidth_method = None
     bandwidth_multiplier = args.bwm if args.bwm is None else float(args.bwm)
     print_flag = args.pf == 't'
+    exact = args.ex == 't'
     
     if print_flag:
         print(f'\ngrid_file_path = {grid_file_path}\ntarget_folder = {target_folder}')
         print(f'target_file_name_list = {target_file_name_list}\nsave_path = {save_path}')
-        print(f'bandwidth_method = {bandwidth_method}\nbandwidth_multiplier = {bandwidth_multiplier}\n')
+        print(f'bandwidth_method = {bandwidth_method}\nbandwidth_multiplier = {bandwidth_multiplier}\nexact = {exact}\n')
     # print('kde analysis starts at: ', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())))
     get_kde(grid_file_path, target_file_name_list, target_folder, save_path, save_flag=True, 
-        bandwidth_method=bandwidth_method, bandwidth_multiplier=bandwidth_multiplier)
+        bandwidth_method=bandwidth_method, bandwidth_multiplier=bandwidth_multiplier, exact=exact)
     # print('kde analysis finishes at: ', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time())))
      
     
@@ -2,6 +2,7 @@ import os, sys, json, time
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+from scipy import signal, ndimage
 
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
@@ -55,5 +56,48 @@ def num2str(num):
         return str(num)
     else:
         return '{:4.4f}'.format(num)
-        
-        
+
+
+def binned_kde(kernel, eval_points, cells_per_bandwidth=5, truncate=4.0, max_grid_size=2048):
+    """
+    Approximate kernel(eval_points) of a 2-d scipy.stats.gaussian_kde: points of the kernel are linearly binned onto a
+    regular grid covering eval_points, the grid is convolved with the gaussian kernel by FFT, and the density is
+    sampled at eval_points by bilinear interpolation. Cost is O(grid log grid + n + m) instead of O(n * m).
+    :param kernel: scipy.stats.gaussian_kde of 2-d points
+    :param eval_points: array of shape (2, n)
+    :param cells_per_bandwidth: grid step is the kernel std / cells_per_bandwidth along each axis
+    :param truncate: the gaussian kernel is truncated at truncate * std along each axis, points farther than that
+        from the bounding box of eval_points are ignored
+    :param max_grid_size: the grid step is enlarged if the grid would have more cells than this along an axis
+    :return: densities, array of shape (n,)
+    """
+    eval_points = np.asarray(eval_points, dtype=np.float64).reshape(2, -1)
+    if eval_points.shape[1] == 0:
+        return np.zeros(0)
+    cov = np.asarray(kernel.covariance, dtype=np.float64)
+    std = np.sqrt(np.diag(cov))
+    step = std / cells_per_bandwidth
+    lower = eval_points.min(axis=1) - truncate * std
+    upper = eval_points.max(axis=1) + truncate * std
+    step = np.maximum(step, (upper - lower) / (max_grid_size - 1))
+    shape = np.ceil((upper - lower) / step).astype(int) + 2
+    # linear binning of weighted points onto grid nodes
+    grid_coords = (np.asarray(kernel.dataset, dtype=np.float64) - lower[:, None]) / step[:, None]
+    base = np.floor(grid_coords).astype(np.int64)
+    frac = grid_coords - base
+    inside = np.all((base >= 0) & (base < shape[:, None] - 1), axis=0)
+    base, frac, weights = base[:, inside], frac[:, inside], np.asarray(kernel.weights)[inside]
+    binned = np.zeros(shape[0] * shape[1])
+    for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+        corner_weights = weights * (frac[0] if dx else 1 - frac[0]) * (frac[1] if dy else 1 - frac[1])
+        binned += np.bincount((base[0] + dx) * shape[1] + base[1] + dy, corner_weights, minlength=len(binned))
+    binned = binned.reshape(shape)
+    # gaussian kernel on grid offsets
+    half_size = np.ceil(truncate * std / step).astype(int)
+    offsets = np.stack(np.meshgrid(np.arange(-half_size[0], half_size[0] + 1) * step[0],
+                                   np.arange(-half_size[1], half_size[1] + 1) * step[1], indexing='ij'))
+    inv_cov = np.linalg.inv(cov)
+    mahalanobis = np.einsum('i...,ij,j...->...', offsets, inv_cov, offsets)
+    kernel_grid = np.exp(-0.5 * mahalanobis) / (2 * np.pi * np.sqrt(np.linalg.det(cov)))
+    density = signal.fftconvolve(binned, kernel_grid, mode='same')
+    return ndimage.map_coordinates(density, (eval_points - lower[:, None]) / step[:, None], order=1, mode='nearest')
@@ -1,6 +1,7 @@
 import json, time, os
 import numpy as np
 from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 from shapely.geometry import Polygon
 import pandas as pd
 
@@ -101,17 +102,70 @@ def calc_proximity(from_obj_list, to_obj_list, from_obj_weight=None,
         return pass_ratio
 
 
-def calc_proximity_to_poi_kpi(points_name, points_type, dist_threshold,
-                              method='straight_line', network_dist_multiplier=1,
-                              kth=1, dist_matrix=None, print_flag=True):
-    t0 = time.time()
+def calc_kth_nearest_dists(from_obj_list, to_obj_list, max_k):
+    """
+    Distances from each of from_obj_list to its 1st, 2nd, ... max_k-th nearest of to_obj_list by a kd-tree,
+    instead of a full distance matrix. Shape is (len(from_obj_list), min(max_k, len(to_obj_list))), sorted by row.
+    """
+    from_coords = np.asarray(get_coords(from_obj_list), dtype=float)
+    to_coords = np.asarray(get_coords(to_obj_list), dtype=float)
+    k = min(max_k, len(to_coords))
+    dists, _ = cKDTree(to_coords).query(from_coords, k=list(range(1, k+1)))
+    return dists
+
+
+def batch_calc_proximity(from_obj_list, to_obj_list, from_obj_weight=None,
+                         dist_threshold_list=[300], network_dist_multiplier_list=[1], kth_list=[1]):
+    """
+    calc_proximity() with method='straight_line' for every combination of dist_threshold, network_dist_multiplier
+    and kth, sharing one kd-tree query with the largest kth
+    :return: list of (dist_threshold, network_dist_multiplier, kth, pass_ratio)
+    """
+    if len(to_obj_list) == 0:
+        return [(dist_threshold, network_dist_multiplier, kth, 0)
+                for dist_threshold in dist_threshold_list
+                for network_dist_multiplier in network_dist_multiplier_list
+                for kth in kth_list]
+    # same kth as calc_proximity(), which caps kth>1 to the number of targets - 1
+    effective_kth = {kth: kth if kth == 1 else min(kth, len(to_obj_list)-1) for kth in kth_list}
+    kth_nearest_dists = calc_kth_nearest_dists(from_obj_list, to_obj_list,
+                                               max(max(effective_kth.values()), 1))
+    rst = []
+    for dist_threshold in dist_threshold_list:
+        for network_dist_multiplier in network_dist_multiplier_list:
+            for kth in kth_list:
+                kth_nearest_dist = kth_nearest_dists[:, effective_kth[kth]-1] * network_dist_multiplier
+                nearest_dist_lt_threshold = kth_nearest_dist <= dist_threshold
+                if from_obj_weight is None:
+                    pass_ratio = np.sum(nearest_dist_lt_threshold) / len(nearest_dist_lt_threshold)
+                else:
+                    pass_ratio = np.sum(nearest_dist_lt_threshold * from_obj_weight) / np.sum(from_obj_weight)
+                rst.append((dist_threshold, network_dist_multiplier, kth, pass_ratio))
+    return rst
+
+
+def load_poi_kpi(points_name, points_type):
     if points_type.upper() == 'POI':
         to_fpath = os.path.join(poi_folder, 'poi_'+points_name+'.geojson')
     elif points_type.upper() == 'KPI':
         to_fpath = os.path.join(kpi_folder, 'kpi_'+points_name+'.geojson')
-
     to_geojson = json.load(open(to_fpath, 'r', encoding='utf-8'))
-    to_obj_list = to_geojson['features']
+    return to_geojson['features']
+
+
+def print_batch_rst(rst, t0):
+    for this_rst in rst:
+        print('{:4.2f}% of population can access {:d} of {} within {} meters (network_dist_multiplier = {})'.format(
+            this_rst['accessible_ratio'] * 100, this_rst['nearest_k'], this_rst['destination'],
+            this_rst['dist_threshold'], this_rst['network_dist_multiplier']))
+    print('Time cost of calculation = {:4.4f} seconds'.format(time.time()-t0))
+
+
+def calc_proximity_to_poi_kpi(points_name, points_type, dist_threshold,
+                              method='straight_line', network_dist_multiplier=1,
+                              kth=1, dist_matrix=None, print_flag=True):
+    t0 = time.time()
+    to_obj_list = load_poi_kpi(points_name, points_type)
     rst = calc_proximity(from_obj_list, to_obj_list, from_obj_weight=from_obj_weight,
                          dist_threshold=dist_threshold, kth=kth,
                          dist_matrix=dist_matrix, method=method,
@@ -142,6 +196,23 @@ def batch_calc_proximity_to_poi_kpi(points_type, points_name_list='all',
         elif points_type.upper() == 'KPI':
             points_name_list = [f.split('.')[0][4:] for f in sorted(os.listdir(kpi_folder)) if f.startswith('kpi_')]
     for points_name in points_name_list:
+        if method == 'straight_line':
+            t0 = time.time()
+            to_obj_list = load_poi_kpi(points_name, points_type)
+            for dist_threshold, network_dist_multiplier, kth, pass_ratio in batch_calc_proximity(
+                    from_obj_list, to_obj_list, from_obj_weight, dist_threshold_list,
+                    network_dist_multiplier_list, kth_list):
+                rst.append({
+                    'destination': points_name,
+                    'dist_threshold': dist_threshold,
+                    'nearest_k': kth,
+                    'network_dist_multiplier': network_dist_multiplier,
+                    'accessible_ratio': pass_ratio
+                })
+            if print_flag:
+                print('\nProximity to {} of {}:\n'.format(points_type.upper(), points_name) + '='*40)
+                print_batch_rst(rst[-len(dist_threshold_list)*len(network_dist_multiplier_list)*len(kth_list):], t0)
+            continue
         for dist_threshold in dist_threshold_list:
             for network_dist_multiplier in network_dist_multiplier_list:
                 for kth in kth_list:
@@ -196,6 +267,23 @@ def batch_calc_proximity_to_lu_bldg(to_obj_type, usage_list='all',
         raise TypeError('usage_list must be a list, or "all", or a string of usage name')
 
     for usage in usage_list:
+        if method == 'straight_line':
+            t0 = time.time()
+            to_obj_list = [f for f in all_features if f['properties'][usage_column]==usage]
+            for dist_threshold, network_dist_multiplier, kth, pass_ratio in batch_calc_proximity(
+                    from_obj_list, to_obj_list, from_obj_weight, dist_threshold_list,
+                    network_dist_multiplier_list, kth_list):
+                rst.append({
+                    'destination': usage,
+                    'dist_threshold': dist_threshold,
+                    'nearest_k': kth,
+                    'network_dist_multiplier': network_dist_multiplier,
+                    'accessible_ratio': pass_ratio
+                })
+            if print_flag:
+                print('\nProximity to {} with usage = {}:\n'.format(to_obj_type, usage) + '=' * 60)
+                print_batch_rst(rst[-len(dist_threshold_list)*len(network_dist_multiplier_list)*len(kth_list):], t0)
+            continue
         for dist_threshold in dist_threshold_list:
             for network_dist_multiplier in network_dist_multiplier_list:
                 for kth in kth_list:
@@ -4,7 +4,8 @@ from functools import reduce
 from shapely.geometry import Point, LineString, MultiLineString
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
-from pyproj import Transformer
+from geometry_coords import transform_geojson_data, pyproj_transform_func, affine_transform_func, \
+    chain_transform_funcs
 from general import NpEncoder
 random.seed(2021)
 np.random.seed(2021)
@@ -69,40 +70,13 @@ def convert_coords_to_ref(source, ref_info, save_path=None):
         print('Source error')
         exit()
     data['crs'] = ref_info['crs']
-    features = data['features']
-    for f in features:
-        if f['geometry']['type'] == 'MultiPolygon':
-            for polygon_level1 in f['geometry']['coordinates']:
-                for polygon_level2 in polygon_level1:
-                    for coord in polygon_level2:
-                        coord[0] = coord[0]*ref_info['scale'] + ref_info['move'][0]
-                        coord[1] = coord[1]*ref_info['scale'] + ref_info['move'][1]
-        elif f['geometry']['type'] == 'Polygon':
-            for polygon_level1 in f['geometry']['coordinates']:
-                for coord in polygon_level1:
-                    coord[0] = coord[0]*ref_info['scale'] + ref_info['move'][0]
-                    coord[1] = coord[1]*ref_info['scale'] + ref_info['move'][1]
-        elif f['geometry']['type'] == 'Point':
-            coord = f['geometry']['coordinates']
-            coord[0] = coord[0]*ref_info['scale'] + ref_info['move'][0]
-            coord[1] = coord[1]*ref_info['scale'] + ref_info['move'][1]
-        elif f['geometry']['type'] == 'MultiLineString':
-            for line_level1 in f['geometry']['coordinates']:
-                for coord in line_level1:
-                    coord[0] = coord[0]*ref_info['scale'] + ref_info['move'][0]
-                    coord[1] = coord[1]*ref_info['scale'] + ref_info['move'][1]
-        elif f['geometry']['type'] == 'LineString':
-            for coord in f['geometry']['coordinates']:
-                coord[0] = coord[0]*ref_info['scale'] + ref_info['move'][0]
-                coord[1] = coord[1]*ref_info['scale'] + ref_info['move'][1]
-    data['features'] = features
+    transform_geojson_data(data, affine_transform_func(ref_info['scale'], ref_info['move']))
     if save_path is not None:
         safe_save(data, save_path)
         print('Finished converting to certain ref, data saved to: {}'.format(os.path.abspath(save_path)))
     return data
     
 def convert_coords_from_crs_to_crs(source, source_crs, save_crs, save_path=None, crs_header=None):
-    transformer = Transformer.from_crs(source_crs, save_crs)
     if type(source) == dict:
         data = source
     elif type(source) == str:
@@ -112,33 +86,7 @@ def convert_coords_from_crs_to_crs(source, source_crs, save_crs, save_path=None,
         exit()
     if crs_header:
         data['crs'] = crs_header
-    features = data['features']
-    for f in features:
-        if f['geometry']['type'] == 'MultiPolygon':
-            for polygon_level1 in f['geometry']['coordinates']:
-                for polygon_level2 in polygon_level1:
-                    for coord in polygon_level2:
-                        new_coord = transformer.transform(coord[1], coord[0])
-                        coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif f['geometry']['type'] == 'Polygon':
-            for polygon_level1 in f['geometry']['coordinates']:
-                for coord in polygon_level1:
-                    new_coord = transformer.transform(coord[1], coord[0])
-                    coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif f['geometry']['type'] == 'Point':
-            coord = f['geometry']['coordinates']
-            new_coord = transformer.transform(coord[1], coord[0])
-            coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif f['geometry']['type'] == 'MultiLineString':
-            for line_level1 in f['geometry']['coordinates']:
-                for coord in line_level1:
-                    new_coord = transformer.transform(coord[1], coord[0])
-                    coord[0], coord[1] = new_coord[1], new_coord[0]
-        elif f['geometry']['type'] == 'LineString':
-            for coord in f['geometry']['coordinates']:
-                new_coord = transformer.transform(coord[1], coord[0])
-                coord[0], coord[1] = new_coord[1], new_coord[0]
-    data['features'] = features
+    transform_geojson_data(data, pyproj_transform_func(source_crs, save_crs))
     if save_path is not None:
         safe_save(data, save_path)
         print('Finished converting to expecting CRS, data saved to: {}'.format(os.path.abspath(save_path)))
@@ -147,12 +95,11 @@ def convert_coords_from_crs_to_crs(source, source_crs, save_crs, save_path=None,
 
 
 def convert_pure_coords_from_crs_to_crs(coords, source_crs, save_crs):
-    transformer = Transformer.from_crs(source_crs, save_crs)
-    new_coords = []
-    for coord in coords:
-        new_coord = transformer.transform(coord[1], coord[0])
-        new_coords.append([new_coord[1], new_coord[0]])
-    return new_coords
+    if len(coords) == 0:
+        return []
+    coords = np.asarray(coords, dtype=np.float64)
+    new_xs, new_ys = pyproj_transform_func(source_crs, save_crs)(coords[:, 0], coords[:, 1])
+    return np.column_stack([new_xs, new_ys]).tolist()
 
 
 def change_outer_path(outer_path, inner_path, another_outer_path):
@@ -174,6 +121,10 @@ def batch_converting(source_dir, save_dir, ref_info, source_crs, save_crs, crs_h
         exit()
     if not os.path.exists(os.path.abspath(save_dir)):
         os.makedirs(os.path.abspath(save_dir))
+    transform_func = chain_transform_funcs(
+        affine_transform_func(ref_info['scale'], ref_info['move']),
+        pyproj_transform_func(source_crs, save_crs)
+    )
     for root, dirs, files in os.walk(source_dir):
         for this_dir in dirs:
             this_dir_target_full = os.path.join(os.path.abspath(save_dir), this_dir)
@@ -183,14 +134,13 @@ def batch_converting(source_dir, save_dir, ref_info, source_crs, save_crs, crs_h
             if file.endswith('geojson'):
                 this_file_path_full = os.path.join(root, file)
                 this_file_save_path_full = change_outer_path(source_dir, this_file_path_full, save_dir)
-                data_to_ref = convert_coords_to_ref(source=this_file_path_full, ref_info=ref_info)
-                data_to_expecting_crs = convert_coords_from_crs_to_crs(
-                    source = data_to_ref, 
-                    source_crs = source_crs, 
-                    save_crs = save_crs, 
-                    save_path = this_file_save_path_full, 
-                    crs_header = crs_header
-                )
+                # to ref and then to expecting crs, with a single pass over the vertices of this file
+                data = json.load(open(this_file_path_full, 'r', encoding='utf-8'))
+                data['crs'] = crs_header if crs_header else ref_info['crs']
+                transform_geojson_data(data, transform_func)
+                safe_save(data, this_file_save_path_full)
+                print('Finished converting to expecting CRS, data saved to: {}'.format(
+                    os.path.abspath(this_file_save_path_full)))
         
   
 def test():
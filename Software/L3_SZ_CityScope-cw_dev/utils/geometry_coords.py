@@ -0,0 +1,233 @@
+"""
+Vectorized coordinate conversion for GeoJSON data.
+All vertices of all geometries are gathered into flat numpy arrays, converted with one call, and written back
+into the original coordinate lists, instead of converting vertex by vertex in nested python loops.
+
+Usage in other script folders:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+    from geometry_coords import transform_geojson_data, pyproj_transform_func
+"""
+import numpy as np
+from pyproj import Transformer
+
+# nesting depth of the position sequences in geojson "coordinates", a Point is treated as a sequence of one position
+GEOJSON_COORDS_DEPTH = {
+    'Point': 0,
+    'MultiPoint': 1,
+    'LineString': 1,
+    'MultiLineString': 2,
+    'Polygon': 2,
+    'MultiPolygon': 3
+}
+
+# constants of GCJ-02 and BD-09, the same as coordTransform_utils.py
+x_pi = 3.14159265358979324 * 3000.0 / 180.0
+pi = 3.1415926535897932384626  # π
+a = 6378245.0  # 长半轴
+ee = 0.00669342162296594323  # 偏心率平方
+
+
+#======================================#
+#      Flatten & write back            #
+#======================================#
+def _collect_positions(coordinates, depth, positions):
+    if depth == 0:
+        positions.append(coordinates)
+    elif depth == 1:
+        positions.extend(coordinates)
+    else:
+        for sub_coordinates in coordinates:
+            _collect_positions(sub_coordinates, depth-1, positions)
+
+
+def flatten_geometries(geometries):
+    """
+    Gather the positions of geojson geometries
+    :param geometries: list of geojson geometry dicts, None and unsupported types (eg, GeometryCollection) are skipped
+    :return: positions (list of the original position lists, in order), xs and ys (1d float arrays)
+    """
+    positions = []
+    for geometry in geometries:
+        depth = GEOJSON_COORDS_DEPTH.get(geometry['type'], None) if geometry else None
+        if depth is None:
+            continue
+        _collect_positions(geometry['coordinates'], depth, positions)
+    num_positions = len(positions)
+    xs = np.fromiter((position[0] for position in positions), dtype=np.float64, count=num_positions)
+    ys = np.fromiter((position[1] for position in positions), dtype=np.float64, count=num_positions)
+    return positions, xs, ys
+
+
+def transform_geometries(geometries, transform_func):
+    """
+    Convert the coordinates of geojson geometries in place
+    :param geometries: list of geojson geometry dicts, positions must be mutable lists (as loaded by json)
+    :param transform_func: function(xs, ys) -> (new_xs, new_ys) working on 1d float arrays
+    :return: geometries
+    """
+    positions, xs, ys = flatten_geometries(geometries)
+    if not positions:
+        return geometries
+    new_xs, new_ys = transform_func(xs, ys)
+    for position, x, y in zip(positions, np.asarray(new_xs).tolist(), np.asarray(new_ys).tolist()):
+        position[0], position[1] = x, y
+    return geometries
+
+
+def transform_geojson_data(data, transform_func):
+    """
+    Convert the coordinates of all features of geojson data (FeatureCollection dict) in place
+    """
+    transform_geometries([f['geometry'] for f in data['features']], transform_func)
+    return data
+
+
+#======================================#
+#      Transform functions             #
+#======================================#
+def pyproj_transform_func(source_crs, save_crs):
+    """
+    Make a transform function(xs, ys) from source_crs to save_crs, with the same axis order as
+    Transformer.from_crs(source_crs, save_crs).transform(coord[1], coord[0])
+    """
+    transformer = Transformer.from_crs(source_crs, save_crs)
+
+    def transform_func(xs, ys):
+        new_ys, new_xs = transformer.transform(ys, xs)
+        return new_xs, new_ys
+    return transform_func
+
+
+def affine_transform_func(scale, move):
+    """
+    Make a transform function(xs, ys) of x*scale + move[0], y*scale + move[1], see convert_coords.get_converting_ref()
+    """
+    def transform_func(xs, ys):
+        return xs * scale + move[0], ys * scale + move[1]
+    return transform_func
+
+
+def chain_transform_funcs(*transform_funcs):
+    """
+    Make a transform function(xs, ys) applying transform_funcs one by one, so that several conversions only need to
+    flatten and write back the geometries once
+    """
+    def transform_func(xs, ys):
+        for func in transform_funcs:
+            xs, ys = func(xs, ys)
+        return xs, ys
+    return transform_func
+
+
+#======================================#
+#      GCJ-02 / BD-09 in numpy         #
+#======================================#
+def out_of_china(lng, lat):
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    return ~((lng > 73.66) & (lng < 135.05) & (lat > 3.86) & (lat < 53.55))
+
+
+def _transformlat(lng, lat):
+    ret = -100.0 + 2.0 * lng + 3.0 * lat + 0.2 * lat * lat + \
+          0.1 * lng * lat + 0.2 * np.sqrt(np.abs(lng))
+    ret += (20.0 * np.sin(6.0 * lng * pi) + 20.0 *
+            np.sin(2.0 * lng * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(lat * pi) + 40.0 *
+            np.sin(lat / 3.0 * pi)) * 2.0 / 3.0
+    ret += (160.0 * np.sin(lat / 12.0 * pi) + 320 *
+            np.sin(lat * pi / 30.0)) * 2.0 / 3.0
+    return ret
+
+
+def _transformlng(lng, lat):
+    ret = 300.0 + lng + 2.0 * lat + 0.1 * lng * lng + \
+          0.1 * lng * lat + 0.1 * np.sqrt(np.abs(lng))
+    ret += (20.0 * np.sin(6.0 * lng * pi) + 20.0 *
+            np.sin(2.0 * lng * pi)) * 2.0 / 3.0
+    ret += (20.0 * np.sin(lng * pi) + 40.0 *
+            np.sin(lng / 3.0 * pi)) * 2.0 / 3.0
+    ret += (150.0 * np.sin(lng / 12.0 * pi) + 300.0 *
+            np.sin(lng / 30.0 * pi)) * 2.0 / 3.0
+    return ret
+
+
+def _gcj02_offset(lng, lat):
+    dlat = _transformlat(lng - 105.0, lat - 35.0)
+    dlng = _transformlng(lng - 105.0, lat - 35.0)
+    radlat = lat / 180.0 * pi
+    magic = np.sin(radlat)
+    magic = 1 - ee * magic * magic
+    sqrtmagic = np.sqrt(magic)
+    dlat = (dlat * 180.0) / ((a * (1 - ee)) / (magic * sqrtmagic) * pi)
+    dlng = (dlng * 180.0) / (a / sqrtmagic * np.cos(radlat) * pi)
+    # no offset out of china
+    outside = out_of_china(lng, lat)
+    return np.where(outside, 0.0, dlng), np.where(outside, 0.0, dlat)
+
+
+def gcj02_to_bd09(lng, lat):
+    """
+    火星坐标系(GCJ-02)转百度坐标系(BD-09), lng and lat are arrays
+    """
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    z = np.sqrt(lng * lng + lat * lat) + 0.00002 * np.sin(lat * x_pi)
+    theta = np.arctan2(lat, lng) + 0.000003 * np.cos(lng * x_pi)
+    return z * np.cos(theta) + 0.0065, z * np.sin(theta) + 0.006
+
+
+def bd09_to_gcj02(bd_lon, bd_lat):
+    """
+    百度坐标系(BD-09)转火星坐标系(GCJ-02), bd_lon and bd_lat are arrays
+    """
+    x = np.asarray(bd_lon, dtype=np.float64) - 0.0065
+    y = np.asarray(bd_lat, dtype=np.float64) - 0.006
+    z = np.sqrt(x * x + y * y) - 0.00002 * np.sin(y * x_pi)
+    theta = np.arctan2(y, x) - 0.000003 * np.cos(x * x_pi)
+    return z * np.cos(theta), z * np.sin(theta)
+
+
+def wgs84_to_gcj02(lng, lat):
+    """
+    WGS84转GCJ02(火星坐标系), lng and lat are arrays
+    """
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    dlng, dlat = _gcj02_offset(lng, lat)
+    return lng + dlng, lat + dlat
+
+
+def gcj02_to_wgs84(lng, lat):
+    """
+    GCJ02(火星坐标系)转GPS84, lng and lat are arrays
+    """
+    lng, lat = np.asarray(lng, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    dlng, dlat = _gcj02_offset(lng, lat)
+    return lng - dlng, lat - dlat
+
+
+def bd09_to_wgs84(bd_lon, bd_lat):
+    lon, lat = bd09_to_gcj02(bd_lon, bd_lat)
+    return gcj02_to_wgs84(lon, lat)
+
+
+def wgs84_to_bd09(lon, lat):
+    lon, lat = wgs84_to_gcj02(lon, lat)
+    return gcj02_to_bd09(lon, lat)
+
+
+if __name__ == '__main__':
+    # compare with the scalar version in coordTransform_utils.py
+    import os, sys, time
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'desensitization'))
+    import coordTransform_utils
+    num = 100000
+    lngs = 113.8 + np.random.random(num) * 0.5
+    lats = 22.4 + np.random.random(num) * 0.3
+    for name in ['wgs84_to_gcj02', 'gcj02_to_wgs84', 'gcj02_to_bd09', 'bd09_to_gcj02',
+                 'wgs84_to_bd09', 'bd09_to_wgs84']:
+        t0 = time.time()
+        scalar_rst = np.array([getattr(coordTransform_utils, name)(lng, lat) for lng, lat in zip(lngs, lats)])
+        t1 = time.time()
+        vector_rst = np.column_stack(globals()[name](lngs, lats))
+        t2 = time.time()
+        print('{:16s} scalar {:8.4f}s | numpy {:8.4f}s | max abs diff {:.2e}'.format(
+            name, t1-t0, t2-t1, np.abs(scalar_rst - vector_rst).max()))